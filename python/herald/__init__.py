@@ -135,6 +135,33 @@ SERVICE_TRANSPORT_DIRECTORY = "herald.transport.directory"
 Specification of the directory associated to a transport implementation
 """
 
+SERVICE_STREAM = "herald.stream"
+"""
+Specification of the streams service, sending large contents as a sequence of
+chunks with flow control (see ``herald.stream``)
+"""
+
+SERVICE_STREAM_LISTENER = "herald.stream.listener"
+"""
+Specification of a stream listener, with a ``herald_stream(herald_svc,
+stream)`` method. Its ``herald.filters`` property gives the subjects of the
+streams it accepts.
+"""
+
+SERVICE_NOTIFICATION_EXECUTOR = "herald.core.executor"
+"""
+Specification of the executor calling message listeners, with an
+``execute(subject, listener, method, *args)`` method returning False if the
+notification is rejected. The Herald core uses its own
+``herald.executor.NotificationExecutor`` if this service is missing.
+"""
+
+SERVICE_METRICS = "herald.metrics"
+"""
+Specification of the metrics registry (see ``herald.metrics``): counters,
+latency histograms and gauges of the Herald core and transports
+"""
+
 # ------------------------------------------------------------------------------
 # Special subjects
 
@@ -0,0 +1,322 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Herald asyncio facade: awaitable send/post/fire methods and message listeners
+notified in an event loop.
+
+Replies complete their future from the thread handling the message, through
+``loop.call_soon_threadsafe()``: no thread is blocked while waiting for them.
+Only the transport calls (fire) are run in an executor, as transports are
+blocking.
+
+This module requires Python 3.5+; it isn't imported by the Herald core.
+
+Usage::
+
+    aherald = AsyncHerald(herald_svc)
+    reply = await aherald.send(peer_uid, Message("some/subject", content))
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Standard library
+import asyncio
+import functools
+import logging
+
+# ------------------------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+
+
+def _set_result(future, result):
+    """
+    Sets the result of a future, if it is still pending
+    """
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exception):
+    """
+    Sets the exception of a future, if it is still pending
+    """
+    if not future.done():
+        future.set_exception(exception)
+
+
+def _log_task_error(task):
+    """
+    Logs the exception raised by a listener task
+    """
+    if not task.cancelled() and task.exception() is not None:
+        _logger.error("Error notifying an async listener: %s",
+                      task.exception(), exc_info=task.exception())
+
+
+class _LoopListener(object):
+    """
+    Wraps an async message listener: the Herald core calls its
+    herald_dispatch() method, which schedules the listener in the loop
+    """
+    def __init__(self, aherald, listener):
+        """
+        Sets up members
+
+        :param aherald: The AsyncHerald facade
+        :param listener: The listener, with a herald_message(aherald, message)
+                         method (coroutine or standard function)
+        """
+        self.__aherald = aherald
+        self.listener = listener
+
+    def herald_dispatch(self, _, message):
+        """
+        Called by the Herald core when a message is received
+
+        :param _: The Herald core service
+        :param message: The received message
+        """
+        self.__aherald.loop.call_soon_threadsafe(self.__notify, message)
+
+    def __notify(self, message):
+        """
+        Notifies the listener, in the loop thread
+
+        :param message: The received message
+        """
+        try:
+            result = self.listener.herald_message(self.__aherald, message)
+        except Exception as ex:
+            _logger.exception("Error notifying an async listener: %s", ex)
+        else:
+            if asyncio.iscoroutine(result):
+                task = self.__aherald.loop.create_task(result)
+                task.add_done_callback(_log_task_error)
+
+
+class AsyncHerald(object):
+    """
+    Asyncio facade of a Herald core service
+    """
+    def __init__(self, herald_svc, loop=None, executor=None):
+        """
+        Sets up members
+
+        :param herald_svc: The Herald core service
+        :param loop: The event loop (current one by default)
+        :param executor: Executor for the (blocking) transport calls. Uses
+                         the default executor of the loop if None.
+        """
+        self.herald = herald_svc
+        self.loop = loop or asyncio.get_event_loop()
+        self.__executor = executor
+
+        # Listener -> (_LoopListener, filters)
+        self.__listeners = {}
+
+    def __run(self, method, *args, **kwargs):
+        """
+        Calls a blocking method in the executor
+
+        :return: A future
+        """
+        return self.loop.run_in_executor(
+            self.__executor, functools.partial(method, *args, **kwargs))
+
+    def add_listener(self, listener, filters):
+        """
+        Registers a message listener notified in the event loop.
+
+        The listener must have a ``herald_message(aherald, message)`` method,
+        which can be a coroutine function. It is given this facade as first
+        argument.
+
+        :param listener: A message listener
+        :param filters: Subject filter(s) (file name patterns)
+        """
+        if listener in self.__listeners:
+            raise ValueError("Listener already registered")
+
+        wrapper = _LoopListener(self, listener)
+        self.__listeners[listener] = (wrapper, filters)
+        self.herald.add_message_listener(wrapper, filters)
+
+    def remove_listener(self, listener):
+        """
+        Unregisters a message listener
+
+        :param listener: A message listener
+        :return: True if the listener was registered
+        """
+        try:
+            wrapper, filters = self.__listeners.pop(listener)
+        except KeyError:
+            return False
+
+        self.herald.remove_message_listener(wrapper, filters)
+        return True
+
+    def close(self):
+        """
+        Unregisters all the listeners of this facade
+        """
+        for listener in tuple(self.__listeners):
+            self.remove_listener(listener)
+
+    async def fire(self, target, message):
+        """
+        Fires (and forgets) the given message to the given target
+
+        :param target: The UID of a Peer, or a Peer object
+        :param message: A Message bean
+        :return: The UID of the message sent
+        :raise KeyError: Unknown peer UID
+        :raise NoTransport: No transport found to send the message
+        """
+        return await self.__run(self.herald.fire, target, message)
+
+    async def fire_group(self, group, message):
+        """
+        Fires (and forgets) the given message to the given group of peers
+
+        :param group: The name of a group of peers
+        :param message: A Message bean
+        :return: A tuple: the UID of the message sent and the list of peers
+        :raise KeyError: Unknown group
+        :raise NoTransport: No transport found to send the message
+        """
+        return await self.__run(self.herald.fire_group, group, message)
+
+    async def send(self, target, message, timeout=None):
+        """
+        Sends a message and waits for its reply, without blocking a thread
+
+        :param target: The UID of a Peer, or a Peer object
+        :param message: A Message bean
+        :param timeout: Maximum time to wait for an answer (None for ever)
+        :return: The reply message bean
+        :raise KeyError: Unknown peer UID
+        :raise NoTransport: No transport found to send the message
+        :raise NoListener: Message received, but nobody was registered to
+                           listen to it
+        :raise HeraldTimeout: Timeout raised before getting an answer
+        """
+        future = self.loop.create_future()
+
+        def callback(_, reply):
+            self.loop.call_soon_threadsafe(_set_result, future, reply)
+
+        def errback(_, exception):
+            self.loop.call_soon_threadsafe(_set_exception, future, exception)
+
+        uid = await self.__run(self.herald.post, target, message,
+                               callback, errback, timeout, True)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # Nobody waits for the reply anymore
+            self.herald.forget(uid)
+            raise
+
+    async def post(self, target, message, callback, errback,
+                   timeout=180, forget_on_first=True):
+        """
+        Posts a message. The given methods will be called back in the event
+        loop as soon as a result is given, or in case of error.
+
+        The given callback methods must have the following signatures, and
+        can be coroutine functions:
+          - callback(aherald, reply_message)
+          - errback(aherald, exception)
+
+        :param target: The UID of a Peer, or a Peer object
+        :param message: A Message bean
+        :param callback: Method to call back when a reply is received
+        :param errback: Method to call back if an error occurs
+        :param timeout: Time after which the message will be forgotten
+        :param forget_on_first: Forget the message after the first answer
+        :return: The message UID
+        :raise KeyError: Unknown peer UID
+        :raise NoTransport: No transport found to send the message
+        """
+        return await self.__run(
+            self.herald.post, target, message,
+            self.__wrap_callback(callback), self.__wrap_callback(errback),
+            timeout, forget_on_first)
+
+    async def reply(self, message, content, subject=None):
+        """
+        Replies to a message
+
+        :param message: Original message
+        :param content: Content of the response
+        :param subject: Reply message subject (same as request if None)
+        :raise NoTransport: No transport/access found to send the reply
+        """
+        return await self.__run(self.herald.reply, message, content, subject)
+
+    def forget(self, uid):
+        """
+        Tells Herald to forget information about the given message UID
+
+        :param uid: The UID of a message
+        :return: True if there was a reference about this message
+        """
+        return self.herald.forget(uid)
+
+    def __wrap_callback(self, method):
+        """
+        Prepares a post() callback which calls the given method in the loop
+
+        :param method: A callback(aherald, data) method, or None
+        :return: A post() callback, or None
+        """
+        if method is None:
+            return None
+
+        def call(data):
+            try:
+                result = method(self, data)
+            except Exception as ex:
+                _logger.exception("Error calling a post() callback: %s", ex)
+            else:
+                if asyncio.iscoroutine(result):
+                    task = self.loop.create_task(result)
+                    task.add_done_callback(_log_task_error)
+
+        def callback(_, data):
+            self.loop.call_soon_threadsafe(call, data)
+
+        return callback
@@ -39,8 +39,13 @@ __docformat__ = "restructuredtext en"
 import functools
 import threading
 import time
-import uuid
-import json
+
+try:
+    # Python 3
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
 
 # import herald module to use constantes
 import herald
@@ -52,8 +57,18 @@ import herald.utils as utils
 @functools.total_ordering
 class Peer(object):
     """
-    Represents a peer in Herald
+    Represents a peer in Herald.
+
+    The description of a peer is versioned: each change increases its
+    generation, and the generation of the last change of each field is kept
+    to describe only the changes made since a known generation (see
+    dump_delta()). The changes made before the last call to reset_changes()
+    are unknown: they are described by a full dump.
     """
+    __slots__ = ('__uid', '__name', '__node', '__node_name', '__app_id',
+                 '__groups', '__accesses', '__directory', '__lock',
+                 '__generation', '__base', '__changes')
+
     def __init__(self, uid, node_uid, app_id, groups, directory):
         """
         Sets up the peer
@@ -73,11 +88,17 @@ class Peer(object):
         self.__node = node_uid or uid
         self.__node_name = self.__node
         self.__app_id = app_id
-        self.__groups = set(groups or [])
+        self.__groups = frozenset(groups or ())
         self.__accesses = {}
         self.__directory = directory
         self.__lock = threading.RLock()
 
+        # Current generation, generation of the last reset, and
+        # field -> generation of its last change (created on demand)
+        self.__generation = 0
+        self.__base = 0
+        self.__changes = None
+
     def __repr__(self):
         """
         Peer representation
@@ -143,7 +164,7 @@ class Peer(object):
 
         :param value: A peer name
         """
-        self.__name = value or self.__uid
+        self.set_name(value)
 
     @property
     def node_uid(self):
@@ -166,14 +187,102 @@ class Peer(object):
 
         :param value: A node name
         """
-        self.__node_name = value or self.__node
+        self.set_node_name(value)
+
+    @property
+    def generation(self):
+        """
+        Retrieves the generation of the description of the peer, increased
+        on each change
+        """
+        return self.__generation
 
     @property
     def groups(self):
         """
         Retrieves the set of groups this peer belongs
         """
-        return self.__groups.copy()
+        return set(self.__groups)
+
+    def __changed(self, field, generation):
+        """
+        Stores the generation of the change of a field.
+        Must be called with the lock held.
+
+        :param field: The changed field
+        :param generation: Generation of the change (None for the next one)
+        """
+        if generation is None:
+            generation = self.__generation + 1
+
+        if generation > self.__generation:
+            self.__generation = generation
+
+        if self.__changes is None:
+            self.__changes = {}
+        self.__changes[field] = generation
+
+    def set_name(self, name, generation=None):
+        """
+        Sets the name of the peer
+
+        :param name: A peer name
+        :param generation: Generation of the change (None for the next one)
+        """
+        with self.__lock:
+            name = name or self.__uid
+            if name != self.__name:
+                self.__name = name
+                self.__changed('name', generation)
+
+    def set_node_name(self, node_name, generation=None):
+        """
+        Sets the name of the node hosting the peer
+
+        :param node_name: A node name
+        :param generation: Generation of the change (None for the next one)
+        """
+        with self.__lock:
+            node_name = node_name or self.__node
+            if node_name != self.__node_name:
+                self.__node_name = node_name
+                self.__changed('node_name', generation)
+
+    def set_groups(self, groups, generation=None):
+        """
+        Sets the groups of the peer. This must only be done by the directory,
+        which indexes the peers by group.
+
+        :param groups: The groups this peer belongs to
+        :param generation: Generation of the change (None for the next one)
+        """
+        with self.__lock:
+            groups = frozenset(groups or ())
+            if groups != self.__groups:
+                self.__groups = groups
+                self.__changed('groups', generation)
+
+    def set_generation(self, generation):
+        """
+        Sets the generation of the description, if it is newer than the
+        current one
+
+        :param generation: A generation
+        """
+        with self.__lock:
+            if generation > self.__generation:
+                self.__generation = generation
+
+    def reset_changes(self, generation):
+        """
+        Forgets the changes made until now: the current description is
+        considered as the one of the given generation
+
+        :param generation: Generation of the current description
+        """
+        with self.__lock:
+            self.__generation = self.__base = generation
+            self.__changes = None
 
     def __callback(self, method_name, *args):
         """
@@ -197,15 +306,63 @@ class Peer(object):
 
         :return: A dictionary describing this peer
         """
-        # Properties
-        dump = {name: getattr(self, name)
-                for name in ('uid', 'name', 'node_uid', 'node_name',
-                             'app_id', 'groups')}
+        with self.__lock:
+            # Properties
+            dump = {name: getattr(self, name)
+                    for name in ('uid', 'name', 'node_uid', 'node_name',
+                                 'app_id', 'groups', 'generation')}
+
+            # Accesses
+            dump['accesses'] = {access: data.dump()
+                                for access, data in self.__accesses.items()}
+            return dump
+
+    def dump_delta(self, since):
+        """
+        Dumps the changes made to this Peer since the given generation.
 
-        # Accesses
-        dump['accesses'] = {access: data.dump()
-                            for access, data in self.__accesses.items()}
-        return dump
+        The delta contains the UID, the generation and a "since" entry, then
+        only the changed name, node name, groups and accesses ("accesses"
+        entry, like in dump()), and a "removed" entry listing the removed
+        accesses. If the changes since the given generation are unknown, a
+        full dump is returned, with a "since" entry set to 0.
+
+        :param since: A generation of this peer
+        :return: A dictionary describing the changes
+        """
+        with self.__lock:
+            if since < self.__base:
+                # Changes unknown: full dump
+                dump = self.dump()
+                dump['since'] = 0
+                return dump
+
+            delta = {'uid': self.__uid, 'generation': self.__generation,
+                     'since': since}
+            if self.__changes:
+                accesses = {}
+                removed = []
+                for field, generation in self.__changes.items():
+                    if generation <= since:
+                        continue
+
+                    if isinstance(field, tuple):
+                        # Access
+                        access_id = field[1]
+                        try:
+                            accesses[access_id] = \
+                                self.__accesses[access_id].dump()
+                        except KeyError:
+                            removed.append(access_id)
+                    else:
+                        delta[field] = getattr(self, field)
+
+                if accesses:
+                    delta['accesses'] = accesses
+                if removed:
+                    delta['removed'] = removed
+
+            return delta
 
     def get_access(self, access_id):
         """
@@ -242,12 +399,13 @@ class Peer(object):
         """
         return bool(self.__accesses)
 
-    def set_access(self, access_id, data):
+    def set_access(self, access_id, data, generation=None):
         """
         Sets the description associated to an access ID.
 
         :param access_id: An access ID (xmpp, http, ...)
         :param data: The description associated to the given ID
+        :param generation: Generation of the change (None for the next one)
         """
         with self.__lock:
             try:
@@ -259,15 +417,17 @@ class Peer(object):
             if data != old_data:
                 # Update only if necessary
                 self.__accesses[access_id] = data
+                self.__changed(('access', access_id), generation)
 
                 if not isinstance(data, RawAccess):
                     self.__callback("peer_access_set", access_id, data)
 
-    def unset_access(self, access_id):
+    def unset_access(self, access_id, generation=None):
         """
         Removes and returns the description associated to an access ID.
 
         :param access_id: An access ID (xmpp, http, ...)
+        :param generation: Generation of the change (None for the next one)
         :return: The associated description, or None
         """
         with self.__lock:
@@ -278,6 +438,7 @@ class Peer(object):
                 return None
             else:
                 # Notify the directory
+                self.__changed(('access', access_id), generation)
                 self.__callback("peer_access_unset", access_id, data)
                 return data
 
@@ -342,6 +503,21 @@ class RawAccess(object):
         self.__access_id = access_id
         self.__raw_data = raw_data
 
+    def __hash__(self):
+        """
+        Hash is based on the access ID
+        """
+        return hash(self.__access_id)
+
+    def __eq__(self, other):
+        """
+        Equality based on the access ID and the raw data
+        """
+        if isinstance(other, RawAccess):
+            return self.__access_id == other.access_id \
+                and self.__raw_data == other.data
+        return False
+
     @property
     def access_id(self):
         """
@@ -401,10 +577,174 @@ class DelayedNotification(object):
 # ------------------------------------------------------------------------------
 
 
+
+
+class Headers(MutableMapping):
+    """
+    The headers of a message.
+
+    The well-known headers, set on every message, are stored in slots: the
+    other ones are stored in a dictionary, created on demand.
+    """
+    __slots__ = ('_version', '_timestamp', '_uid', '_sender_uid', '_replies_to',
+                 '_target_peer', '_target_group', '_others')
+
+    def __init__(self, uid, timestamp,
+                 version=herald.HERALD_SPECIFICATION_VERSION):
+        """
+        Sets up the headers
+
+        :param uid: Message UID
+        :param timestamp: Message time stamp
+        :param version: Version of the Herald specification
+        """
+        self._version = version
+        self._timestamp = timestamp
+        self._uid = uid
+        self._others = None
+
+    def __repr__(self):
+        """
+        Headers representation
+        """
+        return repr(dict(self.items()))
+
+    def __getitem__(self, key):
+        """
+        Returns the value of a header
+
+        :raise KeyError: Header not set
+        """
+        slot = _HEADER_SLOTS.get(key)
+        if slot is None:
+            if self._others is None:
+                raise KeyError(key)
+            return self._others[key]
+
+        value = getattr(self, slot, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        """
+        Sets the value of a header
+        """
+        slot = _HEADER_SLOTS.get(key)
+        if slot is not None:
+            setattr(self, slot, value)
+        elif self._others is None:
+            self._others = {key: value}
+        else:
+            self._others[key] = value
+
+    def __delitem__(self, key):
+        """
+        Removes a header
+
+        :raise KeyError: Header not set
+        """
+        slot = _HEADER_SLOTS.get(key)
+        try:
+            if slot is None:
+                del self._others[key]
+            else:
+                delattr(self, slot)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        """
+        Checks if a header is set
+        """
+        slot = _HEADER_SLOTS.get(key)
+        if slot is None:
+            return self._others is not None and key in self._others
+        return getattr(self, slot, _MISSING) is not _MISSING
+
+    def __iter__(self):
+        """
+        Iterates over the names of the headers
+        """
+        for key, slot in _HEADER_SLOTS_ORDER:
+            if getattr(self, slot, _MISSING) is not _MISSING:
+                yield key
+
+        if self._others is not None:
+            for key in tuple(self._others):
+                yield key
+
+    def __len__(self):
+        """
+        Returns the number of headers
+        """
+        size = sum(1 for _, slot in _HEADER_SLOTS_ORDER
+                   if getattr(self, slot, _MISSING) is not _MISSING)
+        if self._others is not None:
+            size += len(self._others)
+        return size
+
+    def get(self, key, default=None):
+        """
+        Returns the value of a header, or the default value
+        """
+        slot = _HEADER_SLOTS.get(key)
+        if slot is None:
+            if self._others is None:
+                return default
+            return self._others.get(key, default)
+
+        value = getattr(self, slot, _MISSING)
+        if value is _MISSING:
+            return default
+        return value
+
+    def items(self):
+        """
+        Returns the list of (name, value) tuples of the headers
+        """
+        items = []
+        for key, slot in _HEADER_SLOTS_ORDER:
+            value = getattr(self, slot, _MISSING)
+            if value is not _MISSING:
+                items.append((key, value))
+
+        if self._others is not None:
+            items.extend(self._others.items())
+        return items
+
+    def copy(self):
+        """
+        Returns a dictionary containing the headers
+        """
+        return dict(self.items())
+
+
+_MISSING = object()
+""" Value of the header slots which are not set """
+
+_HEADER_SLOTS_ORDER = (
+    (herald.MESSAGE_HERALD_VERSION, '_version'),
+    (herald.MESSAGE_HEADER_TIMESTAMP, '_timestamp'),
+    (herald.MESSAGE_HEADER_UID, '_uid'),
+    (herald.MESSAGE_HEADER_SENDER_UID, '_sender_uid'),
+    (herald.MESSAGE_HEADER_REPLIES_TO, '_replies_to'),
+    (herald.MESSAGE_HEADER_TARGET_PEER, '_target_peer'),
+    (herald.MESSAGE_HEADER_TARGET_GROUP, '_target_group'))
+""" Well-known headers: (name, slot) tuples """
+
+_HEADER_SLOTS = dict(_HEADER_SLOTS_ORDER)
+""" Well-known header name -> slot """
+
+# ------------------------------------------------------------------------------
+
+
 class Message(object):
     """
     Represents a message to be sent
     """
+    __slots__ = ('_subject', '_content', '_headers', '_metadata')
+
     def __init__(self, subject, content=None):
         """
         Sets up members
@@ -414,13 +754,10 @@ class Message(object):
         """
         self._subject = subject
         self._content = content
-        
-        self._headers = {}
-        self._headers[herald.MESSAGE_HERALD_VERSION] = herald.HERALD_SPECIFICATION_VERSION
-        self._headers[herald.MESSAGE_HEADER_TIMESTAMP] = int(time.time() * 1000) 
-        self._headers[herald.MESSAGE_HEADER_UID] = str(uuid.uuid4()).replace('-', '').upper()
-        
-        self._metadata = {}  
+        self._headers = Headers(utils.generate_uid(), int(time.time() * 1000))
+
+        # Created on demand
+        self._metadata = None
 
     def __str__(self):
         """
@@ -442,19 +779,34 @@ class Message(object):
         """
         return self._content
 
+    @property
+    def raw_content(self):
+        """
+        The encoded content of the message, kept by lazy messages until it
+        is decoded or replaced (None for other messages)
+        """
+        return None
+
+    @property
+    def raw_format(self):
+        """
+        The format of the encoded content (see raw_content)
+        """
+        return None
+
     @property
     def timestamp(self):
         """
         Time stamp of the message
         """
-        return self._headers[herald.MESSAGE_HEADER_TIMESTAMP]
+        return self._headers.get(herald.MESSAGE_HEADER_TIMESTAMP)
 
     @property
     def uid(self):
         """
         Message UID
         """
-        return self._headers[herald.MESSAGE_HEADER_UID]
+        return self._headers.get(herald.MESSAGE_HEADER_UID)
 
     @property
     def headers(self):
@@ -462,12 +814,14 @@ class Message(object):
         Message headers
         """
         return self._headers
-    
-    @property    
+
+    @property
     def metadata(self):
         """
         Message metadata
         """
+        if self._metadata is None:
+            self._metadata = {}
         return self._metadata
 
     def add_header(self, key, value):
@@ -475,54 +829,56 @@ class Message(object):
         Adds a header
         """
         self._headers[key] = value
-        
+
     def get_header(self, key):
         """
-        Gets a header value 
+        Gets a header value
         """
-        if key in self._headers:
-            return self._headers[key]       
-        return None
+        return self._headers.get(key)
 
     def remove_header(self, key):
         """
         Removes a header from the headers list
         """
-        if key in self._headers:
+        try:
             del self._headers[key]
+        except KeyError:
+            pass
 
     def set_content(self, content):
         """
         Set content
         """
         self._content = content
-        
+
     def add_metadata(self, key, value):
         """
         Adds a metadata
         """
-        self._metadata[key] = value
-        
+        self.metadata[key] = value
+
     def get_metadata(self, key):
         """
         Gets a metadata
         """
-        if key in self._metadata:
-            return self._metadata[key]
-        return None
-        
+        if self._metadata is None:
+            return None
+        return self._metadata.get(key)
+
     def remove_metadata(self, key):
         """
-        Removes a metadata 
+        Removes a metadata
         """
-        if key in self._metadata:
-            del self._metadata[key]
-            
-            
+        if self._metadata is not None:
+            self._metadata.pop(key, None)
+
+
 class MessageReceived(Message):
     """
     Represents a message received by a transport
     """
+    __slots__ = ('_access', '_extra')
+
     def __init__(self, uid, subject, content, sender_uid, reply_to, access,
                  timestamp=None, extra=None):
         """
@@ -537,13 +893,15 @@ class MessageReceived(Message):
         :param timestamp: Message sending time stamp
         :param extra: Extra configuration for the transport in case of reply
         """
-        Message.__init__(self, subject, content)
-        self._headers[herald.MESSAGE_HEADER_UID] = uid
-        self._headers[herald.MESSAGE_HEADER_SENDER_UID] = sender_uid
-        self._headers[herald.MESSAGE_HEADER_REPLIES_TO] = reply_to
+        # The UID is given: don't generate one
+        self._subject = subject
+        self._content = content
+        self._headers = headers = Headers(uid, timestamp)
+        headers[herald.MESSAGE_HEADER_SENDER_UID] = sender_uid
+        headers[herald.MESSAGE_HEADER_REPLIES_TO] = reply_to
+        self._metadata = None
         self._access = access
         self._extra = extra
-        self._headers[herald.MESSAGE_HEADER_TIMESTAMP] = timestamp
 
     def __str__(self):
         """
@@ -564,14 +922,14 @@ class MessageReceived(Message):
         """
         UID of the message this one replies to
         """
-        return self._headers[herald.MESSAGE_HEADER_REPLIES_TO]
+        return self._headers.get(herald.MESSAGE_HEADER_REPLIES_TO)
 
     @property
     def sender(self):
         """
         UID of the peer that sent this message
         """
-        return self._headers[herald.MESSAGE_HEADER_SENDER_UID]
+        return self._headers.get(herald.MESSAGE_HEADER_SENDER_UID)
 
     @property
     def extra(self):
@@ -585,9 +943,99 @@ class MessageReceived(Message):
         Sets the access
         """
         self._access = access
-        
+
     def set_extra(self, extra):
         """
         Sets the extra
         """
-        self._extra = extra
\ No newline at end of file
+        self._extra = extra
+
+
+_DECODE_LOCKS = tuple(threading.Lock() for _ in range(16))
+"""
+Locks used to decode the content of lazy messages, shared by all messages
+(one lock per message would be bigger than the message itself)
+"""
+
+
+class LazyMessageReceived(MessageReceived):
+    """
+    A received message whose content is decoded on first access.
+
+    Transports decode the headers and the subject eagerly, which is enough to
+    drop duplicates or to forward the message: in that case, the encoded
+    content is sent as is.
+    """
+    __slots__ = ('_raw_content', '_raw_format', '_decoder', '_decoded')
+
+    def __init__(self, uid, subject, raw_content, raw_format, decoder,
+                 sender_uid, reply_to, access, timestamp=None, extra=None):
+        """
+        Sets up the bean
+
+        :param uid: Message UID
+        :param subject: Subject of the message
+        :param raw_content: Encoded content of the message
+        :param raw_format: Format of the encoded content
+        :param decoder: Method converting the encoded content to the content
+        :param sender_uid: UID of the sending peer
+        :param reply_to: UID of the message this one replies to
+        :param access: Access ID of the transport which received this message
+        :param timestamp: Message sending time stamp
+        :param extra: Extra configuration for the transport in case of reply
+        """
+        MessageReceived.__init__(self, uid, subject, None, sender_uid,
+                                 reply_to, access, timestamp, extra)
+        self._raw_content = raw_content
+        self._raw_format = raw_format
+        self._decoder = decoder
+        self._decoded = False
+
+    def __lock(self):
+        """
+        Returns the lock to use to decode or replace the content
+        """
+        return _DECODE_LOCKS[hash(self) % len(_DECODE_LOCKS)]
+
+    @property
+    def content(self):
+        """
+        The content of the message, decoded on first access
+        """
+        if not self._decoded:
+            with self.__lock():
+                if not self._decoded:
+                    self._content = self._decoder(self._raw_content)
+                    self._decoded = True
+        return self._content
+
+    @property
+    def raw_content(self):
+        """
+        The encoded content of the message, or None if it has been replaced
+        """
+        return self._raw_content
+
+    @property
+    def raw_format(self):
+        """
+        The format of the encoded content
+        """
+        return self._raw_format
+
+    @property
+    def decoded(self):
+        """
+        True if the content has been decoded (or replaced)
+        """
+        return self._decoded
+
+    def set_content(self, content):
+        """
+        Replaces the content: the encoded content is forgotten
+        """
+        with self.__lock():
+            self._content = content
+            self._raw_content = None
+            self._raw_format = None
+            self._decoded = True
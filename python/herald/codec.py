@@ -0,0 +1,349 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Herald messages codecs: conversion of Message beans to and from their wire
+format.
+
+JSON is always available and is the format understood by every peer. The
+MessagePack codec is used when the ``msgpack`` package is installed and the
+remote peer advertises it: it encodes a message as an array instead of a
+dictionary and replaces the well-known header keys by their index in an
+interned table.
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Herald
+import herald
+import herald.utils as utils
+
+# Pelix
+from pelix.utilities import to_bytes, to_str
+import pelix.misc.jabsorb as jabsorb
+
+# Standard library
+import json
+import logging
+
+try:
+    # MessagePack is optional
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# ------------------------------------------------------------------------------
+
+CODEC_JSON = "json"
+""" Name of the JSON codec (always available) """
+
+CODEC_MSGPACK = "msgpack"
+""" Name of the MessagePack codec """
+
+CONTENT_FORMAT_MSGPACK = "msgpack"
+"""
+Format of the encoded content of the lazy messages read from MessagePack:
+the packed jabsorb content
+"""
+
+HEADER_KEYS = (
+    herald.MESSAGE_HERALD_VERSION,
+    herald.MESSAGE_HEADER_UID,
+    herald.MESSAGE_HEADER_TIMESTAMP,
+    herald.MESSAGE_HEADER_SENDER_UID,
+    herald.MESSAGE_HEADER_TARGET_PEER,
+    herald.MESSAGE_HEADER_TARGET_GROUP,
+    herald.MESSAGE_HEADER_REPLIES_TO,
+    # HTTP transport headers
+    "herald-http-tansport-port",
+    "herald-http-tansport-path",
+    # Routing headers
+    "original_sender",
+    "final_destination",
+    "group",
+)
+"""
+Interned header keys: they are replaced by their index in binary messages.
+This table is part of the wire format: new keys must be appended.
+"""
+
+_HEADER_IDS = dict((key, idx) for idx, key in enumerate(HEADER_KEYS))
+""" Header key -> index """
+
+_logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+
+
+class JsonCodec(object):
+    """
+    JSON codec: the historical Herald wire format
+    """
+    name = CODEC_JSON
+    binary = False
+
+    @staticmethod
+    def encode(message):
+        """
+        Encodes a message
+
+        :param message: A Message bean
+        :return: The JSON representation of the message (string)
+        """
+        return utils.to_json(message)
+
+    @staticmethod
+    def decode(data):
+        """
+        Decodes a message
+
+        :param data: A JSON message (string)
+        :return: A MessageReceived bean, or None
+        """
+        return utils.from_json(data)
+
+    @staticmethod
+    def make_envelope(contents):
+        """
+        Prepares a batch envelope: a JSON array of JSON messages
+
+        :param contents: A list of encoded messages
+        :return: The envelope (bytes)
+        """
+        return b'[' + b','.join(to_bytes(content) for content in contents) \
+            + b']'
+
+    @staticmethod
+    def read_envelope(data):
+        """
+        Decodes the messages of a batch envelope
+
+        :param data: A batch envelope
+        :return: The list of valid MessageReceived beans
+        :raise ValueError: Invalid envelope
+        """
+        messages = []
+        for parsed_msg in json.loads(to_str(data)):
+            message = utils.from_dict(parsed_msg)
+            if message is not None:
+                messages.append(message)
+        return messages
+
+
+class MsgPackCodec(object):
+    """
+    MessagePack codec: a message is encoded as a
+    ``[headers, subject, content, metadata]`` array, with interned header keys.
+    The content is packed separately and stored as binary data, so that it
+    can be decoded on demand and forwarded without being decoded.
+    """
+    name = CODEC_MSGPACK
+    binary = True
+
+    def __init__(self):
+        """
+        Sets up the codec
+        """
+        try:
+            # Integer map keys must be explicitly allowed (msgpack >= 1.0)
+            msgpack.unpackb(msgpack.packb({0: 0}), raw=False,
+                            strict_map_key=False)
+            self.__unpack_kwargs = {"raw": False, "strict_map_key": False}
+        except TypeError:
+            # Older version of msgpack
+            self.__unpack_kwargs = {"raw": False}
+
+    @staticmethod
+    def __pack(data):
+        """
+        Packs the given data
+        """
+        return msgpack.packb(data, use_bin_type=True,
+                             default=utils.json_converter)
+
+    def __decode_content(self, raw_content):
+        """
+        Decodes the packed content of a message
+        """
+        return jabsorb.from_jabsorb(
+            msgpack.unpackb(raw_content, **self.__unpack_kwargs))
+
+    def __to_array(self, message):
+        """
+        Converts a message to the array to pack
+        """
+        headers = {}
+        if message.headers is not None:
+            for key, value in message.headers.items():
+                headers[_HEADER_IDS.get(key, key)] = value or None
+
+        raw_format = message.raw_format
+        if raw_format == CONTENT_FORMAT_MSGPACK:
+            # Content received and not decoded: send it as is
+            content = message.raw_content
+        elif raw_format == utils.CONTENT_FORMAT_JABSORB:
+            # Content received as JSON and not decoded
+            content = self.__pack(message.raw_content)
+        else:
+            content = message.content
+            if content is not None:
+                if not isinstance(content, str):
+                    content = jabsorb.to_jabsorb(content)
+                content = self.__pack(content)
+
+        metadata = {}
+        if message.metadata is not None:
+            for key, value in message.metadata.items():
+                metadata[key] = value or None
+
+        return headers, message.subject, content, metadata
+
+    @staticmethod
+    def __to_dict(array):
+        """
+        Converts an unpacked array to the dictionary given to from_dict()
+
+        :raise ValueError: Invalid array
+        """
+        try:
+            headers, subject, content, metadata = array
+            headers = dict(
+                (HEADER_KEYS[key] if isinstance(key, int) else key, value)
+                for key, value in headers.items())
+        except (TypeError, ValueError, IndexError, AttributeError) as ex:
+            raise ValueError("Invalid MessagePack message: {0}".format(ex))
+
+        return {herald.MESSAGE_HEADERS: headers,
+                herald.MESSAGE_SUBJECT: subject,
+                herald.MESSAGE_CONTENT: content,
+                herald.MESSAGE_METADATA: metadata or {}}
+
+    def encode(self, message):
+        """
+        Encodes a message
+
+        :param message: A Message bean
+        :return: The packed message (bytes)
+        """
+        return self.__pack(self.__to_array(message))
+
+    def decode(self, data):
+        """
+        Decodes a message
+
+        :param data: A packed message (bytes)
+        :return: A MessageReceived bean, or None
+        """
+        try:
+            array = msgpack.unpackb(data, **self.__unpack_kwargs)
+            return utils.from_dict(self.__to_dict(array),
+                                   CONTENT_FORMAT_MSGPACK,
+                                   self.__decode_content)
+        except ValueError as ex:
+            _logger.error("Error decoding a MessagePack message: %s", ex)
+            return None
+
+    @staticmethod
+    def make_envelope(contents):
+        """
+        Prepares a batch envelope: MessagePack objects are self-delimited,
+        so they are simply concatenated
+
+        :param contents: A list of encoded messages
+        :return: The envelope (bytes)
+        """
+        return b''.join(contents)
+
+    def read_envelope(self, data):
+        """
+        Decodes the messages of a batch envelope
+
+        :param data: A batch envelope
+        :return: The list of valid MessageReceived beans
+        :raise ValueError: Invalid envelope
+        """
+        unpacker = msgpack.Unpacker(**self.__unpack_kwargs)
+        unpacker.feed(data)
+        messages = []
+        for array in unpacker:
+            message = utils.from_dict(self.__to_dict(array),
+                                      CONTENT_FORMAT_MSGPACK,
+                                      self.__decode_content)
+            if message is not None:
+                messages.append(message)
+        return messages
+
+# ------------------------------------------------------------------------------
+
+_CODECS = {CODEC_JSON: JsonCodec()}
+""" Available codecs: Name -> Codec """
+
+if msgpack is not None:
+    _CODECS[CODEC_MSGPACK] = MsgPackCodec()
+
+_PREFERENCES = (CODEC_MSGPACK, CODEC_JSON)
+""" Codecs names, by order of preference """
+
+
+def get_codec(name=CODEC_JSON):
+    """
+    Returns the codec with the given name
+
+    :param name: Name of a codec
+    :return: The codec
+    :raise KeyError: Unknown or unavailable codec
+    """
+    return _CODECS[name]
+
+
+def available_codecs():
+    """
+    Returns the names of the codecs available locally, by order of preference
+
+    :return: A tuple of codec names
+    """
+    return tuple(name for name in _PREFERENCES if name in _CODECS)
+
+
+def select_codec(remote_codecs):
+    """
+    Selects the preferred codec supported by both the local and the remote
+    peer. JSON is used if no other codec is shared.
+
+    :param remote_codecs: Names of the codecs supported by the remote peer
+    :return: A codec
+    """
+    if remote_codecs:
+        for name in _PREFERENCES:
+            if name in remote_codecs and name in _CODECS:
+                return _CODECS[name]
+
+    return _CODECS[CODEC_JSON]
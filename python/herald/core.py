@@ -36,9 +36,12 @@ __docformat__ = "restructuredtext en"
 # ------------------------------------------------------------------------------
 
 # Herald
+from herald.dedup import create_store, STORE_BUCKETS
+from herald.dispatch import SubjectIndex
 from herald.exceptions import InvalidPeerAccess, NoTransport, HeraldTimeout, \
-    NoListener, ForgotMessage, PeerLost
-from herald.utils import LoopTimer
+    NoListener, ForgotMessage, PeerLost, Overloaded
+from herald.executor import NotificationExecutor
+from herald.utils import TimerWheel
 import herald
 import herald.beans as beans
 import herald.probe
@@ -46,18 +49,18 @@ import herald.probe
 # Pelix
 from pelix.ipopo.decorators import ComponentFactory, Requires, Provides, \
     Validate, Invalidate, Instantiate, RequiresMap, BindField, UpdateField, \
-    UnbindField
+    UnbindField, Property
 import pelix.constants
-import pelix.threadpool
 import pelix.utilities
 
 # Standard library
-import fnmatch
+import bisect
 import itertools
 import logging
-import re
+import random
 import threading
 import time
+import zlib
 
 # routing imports
 import herald.routing_constants
@@ -99,44 +102,113 @@ class _BundleActivator(object):
 # ------------------------------------------------------------------------------
 
 
+class _Route(object):
+    """
+    A bean that describes a route of the cache of fire(): the next hops to a
+    destination, best first, and the (peer, access, transport) tuple which
+    worked for each of them
+    """
+    __slots__ = ('generation', 'via', 'hops', 'distances', 'paths', 'weights')
+
+    def __init__(self, generation, via, hops, distances=None):
+        """
+        Sets up members
+
+        :param generation: Generation of the routes of the routing service
+        :param via: None for a neighbour, "next-hop" or "gateway"
+        :param hops: UIDs of the next hops, best first
+        :param distances: Distances of the roads through the next hops
+        """
+        self.generation = generation
+        self.via = via
+        self.hops = tuple(hops)
+        self.distances = distances
+        self.paths = [None] * len(self.hops)
+
+        # Cumulated weights of the next hops, for the latency balancing
+        self.weights = None
+        if distances and len(self.hops) > 1 \
+                and all(distance > 0 for distance in distances):
+            total = 0.
+            self.weights = []
+            for distance in distances:
+                total += 1. / distance
+                self.weights.append(total)
+
+    def choose(self, balance, flow):
+        """
+        Chooses the next hop of a message
+
+        :param balance: Balancing mode (see herald.routing_constants)
+        :param flow: Method returning the flow key of the message (bytes)
+        :return: The index of the next hop
+        """
+        nb_hops = len(self.hops)
+        if nb_hops == 1 or not balance:
+            return 0
+        elif balance == herald.routing_constants.BALANCE_LATENCY \
+                and self.weights:
+            return bisect.bisect(self.weights,
+                                 random.random() * self.weights[-1])
+        return (zlib.crc32(flow()) & 0xffffffff) % nb_hops
+
+    def without(self, index):
+        """
+        Returns a copy of this route without a next hop
+
+        :param index: Index of the next hop to remove
+        :return: A new route
+        """
+        keep = [idx for idx in range(len(self.hops)) if idx != index]
+        distances = self.distances
+        if distances:
+            distances = [distances[idx] for idx in keep]
+        route = _Route(self.generation, self.via,
+                       [self.hops[idx] for idx in keep], distances)
+        route.paths = [self.paths[idx] for idx in keep]
+        return route
+
+
 class _WaitingSend(pelix.utilities.EventData):
     """
     A bean that describes a waiting send() call
     """
-    def __init__(self, peer, msg_uid):
+    def __init__(self, peer, msg_uid, subject=None):
         """
         Sets up the bean
         """
         super(_WaitingSend, self).__init__()
         self.peer = peer
         self.msg_uid = msg_uid
+        self.subject = subject
+        self.start = time.time()
 
 
 class _WaitingPost(object):
     """
     A bean that describes parameters of a post() call
     """
-    def __init__(self, callback, errback, timeout, forget_on_first, peer=None):
+    def __init__(self, message, callback, errback, forget_on_first,
+                 peer=None):
         """
         Sets up members
 
+        :param message: The posted message
         :param callback: Method to call back when an answer is received
         :param errback: Method to call back on error
-        :param timeout: Time to wait before forgetting this post, in seconds
-                        (<= 0 or None for never)
         :param forget_on_first: If True, forget this post after the first
                                 answer
         :param peer: Bean of the target peer, in single-target mode
         """
+        self.message = message
         self.peer = peer
+        self.start = time.time()
         self.__callback = callback
         self.__errback = errback
         self.__forget_on_first = forget_on_first
 
-        if timeout is not None and timeout > 0:
-            self.__deadline = time.time() + timeout
-        else:
-            self.__deadline = None
+        # Timeout timer (TimerHandle)
+        self.timer = None
 
     @property
     def forget_on_first(self):
@@ -145,17 +217,6 @@ class _WaitingPost(object):
         """
         return self.__forget_on_first
 
-    def is_dead(self):
-        """
-        Checks if the deadline has been reached
-
-        :return: True if this message can be forgotten
-        """
-        if self.__deadline is not None:
-            return self.__deadline > time.time()
-        else:
-            return False
-
     def callback(self, herald_svc, message):
         """
         Tries to call the callback of the post message.
@@ -193,8 +254,18 @@ class _WaitingPost(object):
 @Requires('_directory', herald.SERVICE_DIRECTORY)
 @Requires('_listeners', herald.SERVICE_LISTENER, True, True)
 @Requires('_routing', herald.routing_constants.ROUTING_INFO, optional=True)
+@Requires('_executor', herald.SERVICE_NOTIFICATION_EXECUTOR, optional=True)
+@Requires('_metrics', herald.SERVICE_METRICS, optional=True)
 @RequiresMap('_transports', herald.SERVICE_TRANSPORT, herald.PROP_ACCESS_ID,
              False, False, True)
+@Property('_dedup_kind', 'dedup.kind', STORE_BUCKETS)
+@Property('_dedup_ttl', 'dedup.ttl', 300)
+@Property('_dedup_capacity', 'dedup.capacity', 1000000)
+@Property('_dedup_error_rate', 'dedup.error_rate', .001)
+@Property('_timers_resolution', 'timers.resolution', .1)
+@Property('_notify_lanes', 'notify.lanes', None)
+@Property('_balance', 'routing.balance',
+          herald.routing_constants.BALANCE_FLOW)
 @Instantiate("herald-core")
 class Herald(object):
     """
@@ -214,22 +285,52 @@ class Herald(object):
         self._listeners = []
 
         # Filter -> Listener (computed)
-        self.__msg_listeners = {}
+        self.__msg_listeners = SubjectIndex()
 
         # Herald transports: access ID -> implementation
         self._transports = {}
 
-        # Notification threads
-        self.__pool = pelix.threadpool.ThreadPool(5, logname="HeraldNotify")
+        # Notification executor (optional dependency)
+        self._executor = None
+
+        # Lanes of the default notification executor (see herald.executor)
+        self._notify_lanes = None
+
+        # Default notification executor
+        self.__default_executor = None
 
-        # Garbage collection timer
-        self.__gc_timer = None
+        # Metrics registry (optional dependency) and its metric families
+        self._metrics = None
+        self.__messages_in = None
+        self.__messages_out = None
+        self.__forwarded = None
+        self.__routed = None
+        self.__rtt = None
+        self.__listener_time = None
+        self.__route_cache = None
+        self.__failovers = None
 
-        # Last time a GC was done
-        self._last_gc = None
+        # Route cache: destination UID -> _Route. The dictionary is replaced
+        # to invalidate it.
+        self.__routes = {}
 
-        # List of received messages UIDs, kept 5 minutes: UID -> TTL
-        self.__treated = {}
+        # Balancing of routed messages over the next hops
+        self._balance = herald.routing_constants.BALANCE_FLOW
+
+        # Resolution of post() timeouts, in seconds
+        self._timers_resolution = .1
+
+        # Timeouts of post() calls
+        self.__timers = None
+
+        # Configuration of the store of received messages UIDs
+        self._dedup_kind = STORE_BUCKETS
+        self._dedup_ttl = 300
+        self._dedup_capacity = 1000000
+        self._dedup_error_rate = .001
+
+        # Received messages UIDs (see herald.dedup)
+        self.__treated = None
 
         # Events used for blocking "send()": UID -> EventData
         self.__waiting_events = {}
@@ -239,8 +340,7 @@ class Herald(object):
         self.__waiting_posts = {}
 
         # Thread safety
-        self.__listeners_lock = threading.Lock()
-        self.__gc_lock = threading.Lock()
+        self.__posts_lock = threading.Lock()
 
         # routing: default gateway
         self._gateway = None
@@ -250,27 +350,32 @@ class Herald(object):
         """
         Component validated
         """
-        # Start the thread pool
-        self.__pool.start()
+        # Prepare the store of received messages UIDs
+        self.__treated = create_store(
+            self._dedup_kind, float(self._dedup_ttl),
+            int(self._dedup_capacity), float(self._dedup_error_rate))
+
+        # Start the default notification executor
+        self.__default_executor = NotificationExecutor(self._notify_lanes,
+                                                       "HeraldNotify")
+        self.__default_executor.start()
 
-        # Start the garbage collector
-        self._last_gc = None
-        self.__gc_timer = LoopTimer(30, self.__garbage_collect,
-                                    name="Herald-GC")
-        self.__gc_timer.start()
+        # Start the timeouts scheduler
+        self.__timers = TimerWheel(float(self._timers_resolution),
+                                   name="Herald-Timers")
+        self.__timers.start()
 
     @Invalidate
     def _invalidate(self, _):
         """
         Component invalidated
         """
-        # Stop the garbage collector
-        self.__gc_timer.cancel()
-        self.__gc_timer.join()
-        self.__gc_timer = None
+        # Stop the timeouts scheduler
+        self.__timers.stop()
+        self.__timers = None
 
-        # Stop the thread pool
-        self.__pool.stop()
+        # Stop the default notification executor
+        self.__default_executor.stop()
 
         # Clear waiting events (set them with no data)
         for event in tuple(self.__waiting_events.values()):
@@ -278,7 +383,7 @@ class Herald(object):
 
         exception = HeraldTimeout(None, "Herald stops to listen to messages",
                                   None)
-        with self.__gc_lock:
+        with self.__posts_lock:
             for waiting_post in self.__waiting_posts.values():
                 waiting_post.errback(self, exception)
 
@@ -286,23 +391,18 @@ class Herald(object):
         self.__waiting_events.clear()
         self.__waiting_posts.clear()
 
-        # Clear the thread pool
-        self.__pool.clear()
-
-    def __compile_pattern(self, pattern):
-        """
-        Converts a file name pattern to a regular expression
-
-        :param pattern: A file name pattern
-        :return: A compiled regular expression
-        """
-        return re.compile(fnmatch.translate(pattern), re.IGNORECASE)
+        # Clear the notification executor
+        self.__default_executor.clear()
+        self.__default_executor = None
+        self.__treated = None
 
     @BindField('_transports')
     def _bind_transport(self, _, listener, svc_ref):
         """
         A transport implementation has been bound
         """
+        self.__clear_routes()
+
         # Activate the service
         def set_svc():
             self._controller = True
@@ -313,12 +413,127 @@ class Herald(object):
         """
         A transport implementation has gone away
         """
+        self.__clear_routes()
+
         if len(self._transports) == 1:
             # Last transport is going away
             def set_svc():
                 self._controller = False
             threading.Thread(target=set_svc, name="Herald-Unbind").start()
 
+    @BindField('_routing')
+    def _bind_routing(self, _, routing, svc_ref):
+        """
+        The routing service has been bound
+        """
+        self.__clear_routes()
+
+    @UnbindField('_routing')
+    def _unbind_routing(self, _, routing, svc_ref):
+        """
+        The routing service has gone away
+        """
+        self.__clear_routes()
+
+    @BindField('_metrics')
+    def _bind_metrics(self, _, metrics, svc_ref):
+        """
+        The metrics registry has been bound
+        """
+        self.__messages_in = metrics.counter(
+            "herald.messages.in", ("transport",),
+            "Messages received, per transport")
+        self.__messages_out = metrics.counter(
+            "herald.messages.out", ("transport",),
+            "Messages sent, per transport (one per peer of a group)")
+        self.__forwarded = metrics.counter(
+            "herald.messages.forwarded", ("kind",),
+            "Received messages forwarded by this router, to a peer or to "
+            "a group")
+        self.__routed = metrics.counter(
+            "herald.messages.routed", ("via",),
+            "Messages sent to a peer which is not a neighbour, through the "
+            "next hop or the gateway")
+        self.__rtt = metrics.histogram(
+            "herald.rtt", ("subject", "peer"),
+            "Time between sending a message and receiving a reply")
+        self.__listener_time = metrics.histogram(
+            "herald.listener.time", ("subject",),
+            "Execution time of the message listeners")
+        self.__route_cache = metrics.counter(
+            "herald.routes.cache", ("result",),
+            "Lookups in the route cache of fire()")
+        self.__failovers = metrics.counter(
+            "herald.routes.failover", (),
+            "Messages sent to another next hop after an error")
+        metrics.gauge("herald.routes.cache.ratio", self.__get_routes_ratio,
+                      description="Hit ratio of the route cache")
+        metrics.gauge("herald.routes.cached", self.__get_routes_cached,
+                      description="Destinations in the route cache")
+        metrics.gauge("herald.messages.duplicates", self.__get_duplicates,
+                      description="Duplicated messages dropped")
+        metrics.gauge("herald.notify.queued", self.__get_notify_queued,
+                      ("lane",), "Pending notifications, per executor lane")
+
+    @UnbindField('_metrics')
+    def _unbind_metrics(self, _, metrics, svc_ref):
+        """
+        The metrics registry has gone away
+        """
+        self.__messages_in = None
+        self.__messages_out = None
+        self.__forwarded = None
+        self.__routed = None
+        self.__rtt = None
+        self.__listener_time = None
+        self.__route_cache = None
+        self.__failovers = None
+        metrics.remove("herald.routes.cache.ratio")
+        metrics.remove("herald.routes.cached")
+        metrics.remove("herald.messages.duplicates")
+        metrics.remove("herald.notify.queued")
+
+    def __get_duplicates(self):
+        """
+        Returns the number of duplicated messages dropped (metrics gauge)
+        """
+        treated = self.__treated
+        if treated is not None:
+            return treated.stats()["hits"]
+
+    def __get_routes_ratio(self):
+        """
+        Returns the hit ratio of the route cache (metrics gauge)
+        """
+        route_cache = self.__route_cache
+        if route_cache is None:
+            return None
+
+        hits = route_cache.labels("hit").value
+        lookups = hits + route_cache.labels("miss").value
+        if lookups:
+            return float(hits) / lookups
+
+    def __get_routes_cached(self):
+        """
+        Returns the number of destinations in the route cache (metrics gauge)
+        """
+        return len(self.__routes)
+
+    def __get_notify_queued(self):
+        """
+        Returns the number of pending notifications per lane of the
+        notification executor (metrics gauge)
+        """
+        executor = self._executor or self.__default_executor
+        try:
+            lanes = executor.stats()
+        except AttributeError:
+            # No executor, or no statistics
+            return None
+
+        return dict(((lane["name"],), lane["queued"]) for lane in lanes)
+
     @BindField('_listeners')
     def _bind_listener(self, _, listener, svc_ref):
         """
@@ -327,110 +542,145 @@ class Herald(object):
         svc_filters = pelix.utilities.to_iterable(
             svc_ref.get_property(herald.PROP_FILTERS), False)
 
-        re_filters = set(self.__compile_pattern(fn_filter)
-                         for fn_filter in svc_filters)
-
-        with self.__listeners_lock:
-            for re_filter in re_filters:
-                self.__msg_listeners.setdefault(re_filter, set()) \
-                    .add(listener)
+        for fn_filter in svc_filters:
+            self.__msg_listeners.add(fn_filter, listener)
 
     @UpdateField('_listeners')
     def _update_listener(self, _, listener, svc_ref, old_props):
         """
         The properties of a message listener have been updated
         """
+        # Get old and new filters as sets
+        new_filters = set(pelix.utilities.to_iterable(
+            svc_ref.get_property(herald.PROP_FILTERS), False))
+        old_filters = set(pelix.utilities.to_iterable(
+            old_props.get(herald.PROP_FILTERS), False))
+
+        # Add new filters
+        for fn_filter in new_filters.difference(old_filters):
+            self.__msg_listeners.add(fn_filter, listener)
+
+        # Remove old ones
+        for fn_filter in old_filters.difference(new_filters):
+            self.__msg_listeners.remove(fn_filter, listener)
+
+    @UnbindField('_listeners')
+    def _unbind_listener(self, _, listener, svc_ref):
+        """
+        A message listener has gone away
+        """
         svc_filters = pelix.utilities.to_iterable(
             svc_ref.get_property(herald.PROP_FILTERS), False)
 
-        new_filters = set(self.__compile_pattern(fn_filter)
-                          for fn_filter in svc_filters)
+        for fn_filter in svc_filters:
+            self.__msg_listeners.remove(fn_filter, listener)
 
-        with self.__listeners_lock:
-            # Get old and new filters as sets
-            old_svc_filters = pelix.utilities.to_iterable(
-                old_props.get(herald.PROP_FILTERS), False)
+        # Forget about its dedicated notification lanes, if any
+        for executor in (self.__default_executor, self._executor):
+            try:
+                executor.forget(listener)
+            except AttributeError:
+                # No executor or no per-listener lane
+                pass
 
-            old_filters = set(self.__compile_pattern(fn_filter)
-                              for fn_filter in old_svc_filters)
+    def __execute(self, subject, listener, method, *args):
+        """
+        Calls the given method using the notification executor service, or
+        the default one
 
-            # Compute differences
-            added_filters = new_filters.difference(old_filters)
-            removed_filters = old_filters.difference(new_filters)
+        :param subject: Subject of the message being notified
+        :param listener: The listener being notified (can be None)
+        :param method: Method to call
+        :param args: Method arguments
+        :return: False if the notification has been rejected (overload)
+        """
+        executor = self._executor or self.__default_executor
+        return executor.execute(subject, listener, method, *args)
 
-            # Add new filters
-            for re_filter in added_filters:
-                self.__msg_listeners.setdefault(re_filter, set()) \
-                    .add(listener)
+    def add_message_listener(self, listener, filters):
+        """
+        Registers a message listener which is not a service, e.g. a listener
+        bound to an event loop (see herald.aio).
 
-            # Remove old ones
-            for re_filter in removed_filters:
-                try:
-                    listeners = self.__msg_listeners[re_filter]
-                    listeners.remove(listener)
-                except KeyError:
-                    # Filter or listener not found
-                    pass
-                else:
-                    # Clean up dictionary if necessary
-                    if not listeners:
-                        del self.__msg_listeners[re_filter]
+        If the listener has a ``herald_dispatch(herald, message)`` method, it
+        is called by the thread handling the message and must return
+        immediately. Otherwise, its ``herald_message(herald, message)``
+        method is called by the notification thread pool.
 
-    @UnbindField('_listeners')
-    def _unbind_listener(self, _, listener, svc_ref):
+        :param listener: A message listener
+        :param filters: Subject filter(s) (file name patterns)
         """
-        A message listener has gone away
+        for fn_filter in pelix.utilities.to_iterable(filters, False):
+            self.__msg_listeners.add(fn_filter, listener)
+
+    def remove_message_listener(self, listener, filters):
         """
-        svc_filters = pelix.utilities.to_iterable(
-            svc_ref.get_property(herald.PROP_FILTERS), False)
+        Unregisters a message listener added with add_message_listener()
 
-        with self.__listeners_lock:
-            re_filters = set(self.__compile_pattern(fn_filter)
-                             for fn_filter in svc_filters)
-            for re_filter in re_filters:
-                try:
-                    listeners = self.__msg_listeners[re_filter]
-                    listeners.remove(listener)
-                except KeyError:
-                    # Filter or listener not found
-                    pass
-                else:
-                    # Clean up dictionary if necessary
-                    if not listeners:
-                        del self.__msg_listeners[re_filter]
+        :param listener: A message listener
+        :param filters: Subject filter(s) given at registration
+        """
+        for fn_filter in pelix.utilities.to_iterable(filters, False):
+            self.__msg_listeners.remove(fn_filter, listener)
 
-    def __garbage_collect(self):
+    def __add_waiting_post(self, waiting_post, timeout):
         """
-        Garbage collects dead waiting post beans. Calls on a regular basis
-        by a LoopTimer
+        Stores a waiting post bean and schedules its timeout
+
+        :param waiting_post: A _WaitingPost bean
+        :param timeout: Time after which the post will be forgotten, in
+                        seconds (<= 0 or None for never)
         """
-        with self.__gc_lock:
-            # Compute last garbage collect time
-            if self._last_gc is None:
-                gc_delta = 0
-            else:
-                gc_delta = int(time.time()) - self._last_gc
+        uid = waiting_post.message.uid
+        with self.__posts_lock:
+            self.__waiting_posts[uid] = waiting_post
+            if timeout is not None and timeout > 0:
+                waiting_post.timer = self.__timers.schedule(
+                    timeout, self.__post_timeout, uid, waiting_post)
 
-            # Delete timed out post message beans
-            to_delete = [uid
-                         for uid, waiting_post in self.__waiting_posts.items()
-                         if waiting_post.is_dead()]
-            for uid in to_delete:
-                del self.__waiting_posts[uid]
+    def __pop_waiting_post(self, uid):
+        """
+        Removes a waiting post bean and cancels its timeout
 
-            # Delete UID of treated message of more than 5 minutes
-            to_delete = []
-            for uid, ttl in self.__treated.items():
-                new_ttl = ttl + gc_delta
-                self.__treated[uid] = new_ttl
-                if new_ttl > 300:
-                    to_delete.append(uid)
+        :param uid: UID of the posted message
+        :return: The _WaitingPost bean
+        :raise KeyError: Unknown post
+        """
+        with self.__posts_lock:
+            waiting_post = self.__waiting_posts.pop(uid)
 
-            for uid in to_delete:
-                del self.__treated[uid]
+        timers = self.__timers
+        if timers is not None:
+            timers.cancel(waiting_post.timer)
+        return waiting_post
 
-            # Update the "last garbage collect time"
-            self._last_gc = int(time.time())
+    def __post_timeout(self, uid, waiting_post):
+        """
+        Forgets a post which got no answer in time and calls its errback.
+        Called by the timeouts scheduler.
+
+        :param uid: UID of the posted message
+        :param waiting_post: The _WaitingPost bean
+        """
+        with self.__posts_lock:
+            if self.__waiting_posts.get(uid) is not waiting_post:
+                # Already forgotten
+                return
+
+            del self.__waiting_posts[uid]
+
+        if waiting_post.peer is not None:
+            target = beans.Target(uid=waiting_post.peer.uid)
+        else:
+            target = None
+
+        exception = HeraldTimeout(target,
+                                  "Timeout reached before receiving a reply",
+                                  waiting_post.message)
+        # Don't block the timers thread with the errback
+        if not self.__execute(waiting_post.message.subject, None,
+                              waiting_post.errback, self, exception):
+            waiting_post.errback(self, exception)
 
     def handle_message(self, message):
         """
@@ -440,19 +690,14 @@ class Herald(object):
 
         :param message: A MessageReceived bean forged by the transport
         """
-        print("incoming message : {}".format(message))
-        print('-----')
-        print(message.content)
-        print('-----')
-        print("target : {}".format(self._extract_target(message)))
-        with self.__gc_lock:
-            if message.uid in self.__treated:
-                # Message already handled, maybe it has been received by
-                # another transport
-                return
-            else:
-                # Store the message UID in the treated messages
-                self.__treated[message.uid] = 0
+        messages_in = self.__messages_in
+        if messages_in is not None:
+            messages_in.labels(message.access).inc()
+
+        if self.__treated.check_and_add(message.uid):
+            # Message already handled, maybe it has been received by
+            # another transport
+            return
 
         # User a tuple, because list can't be compared to tuples
         parts = tuple(part for part in message.subject.split('/') if part)
@@ -464,9 +709,11 @@ class Herald(object):
                     self._handle_error(message, parts[2])
                     return
                 elif parts[1] == 'routing':
-                        if not self._is_router():
+                        if not self._is_router() \
+                                and self._gateway != message.sender:
                             # if as a non router, I get a router
                             self._gateway = message.sender
+                            self.__clear_routes()
                 elif parts[1] == 'directory':
                     # Directory update message
                     self._handle_directory_message(message, parts[2])
@@ -476,8 +723,7 @@ class Herald(object):
 
         # if the message needs to be resent
         if self._is_router() and message.get_header('group') is not None:
-            # print("$"*42+" {}".format(message.get_header('group')))
-            print('*'*30+' forwarding {}'.format(message))
+            self.__count_forwarded("group")
             self.fire_group(message.get_header('group'), message)
 
         # if the message needs to be routed
@@ -486,11 +732,22 @@ class Herald(object):
             self.__notify(message)
         elif self._is_router():
             target = self._extract_target(message)
+            self.__count_forwarded("peer")
             self.fire(target, message)
         else:
             # if the message needs to be routed but pair can't do it.
             _logger.critical("=== ROUTING: NON DESTINATION AND NON ROUTER")
 
+    def __count_forwarded(self, kind):
+        """
+        Counts a received message forwarded by this router
+
+        :param kind: Kind of forward: "peer" or "group"
+        """
+        forwarded = self.__forwarded
+        if forwarded is not None:
+            forwarded.labels(kind).inc()
+
     def _is_router(self):
         """
         :return: True if peer is router, False elsewhere
@@ -543,12 +800,19 @@ class Herald(object):
         :return: return true if the peer is in neighbours, false
             elsewhere
         """
-        neighbours = {i.uid for i in self._directory.get_peers()}
-        return peer in neighbours
+        return peer in self._directory
 
     def fire(self, target, message):
         """
         Fires message to a peer
+
+        The next hops and the transports to use for a destination are kept in
+        a route cache, cleared when a peer or a transport comes, changes or
+        goes away, and bound to the generation of the routes of the routing
+        service. Routed messages are spread over the next hops given by the
+        routing service (see the ``routing.balance`` property), and sent to
+        the next one when a next hop fails.
+
         :param target: target uid
         :param message: message to fire.
         """
@@ -560,29 +824,138 @@ class Herald(object):
         if isinstance(target, beans.Peer):
             target = target.uid
 
-        # if destination reachable, use old fire directly
-        if self._in_neighbours(target):
-            # print("core:fire -> {} found in neighbours !".format(target))
-            # print("default fire invoked")
-            return self._fire(target, message)
+        # Routes resolved now are only valid for this generation of the
+        # routing table (None if there is no routing service)
+        routing = self._routing
+        generation = getattr(routing, 'routes_generation', None)
+
+        routes = self.__routes
+        route = routes.get(target)
+        route_cache = self.__route_cache
+        if route is not None and route.generation == generation:
+            if route_cache is not None:
+                route_cache.labels("hit").inc()
         else:
-            # print("core:fire -> {} not found in neighbours".format(target))
-            # print("adding {} to message".format(target))
-            #
-            # print("adding for the moment {} to message".format(target))
+            if route_cache is not None:
+                route_cache.labels("miss").inc()
+
+            route = self.__resolve_route(target, routing, generation)
+            if routing is None or generation is not None:
+                # Routing services without generation can't be cached
+                routes[target] = route
+
+        if route.via is not None:
             self._add_destination(message, target)
-            # print("distant target : {}".format(message.get_header('final_destination')))
+            routed = self.__routed
+            if routed is not None:
+                routed.labels(route.via).inc()
 
-            if self._is_router():
-                next_hop = self._routing.get_next_hop_to(target)
-                # print("core:fire -> redirecting message to {}".format(next_hop))
-                return self._fire(next_hop, message)
+        return self.__fire_route(routes, target, route, message)
+
+    def __resolve_route(self, target, routing, generation):
+        """
+        Finds the next hops to a peer
+
+        :param target: UID of the destination peer
+        :param routing: The routing service (or None)
+        :param generation: Generation of the routes of the routing service
+        :return: A _Route bean
+        :raise KeyError: No road to the peer
+        :raise Exception: Not a router and no gateway known
+        """
+        # if destination reachable, use old fire directly
+        if self._in_neighbours(target):
+            return _Route(generation, None, (target,))
+        elif routing is not None:
+            get_next_hops_to = getattr(routing, 'get_next_hops_to', None)
+            if self._balance and get_next_hops_to is not None:
+                roads = get_next_hops_to(target)
             else:
-                # fire to the default gateway
-                if self._gateway is None:
-                    raise Exception('GATEWAY NOT EXISTING')
-                # print("core:fire -> sending to default gateway {}".format(self._gateway))
-                return self._fire(self._gateway, message)
+                next_hop = routing.get_next_hop_to(target)
+                roads = [(next_hop, None)] if next_hop is not None else []
+
+            if not roads:
+                raise KeyError(target)
+
+            distances = [distance for _, distance in roads]
+            if None in distances:
+                distances = None
+            return _Route(generation, "next-hop",
+                          [next_hop for next_hop, _ in roads], distances)
+        elif self._gateway is not None:
+            # fire to the default gateway
+            return _Route(generation, "gateway", (self._gateway,))
+        else:
+            raise Exception('GATEWAY NOT EXISTING')
+
+    def __fire_route(self, routes, target, route, message):
+        """
+        Fires a message through one of the next hops of a route, then through
+        the next ones if it fails
+
+        :param routes: The route cache the route comes from
+        :param target: UID of the destination peer
+        :param route: A _Route bean
+        :param message: A Message bean
+        :return: The UID of the message sent
+        :raise KeyError: Unknown next hop
+        :raise NoTransport: No transport found to send the message
+        """
+        def flow():
+            """
+            Flow key of the message: final destination and sender
+            """
+            sender = message.get_header(herald.MESSAGE_HEADER_SENDER_UID) \
+                or self._directory.local_uid
+            return "{0}\n{1}".format(target, sender).encode("utf-8")
+
+        index = route.choose(self._balance, flow)
+
+        # FIXME: see _fire()
+        if message.raw_content is None \
+                and isinstance(message.content, bytes):
+            message.set_content(message.content.decode("utf8"))
+
+        while True:
+            path = route.paths[index]
+            try:
+                if path is None:
+                    route.paths[index] = \
+                        self.__fire_peer(route.hops[index], message)
+                else:
+                    peer, access, transport = path
+                    try:
+                        transport.fire(peer, message)
+                    except Exception as ex:
+                        # Try the other accesses of the peer
+                        _logger.debug("Error using cached transport %s: %s",
+                                      access, ex)
+                        route.paths[index] = \
+                            self.__fire_peer(peer, message, access)
+                    else:
+                        messages_out = self.__messages_out
+                        if messages_out is not None:
+                            messages_out.labels(access).inc()
+                return message.uid
+            except (KeyError, NoTransport) as ex:
+                if len(route.hops) == 1:
+                    # No other next hop
+                    if routes.get(target) is route:
+                        del routes[target]
+                    raise
+
+                # Fail over to the best remaining next hop
+                _logger.debug("Next hop %s to %s failed: %s",
+                              route.hops[index], target, ex)
+                failed = route
+                route = route.without(index)
+                if routes.get(target) is failed:
+                    routes[target] = route
+                index = 0
+
+                failovers = self.__failovers
+                if failovers is not None:
+                    failovers.labels().inc()
 
     def _handle_error(self, message, kind):
         """
@@ -594,15 +967,21 @@ class Herald(object):
         possible kinds:
             - 'no-listener': means that there is no
                              listener found for this subject
+            - 'overloaded': the peer rejected the message, as its
+                            notification queues are full
         """
-        if kind == 'no-listener':
+        if kind in ('no-listener', 'overloaded'):
             # No listener found for a given message
             # ... release send() calls
             try:
                 # Get the original message UID and Subject
                 uid = message.content['uid']
-                exception = NoListener(message.sender, uid,
-                                       message.content['subject'])
+                if kind == 'overloaded':
+                    exception = Overloaded(message.sender, uid,
+                                           message.content['subject'])
+                else:
+                    exception = NoListener(message.sender, uid,
+                                           message.content['subject'])
             except KeyError:
                 # Invalid error content...
                 return
@@ -616,7 +995,7 @@ class Herald(object):
 
             # ... notify post() callers
             try:
-                self.__waiting_posts.pop(uid).errback(self, exception)
+                self.__pop_waiting_post(uid).errback(self, exception)
             except KeyError:
                 # No error callback for this message
                 pass
@@ -639,6 +1018,8 @@ class Herald(object):
         """
         Peer unregistered: raise an exception in all pending send/post calls
         """
+        self.__clear_routes()
+
         # Prepare the exception to raise
         exception = PeerLost(peer, "Peer {0} has been lost".format(peer))
 
@@ -648,33 +1029,38 @@ class Herald(object):
         for uid in uids:
             self.__waiting_events.pop(uid).raise_exception(exception)
 
-        with self.__gc_lock:
+        with self.__posts_lock:
             # ... list post() callers for this peer
-            entries = {uid: waiting_post
-                       for uid, waiting_post in self.__waiting_posts.items()
-                       if peer == waiting_post.peer}
-
-            # Clean up callers dictionary
-            for uid in entries:
-                del self.__waiting_posts[uid]
+            uids = [uid for uid, waiting_post in self.__waiting_posts.items()
+                    if peer == waiting_post.peer]
 
         # ... notify post() callers
-        for waiting_post in entries.values():
-            waiting_post.errback(self, exception)
+        for uid in uids:
+            try:
+                self.__pop_waiting_post(uid).errback(self, exception)
+            except KeyError:
+                # Answered or timed out in the meantime
+                pass
 
-    @staticmethod
-    def peer_registered(peer):
+    def peer_registered(self, peer):
         """
-        Peer registered: ignore
+        Peer registered: clear the route cache
         """
-        pass
+        self.__clear_routes()
 
-    @staticmethod
-    def peer_updated(peer, access_id, data, previous):
+    def peer_updated(self, peer, access_id, data, previous):
         """
-        Peer updated: ignore
+        Peer updated: clear the route cache
         """
-        pass
+        self.__clear_routes()
+
+    def __clear_routes(self):
+        """
+        Invalidates the route cache of fire(). The dictionary is replaced, so
+        that a route resolved before the invalidation is stored in the old
+        one.
+        """
+        self.__routes = {}
 
     def __notify(self, message):
         """
@@ -687,42 +1073,79 @@ class Herald(object):
             # ... unlock send() calls
             try:
                 # This is an answer to a message: unlock the sender
-                self.__waiting_events.pop(message.reply_to).set(message)
+                event = self.__waiting_events.pop(message.reply_to)
             except KeyError:
                 # Nobody was waiting for the event
                 pass
+            else:
+                self.__record_rtt(event.subject, message, event.start)
+                event.set(message)
 
             # ... notify post() callers
             try:
-                with self.__gc_lock:
+                with self.__posts_lock:
                     waiting_post = self.__waiting_posts[message.reply_to]
             except KeyError:
                 # Nobody was waiting for an answer
                 pass
             else:
-                waiting_post.callback(self, message)
                 if waiting_post.forget_on_first:
                     # First answer received: forget about the message
-                    del self.__waiting_posts[message.reply_to]
+                    try:
+                        self.__pop_waiting_post(message.reply_to)
+                    except KeyError:
+                        # Already forgotten
+                        pass
+                self.__record_rtt(waiting_post.message.subject, message,
+                                  waiting_post.start)
+                waiting_post.callback(self, message)
 
         # Compute the list of listeners to notify
-        msg_listeners = set()
-        subject = message.subject
-
-        with self.__listeners_lock:
-            for re_filter, re_listeners in self.__msg_listeners.items():
-                if re_filter.match(subject) is not None:
-                    msg_listeners.update(re_listeners)
+        msg_listeners = self.__msg_listeners.match(message.subject)
 
         if msg_listeners:
-            # Call listeners in the thread pool
+            # Call listeners with the notification executor
+            overloaded = False
+            listener_time = self.__listener_time
+            if listener_time is not None:
+                listener_time = listener_time.labels(message.subject)
+
             for listener in msg_listeners:
+                # pylint: disable=W0703
                 try:
-                    self.__pool.enqueue(listener.herald_message,
-                                        self, message)
-                except (AttributeError, ValueError):
+                    dispatch = getattr(listener, 'herald_dispatch', None)
+                    if dispatch is not None:
+                        # The listener schedules the notification itself
+                        dispatch(self, message)
+                    elif listener_time is not None:
+                        if not self.__execute(message.subject, listener,
+                                              self.__timed_notify,
+                                              listener_time,
+                                              listener.herald_message,
+                                              message):
+                            overloaded = True
+                    elif not self.__execute(message.subject, listener,
+                                            listener.herald_message,
+                                            self, message):
+                        overloaded = True
+                except AttributeError:
                     # Invalid listener
                     pass
+                except Exception as ex:
+                    _logger.exception("Error dispatching a message: %s", ex)
+
+            if overloaded and not message.subject.startswith('herald/error/'):
+                _logger.warning("Notification queue full: message %s (%s) "
+                                "rejected", message.uid, message.subject)
+                try:
+                    # Tell the sender we can't handle its message
+                    self.reply(message,
+                               {'uid': message.uid,
+                                'subject': message.subject},
+                               'herald/error/overloaded')
+                except Exception as ex:
+                    _logger.error("Can't send an error back to the sender: "
+                                  "%s", ex)
         else:
             try:
                 # No listener found: send an error message
@@ -732,6 +1155,32 @@ class Herald(object):
             except Exception as ex:
                 _logger.error("Can't send an error back to the sender: %s", ex)
 
+    def __record_rtt(self, subject, reply, start):
+        """
+        Records the round trip time of a message
+
+        :param subject: Subject of the sent message
+        :param reply: The reply message
+        :param start: Time when the message was sent
+        """
+        rtt = self.__rtt
+        if rtt is not None:
+            rtt.labels(subject, str(reply.sender)).record(time.time() - start)
+
+    def __timed_notify(self, histogram, notify, message):
+        """
+        Notifies a listener and records its execution time
+
+        :param histogram: Histogram of the subject of the message
+        :param notify: The herald_message() method of the listener
+        :param message: The received message
+        """
+        start = time.time()
+        try:
+            notify(self, message)
+        finally:
+            histogram.record(time.time() - start)
+
     def _fire_reply(self, message, reply_to):
         """
         Tries to fire a reply to the given message
@@ -777,8 +1226,25 @@ class Herald(object):
         :raise KeyError: Unknown peer UID
         :raise NoTransport: No transport found to send the message
         """
+        self.__fire_peer(target, message)
+        return message.uid
+
+    def __fire_peer(self, target, message, skip_access=None):
+        """
+        Fires the given message to the target, with the first transport
+        which succeeds
+
+        :param target: The UID of a Peer, or a Peer object
+        :param message: A Message bean
+        :param skip_access: An access ID not to use (already tried)
+        :return: A (peer, access ID, transport) tuple
+        :raise KeyError: Unknown peer UID
+        :raise NoTransport: No transport found to send the message
+        """
         # FIXME: quick fix : xmlrpc sends bytes instead of strings
-        if isinstance(message.content, bytes):
+        # (received messages are forwarded without decoding their content)
+        if message.raw_content is None \
+                and isinstance(message.content, bytes):
             message.set_content(message.content.decode("utf8"))
 
         # Standard behavior
@@ -796,6 +1262,9 @@ class Herald(object):
         # Get accesses
         accesses = peer.get_accesses()
         for access in accesses:
+            if access == skip_access:
+                continue
+
             try:
                 transport = self._transports[access]
             except KeyError:
@@ -814,14 +1283,15 @@ class Herald(object):
                     _logger.exception("Error using transport %s: %s", access, ex)
                 else:
                     # Success
-                    break
-        else:
-            # No transport for those accesses
-            raise NoTransport(beans.Target(uid=peer.uid),
-                              "No working transport found for peer {0}"
-                              .format(peer))
+                    messages_out = self.__messages_out
+                    if messages_out is not None:
+                        messages_out.labels(access).inc()
+                    return peer, access, transport
 
-        return message.uid
+        # No transport for those accesses
+        raise NoTransport(beans.Target(uid=peer.uid),
+                          "No working transport found for peer {0}"
+                          .format(peer))
 
     @staticmethod
     def _add_group_header(message, group):
@@ -886,6 +1356,10 @@ class Herald(object):
                     # Transport can't find group access data
                     _logger.debug("Missing access info: %s", ex)
                 else:
+                    messages_out = self.__messages_out
+                    if messages_out is not None:
+                        messages_out.labels(access).inc(len(reached_peers))
+
                     # Success: clean up waiting peers
                     all_done = True
                     for remaining_peers in accesses.values():
@@ -931,7 +1405,7 @@ class Herald(object):
             peer = target
 
         # Prepare an event, which will be set when the answer will be received
-        event = _WaitingSend(peer, message.uid)
+        event = _WaitingSend(peer, message.uid, message.subject)
         self.__waiting_events[message.uid] = event
 
         try:
@@ -985,10 +1459,10 @@ class Herald(object):
         else:
             peer = target
 
-        with self.__gc_lock:
-            # Prepare an entry in the waiting posts
-            self.__waiting_posts[message.uid] = \
-                _WaitingPost(callback, errback, timeout, forget_on_first, peer)
+        # Prepare an entry in the waiting posts
+        self.__add_waiting_post(
+            _WaitingPost(message, callback, errback, forget_on_first, peer),
+            timeout)
 
         try:
             # Fire the message
@@ -997,8 +1471,7 @@ class Herald(object):
         except:
             # Early clean up in case of exception
             try:
-                with self.__gc_lock:
-                    del self.__waiting_posts[message.uid]
+                self.__pop_waiting_post(message.uid)
             except KeyError:
                 pass
 
@@ -1032,10 +1505,9 @@ class Herald(object):
                              uids=[peer.uid for peer in all_peers]),
                 "No transport bound yet.")
 
-        with self.__gc_lock:
-            # Prepare an entry in the waiting posts
-            self.__waiting_posts[message.uid] = \
-                _WaitingPost(callback, errback, timeout, False)
+        # Prepare an entry in the waiting posts
+        self.__add_waiting_post(
+            _WaitingPost(message, callback, errback, False), timeout)
 
         # Find the common accesses
         accesses = {}
@@ -1061,6 +1533,10 @@ class Herald(object):
                     # Transport can't find group access data
                     pass
                 else:
+                    messages_out = self.__messages_out
+                    if messages_out is not None:
+                        messages_out.labels(access).inc(len(access_peers))
+
                     # Success: clean up waiting peers
                     all_done = True
                     for remaining_peers in accesses.values():
@@ -1096,16 +1572,28 @@ class Herald(object):
             # ... no pending call
             pass
 
-        with self.__gc_lock:
-            try:
-                self.__waiting_posts.pop(uid).errback(self, exception)
-                result = True
-            except KeyError:
-                # ... no pending call
-                pass
+        try:
+            self.__pop_waiting_post(uid).errback(self, exception)
+            result = True
+        except KeyError:
+            # ... no pending call
+            pass
 
         return result
 
+    def get_dedup_stats(self):
+        """
+        Returns the statistics of the store of received messages UIDs, used
+        to drop duplicated messages: kind of store, number of stored UIDs,
+        duplicates hits, evicted UIDs, memory use (bytes) and false-positive
+        rate
+
+        :return: A dictionary, or None if the component is invalid
+        """
+        treated = self.__treated
+        if treated is not None:
+            return treated.stats()
+
     # No listener found: send an error message
     # self.reply(message,
     #            {'uid': message.uid, 'subject': message.subject},
@@ -0,0 +1,365 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Stores of the UIDs of the messages already treated by Herald, used to drop
+the messages received more than once (e.g. through different transports)
+
+Both implementations have a fixed memory budget and forget UIDs after a TTL,
+without a garbage collection pass. Their ``check_and_add()`` method doesn't
+acquire a lock, except when a time bucket must be rotated.
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Pelix
+from pelix.utilities import to_bytes
+
+# Standard library
+import hashlib
+import math
+import struct
+import sys
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+STORE_BUCKETS = "buckets"
+""" Exact store: a ring of time buckets """
+
+STORE_BLOOM = "bloom"
+""" Probabilistic store: a rotating pair of Bloom filters """
+
+# ------------------------------------------------------------------------------
+
+
+def create_store(kind, ttl, capacity, error_rate=None):
+    """
+    Creates a store of treated messages UIDs
+
+    :param kind: Kind of store (STORE_BUCKETS or STORE_BLOOM)
+    :param ttl: Minimal time to keep an UID, in seconds
+    :param capacity: Maximum number of UIDs to keep
+    :param error_rate: False-positive rate (Bloom filters only)
+    :return: A store instance
+    :raise ValueError: Unknown kind of store
+    """
+    if kind == STORE_BUCKETS:
+        return TimeBucketedSet(ttl, capacity)
+    elif kind == STORE_BLOOM:
+        return RotatingBloomFilter(ttl, capacity, error_rate or .001)
+    else:
+        raise ValueError("Unknown kind of UID store: {0}".format(kind))
+
+
+class TimeBucketedSet(object):
+    """
+    Exact store: a ring of dictionaries, each one holding the UIDs received
+    during a slice of the TTL. The oldest slice is dropped as a whole when
+    the time goes by, or when the current slice exceeds its share of the
+    capacity.
+    """
+    def __init__(self, ttl=300, capacity=1000000, nb_buckets=10, clock=None):
+        """
+        Sets up members
+
+        :param ttl: Minimal time to keep an UID, in seconds
+        :param capacity: Maximum number of UIDs to keep
+        :param nb_buckets: Number of slices of the TTL
+        :param clock: Method returning the current time (in seconds)
+        """
+        # The ring holds one more bucket than the TTL, as the current one
+        # is being filled
+        self.__nb_buckets = int(nb_buckets) + 1
+        self.__span = float(ttl) / nb_buckets
+        self.__bucket_capacity = max(1, int(capacity) // self.__nb_buckets)
+        self.__clock = clock or time.time
+
+        # Buckets and index of the current one
+        self.__ring = [{} for _ in range(self.__nb_buckets)]
+        self.__epoch = int(self.__clock() / self.__span)
+        self.__offset = 0
+        self.__lock = threading.Lock()
+
+        # Statistics (approximate: not protected against concurrency)
+        self.__hits = 0
+        self.__evictions = 0
+
+    def __len__(self):
+        """
+        Returns the number of stored UIDs
+        """
+        return sum(len(bucket) for bucket in self.__ring)
+
+    def __rotate(self, epoch):
+        """
+        Moves the current bucket to the one of the given epoch, clearing the
+        buckets in-between
+
+        :param epoch: The new current epoch
+        """
+        with self.__lock:
+            if epoch > self.__epoch:
+                self.__advance(epoch)
+
+    def __advance(self, epoch):
+        """
+        Clears the buckets up to the given epoch and makes it the current one
+        (the lock must be held)
+
+        :param epoch: The new current epoch, after the current one
+        """
+        first = max(self.__epoch + 1, epoch - self.__nb_buckets + 1)
+        for idx in range(first, epoch + 1):
+            slot = idx % self.__nb_buckets
+            self.__evictions += len(self.__ring[slot])
+            self.__ring[slot] = {}
+
+        self.__epoch = epoch
+
+    def check_and_add(self, uid):
+        """
+        Stores the given UID and tells if it was already known
+
+        :param uid: A message UID
+        :return: True if the UID was already stored
+        """
+        epoch = int(self.__clock() / self.__span) + self.__offset
+        if epoch > self.__epoch:
+            self.__rotate(epoch)
+
+        ring = self.__ring
+        current = ring[self.__epoch % self.__nb_buckets]
+        for bucket in ring:
+            if uid in bucket and bucket is not current:
+                self.__hits += 1
+                return True
+
+        # setdefault() is atomic: only one thread can insert the UID
+        marker = object()
+        if current.setdefault(uid, marker) is not marker:
+            self.__hits += 1
+            return True
+
+        if len(current) >= self.__bucket_capacity:
+            # Memory budget reached: drop the oldest bucket right now, once
+            # even if several threads filled the current bucket
+            with self.__lock:
+                if current is self.__ring[self.__epoch % self.__nb_buckets] \
+                        and len(current) >= self.__bucket_capacity:
+                    self.__offset += 1
+                    self.__advance(self.__epoch + 1)
+
+        return False
+
+    def clear(self):
+        """
+        Forgets all UIDs
+        """
+        with self.__lock:
+            self.__ring = [{} for _ in range(self.__nb_buckets)]
+
+    def stats(self):
+        """
+        Returns the statistics of this store
+
+        :return: A dictionary
+        """
+        ring = self.__ring
+        size = sum(len(bucket) for bucket in ring)
+        memory = sum(sys.getsizeof(bucket) for bucket in ring)
+        for bucket in ring:
+            for uid in bucket:
+                # Estimate the size of the keys from the first one
+                memory += size * sys.getsizeof(uid)
+                break
+            else:
+                continue
+            break
+
+        return {"kind": STORE_BUCKETS, "size": size, "hits": self.__hits,
+                "evictions": self.__evictions, "memory": memory,
+                "error_rate": 0.}
+
+
+class _BloomFilter(object):
+    """
+    A simple Bloom filter on strings
+    """
+    def __init__(self, nb_bits, nb_hashes):
+        """
+        Sets up the filter
+
+        :param nb_bits: Size of the filter in bits
+        :param nb_hashes: Number of hash functions
+        """
+        self.nb_bits = nb_bits
+        self.nb_hashes = nb_hashes
+        self.bits = bytearray((nb_bits + 7) // 8)
+        self.count = 0
+        self.creation = time.time()
+
+    def positions(self, uid):
+        """
+        Computes the bits positions of the given UID (double hashing)
+
+        :param uid: A message UID
+        :return: A list of bits positions
+        """
+        hash_1, hash_2 = struct.unpack_from(
+            "<QQ", hashlib.md5(to_bytes(uid)).digest())
+        hash_2 |= 1
+        return [(hash_1 + idx * hash_2) % self.nb_bits
+                for idx in range(self.nb_hashes)]
+
+    def contains(self, positions):
+        """
+        Checks if all the given bits are set
+
+        :param positions: Result of positions()
+        :return: True if the UID might be in the filter
+        """
+        bits = self.bits
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, positions):
+        """
+        Sets the given bits
+
+        :param positions: Result of positions()
+        """
+        bits = self.bits
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+class RotatingBloomFilter(object):
+    """
+    Probabilistic store: UIDs are added to the current Bloom filter, and
+    looked for in both the current and the previous ones. The previous filter
+    is dropped when the current one is older than half the TTL or holds
+    half the capacity.
+
+    A false positive means that a new message is dropped as a duplicate.
+    """
+    def __init__(self, ttl=300, capacity=1000000, error_rate=.001):
+        """
+        Sets up members
+
+        :param ttl: Minimal time to keep an UID, in seconds
+        :param capacity: Maximum number of UIDs to keep
+        :param error_rate: Maximum false-positive rate
+        """
+        self.__max_age = float(ttl) / 2
+        self.__generation_size = max(1, int(capacity) // 2)
+        self.__error_rate = float(error_rate)
+
+        # Each filter is checked: split the error rate between them
+        filter_error = self.__error_rate / 2
+        self.__nb_bits = int(math.ceil(-self.__generation_size *
+                                       math.log(filter_error) /
+                                       (math.log(2) ** 2)))
+        self.__nb_hashes = max(1, int(round(
+            float(self.__nb_bits) / self.__generation_size * math.log(2))))
+
+        self.__current = self.__new_filter()
+        self.__previous = self.__new_filter()
+        self.__lock = threading.Lock()
+
+        # Statistics
+        self.__hits = 0
+        self.__evictions = 0
+
+    def __new_filter(self):
+        """
+        Prepares a new Bloom filter
+        """
+        return _BloomFilter(self.__nb_bits, self.__nb_hashes)
+
+    def __rotate(self):
+        """
+        Makes the current filter the previous one (the lock must be held)
+        """
+        self.__evictions += self.__previous.count
+        self.__previous = self.__current
+        self.__current = self.__new_filter()
+
+    def check_and_add(self, uid):
+        """
+        Stores the given UID and tells if it was (probably) already known.
+        The check and the addition are atomic: only one of the threads
+        receiving the same UID at once gets False.
+
+        :param uid: A message UID
+        :return: True if the UID was (probably) already stored
+        """
+        # All filters have the same size: hash outside the lock
+        positions = self.__current.positions(uid)
+
+        with self.__lock:
+            current = self.__current
+            if current.count >= self.__generation_size \
+                    or time.time() - current.creation > self.__max_age:
+                self.__rotate()
+                current = self.__current
+
+            if current.contains(positions) \
+                    or self.__previous.contains(positions):
+                self.__hits += 1
+                return True
+
+            current.add(positions)
+            return False
+
+    def clear(self):
+        """
+        Forgets all UIDs
+        """
+        with self.__lock:
+            self.__current = self.__new_filter()
+            self.__previous = self.__new_filter()
+
+    def stats(self):
+        """
+        Returns the statistics of this store
+
+        :return: A dictionary
+        """
+        return {"kind": STORE_BLOOM,
+                "size": self.__current.count + self.__previous.count,
+                "hits": self.__hits, "evictions": self.__evictions,
+                "memory": len(self.__current.bits) + len(self.__previous.bits),
+                "error_rate": self.__error_rate}
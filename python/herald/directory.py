@@ -50,6 +50,7 @@ import pelix.constants
 # Standard library
 import logging
 import threading
+import time
 
 # ------------------------------------------------------------------------------
 
@@ -58,6 +59,137 @@ _logger = logging.getLogger(__name__)
 # ------------------------------------------------------------------------------
 
 
+class _Snapshot(object):
+    """
+    Immutable view of the content of the directory.
+
+    Each modification of the directory publishes a new snapshot: readers
+    get the current one without locking and never see a partial update.
+    Modifications only copy the index entries they change.
+    """
+    __slots__ = ('peers', 'all_peers', 'names', 'name_peers', 'groups',
+                 'nodes')
+
+    def __init__(self, peers=None, all_peers=None, names=None,
+                 name_peers=None, groups=None, nodes=None):
+        """
+        :param peers: UID -> Peer bean
+        :param all_peers: Tuple of all Peer beans
+        :param names: Name -> Frozen set of Peer UIDs
+        :param name_peers: Name -> Tuple of Peer beans
+        :param groups: Group name -> Frozen set of Peer beans
+        :param nodes: Node UID -> Tuple of Peer beans
+        """
+        self.peers = peers or {}
+        self.all_peers = all_peers or ()
+        self.names = names or {}
+        self.name_peers = name_peers or {}
+        self.groups = groups or {}
+        self.nodes = nodes or {}
+
+    def add(self, peer):
+        """
+        Returns a new snapshot containing the given peer
+
+        :param peer: A Peer bean
+        :return: A tuple: (new snapshot, names of the new groups)
+        """
+        peers = self.peers.copy()
+        peers[peer.uid] = peer
+
+        names = self.names.copy()
+        names[peer.name] = names.get(peer.name, frozenset()) \
+            .union((peer.uid,))
+        name_peers = self.name_peers.copy()
+        name_peers[peer.name] = name_peers.get(peer.name, ()) + (peer,)
+
+        nodes = self.nodes.copy()
+        nodes[peer.node_uid] = nodes.get(peer.node_uid, ()) + (peer,)
+
+        groups = self.groups.copy()
+        new_groups = set()
+        for group in peer.groups:
+            try:
+                groups[group] = groups[group].union((peer,))
+            except KeyError:
+                # Group must be created
+                groups[group] = frozenset((peer,))
+                new_groups.add(group)
+
+        return _Snapshot(peers, tuple(peers.values()), names, name_peers,
+                         groups, nodes), new_groups
+
+    def remove(self, peer):
+        """
+        Returns a new snapshot without the given peer
+
+        :param peer: A registered Peer bean
+        :return: A tuple: (new snapshot, names of the removed groups)
+        """
+        return self.remove_all((peer,))
+
+    def remove_all(self, peers):
+        """
+        Returns a new snapshot without the given peers: each index entry is
+        copied once, whatever the number of removed peers it contains
+
+        :param peers: Registered Peer beans
+        :return: A tuple: (new snapshot, names of the removed groups)
+        """
+        all_peers = self.peers.copy()
+        by_name = {}
+        by_node = {}
+        by_group = {}
+        for peer in peers:
+            del all_peers[peer.uid]
+            by_name.setdefault(peer.name, set()).add(peer)
+            by_node.setdefault(peer.node_uid, set()).add(peer)
+            for group in peer.groups:
+                by_group.setdefault(group, set()).add(peer)
+
+        names = self.names.copy()
+        name_peers = self.name_peers.copy()
+        for name, removed in by_name.items():
+            uids = names.get(name, frozenset()).difference(
+                peer.uid for peer in removed)
+            if uids:
+                names[name] = uids
+                name_peers[name] = tuple(other for other in name_peers[name]
+                                         if other not in removed)
+            else:
+                names.pop(name, None)
+                name_peers.pop(name, None)
+
+        nodes = self.nodes.copy()
+        for node_uid, removed in by_node.items():
+            node_peers = tuple(other for other in nodes.get(node_uid, ())
+                               if other not in removed)
+            if node_peers:
+                nodes[node_uid] = node_peers
+            else:
+                nodes.pop(node_uid, None)
+
+        groups = self.groups.copy()
+        removed_groups = set()
+        for group, removed in by_group.items():
+            try:
+                group_peers = groups[group].difference(removed)
+            except KeyError:
+                # Peers weren't in that group
+                continue
+
+            if group_peers:
+                groups[group] = group_peers
+            else:
+                del groups[group]
+                removed_groups.add(group)
+
+        return _Snapshot(all_peers, tuple(all_peers.values()), names,
+                         name_peers, groups, nodes), removed_groups
+
+# ------------------------------------------------------------------------------
+
+
 @ComponentFactory("herald-directory-factory")
 @Provides(herald.SERVICE_DIRECTORY)
 @RequiresMap('_directories', herald.SERVICE_TRANSPORT_DIRECTORY,
@@ -86,16 +218,11 @@ class HeraldDirectory(object):
         # Local bean description
         self._local = None
 
-        # UID -> Peer bean
-        self._peers = {}
-
-        # Name -> Set of Peer UIDs
-        self._names = {}
+        # Current content of the directory: peers and indexes
+        # (replaced as a whole, under the lock)
+        self._snapshot = _Snapshot()
 
-        # Group name -> Set of Peers
-        self._groups = {}
-
-        # Thread safety
+        # Thread safety (modifications only)
         self.__lock = threading.Lock()
 
     def __contains__(self, peer):
@@ -106,7 +233,15 @@ class HeraldDirectory(object):
         :param peer: A peer UID or object
         :return: True if the peer is known
         """
-        return peer in self._peers or peer in self._peers.values()
+        peers = self._snapshot.peers
+        if peer in peers:
+            return True
+
+        try:
+            return peers.get(peer.uid) == peer
+        except AttributeError:
+            # Not a Peer bean
+            return False
 
     def __make_local_peer(self, context):
         """
@@ -140,6 +275,10 @@ class HeraldDirectory(object):
         # Setup node and name information
         peer.name = context.get_property(herald.FWPROP_PEER_NAME)
         peer.node_name = context.get_property(herald.FWPROP_NODE_NAME)
+
+        # Start from a time-based generation, to be newer than the one of a
+        # previous execution
+        peer.reset_changes(int(time.time() * 1000))
         return peer
 
     @Validate
@@ -147,16 +286,12 @@ class HeraldDirectory(object):
         """
         Component validated
         """
-        # Clean up remaining data (if any)
-        self._peers.clear()
-        self._names.clear()
-        self._groups.clear()
-
         # Prepare local peer
         self._local = self.__make_local_peer(context)
-        for group in self._local.groups:
-            # Create (empty) groups
-            self._groups[group] = set()
+
+        # Clean up remaining data (if any) and create (empty) local groups
+        self._snapshot = _Snapshot(
+            groups={group: frozenset() for group in self._local.groups})
 
     @Invalidate
     def _invalidate(self, _):
@@ -164,9 +299,7 @@ class HeraldDirectory(object):
         Component invalidated
         """
         # Clean all up
-        self._peers.clear()
-        self._names.clear()
-        self._groups.clear()
+        self._snapshot = _Snapshot()
         self._local = None
 
     @BindField('_directories')
@@ -179,7 +312,7 @@ class HeraldDirectory(object):
             return
 
         with self.__lock:
-            for peer in self._peers.values():
+            for peer in self._snapshot.all_peers:
                 try:
                     access = peer.get_access(access_id)
                 except KeyError:
@@ -201,7 +334,7 @@ class HeraldDirectory(object):
             return
 
         with self.__lock:
-            for peer in self._peers.values():
+            for peer in self._snapshot.all_peers:
                 try:
                     # Get the current access information
                     access = peer.get_access(access_id)
@@ -218,7 +351,7 @@ class HeraldDirectory(object):
         """
         A directory listener has been bound
         """
-        for peer in list(self._peers.values()):
+        for peer in self._snapshot.all_peers:
             svc.peer_registered(peer)
 
     @BindField('_group_listeners', if_valid=True)
@@ -226,7 +359,7 @@ class HeraldDirectory(object):
         """
         A directory group listener has been bound
         """
-        for group in self._groups:
+        for group in list(self._snapshot.groups):
             svc.group_set(group)
 
     def __notify_group_set(self, group):
@@ -317,7 +450,7 @@ class HeraldDirectory(object):
         :return: A Peer bean
         :raise KeyError: Unknown peer
         """
-        return self._peers[uid]
+        return self._snapshot.peers[uid]
 
     def get_local_peer(self):
         """
@@ -333,57 +466,58 @@ class HeraldDirectory(object):
 
         :return: A tuple containing all known peers
         """
-        return tuple(self._peers.values())
+        return self._snapshot.all_peers
 
     def get_uids_for_name(self, name):
         """
         Returns the UIDs of the peers having the given name
 
         :param name: The name used by some peers
-        :return: A set of UIDs
+        :return: A frozen set of UIDs
         :raise KeyError: No peer has this name
         """
+        snapshot = self._snapshot
         try:
-            return self._names[name].copy()
+            return snapshot.names[name]
         except KeyError:
-            return [self._peers[name].uid]
+            return frozenset((snapshot.peers[name].uid,))
 
     def get_peers_for_name(self, name):
         """
         Returns the Peer beans of the peers having the given name
 
         :param name: The name used by some peers
-        :return: A list of Peer beans
+        :return: A tuple of Peer beans
         :raise KeyError: No peer has this name
         """
+        snapshot = self._snapshot
         try:
-            return [self._peers[uid] for uid in self._names[name]]
+            return snapshot.name_peers[name]
         except KeyError:
-            return [self._peers[name]]
+            return (snapshot.peers[name],)
 
     def get_peers_for_group(self, group):
         """
         Returns the Peer beans of the peers belonging to the given group
 
         :param group: The name of a group
-        :return: A list of Peer beans
+        :return: A frozen set (or tuple for the "all" group) of Peer beans
         :raise KeyError: Unknown group
         """
         if group == 'all':
             # Special group: retrieve all peers
-            return list(self._peers.values())
+            return self._snapshot.all_peers
 
-        return self._groups[group].copy()
+        return self._snapshot.groups[group]
 
     def get_peers_for_node(self, node_uid):
         """
         Returns the Peer beans of the peers associated to the given node UID
 
         :param node_uid: The UID of a node
-        :return: A list of Peer beans
+        :return: A tuple of Peer beans
         """
-        return [peer for peer in self._peers.values()
-                if peer.node_uid == node_uid]
+        return self._snapshot.nodes.get(node_uid, ())
 
     def peer_access_set(self, peer, access_id, data):
         """
@@ -408,7 +542,7 @@ class HeraldDirectory(object):
                                   ex)
 
             # Notify listeners only if the peer is already/still registered
-            if peer.uid in self._peers:
+            if peer.uid in self._snapshot.peers:
                 # Notify directory listeners
                 self.__notify_peer_updated(peer, access_id, data)
 
@@ -447,7 +581,7 @@ class HeraldDirectory(object):
 
         :return: A UID -> description dictionary
         """
-        return {peer.uid: peer.dump() for peer in self._peers.values()}
+        return {peer.uid: peer.dump() for peer in self._snapshot.all_peers}
 
     def load(self, dump):
         """
@@ -456,7 +590,7 @@ class HeraldDirectory(object):
         :param dump: The result of a call to dump()
         """
         for uid, description in dump.items():
-            if uid not in self._peers:
+            if uid not in self._snapshot.peers:
                 try:
                     # Do not reload already known peer
                     self.register(description)
@@ -484,7 +618,6 @@ class HeraldDirectory(object):
         :raise ValueError: Invalid peer UID
         """
         with self.__lock:
-            print(description)
             uid = description['uid']
             if uid == self._local.uid:
                 # Ignore local peer
@@ -503,7 +636,7 @@ class HeraldDirectory(object):
 
             try:
                 # Check if the peer is known
-                peer = self._peers[uid]
+                peer = self._snapshot.peers[uid]
                 peer_update = True
             except KeyError:
                 # Make a new bean
@@ -516,37 +649,23 @@ class HeraldDirectory(object):
                     setattr(peer, name, description[name])
 
             # In any case, parse and store (new/updated) accesses
+            # Listeners will be notified IF the peer was already stored
+            generation = description.get('generation')
             for access_id, data in description['accesses'].items():
-                try:
-                    data = self._directories[access_id].load_access(data)
-                except KeyError:
-                    # Access not available for parsing: keep a RawAccess bean
-                    data = beans.RawAccess(access_id, data)
+                peer.set_access(access_id, self.__load_access(access_id, data),
+                                generation)
 
-                # Store the parsed data: listeners will be notified IF the peer
-                # was already stored
-                peer.set_access(access_id, data)
+            if generation is not None:
+                # Description of a known generation
+                peer.reset_changes(max(generation, peer.generation))
+            elif not peer_update:
+                # Peer without generation
+                peer.reset_changes(0)
 
             if not peer_update:
                 # Store the peer after accesses have been set
                 # (avoids to notify about update before registration)
-                self._peers[uid] = peer
-
-                # Store the peer
-                self._names.setdefault(peer.name, set()).add(peer.uid)
-
-                # Set up groups
-                new_groups = set()
-                for group in peer.groups:
-                    try:
-                        # Get the group
-                        peers = self._groups[group]
-                    except KeyError:
-                        # Group must be created: notify about it
-                        peers = self._groups[group] = set()
-                        new_groups.add(group)
-
-                    peers.add(peer)
+                self._snapshot, new_groups = self._snapshot.add(peer)
 
                 # Notify about new groups
                 for group in new_groups:
@@ -557,6 +676,138 @@ class HeraldDirectory(object):
             else:
                 return beans.DelayedNotification(peer, None)
 
+    def __load_access(self, access_id, data):
+        """
+        Parses the dump of an access
+
+        :param access_id: Access ID
+        :param data: Dump of the access
+        :return: The parsed access bean, or a RawAccess bean if no transport
+                 directory can parse it
+        """
+        try:
+            return self._directories[access_id].load_access(data)
+        except KeyError:
+            # Access not available for parsing: keep a RawAccess bean
+            return beans.RawAccess(access_id, data)
+
+    def digest(self):
+        """
+        Returns the generations of the descriptions of the local peer and of
+        all known peers
+
+        :return: A UID -> generation dictionary
+        """
+        digest = {peer.uid: peer.generation
+                  for peer in self._snapshot.all_peers}
+        if self._local is not None:
+            digest[self._local.uid] = self._local.generation
+        return digest
+
+    def dump_delta(self, digest):
+        """
+        Dumps the changes made to the descriptions of the local peer and of
+        the known peers since the generations given in a remote digest.
+        Peers missing in the digest are fully dumped.
+
+        :param digest: The result of a call to digest() by another peer
+        :return: A list of deltas, in the format of Peer.dump_delta()
+        """
+        peers = self._snapshot.all_peers
+        if self._local is not None:
+            peers = peers + (self._local,)
+
+        deltas = []
+        for peer in peers:
+            since = digest.get(peer.uid)
+            if since is None:
+                deltas.append(peer.dump_delta(-1))
+            elif peer.generation > since:
+                deltas.append(peer.dump_delta(since))
+        return deltas
+
+    def load_delta(self, delta):
+        """
+        Applies the changes described by a delta to the description of a
+        peer. Unknown peers are registered if the delta is a full dump.
+
+        :param delta: The result of a call to Peer.dump_delta()
+        :return: The updated Peer bean, or None if the delta was ignored
+                 (stale or about an unknown peer)
+        :raise ValueError: Invalid peer UID
+        """
+        uid = delta['uid']
+        since = delta.get('since', 0)
+        generation = delta.get('generation', 0)
+        if uid == self._local.uid:
+            # Ignore local peer
+            return None
+
+        with self.__lock:
+            try:
+                peer = self._snapshot.peers[uid]
+            except KeyError:
+                peer = None
+            else:
+                if generation <= peer.generation:
+                    # Nothing new
+                    return None
+                elif since > peer.generation:
+                    # Previous changes are missing
+                    _logger.debug("Missing changes of peer %s before "
+                                  "generation %d", uid, since)
+                    return None
+
+                # Update the indexed fields
+                new_groups = removed_groups = ()
+                if 'name' in delta or 'groups' in delta:
+                    snapshot, emptied = self._snapshot.remove(peer)
+                    if 'name' in delta:
+                        peer.set_name(delta['name'], generation)
+                    if 'groups' in delta:
+                        peer.set_groups(delta['groups'], generation)
+                    self._snapshot, created = snapshot.add(peer)
+                    new_groups = created.difference(emptied)
+                    removed_groups = emptied.difference(created)
+
+                if 'node_name' in delta:
+                    peer.set_node_name(delta['node_name'], generation)
+
+                accesses = delta.get('accesses') or {}
+                for access_id, data in accesses.items():
+                    peer.set_access(access_id,
+                                    self.__load_access(access_id, data),
+                                    generation)
+
+                # Removed accesses
+                removed = set(delta.get('removed') or ())
+                if not since:
+                    # Full description: remove missing accesses
+                    removed.update(access_id
+                                   for access_id in peer.get_accesses()
+                                   if access_id not in accesses)
+
+                for group in new_groups:
+                    self.__notify_group_set(group)
+                for group in removed_groups:
+                    self.__notify_group_unset(group)
+
+        if peer is None:
+            if since:
+                # Not a full description
+                _logger.debug("Partial description of unknown peer %s", uid)
+                return None
+
+            return self.register(delta)
+
+        # Remove accesses without the lock, as the peer is unregistered
+        # when it has no access left
+        for access_id in removed:
+            peer.unset_access(access_id, generation)
+
+        peer.set_generation(generation)
+        return peer
+
     def unregister(self, uid):
         """
         Unregisters a peer from the directory
@@ -566,35 +817,52 @@ class HeraldDirectory(object):
         """
         with self.__lock:
             try:
-                # Pop the peer bean
-                peer = self._peers.pop(uid)
+                # Get the peer bean
+                peer = self._snapshot.peers[uid]
             except KeyError:
                 # Unknown peer
                 return
             else:
-                # Remove it from other dictionaries
+                # Remove it from all indexes
+                self._snapshot, removed_groups = self._snapshot.remove(peer)
+
+                # Notify listeners about removed groups
+                for group in removed_groups:
+                    self.__notify_group_unset(group)
+
+        # Notify listeners
+        self.__notify_peer_unregistered(peer)
+        return peer
+
+    def unregister_all(self, uids):
+        """
+        Unregisters several peers at once, e.g. when they all timed out.
+        The indexes are rebuilt only once.
+
+        :param uids: UIDs of the peers
+        :return: The list of the Peer beans which were known
+        """
+        with self.__lock:
+            snapshot = self._snapshot
+            peers = []
+            for uid in set(uids):
                 try:
-                    uids = self._names[peer.name]
-                    uids.remove(uid)
-                    if not uids:
-                        del self._names[peer.name]
+                    peers.append(snapshot.peers[uid])
                 except KeyError:
-                    # Name wasn't registered...
+                    # Unknown peer
                     pass
 
-                for group in peer.groups:
-                    try:
-                        peers = self._groups[group]
-                        peers.remove(peer)
-                        if not peers:
-                            # Remove the group and notify listeners
-                            del self._groups[group]
-                            self.__notify_group_unset(group)
+            if not peers:
+                return peers
+
+            # Remove them from all indexes
+            self._snapshot, removed_groups = snapshot.remove_all(peers)
 
-                    except KeyError:
-                        # Peer wasn't in that group
-                        pass
+            # Notify listeners about removed groups
+            for group in removed_groups:
+                self.__notify_group_unset(group)
 
         # Notify listeners
-        self.__notify_peer_unregistered(peer)
-        return peer
+        for peer in peers:
+            self.__notify_peer_unregistered(peer)
+        return peers
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Herald subject dispatch index: finds the listeners of a message subject
+without testing every listener filter
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Standard library
+import fnmatch
+import re
+import threading
+
+# ------------------------------------------------------------------------------
+
+WILDCARDS = frozenset('*?[')
+""" Characters having a special meaning in a file name pattern """
+
+# ------------------------------------------------------------------------------
+
+
+def _has_wildcard(string):
+    """
+    Checks if the given string contains a file name pattern special character
+
+    :param string: A string
+    :return: True if the string contains a wildcard
+    """
+    return not WILDCARDS.isdisjoint(string)
+
+
+class _SubjectNode(object):
+    """
+    A node of the subject trie. Nodes are never modified once published:
+    updates copy the nodes along the path of the modified pattern.
+    """
+    __slots__ = ('children', 'tail', 'patterns')
+
+    def __init__(self, children=None, tail=None, patterns=None):
+        """
+        Sets up the node
+
+        :param children: Segment -> _SubjectNode dictionary
+        :param tail: Listeners of the "<path>/*" patterns ending at this node
+        :param patterns: Tuple of (pattern, regex, listeners) for the other
+                         wildcard patterns starting at this node
+        """
+        self.children = children if children is not None else {}
+        self.tail = tail or frozenset()
+        self.patterns = patterns or ()
+
+    def copy(self):
+        """
+        Returns a shallow copy of this node
+        """
+        return _SubjectNode(self.children.copy(), self.tail, self.patterns)
+
+    def is_empty(self):
+        """
+        Checks if this node can be removed from its parent
+        """
+        return not (self.children or self.tail or self.patterns)
+
+
+class SubjectIndex(object):
+    """
+    Associates message listeners to file name patterns (case-insensitive) and
+    computes the listeners matching a subject.
+
+    Patterns without wildcard are stored in an exact-match dictionary. The
+    other ones are stored in a trie keyed on their '/'-separated literal
+    prefix: patterns like "herald/routing/*" are resolved by the trie only,
+    others are matched against the subject only if the subject shares their
+    literal prefix.
+
+    The index is read without lock: each modification publishes a new
+    snapshot, sharing the unmodified nodes with the previous one.
+    """
+    def __init__(self):
+        """
+        Sets up members
+        """
+        # Published snapshot: (exact subject -> listeners, trie root)
+        self.__snapshot = ({}, _SubjectNode())
+
+        # Pattern -> set of listeners (writers only)
+        self.__patterns = {}
+
+        # Writers lock
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Returns the number of registered patterns
+        """
+        return len(self.__patterns)
+
+    def clear(self):
+        """
+        Removes all patterns from the index
+        """
+        with self.__lock:
+            self.__patterns.clear()
+            self.__snapshot = ({}, _SubjectNode())
+
+    def add(self, pattern, listener):
+        """
+        Associates a listener to a pattern
+
+        :param pattern: A file name pattern
+        :param listener: A message listener
+        """
+        pattern = pattern.lower()
+        with self.__lock:
+            listeners = self.__patterns.get(pattern, frozenset())
+            if listener not in listeners:
+                listeners = listeners.union((listener,))
+                self.__patterns[pattern] = listeners
+                self.__publish(pattern, listeners)
+
+    def remove(self, pattern, listener):
+        """
+        Removes the association between a listener and a pattern
+
+        :param pattern: A file name pattern
+        :param listener: A message listener
+        :return: True if the association existed
+        """
+        pattern = pattern.lower()
+        with self.__lock:
+            listeners = self.__patterns.get(pattern)
+            if not listeners or listener not in listeners:
+                # Unknown association
+                return False
+
+            listeners = listeners.difference((listener,))
+            if listeners:
+                self.__patterns[pattern] = listeners
+            else:
+                del self.__patterns[pattern]
+
+            self.__publish(pattern, listeners)
+            return True
+
+    def match(self, subject):
+        """
+        Computes the set of listeners of the given subject
+
+        :param subject: A message subject
+        :return: The set of listeners whose patterns match the subject
+        """
+        exact, node = self.__snapshot
+
+        subject = subject.lower()
+        result = set(exact.get(subject, ()))
+
+        parts = subject.split('/')
+        nb_parts = len(parts)
+        depth = 0
+        while node is not None:
+            if node.tail and depth < nb_parts:
+                # "<prefix>/*" patterns: the subject goes after the prefix
+                result.update(node.tail)
+
+            for _, regex, listeners in node.patterns:
+                if regex.match(subject) is not None:
+                    result.update(listeners)
+
+            if depth == nb_parts:
+                break
+
+            node = node.children.get(parts[depth])
+            depth += 1
+
+        return result
+
+    def __publish(self, pattern, listeners):
+        """
+        Publishes a new snapshot with the new listeners of the given pattern.
+        Must be called while holding the writers lock.
+
+        :param pattern: A lower-case file name pattern
+        :param listeners: The new set of listeners of the pattern (can be empty)
+        """
+        exact, root = self.__snapshot
+
+        if not _has_wildcard(pattern):
+            # Exact-match fast path
+            exact = exact.copy()
+            if listeners:
+                exact[pattern] = listeners
+            else:
+                exact.pop(pattern, None)
+
+            self.__snapshot = (exact, root)
+            return
+
+        # Split the literal prefix of the pattern
+        segments = pattern.split('/')
+        prefix = []
+        for segment in segments:
+            if _has_wildcard(segment):
+                break
+            prefix.append(segment)
+
+        is_tail = len(prefix) == len(segments) - 1 and segments[-1] == '*'
+
+        # Copy the nodes along the path
+        path = [root.copy()]
+        for segment in prefix:
+            child = path[-1].children.get(segment)
+            child = child.copy() if child is not None else _SubjectNode()
+            path[-1].children[segment] = child
+            path.append(child)
+
+        # Update the last node
+        node = path[-1]
+        if is_tail:
+            node.tail = listeners
+        else:
+            patterns = tuple(entry for entry in node.patterns
+                             if entry[0] != pattern)
+            if listeners:
+                regex = re.compile(fnmatch.translate(pattern), re.IGNORECASE)
+                patterns += ((pattern, regex, listeners),)
+            node.patterns = patterns
+
+        # Clean up empty nodes, bottom-up
+        for depth in range(len(prefix), 0, -1):
+            if path[depth].is_empty():
+                del path[depth - 1].children[prefix[depth - 1]]
+            else:
+                break
+
+        self.__snapshot = (exact, path[0])
@@ -106,6 +106,43 @@ class NoListener(HeraldException):
         self.subject = subject
 
 
+class Overloaded(HeraldException):
+    """
+    The message has been received by the remote peer, but has been rejected
+    as its notification queues are full.
+    """
+    def __init__(self, target, uid, subject):
+        """
+        Sets up the exception
+
+        :param target: Overloaded target peer
+        :param uid: Original message UID
+        :param subject: Subject of the original message
+        """
+        super(Overloaded, self).__init__(
+            target, "Peer overloaded: {0} ({1}) rejected".format(uid, subject))
+        self.uid = uid
+        self.subject = subject
+
+
+class StreamAborted(HeraldException):
+    """
+    A stream has been aborted, by the local or the remote peer
+    """
+    def __init__(self, target, uid, reason):
+        """
+        Sets up the exception
+
+        :param target: Peer on the other side of the stream
+        :param uid: UID of the stream
+        :param reason: Description of the reason of the abort
+        """
+        super(StreamAborted, self).__init__(
+            target, "Stream {0} aborted: {1}".format(uid, reason))
+        self.uid = uid
+        self.reason = reason
+
+
 class ForgotMessage(HeraldException):
     """
     Exception given to callback methods waiting for a message that has been
@@ -0,0 +1,455 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Herald notification executor: calls message listeners in thread pools
+("lanes") selected by subject prefix, with bounded queues and a back-pressure
+policy.
+
+A lane spec is a dictionary with the following entries:
+
+* ``name``: Name of the lane (used in thread names and statistics)
+* ``prefixes``: Subject prefixes handled by the lane (the longest matching
+  prefix wins). The lane without prefix handles the other subjects.
+* ``max_threads``, ``min_threads``: Bounds of the number of workers. Workers
+  are started when all of them are busy, and stop after ``idle_timeout``
+  seconds without work.
+* ``queue_size``: Maximum number of pending notifications (0 for no limit)
+* ``policy``: What to do when the queue is full: ``block`` the caller (at
+  most ``block_timeout`` seconds), ``drop-oldest`` pending notification, or
+  reject the message (``overloaded``): the Herald core then replies with a
+  ``herald/error/overloaded`` message.
+* ``per_listener``: If True, each listener gets its own queue and workers,
+  with the limits of the lane, so that a slow listener doesn't delay the
+  others
+
+The default lanes isolate the control subjects (routing and directory) from
+the application ones.
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Standard library
+import collections
+import logging
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+
+POLICY_BLOCK = "block"
+""" Block the caller until there is room in the queue """
+
+POLICY_DROP_OLDEST = "drop-oldest"
+""" Drop the oldest pending notification """
+
+POLICY_OVERLOADED = "overloaded"
+""" Reject the notification """
+
+DEFAULT_LANES = (
+    {"name": "control",
+     "prefixes": ("herald/routing/", "herald/directory/", "herald/error/"),
+     "max_threads": 2, "min_threads": 1, "queue_size": 0,
+     "policy": POLICY_BLOCK},
+    {"name": "default", "prefixes": (),
+     "max_threads": 10, "min_threads": 1, "queue_size": 10000,
+     "policy": POLICY_BLOCK},
+)
+""" Default lanes of the notification executor """
+
+# ------------------------------------------------------------------------------
+
+
+class _Lane(object):
+    """
+    A queue of notifications with its own workers
+    """
+    def __init__(self, name, max_threads=5, min_threads=1, queue_size=0,
+                 policy=POLICY_BLOCK, block_timeout=30, idle_timeout=60):
+        """
+        Sets up the lane
+
+        :param name: Name of the lane
+        :param max_threads: Maximum number of workers
+        :param min_threads: Number of workers kept when idle
+        :param queue_size: Maximum number of pending tasks (0 for no limit)
+        :param policy: Policy applied when the queue is full
+        :param block_timeout: Maximum time to block a caller (block policy)
+        :param idle_timeout: Time after which an idle worker stops
+        :raise ValueError: Invalid parameter
+        """
+        if policy not in (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_OVERLOADED):
+            raise ValueError("Unknown policy: {0}".format(policy))
+
+        self.name = name
+        self.__max_threads = max(1, int(max_threads))
+        self.__min_threads = min(max(0, int(min_threads)), self.__max_threads)
+        self.__queue_size = max(0, int(queue_size))
+        self.__policy = policy
+        self.__block_timeout = block_timeout
+        self.__idle_timeout = idle_timeout
+
+        # Pending tasks: (method, args)
+        self.__queue = collections.deque()
+
+        # Workers
+        self.__running = False
+        self.__threads = []
+        self.__nb_idle = 0
+        self.__thread_id = 0
+
+        # Statistics
+        self.__dropped = 0
+        self.__rejected = 0
+        self.__executed = 0
+
+        self.__lock = threading.Lock()
+        self.__not_empty = threading.Condition(self.__lock)
+        self.__not_full = threading.Condition(self.__lock)
+
+    def __start_thread(self):
+        """
+        Starts a worker. Must be called while holding the lock.
+        """
+        thread = threading.Thread(
+            target=self.__run,
+            name="{0}-{1}".format(self.name, self.__thread_id))
+        thread.daemon = True
+        self.__thread_id += 1
+        self.__threads.append(thread)
+        thread.start()
+
+    def start(self):
+        """
+        Starts the minimal number of workers
+        """
+        with self.__lock:
+            if self.__running:
+                return
+
+            self.__running = True
+            nb_threads = max(self.__min_threads,
+                             min(len(self.__queue), self.__max_threads))
+            for _ in range(nb_threads):
+                self.__start_thread()
+
+    def stop(self):
+        """
+        Stops the workers and forgets about pending tasks
+        """
+        with self.__lock:
+            self.__running = False
+            self.__queue.clear()
+            threads = self.__threads[:]
+            self.__not_empty.notify_all()
+            self.__not_full.notify_all()
+
+        current = threading.current_thread()
+        for thread in threads:
+            if thread is not current:
+                thread.join(3)
+
+    def clear(self):
+        """
+        Forgets about pending tasks
+        """
+        with self.__lock:
+            self.__queue.clear()
+            self.__not_full.notify_all()
+
+    def submit(self, method, args):
+        """
+        Queues a task
+
+        :param method: Method to call
+        :param args: Method arguments
+        :return: False if the task has been rejected
+        """
+        with self.__lock:
+            if self.__queue_size and len(self.__queue) >= self.__queue_size:
+                if self.__policy == POLICY_DROP_OLDEST:
+                    self.__queue.popleft()
+                    self.__dropped += 1
+                elif self.__policy == POLICY_BLOCK and self.__running:
+                    deadline = time.time() + self.__block_timeout
+                    while self.__running \
+                            and len(self.__queue) >= self.__queue_size:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.__not_full.wait(remaining)
+
+                    if len(self.__queue) >= self.__queue_size:
+                        self.__rejected += 1
+                        return False
+                else:
+                    self.__rejected += 1
+                    return False
+
+            self.__queue.append((method, args))
+            if not self.__running:
+                # Task will be executed once the lane is started
+                pass
+            elif self.__nb_idle == 0 \
+                    and len(self.__threads) < self.__max_threads:
+                self.__start_thread()
+            else:
+                self.__not_empty.notify()
+
+        return True
+
+    def stats(self):
+        """
+        Returns the statistics of this lane
+
+        :return: A dictionary
+        """
+        with self.__lock:
+            return {"name": self.name, "queued": len(self.__queue),
+                    "threads": len(self.__threads),
+                    "busy": len(self.__threads) - self.__nb_idle,
+                    "executed": self.__executed, "dropped": self.__dropped,
+                    "rejected": self.__rejected}
+
+    def __run(self):
+        """
+        Worker loop
+        """
+        current = threading.current_thread()
+        while True:
+            with self.__lock:
+                while self.__running and not self.__queue:
+                    start = time.time()
+                    self.__nb_idle += 1
+                    self.__not_empty.wait(self.__idle_timeout)
+                    self.__nb_idle -= 1
+
+                    if not self.__queue \
+                            and len(self.__threads) > self.__min_threads \
+                            and time.time() - start >= self.__idle_timeout:
+                        # Idle for too long
+                        self.__threads.remove(current)
+                        return
+
+                if not self.__running:
+                    self.__threads.remove(current)
+                    return
+
+                method, args = self.__queue.popleft()
+                self.__not_full.notify()
+
+            try:
+                # pylint: disable=W0703
+                method(*args)
+            except Exception as ex:
+                _logger.exception("Error notifying %s: %s", method, ex)
+
+            with self.__lock:
+                self.__executed += 1
+
+
+class NotificationExecutor(object):
+    """
+    Calls message listeners in the lane associated to the message subject
+    """
+    def __init__(self, lanes=None, name="HeraldNotify"):
+        """
+        Sets up the executor
+
+        :param lanes: Lane specs (see module documentation)
+        :param name: Prefix of the name of the lanes threads
+        :raise ValueError: Invalid lane spec
+        """
+        self.__name = name
+        self.__lock = threading.Lock()
+        self.__running = False
+
+        # List of (prefix, spec index), longest prefixes first
+        self.__prefixes = []
+
+        # Spec index -> (spec, _Lane or {key -> _Lane})
+        self.__lanes = []
+
+        # Spec index of the lane without prefix
+        self.__fallback = None
+
+        for spec in lanes or DEFAULT_LANES:
+            idx = len(self.__lanes)
+            prefixes = tuple(spec.get("prefixes", ()))
+            if spec.get("per_listener"):
+                self.__lanes.append((spec, {}))
+            else:
+                self.__lanes.append((spec, self.__make_lane(spec)))
+
+            if not prefixes:
+                self.__fallback = idx
+            for prefix in prefixes:
+                self.__prefixes.append((prefix.lower(), idx))
+
+        if self.__fallback is None:
+            # Add a default lane
+            spec = {"name": "default"}
+            self.__fallback = len(self.__lanes)
+            self.__lanes.append((spec, self.__make_lane(spec)))
+
+        self.__prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+
+    def __make_lane(self, spec, suffix=None):
+        """
+        Prepares a lane according to the given spec
+
+        :param spec: A lane spec
+        :param suffix: Suffix of the lane name
+        :return: A _Lane object
+        """
+        name = "{0}-{1}".format(self.__name, spec.get("name", "lane"))
+        if suffix:
+            name = "{0}-{1}".format(name, suffix)
+
+        return _Lane(name, spec.get("max_threads", 5),
+                     spec.get("min_threads", 1), spec.get("queue_size", 0),
+                     spec.get("policy", POLICY_BLOCK),
+                     spec.get("block_timeout", 30),
+                     spec.get("idle_timeout", 60))
+
+    def __all_lanes(self):
+        """
+        Returns the list of lanes. Must be called while holding the lock.
+        """
+        result = []
+        for _, lane in self.__lanes:
+            if isinstance(lane, dict):
+                result.extend(lane.values())
+            else:
+                result.append(lane)
+        return result
+
+    def __get_lane(self, subject, key):
+        """
+        Returns the lane associated to the given subject and key
+
+        :param subject: A message subject
+        :param key: The listener to notify
+        :return: A _Lane object
+        """
+        subject = subject.lower()
+        for prefix, idx in self.__prefixes:
+            if subject.startswith(prefix):
+                break
+        else:
+            idx = self.__fallback
+
+        spec, lane = self.__lanes[idx]
+        if not isinstance(lane, dict):
+            return lane
+
+        try:
+            return lane[key]
+        except KeyError:
+            with self.__lock:
+                sub_lane = lane.get(key)
+                if sub_lane is None:
+                    sub_lane = lane[key] = self.__make_lane(spec, len(lane))
+                    if self.__running:
+                        sub_lane.start()
+                return sub_lane
+
+    def start(self):
+        """
+        Starts the lanes
+        """
+        with self.__lock:
+            self.__running = True
+            for lane in self.__all_lanes():
+                lane.start()
+
+    def stop(self):
+        """
+        Stops the lanes and forgets about pending notifications
+        """
+        with self.__lock:
+            self.__running = False
+            lanes = self.__all_lanes()
+
+        for lane in lanes:
+            lane.stop()
+
+    def clear(self):
+        """
+        Forgets about pending notifications
+        """
+        with self.__lock:
+            lanes = self.__all_lanes()
+
+        for lane in lanes:
+            lane.clear()
+
+    def execute(self, subject, key, method, *args):
+        """
+        Calls the given method in the lane associated to the subject
+
+        :param subject: Subject of the message being notified
+        :param key: The listener being notified (used by per-listener lanes)
+        :param method: Method to call
+        :param args: Method arguments
+        :return: False if the notification has been rejected (overload)
+        """
+        return self.__get_lane(subject, key).submit(method, args)
+
+    def forget(self, key):
+        """
+        Stops the per-listener lanes of the given listener
+
+        :param key: A listener
+        """
+        lanes = []
+        with self.__lock:
+            for _, lane in self.__lanes:
+                if isinstance(lane, dict) and key in lane:
+                    lanes.append(lane.pop(key))
+
+        for lane in lanes:
+            lane.stop()
+
+    def stats(self):
+        """
+        Returns the statistics of the lanes
+
+        :return: A list of dictionaries
+        """
+        with self.__lock:
+            lanes = self.__all_lanes()
+
+        return [lane.stats() for lane in lanes]
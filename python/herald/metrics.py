@@ -0,0 +1,726 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Herald metrics: in-process counters, latency histograms and gauges, cheap
+enough to be always enabled.
+
+Metrics are grouped in families, identified by a name and a tuple of label
+names (e.g. ``herald.messages.in`` by ``transport``). Each set of label
+values is a series of the family::
+
+    messages_in = registry.counter("herald.messages.in", ("transport",))
+    messages_in.labels("http").inc()
+
+Histograms store values (in seconds) in log-linear buckets, in the manner of
+HDR histograms: memory is fixed and the relative error of the percentiles is
+below 1/16. Gauges are read by a method when the metrics are exported, and
+cost nothing until then.
+
+The number of series of a family is bounded: additional label values are
+accounted in a series with ``<other>`` labels.
+
+The ``herald-metrics`` component provides the registry as a service, the
+``herald.metrics`` and ``herald.metrics_reset`` shell commands and an HTTP
+servlet (``/herald-metrics``) exporting the metrics in JSON, or in the
+Prometheus text format (``/herald-metrics/prometheus``).
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Herald
+import herald
+
+# Pelix
+from pelix.ipopo.decorators import ComponentFactory, Provides, Property, \
+    Requires, Validate, Instantiate
+import pelix.http
+import pelix.remote
+import pelix.shell
+
+# Standard library
+import json
+import logging
+import threading
+
+# ------------------------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+
+KIND_COUNTER = "counter"
+""" A monotonic counter """
+
+KIND_HISTOGRAM = "histogram"
+""" A distribution of durations """
+
+KIND_GAUGE = "gauge"
+""" A value read when exporting the metrics """
+
+OTHER_LABEL = "<other>"
+""" Label value of the series beyond the limit of a family """
+
+PERCENTILES = (50, 90, 99, 99.9)
+""" Percentiles given in the snapshots of histograms """
+
+_SUB_BITS = 5
+""" Number of significant bits kept in the buckets of the histograms """
+
+_SUB_COUNT = 1 << _SUB_BITS
+""" Number of linear buckets of the first range """
+
+_HALF_COUNT = _SUB_COUNT >> 1
+""" Number of buckets per power of two, after the first range """
+
+_MAX_SHIFT = 32
+""" Largest power of two of the histograms (about 38 hours, in microseconds) """
+
+_NB_BUCKETS = (_MAX_SHIFT + 2) * _HALF_COUNT
+""" Number of buckets of a histogram """
+
+# ------------------------------------------------------------------------------
+
+
+def _bucket_index(value):
+    """
+    Returns the index of the bucket of a histogram holding the given value
+
+    :param value: A positive integer (microseconds)
+    :return: A bucket index
+    """
+    if value < _SUB_COUNT:
+        return value
+
+    shift = value.bit_length() - _SUB_BITS
+    if shift > _MAX_SHIFT:
+        return _NB_BUCKETS - 1
+    return shift * _HALF_COUNT + (value >> shift)
+
+
+def _bucket_value(index):
+    """
+    Returns the highest value held by the bucket at the given index
+
+    :param index: A bucket index
+    :return: A positive integer (microseconds)
+    """
+    if index < _SUB_COUNT:
+        return index
+
+    shift = index // _HALF_COUNT - 1
+    return ((index - shift * _HALF_COUNT + 1) << shift) - 1
+
+
+class Counter(object):
+    """
+    A monotonic counter
+    """
+    __slots__ = ('__lock', '__value')
+
+    def __init__(self):
+        """
+        Sets up members
+        """
+        self.__lock = threading.Lock()
+        self.__value = 0
+
+    @property
+    def value(self):
+        """
+        Current value of the counter
+        """
+        return self.__value
+
+    def inc(self, amount=1):
+        """
+        Increases the counter
+
+        :param amount: Value to add
+        """
+        with self.__lock:
+            self.__value += amount
+
+    def reset(self):
+        """
+        Resets the counter
+        """
+        with self.__lock:
+            self.__value = 0
+
+    def snapshot(self):
+        """
+        Returns the value of the counter
+        """
+        return self.__value
+
+
+class Histogram(object):
+    """
+    A distribution of durations, in log-linear buckets
+    """
+    __slots__ = ('__lock', '__counts', '__count', '__total', '__min',
+                 '__max')
+
+    def __init__(self):
+        """
+        Sets up members
+        """
+        self.__lock = threading.Lock()
+        self.__counts = [0] * _NB_BUCKETS
+        self.__count = 0
+        self.__total = 0
+        self.__min = None
+        self.__max = 0
+
+    @property
+    def count(self):
+        """
+        Number of recorded values
+        """
+        return self.__count
+
+    def record(self, duration):
+        """
+        Records a duration
+
+        :param duration: A duration, in seconds
+        """
+        value = int(duration * 1000000)
+        if value < 0:
+            value = 0
+        index = _bucket_index(value)
+
+        with self.__lock:
+            self.__counts[index] += 1
+            self.__count += 1
+            self.__total += value
+            if value > self.__max:
+                self.__max = value
+            if self.__min is None or value < self.__min:
+                self.__min = value
+
+    def reset(self):
+        """
+        Forgets the recorded values
+        """
+        with self.__lock:
+            self.__counts = [0] * _NB_BUCKETS
+            self.__count = 0
+            self.__total = 0
+            self.__min = None
+            self.__max = 0
+
+    def percentiles(self, percentiles=PERCENTILES):
+        """
+        Computes percentiles of the recorded values
+
+        :param percentiles: Sorted percentiles to compute (0 to 100)
+        :return: A list of durations, in seconds (None if empty)
+        """
+        with self.__lock:
+            counts = self.__counts[:]
+            count = self.__count
+            maximum = self.__max
+
+        if not count:
+            return [None] * len(percentiles)
+
+        results = []
+        wanted = iter(percentiles)
+        percentile = next(wanted)
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if not bucket_count:
+                continue
+
+            seen += bucket_count
+            while seen * 100. >= percentile * count:
+                results.append(min(_bucket_value(index), maximum) / 1e6)
+                try:
+                    percentile = next(wanted)
+                except StopIteration:
+                    return results
+
+        while len(results) < len(percentiles):
+            results.append(maximum / 1e6)
+        return results
+
+    def snapshot(self):
+        """
+        Returns the statistics of the recorded values
+
+        :return: A dictionary (durations are in seconds)
+        """
+        with self.__lock:
+            count = self.__count
+            total = self.__total
+            minimum = self.__min
+            maximum = self.__max
+
+        result = {"count": count, "sum": total / 1e6,
+                  "min": minimum / 1e6 if count else None,
+                  "max": maximum / 1e6 if count else None,
+                  "mean": total / 1e6 / count if count else None}
+        for percentile, value in zip(PERCENTILES,
+                                     self.percentiles(PERCENTILES)):
+            result["p{0:g}".format(percentile)] = value
+        return result
+
+
+class MetricFamily(object):
+    """
+    A set of series of the same metric, one per set of label values
+    """
+    def __init__(self, name, kind, label_names=(), description="",
+                 max_series=1000, getter=None):
+        """
+        Sets up the family
+
+        :param name: Name of the metric
+        :param kind: Kind of metric (KIND_* constants)
+        :param label_names: Names of the labels of the series
+        :param description: Description of the metric
+        :param max_series: Maximum number of series
+        :param getter: Method returning the value of a gauge: a number, or
+                       a dictionary associating tuples of label values to
+                       numbers
+        """
+        self.name = name
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self.description = description
+        self.getter = getter
+        self.__max_series = max(1, max_series)
+
+        if kind == KIND_COUNTER:
+            self.__factory = Counter
+        elif kind == KIND_HISTOGRAM:
+            self.__factory = Histogram
+        else:
+            self.__factory = None
+
+        # Label values -> series
+        self.__series = {}
+        self.__lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        Returns the series associated to the given label values
+
+        :param values: Label values, in the order of the label names
+        :return: A Counter or Histogram
+        :raise ValueError: Invalid number of labels
+        """
+        try:
+            return self.__series[values]
+        except KeyError:
+            return self.__add_series(values)
+
+    def __add_series(self, values):
+        """
+        Creates the series for the given label values
+
+        :param values: Label values
+        :return: The new series
+        :raise ValueError: Invalid number of labels or gauge family
+        """
+        if self.__factory is None:
+            raise ValueError("Gauges have no series: {0}".format(self.name))
+
+        if len(values) != len(self.label_names):
+            raise ValueError("{0} expects labels {1}, got {2}"
+                             .format(self.name, self.label_names, values))
+
+        with self.__lock:
+            series = self.__series.get(values)
+            if series is None:
+                if len(self.__series) >= self.__max_series:
+                    # Too many series: use the default one
+                    values = (OTHER_LABEL,) * len(self.label_names)
+                    series = self.__series.get(values)
+
+                if series is None:
+                    series = self.__factory()
+                    # Copy on write: labels() doesn't lock
+                    new_series = self.__series.copy()
+                    new_series[values] = series
+                    self.__series = new_series
+
+            return series
+
+    def reset(self):
+        """
+        Resets the series of the family
+        """
+        for series in self.__series.values():
+            series.reset()
+
+    def snapshot(self):
+        """
+        Returns the values of the series of the family
+
+        :return: A list of (label values, value) tuples
+        """
+        if self.getter is not None:
+            try:
+                values = self.getter()
+            except Exception as ex:
+                # pylint: disable=W0703
+                _logger.warning("Error reading gauge %s: %s", self.name, ex)
+                return []
+
+            if values is None:
+                return []
+            elif isinstance(values, dict):
+                return sorted(values.items())
+            return [((), values)]
+
+        return sorted((labels, series.snapshot())
+                      for labels, series in self.__series.items())
+
+
+class MetricsRegistry(object):
+    """
+    Registry of metric families
+    """
+    def __init__(self, max_series=1000):
+        """
+        Sets up members
+
+        :param max_series: Maximum number of series per family
+        """
+        self.max_series = max_series
+
+        # Name -> MetricFamily
+        self.__families = {}
+        self.__lock = threading.Lock()
+
+    def __get_family(self, name, kind, label_names, description, getter=None):
+        """
+        Returns the family with the given name, or creates it
+
+        :raise ValueError: A family with the same name but another kind or
+                           other labels exists
+        """
+        label_names = tuple(label_names)
+        family = self.__families.get(name)
+        if family is not None and getter is None and family.kind == kind \
+                and family.label_names == label_names:
+            # Known family
+            return family
+
+        with self.__lock:
+            family = self.__families.get(name)
+            if family is None or (getter is not None
+                                  and family.kind == KIND_GAUGE):
+                family = MetricFamily(name, kind, label_names, description,
+                                      self.max_series, getter)
+                self.__families[name] = family
+            elif family.kind != kind or family.label_names != label_names:
+                raise ValueError("Metric {0} already registered as a {1} "
+                                 "with labels {2}".format(
+                                     name, family.kind, family.label_names))
+            return family
+
+    def counter(self, name, label_names=(), description=""):
+        """
+        Returns the counter family with the given name, or creates it
+
+        :param name: Name of the metric
+        :param label_names: Names of the labels of its series
+        :param description: Description of the metric
+        :return: A MetricFamily
+        :raise ValueError: Another kind of metric has the same name
+        """
+        return self.__get_family(name, KIND_COUNTER, label_names, description)
+
+    def histogram(self, name, label_names=(), description=""):
+        """
+        Returns the histogram family with the given name, or creates it
+
+        :param name: Name of the metric
+        :param label_names: Names of the labels of its series
+        :param description: Description of the metric
+        :return: A MetricFamily
+        :raise ValueError: Another kind of metric has the same name
+        """
+        return self.__get_family(name, KIND_HISTOGRAM, label_names,
+                                 description)
+
+    def gauge(self, name, getter, label_names=(), description=""):
+        """
+        Registers a gauge, replacing the previous one with the same name
+
+        :param name: Name of the metric
+        :param getter: Method returning the value of the gauge: a number, or
+                       a dictionary associating tuples of label values to
+                       numbers
+        :param label_names: Names of the labels of its series
+        :param description: Description of the metric
+        :return: A MetricFamily
+        :raise ValueError: Another kind of metric has the same name
+        """
+        return self.__get_family(name, KIND_GAUGE, label_names, description,
+                                 getter)
+
+    def remove(self, name):
+        """
+        Removes a metric family
+
+        :param name: Name of the metric
+        :return: True if the metric was known
+        """
+        with self.__lock:
+            return self.__families.pop(name, None) is not None
+
+    def get_names(self):
+        """
+        Returns the sorted names of the metrics
+        """
+        with self.__lock:
+            return sorted(self.__families)
+
+    def reset(self):
+        """
+        Resets all the counters and histograms
+        """
+        with self.__lock:
+            families = list(self.__families.values())
+
+        for family in families:
+            family.reset()
+
+    def snapshot(self, prefix=""):
+        """
+        Returns the values of the metrics
+
+        :param prefix: Prefix of the names of the metrics to return
+        :return: A list of dictionaries, sorted by name
+        """
+        with self.__lock:
+            families = sorted(
+                (family for name, family in self.__families.items()
+                 if name.startswith(prefix)), key=lambda family: family.name)
+
+        result = []
+        for family in families:
+            result.append({
+                "name": family.name, "kind": family.kind,
+                "description": family.description,
+                "series": [{"labels": dict(zip(family.label_names, labels)),
+                            "value": value}
+                           for labels, value in family.snapshot()]})
+        return result
+
+# ------------------------------------------------------------------------------
+
+
+def _prometheus_name(name):
+    """
+    Converts a metric name to a Prometheus one
+    """
+    return "".join(char if char.isalnum() else "_" for char in name)
+
+
+def _prometheus_labels(labels, extra=None):
+    """
+    Formats Prometheus labels
+    """
+    items = sorted(labels.items())
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+
+    return "{{{0}}}".format(",".join(
+        '{0}="{1}"'.format(
+            _prometheus_name(key),
+            str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+        for key, value in items))
+
+
+def to_prometheus(snapshot):
+    """
+    Converts a snapshot of the metrics to the Prometheus text format.
+    Histograms are converted to summaries.
+
+    :param snapshot: A snapshot of a MetricsRegistry
+    :return: A string
+    """
+    lines = []
+    for metric in snapshot:
+        name = _prometheus_name(metric["name"])
+        if metric["description"]:
+            lines.append("# HELP {0} {1}".format(name, metric["description"]))
+
+        if metric["kind"] == KIND_HISTOGRAM:
+            lines.append("# TYPE {0}_seconds summary".format(name))
+            for series in metric["series"]:
+                value = series["value"]
+                for percentile in PERCENTILES:
+                    quantile = value["p{0:g}".format(percentile)]
+                    if quantile is not None:
+                        lines.append("{0}_seconds{1} {2!r}".format(
+                            name, _prometheus_labels(
+                                series["labels"],
+                                ("quantile", "{0:g}".format(
+                                    percentile / 100.))), quantile))
+
+                labels = _prometheus_labels(series["labels"])
+                lines.append("{0}_seconds_count{1} {2}".format(
+                    name, labels, value["count"]))
+                lines.append("{0}_seconds_sum{1} {2!r}".format(
+                    name, labels, value["sum"]))
+        else:
+            lines.append("# TYPE {0} {1}".format(name, metric["kind"]))
+            for series in metric["series"]:
+                lines.append("{0}{1} {2}".format(
+                    name, _prometheus_labels(series["labels"]),
+                    series["value"]))
+
+    lines.append("")
+    return "\n".join(lines)
+
+
+def _format_duration(duration):
+    """
+    Formats a duration given in seconds
+    """
+    if duration is None:
+        return "-"
+    elif duration < .001:
+        return "{0:.0f}us".format(duration * 1e6)
+    elif duration < 1:
+        return "{0:.2f}ms".format(duration * 1e3)
+    return "{0:.2f}s".format(duration)
+
+
+# ------------------------------------------------------------------------------
+
+
+@ComponentFactory("herald-metrics-factory")
+@Provides(herald.SERVICE_METRICS)
+@Provides(pelix.http.HTTP_SERVLET)
+@Provides(pelix.shell.SERVICE_SHELL_COMMAND)
+@Requires('_utils', pelix.shell.SERVICE_SHELL_UTILS, optional=True)
+@Property('_path', pelix.http.HTTP_SERVLET_PATH, "/herald-metrics")
+@Property('max_series', 'metrics.max_series', 1000)
+@Property('_reject', pelix.remote.PROP_EXPORT_REJECT,
+          [pelix.http.HTTP_SERVLET, pelix.shell.SERVICE_SHELL_COMMAND])
+@Instantiate('herald-metrics')
+class HeraldMetrics(MetricsRegistry):
+    """
+    Herald metrics service, with its shell commands and HTTP export
+    """
+    def __init__(self):
+        """
+        Sets up members
+        """
+        super(HeraldMetrics, self).__init__()
+        self._path = None
+        self._reject = None
+
+        # Shell utilities (only used by the shell commands)
+        self._utils = None
+
+    @Validate
+    def _validate(self, _):
+        """
+        Component validated
+        """
+        self.max_series = int(self.max_series)
+
+    def get_namespace(self):
+        """
+        Retrieves the name space of this command handler
+        """
+        return "herald"
+
+    def get_methods(self):
+        """
+        Retrieves the list of tuples (command, method) for this command handler
+        """
+        return [("metrics", self.print_metrics),
+                ("metrics_reset", self.reset_metrics)]
+
+    def print_metrics(self, io_handler, prefix=""):
+        """
+        Prints the metrics, optionally only those starting with a prefix
+        """
+        lines = []
+        histograms = []
+        for metric in self.snapshot(prefix):
+            for series in metric["series"]:
+                labels = ", ".join("{0}={1}".format(key, value) for key, value
+                                   in sorted(series["labels"].items()))
+                value = series["value"]
+                if metric["kind"] == KIND_HISTOGRAM:
+                    histograms.append(
+                        (metric["name"], labels, value["count"]) + tuple(
+                            _format_duration(value[key]) for key in
+                            ("mean", "p50", "p90", "p99", "p99.9", "max")))
+                else:
+                    lines.append((metric["name"], labels, value))
+
+        if lines:
+            io_handler.write(self._utils.make_table(
+                ("Metric", "Labels", "Value"), lines))
+        if histograms:
+            io_handler.write(self._utils.make_table(
+                ("Histogram", "Labels", "Count", "Mean", "P50", "P90", "P99",
+                 "P99.9", "Max"), histograms))
+        if not lines and not histograms:
+            io_handler.write_line("No metric")
+
+    def reset_metrics(self, io_handler):
+        """
+        Resets the counters and histograms
+        """
+        self.reset()
+        io_handler.write_line("Metrics reset")
+
+    def do_GET(self, request, response):
+        """
+        Exports the metrics in JSON, or in the Prometheus text format
+
+        :param request: The HTTP request bean
+        :param response: The HTTP response handler
+        """
+        # pylint: disable=C0103
+        action = request.get_path()[len(self._path) + 1:].strip('/').lower()
+        if action == "prometheus":
+            response.send_content(200, to_prometheus(self.snapshot()),
+                                  "text/plain; version=0.0.4")
+        else:
+            response.send_content(200, json.dumps(self.snapshot()),
+                                  "application/json")
@@ -45,6 +45,9 @@ class DummyProbe(object):
     """
     Skeleton of a probe service implementation
     """
+    active_channels = frozenset()
+    """ Channels to store: transports prepare data only for those """
+
     def activate(self, activate=True):
         """
         (De)Activates the probe
@@ -95,3 +98,27 @@ class DummyProbe(object):
         :param data: A dictionary of data to be stored
         """
         pass
+
+    def store_lazy(self, channel, factory):
+        """
+        Stores the data returned by the given factory in the given channel of
+        the probe. The factory is only called if the channel is active.
+
+        Called from Herald internals.
+
+        :param channel: Channel where to store data
+        :param factory: A method without argument returning the dictionary
+                        of data to be stored
+        """
+        pass
+
+    def store_batch(self, channel, data_list):
+        """
+        Stores a list of data in the given channel of the probe
+
+        Called from Herald internals.
+
+        :param channel: Channel where to store data
+        :param data_list: A list of dictionaries of data to be stored
+        """
+        pass
@@ -3,6 +3,15 @@
 """
 Core probe service
 
+Transports check if a channel is active before preparing the data to store,
+with a set lookup in the ``active_channels`` attribute of the probe::
+
+    if herald.PROBE_CHANNEL_MSG_SEND in self._probe.active_channels:
+        self._probe.store(herald.PROBE_CHANNEL_MSG_SEND, {...})
+
+or give a factory to ``store_lazy()``, called only if the channel is active
+and its filter accepts the data.
+
 :author: Thomas Calmant
 :copyright: Copyright 2014, isandlaTech
 :license: Apache License 2.0
@@ -41,15 +50,114 @@ from herald.probe import SERVICE_STORE
 
 # Pelix
 from pelix.ipopo.decorators import ComponentFactory, Requires, Provides, \
-    Property, Instantiate
+    Property, Instantiate, Validate
 import pelix.ldapfilter as ldapfilter
 
 # Standard library
 import logging
+import re
 _logger = logging.getLogger(__name__)
 
 # ------------------------------------------------------------------------------
 
+# pylint: disable=W0212
+_COMPARATOR_EQ = getattr(ldapfilter, "_comparator_eq", None)
+""" Equality comparator of Pelix LDAP filters """
+
+_COMPARATOR_STAR = getattr(ldapfilter, "_comparator_star", None)
+""" Joker comparator of Pelix LDAP filters """
+
+# ------------------------------------------------------------------------------
+
+
+def _compile_criteria(criteria):
+    """
+    Converts a parsed LDAP criteria into a predicate on dictionaries.
+    Equality and joker tests on strings, the most common in probe filters,
+    don't go through the generic comparators.
+
+    :param criteria: An LDAPCriteria
+    :return: A function accepting a dictionary and returning a boolean
+    """
+    name = criteria.name
+    value = criteria.value
+    comparator = criteria.comparator
+
+    if comparator is _COMPARATOR_EQ and isinstance(value, str):
+        def match_equal(data):
+            try:
+                tested = data[name]
+            except KeyError:
+                return False
+
+            if type(tested) is str:
+                return tested == value
+            return comparator(value, tested)
+        return match_equal
+
+    elif comparator is _COMPARATOR_STAR and isinstance(value, str) \
+            and "\\" not in value:
+        regex = re.compile(
+            ".*".join(re.escape(part) for part in value.split("*")) + r"\Z")
+
+        def match_pattern(data):
+            try:
+                tested = data[name]
+            except KeyError:
+                return False
+
+            if type(tested) is str:
+                return regex.match(tested) is not None
+            return comparator(value, tested)
+        return match_pattern
+
+    def match_criteria(data):
+        try:
+            return comparator(value, data[name])
+        except KeyError:
+            return False
+    return match_criteria
+
+
+def compile_filter(ldap_filter):
+    """
+    Converts a parsed LDAP filter into a predicate on dictionaries, made of
+    nested closures: the filter tree isn't walked on each test
+
+    :param ldap_filter: An LDAPFilter or an LDAPCriteria
+    :return: A function accepting a dictionary and returning a boolean
+    """
+    if isinstance(ldap_filter, ldapfilter.LDAPCriteria):
+        return _compile_criteria(ldap_filter)
+
+    predicates = tuple(compile_filter(subfilter)
+                       for subfilter in ldap_filter.subfilters)
+    if len(predicates) == 1:
+        predicate = predicates[0]
+        if ldap_filter.operator == ldapfilter.NOT:
+            return lambda data: not predicate(data)
+        return predicate
+
+    if ldap_filter.operator == ldapfilter.OR:
+        def match_any(data):
+            for predicate in predicates:
+                if predicate(data):
+                    return True
+            return False
+        return match_any
+
+    def match_all(data):
+        for predicate in predicates:
+            if not predicate(data):
+                return False
+        return True
+
+    if ldap_filter.operator == ldapfilter.NOT:
+        return lambda data: not match_all(data)
+    return match_all
+
+# ------------------------------------------------------------------------------
+
 
 @ComponentFactory()
 @Requires('_stores', SERVICE_STORE, aggregate=True, optional=True)
@@ -73,9 +181,28 @@ class ProbeCore(object):
         # Set of activated channels
         self._channels_enabled = set()
 
-        # LDAP filter of each channel
+        # Channels to store: empty if the probe is deactivated
+        self.active_channels = frozenset()
+
+        # Compiled LDAP filter of each channel
         self._channels_filters = {}
 
+    @Validate
+    def _validate(self, _):
+        """
+        Component validated
+        """
+        self.__update_active()
+
+    def __update_active(self):
+        """
+        Updates the set of channels to store
+        """
+        if self._activated:
+            self.active_channels = frozenset(self._channels_enabled)
+        else:
+            self.active_channels = frozenset()
+
     def __call_stores(self, method, *args, **kwargs):
         """
         Calls the registered stores, if any
@@ -104,6 +231,7 @@ class ProbeCore(object):
         :param activate: Flag to activate or deactivate the probe
         """
         self._activated = activate
+        self.__update_active()
 
     def activate_channel(self, channel, activate=True):
         """
@@ -118,6 +246,7 @@ class ProbeCore(object):
 
             # Activate channel
             self._channels_enabled.add(channel)
+            self.__update_active()
 
         else:
             try:
@@ -126,6 +255,8 @@ class ProbeCore(object):
                 # Unknown channel
                 pass
             else:
+                self.__update_active()
+
                 # Notify stores
                 self.__call_stores("deactivate_channel", channel)
 
@@ -160,8 +291,8 @@ class ProbeCore(object):
                 # No filter to remove
                 pass
         else:
-            # Store the filter
-            self._channels_filters[channel] = parsed_filter
+            # Store the compiled filter
+            self._channels_filters[channel] = compile_filter(parsed_filter)
 
     def store(self, channel, data):
         """
@@ -173,13 +304,66 @@ class ProbeCore(object):
         :param channel: Channel where to store data
         :param data: A dictionary of data to be stored
         """
-        if self._activated and channel in self._channels_enabled:
+        if channel in self.active_channels:
             try:
                 # Check filter
-                authorized = self._channels_filters[channel].matches(data)
+                authorized = self._channels_filters[channel](data)
             except KeyError:
                 # No filter
                 authorized = True
 
             if authorized:
                 self.__call_stores("store", channel, data)
+
+    def store_lazy(self, channel, factory):
+        """
+        Stores the data returned by the given factory in the given channel of
+        the probe. The factory is only called if the channel is active.
+
+        Called from Herald internals.
+
+        :param channel: Channel where to store data
+        :param factory: A method without argument returning the dictionary
+                        of data to be stored
+        """
+        if channel in self.active_channels:
+            self.store(channel, factory())
+
+    def store_batch(self, channel, data_list):
+        """
+        Stores a list of data in the given channel of the probe. The state of
+        the probe and of the channel is checked once for the whole list.
+
+        Called from Herald internals.
+
+        :param channel: Channel where to store data
+        :param data_list: A list of dictionaries of data to be stored
+        """
+        if not data_list or channel not in self.active_channels:
+            return
+
+        try:
+            # Check filter
+            ldap_filter = self._channels_filters[channel]
+        except KeyError:
+            # No filter
+            pass
+        else:
+            data_list = [data for data in data_list if ldap_filter(data)]
+            if not data_list:
+                return
+
+        stores = self._stores[:] if self._stores else []
+        for store in stores:
+            try:
+                try:
+                    store_batch = store.store_batch
+                except AttributeError:
+                    # Store without batch support
+                    for data in data_list:
+                        store.store(channel, data)
+                else:
+                    store_batch(channel, data_list)
+            except Exception as ex:
+                # Error calling store
+                _logger.exception("Error calling store: %s", ex)
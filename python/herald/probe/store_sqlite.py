@@ -3,6 +3,11 @@
 """
 Stores probe data in a sqlite database
 
+Probe events are queued in memory and written by a background thread, which
+keeps its connection open and inserts them by batches: storing an event
+doesn't wait for the disk. When the queue is full, events are dropped
+according to the ``queue.policy`` property and counted.
+
 :author: Thomas Calmant
 :copyright: Copyright 2014, isandlaTech
 :license: Apache License 2.0
@@ -42,11 +47,14 @@ from herald.probe import SERVICE_STORE
 
 # Pelix
 from pelix.ipopo.decorators import ComponentFactory, Provides, Property, \
-    Validate
+    Validate, Invalidate
 
 # Standard library
+import collections
 import logging
 import sqlite3
+import threading
+import time
 
 # ------------------------------------------------------------------------------
 
@@ -59,30 +67,66 @@ CHANNEL_FIELDS = {
                              "source", "transportSource", "repliesTo"),
     PROBE_CHANNEL_MSG_CONTENT: ("uid", "content"),
     'http_multicast': ("timestamp", "uid", "event"),
+    'http_gossip': ("timestamp", "uid", "event"),
 }
 """
 For each channel, the list of fields for which a value is given
 """
 
-CHANNEL_VALUES = dict((key, tuple(":{0}".format(field) for field in fields))
-                      for key, fields in CHANNEL_FIELDS.items())
+FAILSAFE_CHANNELS = (PROBE_CHANNEL_MSG_CONTENT,)
+""" List of channels which integrity error can be ignored """
+
+CHANNEL_INSERTS = dict(
+    (key, "INSERT {0} INTO {1}({2}) VALUES ({3})".format(
+        "OR IGNORE" if key in FAILSAFE_CHANNELS else "", key,
+        ",".join(fields), ",".join("?" * len(fields))))
+    for key, fields in CHANNEL_FIELDS.items())
 """
-For each channel, the list of ':field' parameters to give to execute, in the
-values() SQL statement
+For each channel, the SQL statement inserting a row.
+Channel names are well defined => no need to escape (for now)
 """
 
-FAILSAFE_CHANNELS = (PROBE_CHANNEL_MSG_CONTENT,)
-""" List of channels which integrity error can be ignored """
+POLICY_DROP_NEWEST = "drop-newest"
+""" Drop the new events when the queue is full """
+
+POLICY_DROP_OLDEST = "drop-oldest"
+""" Drop the oldest pending events when the queue is full """
 
 # ------------------------------------------------------------------------------
 
 
+def _to_row(fields, data):
+    """
+    Converts probe data to a row of the table of its channel. The timestamp
+    (if any) is converted from float (second-based) to integer
+    (millisecond-based).
+
+    :param fields: Fields of the channel
+    :param data: Data stored in the channel
+    :return: A tuple of values
+    """
+    row = [data.get(field) for field in fields]
+    try:
+        idx = fields.index("timestamp")
+    except ValueError:
+        # No timestamp in this channel
+        pass
+    else:
+        if row[idx] is not None:
+            row[idx] = int(row[idx] * 1000)
+    return row
+
+
 @ComponentFactory('herald-probe-sqlite-factory')
 @Provides(SERVICE_STORE)
 @Property("_db_name", "db.file", "herald_probe.db")
+@Property("_queue_size", "queue.size", 10000)
+@Property("_policy", "queue.policy", POLICY_DROP_NEWEST)
+@Property("_batch_size", "batch.size", 500)
+@Property("_flush_interval", "flush.interval", .5)
 class SqliteStore(object):
     """
-    Traces data into a logger
+    Stores probe data in a sqlite database
     """
     def __init__(self):
         """
@@ -91,101 +135,268 @@ class SqliteStore(object):
         # DB file name
         self._db_name = ":memory:"
 
+        # Queue configuration
+        self._queue_size = 10000
+        self._policy = POLICY_DROP_NEWEST
+
+        # Flush configuration
+        self._batch_size = 500
+        self._flush_interval = .5
+
+        # Pending events: (channel, data) tuples
+        self.__queue = collections.deque()
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Condition(self.__lock)
+        self.__idle = threading.Condition(self.__lock)
+
+        # Writer state
+        self.__connection = None
+        self.__thread = None
+        self.__running = False
+        self.__writing = False
+        self.__flush_requested = False
+
+        # Statistics
+        self.__written = 0
+        self.__dropped = 0
+        self.__batches = 0
+        self.__errors = 0
+        self.__reported_drops = 0
+
     @Validate
     def validate(self, _):
         """
         Component validated
         """
-        # Open the database
-        sql_con = sqlite3.connect(self._db_name)
+        self._queue_size = max(1, int(self._queue_size))
+        self._batch_size = max(1, int(self._batch_size))
+        self._flush_interval = max(.01, float(self._flush_interval))
+        if self._policy not in (POLICY_DROP_NEWEST, POLICY_DROP_OLDEST):
+            _logger.warning("Unknown probe queue policy: %s", self._policy)
+            self._policy = POLICY_DROP_NEWEST
+
+        # Open the database: the connection is kept by the writer thread
+        sql_con = sqlite3.connect(self._db_name, check_same_thread=False)
         try:
-            with sql_con:
-                # Create tables
-                sql_con.execute('''CREATE TABLE IF NOT EXISTS {0}
-                    (id integer PRIMARY KEY AUTOINCREMENT,
-                     uid text,
-                     timestamp integer,
-                     transport text,
-                     subject text,
-                     target text,
-                     transportTarget text,
-                     repliesTo text
-                    )'''.format(PROBE_CHANNEL_MSG_SEND))
+            # Readers don't block the writer, and no sync at each commit
+            sql_con.execute("PRAGMA journal_mode=WAL")
+            sql_con.execute("PRAGMA synchronous=NORMAL")
+            self.__create_tables(sql_con)
+        except:
+            sql_con.close()
+            raise
 
-                sql_con.execute('''CREATE TABLE IF NOT EXISTS {0}
-                    (id integer PRIMARY KEY AUTOINCREMENT,
-                     uid text,
-                     timestamp integer,
-                     transport text,
-                     subject text,
-                     source text,
-                     transportSource text,
-                     repliesTo text
-                    )'''.format(PROBE_CHANNEL_MSG_RECV))
+        with self.__lock:
+            self.__connection = sql_con
+            self.__running = True
 
-                sql_con.execute('''CREATE TABLE IF NOT EXISTS {0}
-                    (uid text PRIMARY KEY,
-                     content BLOB
-                    )'''.format(PROBE_CHANNEL_MSG_CONTENT))
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="Herald-Probe-SQLite")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @Invalidate
+    def invalidate(self, _):
+        """
+        Component invalidated: writes the pending events and closes the
+        database
+        """
+        with self.__lock:
+            self.__running = False
+            self.__wakeup.notify()
+
+        self.__thread.join()
+        self.__thread = None
+
+    @staticmethod
+    def __create_tables(sql_con):
+        """
+        Creates the tables of the probe channels
+
+        :param sql_con: Connection to the database
+        """
+        with sql_con:
+            # Create tables
+            sql_con.execute('''CREATE TABLE IF NOT EXISTS {0}
+                (id integer PRIMARY KEY AUTOINCREMENT,
+                 uid text,
+                 timestamp integer,
+                 transport text,
+                 subject text,
+                 target text,
+                 transportTarget text,
+                 repliesTo text
+                )'''.format(PROBE_CHANNEL_MSG_SEND))
+
+            sql_con.execute('''CREATE TABLE IF NOT EXISTS {0}
+                (id integer PRIMARY KEY AUTOINCREMENT,
+                 uid text,
+                 timestamp integer,
+                 transport text,
+                 subject text,
+                 source text,
+                 transportSource text,
+                 repliesTo text
+                )'''.format(PROBE_CHANNEL_MSG_RECV))
 
-                sql_con.execute('''CREATE TABLE IF NOT EXISTS http_multicast
+            sql_con.execute('''CREATE TABLE IF NOT EXISTS {0}
+                (uid text PRIMARY KEY,
+                 content BLOB
+                )'''.format(PROBE_CHANNEL_MSG_CONTENT))
+
+            for channel in ('http_multicast', 'http_gossip'):
+                sql_con.execute('''CREATE TABLE IF NOT EXISTS {0}
                     (id integer PRIMARY KEY AUTOINCREMENT,
                      timestamp integer,
                      uid text,
                      event text
-                    )''')
-        finally:
-            sql_con.close()
+                    )'''.format(channel))
 
-    def __convert_timestamp(self, data):
+    def store(self, channel, data):
         """
-        Converts in-place the timestamp in the given dictionary (if any) from
-        float (second-based) to integer (millisecond-based)
+        Queues data to be stored to the given channel
 
-        :param data: Data to be stored in a channel
+        :param channel: Channel where to store data
+        :param data: A dictionary of data to be stored
         """
-        try:
-            timestamp = data['timestamp']
-        except KeyError:
-            # No timestamp in data: do nothing
-            return data
-        else:
-            # Copy dictionary and set the new time stamp
-            new_data = data.copy()
-            new_data['timestamp'] = int(timestamp * 1000)
-            return new_data
+        if channel in CHANNEL_FIELDS:
+            self.__enqueue(((channel, data),))
 
-    def store(self, channel, data):
+    def store_batch(self, channel, data_list):
         """
-        Stores data to the given channel
+        Queues a list of data to be stored to the given channel
 
         :param channel: Channel where to store data
-        :param data: A dictionary of data to be stored
+        :param data_list: A list of dictionaries of data to be stored
+        """
+        if channel in CHANNEL_FIELDS and data_list:
+            self.__enqueue([(channel, data) for data in data_list])
+
+    def __enqueue(self, events):
+        """
+        Queues events, applying the drop policy if the queue is full
+
+        :param events: A list of (channel, data) tuples
+        """
+        with self.__lock:
+            queue = self.__queue
+            available = self._queue_size - len(queue)
+            if len(events) > available:
+                if self._policy == POLICY_DROP_OLDEST:
+                    if len(events) > self._queue_size:
+                        self.__dropped += len(events) - self._queue_size
+                        events = events[-self._queue_size:]
+
+                    for _ in range(len(events) - available):
+                        queue.popleft()
+                        self.__dropped += 1
+                else:
+                    self.__dropped += len(events) - max(0, available)
+                    events = events[:max(0, available)]
+
+            queue.extend(events)
+            if len(queue) >= self._batch_size and not self.__writing:
+                # Wake up the writer before the end of the flush interval
+                self.__wakeup.notify()
+
+    def flush(self, timeout=None):
+        """
+        Waits for the pending events to be written
+
+        :param timeout: Maximum time to wait (in seconds)
+        :return: True if all the events have been written
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.__lock:
+            self.__flush_requested = True
+            self.__wakeup.notify()
+            while self.__running and (self.__queue or self.__writing):
+                if deadline is None:
+                    self.__idle.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.__idle.wait(remaining)
+            return not self.__queue and not self.__writing
+
+    def stats(self):
+        """
+        Returns the statistics of the store
+
+        :return: A dictionary
+        """
+        with self.__lock:
+            return {"queued": len(self.__queue), "written": self.__written,
+                    "dropped": self.__dropped, "batches": self.__batches,
+                    "errors": self.__errors}
+
+    def __write(self, events):
+        """
+        Inserts events in the database, in a single transaction
+
+        :param events: A list of (channel, data) tuples
+        :return: The number of rows written
+        """
+        # Group rows by channel, to use one statement per channel
+        rows = {}
+        for channel, data in events:
+            rows.setdefault(channel, []).append(
+                _to_row(CHANNEL_FIELDS[channel], data))
+
+        with self.__connection:
+            for channel, channel_rows in rows.items():
+                self.__connection.executemany(CHANNEL_INSERTS[channel],
+                                              channel_rows)
+        return len(events)
+
+    def __run(self):
+        """
+        Writer loop
         """
-        sql_con = sqlite3.connect(self._db_name)
         try:
-            if channel in CHANNEL_FIELDS:
-                # Convert timestamp
-                filtered_data = self.__convert_timestamp(data)
+            while True:
+                with self.__lock:
+                    self.__writing = False
+                    if not self.__queue:
+                        self.__flush_requested = False
+                        self.__idle.notify_all()
+
+                    if self.__running and not self.__flush_requested \
+                            and len(self.__queue) < self._batch_size:
+                        self.__wakeup.wait(self._flush_interval)
+
+                    if not self.__queue:
+                        if not self.__running:
+                            break
+                        continue
 
-                # Prepare the request
-                # Channel names are well defined => no need to escape (for now)
-                sql = '''INSERT INTO {0}({1}) values ({2})''' \
-                    .format(channel, ",".join(CHANNEL_FIELDS[channel]),
-                            ",".join(CHANNEL_VALUES[channel]))
+                    nb_events = min(len(self.__queue), self._batch_size)
+                    events = [self.__queue.popleft()
+                              for _ in range(nb_events)]
+                    self.__writing = True
 
                 try:
-                    with sql_con:
-                        # Run it
-                        sql_con.execute(sql, filtered_data)
-                except sqlite3.IntegrityError as ex:
-                    # Error inserting data
-                    if channel == PROBE_CHANNEL_MSG_CONTENT:
-                        # Not a harmful error
-                        _logger.debug("Error inserting data in table %s: %s",
-                                      channel, ex)
-        except:
-            _logger.exception("Error inserting data in table %s", channel)
-            raise
+                    written = self.__write(events)
+                except sqlite3.Error as ex:
+                    _logger.error("Error writing %d probe events: %s",
+                                  len(events), ex)
+                    with self.__lock:
+                        self.__errors += 1
+                        self.__dropped += len(events)
+                else:
+                    with self.__lock:
+                        self.__written += written
+                        self.__batches += 1
+                        dropped = self.__dropped - self.__reported_drops
+                        self.__reported_drops = self.__dropped
+
+                    if dropped:
+                        _logger.warning("Probe queue full: %d events dropped",
+                                        dropped)
         finally:
-            sql_con.close()
+            with self.__lock:
+                self.__writing = False
+                self.__idle.notify_all()
+                self.__connection.close()
+                self.__connection = None
@@ -39,6 +39,28 @@ Return the next hop for a destination.
 None if there are no road to this destination.
 
 It also allows to modify metrics for nodes
+
+Implementations should provide a ``routes_generation`` attribute,
+incremented each time a next hop changes: the Herald core caches the routes
+of its messages while it doesn't change.
+
+They can also provide ``get_next_hops_to(destination)``, returning the
+(next hop, distance) tuples of the best roads to the destination, best
+first: the Herald core then spreads the messages over those next hops, and
+uses the next ones when a next hop fails.
+"""
+
+BALANCE_FLOW = "flow"
+"""
+Routed messages are spread over the next hops according to a hash of their
+final destination and of their sender: the messages of a flow follow the
+same road
+"""
+
+BALANCE_LATENCY = "latency"
+"""
+Routed messages are spread over the next hops randomly, with a weight
+inversely proportional to the distance of their road
 """
 
 ROUTING_JSON = "herald.routing.routing_json"
@@ -35,108 +35,148 @@ __docformat__ = "restructuredtext en"
 
 # ------------------------------------------------------------------------------
 
+# Herald
+from herald.beans import Message
+import herald
+import herald.exceptions
+import herald.routing_constants
+
+# Pelix
 from pelix.ipopo.decorators import ComponentFactory, Provides, \
     Validate, Invalidate, Instantiate, Property, Requires
-import herald
+
+# Standard library
+from array import array
+import heapq
 import logging
-import herald.routing_constants
+import random
 import threading
 import time
-from herald.beans import Message
-import datetime
 
 # ------------------------------------------------------------------------------
 
+SUBJECT_HELLO = 'herald/routing/hello/'
+""" Subject of the hello messages """
+
+RTT_ALPHA = .125
+""" Weight of a new sample in the smoothed round trip time (RFC 6298) """
+
+RTT_BETA = .25
+""" Weight of a new sample in the round trip time variation (RFC 6298) """
+
+NO_METRIC = -1.
+""" Metric of a neighbour which didn't answer yet """
+
 _logger = logging.getLogger(__name__)
 
 # ------------------------------------------------------------------------------
 
 
-class NeighbourInformation:
+class NeighbourTable(object):
     """
-    Class that contains informations about a known peer uid:
-
-     - it's metric (float)
-     - it's last ask (datetime)
-     - if it is a router (boolean)
+    State of the neighbours, as a structure of arrays: each neighbour has a
+    slot, which is its index in all the field arrays. The slots of removed
+    neighbours are reused.
+
+    Fields:
+
+    - metric: published metric (latency), NO_METRIC if unknown
+    - srtt: smoothed round trip time
+    - rttvar: round trip time variation
+    - sent: sending time of the pending hello
+    - due: time of the next hello (negative if not scheduled)
+    - router: 1 if the neighbour is a router, 0 if not, -1 if unknown
+    - pending: UID of the pending hello message (None if none)
     """
-
     def __init__(self):
         """
-        Init attributes
+        Sets up members
         """
-        self._data = {}
-        self._lock = threading.Lock()   # for mutex
+        self.slots = {}     # UID -> slot
+        self.uids = []      # slot -> UID (None if free)
+        self.free = []      # free slots
+        self.metric = array('d')
+        self.srtt = array('d')
+        self.rttvar = array('d')
+        self.sent = array('d')
+        self.due = array('d')
+        self.router = array('b')
+        self.pending = []
 
-    def add_uid(self, uid, metric=None, last_ask=None, router=None):
+    def __contains__(self, uid):
         """
-        adds or replace uid data in the neighbourInformation
+        Checks if the given neighbour has a slot
         """
-        self._data[uid] = {
-            'metric': metric,
-            'last_ask': last_ask,
-            'router': router
-        }
+        return uid in self.slots
 
-    def change_field(self, uid, name, value):
+    def __len__(self):
         """
-        :param uid: peer uid
-        :param name: name of the field
-        :param value: new value for name
+        Returns the number of neighbours
         """
-        with self._lock:
-            if uid not in self._data:
-                self.add_uid(uid)
-            self._data[uid][name] = value
+        return len(self.slots)
 
-    def get_field(self, uid, name):
+    def add(self, uid):
         """
-        Gets the value of the field *name* for *uid*
+        Gives a slot to a neighbour
 
-        :param uid: peer uid
-        :param name: name of the field
-        :return: value of the field
+        :param uid: UID of the neighbour
+        :return: The slot of the neighbour
         """
-        return self._data[uid][name]
+        slot = self.slots.get(uid)
+        if slot is not None:
+            return slot
 
-    def del_uid(self, uid):
-        """
-        Delete uid from neighbourInformation.
-        Does nothing if uid not existing.
-        """
-        with self._lock:
-            if self.exists(uid):
-                del self._data[uid]
+        if self.free:
+            slot = self.free.pop()
+            self.uids[slot] = uid
+        else:
+            slot = len(self.uids)
+            self.uids.append(uid)
+            self.pending.append(None)
+            for field in (self.metric, self.srtt, self.rttvar, self.sent,
+                          self.due):
+                field.append(0.)
+            self.router.append(-1)
 
-    def exists(self, uid):
-        """
-        :return: True if uid exists in information, False elsewhere
+        self.slots[uid] = slot
+        self.reset(slot)
+        self.due[slot] = -1.
+        return slot
+
+    def reset(self, slot):
         """
-        return uid in self._data
+        Forgets the measures of a neighbour
 
-    def clear(self):
+        :param slot: Slot of the neighbour
         """
-        Removes all elements in data
+        self.metric[slot] = NO_METRIC
+        self.srtt[slot] = 0.
+        self.rttvar[slot] = 0.
+        self.sent[slot] = 0.
+        self.router[slot] = -1
+        self.pending[slot] = None
+
+    def remove(self, uid):
         """
-        with self._lock:
-            self._data.clear()
+        Frees the slot of a neighbour
 
-    def neighbours_set(self, field=None):
+        :param uid: UID of the neighbour
+        :return: True if the neighbour was known
         """
-        return a set of neighbours.
-        It is possible to specify a field name
-        to extract only elements that are not None
+        slot = self.slots.pop(uid, None)
+        if slot is None:
+            return False
+
+        self.reset(slot)
+        self.uids[slot] = None
+        self.free.append(slot)
+        return True
 
-        :param field: field to get non null info
-        :return: set of neighbours uid
+    def clear(self):
+        """
+        Removes all neighbours
         """
-        if field is None:
-            return set(self._data)
-        data = set()
-        for i in self._data:
-            if self._data[i][field] is not None:
-                data.add(i)
-        return data
+        self.__init__()
 
 
 @ComponentFactory("herald-routing-hellos-factory")
@@ -148,8 +188,9 @@ class NeighbourInformation:
 @Property('_hello_delay', 'hello_delay', 5)
 @Property('_hello_timeout', 'hello_timeout', 12)
 @Property('_granularity', 'metric_granularity', .00003)
+@Property('_hysteresis', 'metric_hysteresis', .05)
 @Instantiate('herald-routing-hellos')
-class Hellos:
+class Hellos(object):
     """
     Herald Routing Hello sender Daemon
 
@@ -158,17 +199,18 @@ class Hellos:
     It tells the SendRoad daemon if there is any changes
     in the connections with neighbours.
 
-    possible improvements:
+    Each peer of the directory gets a hello every ``hello_delay`` seconds,
+    at its own offset in the period: hellos are spread over the period
+    instead of being sent at once. A new hello isn't sent while the previous
+    one is pending, unless it timed out (``hello_timeout``): the neighbour is
+    then considered not reachable. Replies are matched to the pending hello,
+    so that a late reply isn't measured against a newer hello.
 
-     - keep the current asking uid for checking if
-       the peer don't respond to an other message.
-       e.g.
-
-        - if a hello message is sent at time 0.
-        - an other hello message is sent at time 5 because the peer doesn't respond
-        - the peer responds to the first hello message at time 6.
-        - in the current implementation, the metric will be 1 (6-5) but the real
-          metric should be 6 (6-0)
+    The round trip times are smoothed (Jacobson's algorithm, see RFC 6298)
+    and the metric of a neighbour changes only when the smoothed value moves
+    away from it by more than ``metric_hysteresis`` (ratio) and than
+    ``metric_granularity`` (seconds), so that jitter doesn't make the roads
+    flap.
 
     GET_NEIGHBOURS_AVAILABLE provides :
 
@@ -178,7 +220,7 @@ class Hellos:
     - get_neighbours_routers()
     - change_metric(peer_uid, new_value)
     - set_not_reachable(neighbour)
-"""
+    """
 
     def __init__(self):
         """
@@ -189,14 +231,19 @@ class Hellos:
         self._directory = None
 
         # private objects
-        self._neighbours = None     # uid -> NeighbourInfo
-        self._lock = None           # for mutex
+        self._table = NeighbourTable()  # state of the neighbours
+        self._schedule = []         # heap: (due time, neighbour UID)
+        self._next_sync = None      # next synchronization with the directory
+        self._lock = threading.Lock()   # for mutex
+        self._event = threading.Event()     # set to stop the loop
         self._loop_thread = None    # looping thread
-        self._active = None         # True if looping thread active
+        self._active = False        # True if looping thread active
+        self._clock = getattr(time, 'monotonic', time.time)
 
         # Properties
         self._hello_timeout = None
         self._granularity = None
+        self._hysteresis = None
         self._hello_delay = None
 
     @Validate
@@ -207,10 +254,15 @@ class Hellos:
         :param context:
         :return: nothing
         """
-        self._neighbours = NeighbourInformation()
-        self._lock = threading.Lock()
+        self._hello_delay = float(self._hello_delay)
+        self._hello_timeout = float(self._hello_timeout)
+        self._granularity = float(self._granularity)
+        self._hysteresis = float(self._hysteresis)
+
         self._active = True
-        self._loop_thread = threading.Thread(target=self._loop, args=())
+        self._event.clear()
+        self._loop_thread = threading.Thread(target=self._loop,
+                                             name="Herald-Routing-Hellos")
 
         # launching daemon thread
         self._loop_thread.start()
@@ -224,45 +276,174 @@ class Hellos:
         :return: nothing
         """
         self._active = False
-        self._neighbours.clear()
+        self._event.set()
         # wait for looping thread to stop current iteration
         self._loop_thread.join()
+        self._loop_thread = None
 
-    def _extract_info_from_reply(self, peer_uid, subject):
+        with self._lock:
+            self._table.clear()
+            self._schedule = []
+            self._next_sync = None
+
+    def _loop(self):
         """
-        extract from a message content informations about peer
+        main loop of the hellos sender daemon.
+        It stops when the _active method is set to false
+        and the current iteration is over.
 
-        :param peer_uid: sender uid
-        :param subject: message subject
         :return: nothing
         """
-        info = subject.split('/')
-        router = None
-        if len(info) >= 4:
-            router = info[3]
-        if router == 'R':  # if it is a router
-            self._neighbours.change_field(peer_uid, 'router', True)
-            # _logger.info("router detected : {}".format(peer_uid))
-        else:
-            self._neighbours.change_field(peer_uid, 'router', False)
-            # _logger.info("a non router detected : {}".format(peer_uid))
+        while self._active:
+            next_tick = self.tick()
+            self._event.wait(max(next_tick - self._clock(), 0))
+
+    def tick(self, now=None):
+        """
+        Synchronizes the neighbours with the directory every hello_delay, and
+        sends the hellos which are due
+
+        :param now: Current time, given by the clock of the component
+        :return: The time of the next tick
+        """
+        if now is None:
+            now = self._clock()
+
+        if self._next_sync is None or now >= self._next_sync:
+            self._sync_directory(now)
+
+        targets = []
+        with self._lock:
+            table = self._table
+            schedule = self._schedule
+            while schedule and schedule[0][0] <= now:
+                due, uid = heapq.heappop(schedule)
+                slot = table.slots.get(uid)
+                if slot is None or table.due[slot] != due:
+                    # neighbour gone or rescheduled
+                    continue
+
+                # keep the offset of the neighbour in the period
+                due += self._hello_delay
+                if due <= now:
+                    due = now + self._hello_delay
+                table.due[slot] = due
+                heapq.heappush(schedule, (due, uid))
+
+                if table.pending[slot] is not None:
+                    if now - table.sent[slot] < self._hello_timeout:
+                        # we don't send messages if we are waiting for one
+                        continue
+
+                    # in this case, we have the timeout elapsed
+                    table.reset(slot)
+                targets.append(uid)
+
+            next_tick = self._next_sync
+            if schedule:
+                next_tick = min(next_tick, schedule[0][0])
+
+        for target in targets:
+            self._send_hello(target)
+        return next_tick
+
+    def _sync_directory(self, now):
+        """
+        Starts probing the new peers of the directory, at a random offset in
+        the period, and forgets the peers which left it
+
+        :param now: Current time
+        :return: nothing
+        """
+        peers = set(peer.uid for peer in self._directory.get_peers())
+        with self._lock:
+            table = self._table
+            for uid in [uid for uid in table.slots if uid not in peers]:
+                table.remove(uid)
+
+            for uid in peers:
+                slot = table.slots.get(uid)
+                if slot is None or table.due[slot] < 0:
+                    slot = table.add(uid)
+                    due = now + random.random() * self._hello_delay
+                    table.due[slot] = due
+                    heapq.heappush(self._schedule, (due, uid))
+
+            self._next_sync = now + self._hello_delay
+
+    def _send_hello(self, target):
+        """
+        Send a hello message to a given target
+
+        :param target: UID of the target
+        :return: nothing
+        """
+        message = Message(SUBJECT_HELLO)
+        with self._lock:
+            table = self._table
+            slot = table.slots.get(target)
+            if slot is None:
+                return
+            table.pending[slot] = message.uid
+            table.sent[slot] = self._clock()
+
+        try:
+            self._herald.fire(target, message)
+        except (KeyError, herald.exceptions.NoTransport):  # no more link
+            self.set_not_reachable(target)
 
     def herald_message(self, herald_svc, message):
         """
         An Herald reply message has been received.
         It measures delay between sending and answer receiving.
         """
-        sender_uid = message.sender
-        # if sender_uid have a last_ask existing
-        if sender_uid in self._neighbours.neighbours_set(field='last_ask'):
-            old_time = self._neighbours.get_field(sender_uid, 'last_ask')
-            delay = self._time_between(old_time)
-            # we compute the new metric for sender_uid
-            self.change_metric(sender_uid, delay)
-            # we delete the field last_ask because we have now our answer
-            self._neighbours.change_field(sender_uid, 'last_ask', None)
-            # we set the field router if it's a router
-            self._extract_info_from_reply(sender_uid, message.subject)
+        now = self._clock()
+        info = message.subject.split('/')
+        router = 1 if len(info) >= 4 and info[3] == 'R' else 0
+
+        with self._lock:
+            table = self._table
+            slot = table.slots.get(message.sender)
+            if slot is None or table.pending[slot] is None \
+                    or table.pending[slot] != message.reply_to:
+                # unknown peer, or reply to an older hello
+                return
+
+            # we have now our answer
+            table.pending[slot] = None
+            table.router[slot] = router
+            self.__add_sample(slot, now - table.sent[slot])
+
+    def __add_sample(self, slot, rtt):
+        """
+        Updates the round trip time estimation of a neighbour, and its metric
+        if the estimation moved away from it. Must be called with the lock
+        held.
+
+        :param slot: Slot of the neighbour
+        :param rtt: Measured round trip time
+        :return: nothing
+        """
+        table = self._table
+        metric = table.metric[slot]
+        if metric < 0 or metric >= self._hello_timeout \
+                or rtt >= self._hello_timeout:
+            # first measure, or link lost or back: no smoothing
+            table.srtt[slot] = rtt
+            table.rttvar[slot] = rtt / 2
+            table.metric[slot] = rtt
+            return
+
+        srtt = table.srtt[slot]
+        rttvar = (1 - RTT_BETA) * table.rttvar[slot] \
+            + RTT_BETA * abs(srtt - rtt)
+        srtt = (1 - RTT_ALPHA) * srtt + RTT_ALPHA * rtt
+        table.srtt[slot] = srtt
+        table.rttvar[slot] = rttvar
+
+        if abs(srtt - metric) > max(self._granularity,
+                                    self._hysteresis * metric):
+            table.metric[slot] = srtt
 
     def get_neighbour_metric(self, neighbour):
         """
@@ -273,15 +454,30 @@ class Hellos:
             None if there is no connection
 
         """
-        # if we know a metric for the neighbour
-        if neighbour in self._neighbours.neighbours_set(field='metric'):
-            metric = self._neighbours.get_field(neighbour, 'metric')
-            # if it is superior to the timeout
-            # return None (no link)
-            if metric >= self._hello_timeout:
+        with self._lock:
+            slot = self._table.slots.get(neighbour)
+            if slot is None:
+                return None
+            metric = self._table.metric[slot]
+
+        # no metric, or superior to the timeout: no link
+        if metric < 0 or metric >= self._hello_timeout:
+            return None
+        return metric
+
+    def get_neighbour_rtt(self, neighbour):
+        """
+        Returns the round trip time estimation of a neighbour
+
+        :param neighbour: UID of the neighbour
+        :return: A (smoothed RTT, RTT variation) tuple, None if unknown
+        """
+        with self._lock:
+            table = self._table
+            slot = table.slots.get(neighbour)
+            if slot is None or table.metric[slot] < 0:
                 return None
-            return metric
-        return None
+            return table.srtt[slot], table.rttvar[slot]
 
     def get_neighbours(self):
         """
@@ -289,107 +485,49 @@ class Hellos:
 
         :return: a set object with neighbour UID
         """
-        return self._neighbours.neighbours_set(field='metric')
+        with self._lock:
+            metric = self._table.metric
+            return set(uid for uid, slot in self._table.slots.items()
+                       if metric[slot] >= 0)
 
     def is_reachable(self, neighbour):
         """
         :param neighbour: neighbour to check
         :return: return true if neighbour is reachable, false elsewhere
         """
-        if neighbour in self._neighbours.neighbours_set(field='metric'):
-            metric = self._neighbours.get_field(neighbour, 'metric')
-            return metric is not None and metric < self._hello_timeout
-        else:
-            return False
+        return self.get_neighbour_metric(neighbour) is not None
 
     def get_neighbours_routers(self):
         """
         :return: known neighbours that are routers
         """
-        res = set()
-        for i in self._neighbours.neighbours_set(field='router'):
-            if self._neighbours.get_field(i, 'router'):
-                if self._neighbours.get_field(i, 'metric') is not None:
-                    res.add(i)
-        return res
-
-    def _send_hello(self, target, msg):
-        """
-        Send a message to a given target
-
-        :param target: target for the message
-        :param msg: message to send
-        :return: nothing
-        """
-        self._neighbours.change_field(target, 'last_ask', datetime.datetime.now())
-        try:
-            self._herald.fire(target, msg)
-        except herald.exceptions.NoTransport:  # no more link
-            self.set_not_reachable(target.uid)
+        with self._lock:
+            metric = self._table.metric
+            router = self._table.router
+            return set(uid for uid, slot in self._table.slots.items()
+                       if router[slot] == 1 and metric[slot] >= 0)
 
     def change_metric(self, peer_uid, new_value):
         """
-        change the metric of a given pair for a given value.
-        It changes the value if it's greater than _hello_timeout
-        or if the absolute difference is greater than _granularity.
+        Adds a round trip time measure to the estimation of the metric of a
+        given peer
 
         :param peer_uid: peer to set the metric
-        :param new_value: new metric value
+        :param new_value: measured round trip time
         :return: nothing
         """
-        if peer_uid in self._neighbours.neighbours_set(field='metric'):
-            old_value = self._neighbours.get_field(peer_uid, 'metric')
-            diff = abs(new_value-old_value)
-            if diff >= self._granularity or new_value >= self._hello_timeout:
-                self._neighbours.change_field(peer_uid, 'metric', new_value)
-        else:
-            self._neighbours.change_field(peer_uid, 'metric', new_value)
+        with self._lock:
+            self.__add_sample(self._table.add(peer_uid), new_value)
 
     def set_not_reachable(self, peer_uid):
         """
-        set a pair not reachable in neighbourhood.
+        set a pair not reachable in neighbourhood: forgets its metric, until
+        it answers a new hello.
 
         :param peer_uid: peer to set
         :return: nothing
         """
-        self._neighbours.del_uid(peer_uid)
-
-    @staticmethod
-    def _time_between(old_time):
-        """
-        return time in seconds between old time and now
-
-        :param old_time: time to check with now
-        :return: difference of time
-        """
-        return (datetime.datetime.now()-old_time).total_seconds()
-
-    def _loop(self):
-        """
-        main loop of the hellos sender daemon.
-        It stops when the _active method is set to false
-        and the current iteration is over.
-
-        :return: nothing
-        """
-        while self._active:
-            # send a message for each entry in the directory
-            for target in self._directory.get_peers():
-                if target.uid not in waiting_for:
-                    # we don't send messages if we are waiting for one
-                    self._send_hello(target.uid, Message('herald/routing/hello/'))
-                    # _logger.info("hello sent to {}".format(target))
-            # deleting known peers if timeout exceeded
-            waiting_for = self._neighbours.neighbours_set(field='last_ask')
-            for target in waiting_for:
-                ask_time = self._neighbours.get_field(target, 'last_ask')
-                if self._time_between(ask_time) > self._hello_timeout:
-                    # in this case, we have the timeout elapsed
-                    self.set_not_reachable(target)
-                    # _logger.info("hello sent to {}".format(target))
-            # deleting peers which are not in our directory
-            for peer in self.get_neighbours():
-                if peer not in {i.uid for i in self._directory.get_peers()}:
-                    self.set_not_reachable(peer)
-            # wait a moment
-            time.sleep(self._hello_delay)
+        with self._lock:
+            slot = self._table.slots.get(peer_uid)
+            if slot is not None:
+                self._table.reset(slot)
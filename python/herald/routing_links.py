@@ -0,0 +1,751 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Herald Routing service: link-state routing
+
+An alternative to the distance-vector routing of ``herald.routing_roads``
+(install one or the other on routers). Each router floods a link-state
+advertisement (LSA), giving the metrics of the links to its neighbours
+measured by ``herald.routing_hellos``, to the other routers. Routers keep
+the LSAs in a database describing the topology of the application, and
+compute the shortest paths to all peers with Dijkstra's algorithm.
+
+Shortest paths are only computed again when an LSA can change them: changes
+of links out of the shortest-path tree which don't shorten any path are
+ignored, and changes of the links to leaves (non-router peers) only update
+the roads to those leaves.
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Herald
+from herald.beans import Message
+import herald
+import herald.exceptions
+import herald.routing_constants
+
+# Pelix
+from pelix.ipopo.decorators import ComponentFactory, Provides, Requires, \
+    Property, Validate, Invalidate, Instantiate
+
+# Standard library
+import heapq
+import logging
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+SUBJECT_LINKS = 'herald/routing/links/'
+""" Subject of the messages carrying link-state advertisements """
+
+_logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+
+
+def parse_lsas(content):
+    """
+    Parses the content of a link-state message: a dictionary with a list of
+    (origin, sequence, links) LSAs, where links is a neighbour -> metric
+    dictionary.
+
+    :param content: Content of a link-state message
+    :return: A list of (origin, sequence, links) tuples
+    :raise ValueError: Invalid content
+    """
+    try:
+        return [(origin, int(sequence), dict(
+            (neighbour, float(metric)) for neighbour, metric in links.items()))
+            for origin, sequence, links in content['lsas']]
+    except (KeyError, TypeError, ValueError, AttributeError):
+        raise ValueError("Invalid link-state message: {0}".format(content))
+
+
+def shortest_paths(lsdb, source):
+    """
+    Computes the shortest paths from a source with Dijkstra's algorithm.
+
+    Only peers with an LSA (routers) forward messages: the other peers are
+    leaves of the tree. A link between two routers is only used if both
+    routers announce it.
+
+    :param lsdb: The link-state database: origin -> neighbour -> metric
+    :param source: UID of the source peer
+    :return: A (distance, parent, first hop) tuple of dictionaries,
+             indexed by destination
+    """
+    distance = {source: 0.}
+    parent = {}
+    first_hop = {}
+    queue = [(0., source)]
+    while queue:
+        node_distance, node = heapq.heappop(queue)
+        if node_distance > distance[node]:
+            # already reached by a shorter path
+            continue
+
+        links = lsdb.get(node)
+        if links is None:
+            # leaf
+            continue
+
+        for neighbour, metric in links.items():
+            other_links = lsdb.get(neighbour)
+            if other_links is not None and node not in other_links:
+                # one-way link
+                continue
+
+            new_distance = node_distance + metric
+            if new_distance < distance.get(neighbour, float('inf')):
+                distance[neighbour] = new_distance
+                parent[neighbour] = node
+                first_hop[neighbour] = \
+                    neighbour if node == source else first_hop[node]
+                heapq.heappush(queue, (new_distance, neighbour))
+
+    del distance[source]
+    return distance, parent, first_hop
+
+
+@ComponentFactory("herald-routing-links-factory")
+@Provides(herald.SERVICE_LISTENER)
+@Provides(herald.routing_constants.ROUTING_INFO)
+@Requires('_herald', herald.SERVICE_HERALD_INTERNAL)
+@Requires('_directory', herald.SERVICE_DIRECTORY)
+@Requires('_hellos', herald.routing_constants.GET_NEIGHBOURS_AVAILABLE)
+@Property('_filters', herald.PROP_FILTERS, ['herald/routing/links/*'])
+@Property('_link_delay', 'link_delay', 5)
+@Property('_refresh_delay', 'link_refresh_delay', 60)
+@Property('_max_age', 'link_max_age', 180)
+@Property('_flood_delay', 'link_flood_delay', .1)
+@Property('_threshold', 'link_threshold', .1)
+@Property('_multipath', 'link_multipath', 3)
+@Property('_stretch', 'link_multipath_stretch', 1.5)
+@Instantiate('herald-routing-links')
+class LinkState(object):
+    """
+    Herald Routing link-state daemon
+
+    Links to the neighbours are checked every ``link_delay`` seconds: a new
+    LSA is flooded when a neighbour appears or disappears, or when the
+    metric of a link changes by more than ``link_threshold`` (ratio). LSAs
+    are also flooded every ``link_refresh_delay`` seconds; the LSAs which
+    haven't been refreshed for ``link_max_age`` seconds are forgotten.
+    New neighbour routers receive the whole database.
+
+    The LSAs received during ``link_flood_delay`` seconds are flooded in a
+    single message per neighbour router, and the roads are then computed
+    once. LSAs received from a router aren't sent back to it.
+
+    Up to ``link_multipath`` next hops are given per destination: the best
+    one, then the neighbour routers closer to the destination than this peer
+    (loop-free alternates), if their road is at most
+    ``link_multipath_stretch`` times longer than the best one. The shortest
+    paths from the neighbour routers are computed on demand, once per change
+    of the database.
+
+    ROUTING_INFO service provides:
+
+    - change_road(next_hop, metric, destination)
+            ! should be used only if you know what you do !
+
+    - get_accessible_peers():
+    - get_next_hops()
+    - get_next_hop_to(destination)
+    - get_next_hops_to(destination)
+    - routes_generation: incremented each time a next hop changes
+    """
+    def __init__(self):
+        """
+        Sets up members
+        """
+        # Remote objects
+        self._herald = None
+        self._directory = None
+        self._hellos = None
+
+        # Properties
+        self._link_delay = None
+        self._refresh_delay = None
+        self._max_age = None
+        self._flood_delay = None
+        self._threshold = None
+        self._multipath = 1
+        self._stretch = 1.
+
+        # Private objects
+        self._active = False
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._loop_thread = None
+        self._local_uid = None
+
+        self._sequence = 0      # sequence of the local LSA
+        self._lsdb = {}         # origin -> neighbour -> metric
+        self._lsa_info = {}     # origin -> (sequence, reception time)
+        self._routers = set()   # neighbour routers
+        self._distance = {}     # destination -> distance
+        self._parent = {}       # destination -> previous peer in the path
+        self._next_hop = {}     # destination -> first hop
+        self._static = {}       # destination -> (next hop, distance)
+        self._from_routers = {}     # neighbour router -> distances from it
+        self._changes = {}      # origin -> links before the new LSAs
+        self._pending = {}      # router -> origin -> LSA to flood
+        self._stats = None      # computations of the roads
+
+        # incremented when a next hop changes (route cache of the core)
+        self.routes_generation = 0
+
+    def _clear(self):
+        """
+        Resets the link-state database and the roads
+
+        :return: nothing
+        """
+        self._sequence = 0
+        self._lsdb = {self._local_uid: {}}
+        self._lsa_info = {}
+        self._routers = set()
+        self._distance = {}
+        self._parent = {}
+        self._next_hop = {}
+        self._static = {}
+        self._from_routers = {}
+        self._changes = {}
+        self._pending = {}
+        self._stats = {"full": 0, "partial": 0, "skipped": 0}
+        self.routes_generation += 1
+
+    @Validate
+    def _validate(self, _):
+        """
+        Component validated
+        """
+        self._link_delay = float(self._link_delay)
+        self._refresh_delay = float(self._refresh_delay)
+        self._max_age = float(self._max_age)
+        self._flood_delay = float(self._flood_delay)
+        self._threshold = float(self._threshold)
+        self._multipath = int(self._multipath)
+        self._stretch = float(self._stretch)
+        self._local_uid = self._directory.local_uid
+        self._clear()
+
+        self._active = True
+        self._event.clear()
+        self._loop_thread = threading.Thread(target=self._loop,
+                                             name="Herald-Routing-Links")
+        self._loop_thread.start()
+
+    @Invalidate
+    def _invalidate(self, _):
+        """
+        Component invalidated
+        """
+        self._active = False
+        self._event.set()
+        self._loop_thread.join()
+        self._loop_thread = None
+        self._clear()
+        self._local_uid = None
+
+    def _loop(self):
+        """
+        Checks the links, floods the LSAs, refreshes the local LSA and
+        forgets the old ones
+        """
+        next_check = 0
+        next_refresh = time.time() + self._refresh_delay
+        while self._active:
+            now = time.time()
+            if now >= next_check:
+                self.check_links()
+                next_check = now + self._link_delay
+
+            if now >= next_refresh:
+                self.refresh()
+                self.expire()
+                next_refresh = now + self._refresh_delay
+
+            self.send_updates()
+
+            # wait for the next check or for new LSAs
+            delay = min(next_check, next_refresh) - time.time()
+            if self._event.wait(max(delay, 0)):
+                self._event.clear()
+                # let LSAs accumulate
+                time.sleep(self._flood_delay)
+
+    def get_stats(self):
+        """
+        Returns the number of computations of the roads: full (Dijkstra),
+        partial (leaves only) and skipped (no change)
+
+        :return: A dictionary
+        """
+        with self._lock:
+            return self._stats.copy()
+
+    def get_topology(self):
+        """
+        Returns a copy of the link-state database
+
+        :return: A origin -> neighbour -> metric dictionary
+        """
+        with self._lock:
+            return dict((origin, links.copy())
+                        for origin, links in self._lsdb.items())
+
+    def get_next_hop_to(self, destination):
+        """
+        :param destination: a given destination uid
+        :return: The next hop to the destination.
+            None if there is no known roads
+        """
+        # if it's a direct neighbour
+        if self._hellos.is_reachable(destination):
+            return destination
+
+        try:
+            return self._static[destination][0]
+        except KeyError:
+            return self._next_hop.get(destination)
+
+    def get_next_hops_to(self, destination):
+        """
+        :param destination: a given destination uid
+        :return: The next hops to the destination, with the distance of their
+            road, best first: a list of (next hop, distance) tuples. Empty
+            if there is no known roads
+        """
+        # if it's a direct neighbour
+        if self._hellos.is_reachable(destination):
+            return [(destination,
+                     self._hellos.get_neighbour_metric(destination))]
+
+        with self._lock:
+            if destination in self._static:
+                return [self._static[destination]]
+
+            best_hop = self._next_hop.get(destination)
+            if best_hop is None:
+                return []
+
+            best = self._distance[destination]
+            paths = [(best_hop, best)]
+            if self._multipath > 1:
+                limit = best * self._stretch
+                links = self._lsdb[self._local_uid]
+                roads = []
+                for router in self._routers:
+                    link = links.get(router)
+                    if router == best_hop or link is None:
+                        continue
+
+                    distances = self._from_routers.get(router)
+                    if distances is None:
+                        distances = self._from_routers[router] = \
+                            shortest_paths(self._lsdb, router)[0]
+
+                    # routers closer to the destination don't send back to us
+                    distance = 0. if router == destination \
+                        else distances.get(destination)
+                    if distance is not None and distance < best \
+                            and link + distance <= limit:
+                        roads.append((link + distance, router))
+
+                paths.extend((router, distance)
+                             for distance, router in sorted(roads))
+            return paths[:self._multipath]
+
+    def get_next_hops(self):
+        """
+        :return: A peer -> next hop dictionary, for the peers which are not
+                 direct neighbours
+        """
+        with self._lock:
+            result = dict((destination, next_hop)
+                          for destination, next_hop in self._next_hop.items()
+                          if next_hop != destination)
+            result.update((destination, road[0])
+                          for destination, road in self._static.items())
+            return result
+
+    def get_accessible_peers(self):
+        """
+        :return: A peer -> distance dictionary, for the peers which are not
+                 direct neighbours
+        """
+        with self._lock:
+            result = dict((destination, self._distance[destination])
+                          for destination, next_hop in self._next_hop.items()
+                          if next_hop != destination)
+            result.update((destination, road[1])
+                          for destination, road in self._static.items())
+            return result
+
+    def change_road(self, next_hop, metric, destination):
+        """
+        Sets a static road to destination, through next_hop, overriding the
+        computed one. If next_hop or metric is None, deletes the static road.
+
+        :param next_hop: UID of the next hop
+        :param metric: Distance to the destination
+        :param destination: UID of the destination
+        :return: nothing
+        """
+        with self._lock:
+            if not next_hop or not metric:
+                self._static.pop(destination, None)
+            else:
+                self._static[destination] = (next_hop, metric)
+            self.routes_generation += 1
+
+    def check_links(self):
+        """
+        Reads the links to the neighbours: floods a new local LSA if they
+        changed, and sends the database to new neighbour routers
+
+        :return: nothing
+        """
+        links = {}
+        for neighbour in self._hellos.get_neighbours():
+            metric = self._hellos.get_neighbour_metric(neighbour)
+            if metric is not None:
+                links[neighbour] = round(metric, 6)
+        routers = self._hellos.get_neighbours_routers().intersection(links)
+
+        with self._lock:
+            new_routers = routers.difference(self._routers)
+            self._routers = routers
+
+            if self.__links_changed(self._lsdb[self._local_uid], links):
+                self.__originate(links)
+
+            for router in new_routers:
+                pending = self._pending.setdefault(router, {})
+                for origin, (sequence, _) in self._lsa_info.items():
+                    pending[origin] = [origin, sequence, self._lsdb[origin]]
+
+    def refresh(self):
+        """
+        Floods the local LSA with a new sequence number
+
+        :return: nothing
+        """
+        with self._lock:
+            self.__originate(self._lsdb[self._local_uid])
+
+    def expire(self, now=None):
+        """
+        Forgets the LSAs which haven't been refreshed for link_max_age seconds
+
+        :param now: Current time (time.time() by default)
+        :return: nothing
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            for origin, (_, received) in list(self._lsa_info.items()):
+                if origin != self._local_uid \
+                        and now - received > self._max_age:
+                    del self._lsa_info[origin]
+                    self._changes.setdefault(origin, self._lsdb.pop(origin))
+
+        if self._changes:
+            self._event.set()
+
+    def send_updates(self):
+        """
+        Updates the roads according to the new LSAs, and floods them to the
+        neighbour routers
+
+        :return: nothing
+        """
+        with self._lock:
+            if self._changes:
+                self.__update_roads(
+                    [(origin, old, self._lsdb.get(origin))
+                     for origin, old in self._changes.items()
+                     if old is not None or origin in self._lsdb])
+                self._changes = {}
+
+                # the alternate roads can change with any link
+                self._from_routers = {}
+                if self._multipath > 1:
+                    self.routes_generation += 1
+
+            contents = dict((router, {'lsas': list(lsas.values())})
+                            for router, lsas in self._pending.items() if lsas)
+            self._pending = {}
+
+        for target, content in contents.items():
+            try:
+                self._herald.fire(target, Message(SUBJECT_LINKS, content))
+            except (KeyError, herald.exceptions.NoTransport):
+                self._hellos.set_not_reachable(target)
+
+    def __links_changed(self, old, new):
+        """
+        Checks if the links changed enough to flood a new LSA
+
+        :param old: Announced links
+        :param new: Current links
+        :return: True if a neighbour appeared or disappeared, or if a metric
+                 changed by more than the threshold
+        """
+        if set(old) != set(new):
+            return True
+
+        for neighbour, metric in new.items():
+            if abs(metric - old[neighbour]) > self._threshold * old[neighbour]:
+                return True
+        return False
+
+    def __originate(self, links):
+        """
+        Installs a new local LSA and prepares its flooding. Must be called
+        with the lock held.
+
+        :param links: Links to the neighbours
+        :return: nothing
+        """
+        self._sequence += 1
+        self.__install(self._local_uid, self._sequence, links, None)
+
+    def __install(self, origin, sequence, links, sender_uid):
+        """
+        Installs an LSA and prepares its flooding to the neighbour routers,
+        except the one which sent it. Must be called with the lock held.
+
+        :param origin: UID of the router which emitted the LSA
+        :param sequence: Sequence number of the LSA
+        :param links: Links of the origin
+        :param sender_uid: UID of the router which sent the LSA
+        :return: nothing
+        """
+        self._changes.setdefault(origin, self._lsdb.get(origin))
+        self._lsdb[origin] = links
+        self._lsa_info[origin] = (sequence, time.time())
+
+        lsa = [origin, sequence, links]
+        for router in self._routers:
+            if router != sender_uid:
+                self._pending.setdefault(router, {})[origin] = lsa
+        self._event.set()
+
+    def herald_message(self, herald_svc, message):
+        """
+        LSAs have been received: installs the new ones, to be flooded to the
+        other neighbour routers
+        """
+        try:
+            lsas = parse_lsas(message.content)
+        except ValueError as ex:
+            _logger.warning("Ignoring LSAs from %s: %s", message.sender, ex)
+            return
+
+        sender_uid = message.sender
+        if self._hellos.get_neighbour_metric(sender_uid) is None:
+            # only accept LSAs from reachable neighbours
+            return
+
+        with self._lock:
+            for origin, sequence, links in lsas:
+                if origin == self._local_uid:
+                    if sequence > self._sequence:
+                        # LSA of a previous life: flood a newer one
+                        self._sequence = sequence
+                        self.__originate(self._lsdb[self._local_uid])
+                    continue
+
+                known = self._lsa_info.get(origin)
+                if known is None or sequence > known[0]:
+                    self.__install(origin, sequence, links, sender_uid)
+                elif sequence == known[0]:
+                    # the sender already knows it
+                    pending = self._pending.get(sender_uid)
+                    if pending and pending.get(origin, [0, 0])[1] == sequence:
+                        del pending[origin]
+                else:
+                    # the sender has an older LSA: send it ours
+                    self._pending.setdefault(sender_uid, {})[origin] = \
+                        [origin, known[0], self._lsdb[origin]]
+                    self._event.set()
+
+    def __tree_changed(self, origin, neighbour, old_metric, new_metric):
+        """
+        Checks if the change of the metric of a link can modify the
+        shortest-path tree
+
+        :param origin: Origin of the link
+        :param neighbour: Other end of the link
+        :param old_metric: Previous metric of the link (None if unusable)
+        :param new_metric: New metric of the link (None if unusable)
+        :return: True if the tree must be computed again
+        """
+        if old_metric == new_metric or neighbour == self._local_uid:
+            return False
+
+        if self._parent.get(neighbour) == origin and (
+                old_metric is None or new_metric is None
+                or new_metric > old_metric):
+            # a link of the tree got longer
+            return True
+
+        if new_metric is not None:
+            if origin == self._local_uid:
+                origin_distance = 0.
+            else:
+                origin_distance = self._distance.get(origin)
+
+            if origin_distance is not None and \
+                    origin_distance + new_metric < self._distance.get(
+                        neighbour, float('inf')):
+                # shorter path
+                return True
+
+        return False
+
+    def __update_roads(self, changes):
+        """
+        Updates the roads after the installation of new LSAs. Must be called
+        with the lock held.
+
+        :param changes: A list of (origin, old links, new links) tuples;
+                        links are None if the LSA is new or has been forgotten
+        :return: nothing
+        """
+        full = False
+        leaves = set()
+        origins = set(change[0] for change in changes)
+        for origin, old, new in changes:
+            if old is None or new is None:
+                # a router appeared or disappeared
+                full = True
+                break
+
+            for neighbour in set(old).union(new):
+                old_metric = old.get(neighbour)
+                new_metric = new.get(neighbour)
+                if old_metric == new_metric:
+                    continue
+
+                other_links = self._lsdb.get(neighbour)
+                if other_links is None:
+                    # leaf: only its road can change
+                    if self.__tree_changed(origin, neighbour,
+                                           old_metric, new_metric):
+                        leaves.add(neighbour)
+                    continue
+
+                if neighbour in origins:
+                    # both ends changed: keep it simple
+                    full = True
+                    break
+
+                reverse = other_links.get(origin)
+                if reverse is None:
+                    # one-way link, unusable before and after
+                    continue
+
+                # the reverse link is usable if the origin announces it
+                old_reverse = reverse if old_metric is not None else None
+                new_reverse = reverse if new_metric is not None else None
+                if self.__tree_changed(origin, neighbour,
+                                       old_metric, new_metric) \
+                        or self.__tree_changed(neighbour, origin,
+                                               old_reverse, new_reverse):
+                    full = True
+                    break
+
+            if full:
+                break
+
+        if full:
+            self._stats["full"] += 1
+            old_next_hop = self._next_hop
+            self._distance, self._parent, self._next_hop = \
+                shortest_paths(self._lsdb, self._local_uid)
+            if self._next_hop != old_next_hop:
+                self.routes_generation += 1
+        elif leaves:
+            self._stats["partial"] += 1
+            for leaf in leaves:
+                self.__update_leaf(leaf)
+        else:
+            self._stats["skipped"] += 1
+
+    def __update_leaf(self, leaf):
+        """
+        Computes the road to a leaf, from the roads to the routers linked to
+        it. Must be called with the lock held.
+
+        :param leaf: UID of a peer without LSA
+        :return: nothing
+        """
+        best = None
+        best_parent = None
+        for origin, links in self._lsdb.items():
+            metric = links.get(leaf)
+            if metric is None:
+                continue
+
+            if origin == self._local_uid:
+                distance = metric
+            elif origin in self._distance:
+                distance = self._distance[origin] + metric
+            else:
+                # unreachable router
+                continue
+
+            if best is None or distance < best:
+                best = distance
+                best_parent = origin
+
+        old_next_hop = self._next_hop.get(leaf)
+        if best is None:
+            self._distance.pop(leaf, None)
+            self._parent.pop(leaf, None)
+            self._next_hop.pop(leaf, None)
+        else:
+            self._distance[leaf] = best
+            self._parent[leaf] = best_parent
+            if best_parent == self._local_uid:
+                self._next_hop[leaf] = leaf
+            else:
+                self._next_hop[leaf] = self._next_hop[best_parent]
+
+        if self._next_hop.get(leaf) != old_next_hop:
+            self.routes_generation += 1
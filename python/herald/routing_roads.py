@@ -37,37 +37,95 @@ __docformat__ = "restructuredtext en"
 
 from pelix.ipopo.decorators import ComponentFactory, Provides, \
     Validate, Invalidate, Instantiate, Property, Requires
+from pelix.utilities import is_string
 import herald
+import herald.exceptions
 import logging
 import herald.routing_constants
+import ast
 import threading
 import time
 from herald.beans import Message
 
 # ------------------------------------------------------------------------------
 
+SUBJECT_ROADS = 'herald/routing/roads/'
+""" Subject of the messages carrying roads """
+
 _logger = logging.getLogger(__name__)
 
 # ------------------------------------------------------------------------------
 
 
+def parse_roads(content):
+    """
+    Parses the content of a roads message.
+
+    Roads messages contain a dictionary with a sequence number ("seq"),
+    a flag indicating if the message contains the whole table of the sender
+    ("full") and the announced roads ("routes"), as a destination -> distance
+    dictionary. A None distance withdraws the road.
+
+    Older peers send their whole table as the string representation of
+    a destination -> distance dictionary.
+
+    :param content: Content of a roads message
+    :return: A (sequence, full, routes) tuple. The sequence is None for older
+             peers
+    :raise ValueError: Invalid content
+    """
+    if is_string(content):
+        # Table sent by an older peer
+        try:
+            routes = ast.literal_eval(content)
+        except (SyntaxError, ValueError) as ex:
+            raise ValueError("Invalid roads table: {0}".format(ex))
+
+        if not isinstance(routes, dict):
+            raise ValueError("Roads table is not a dictionary")
+        return None, True, routes
+
+    try:
+        return content['seq'], bool(content['full']), dict(content['routes'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Invalid roads message: {0}".format(content))
+
+
 @ComponentFactory("herald-routing-roads-factory")
 @Provides(herald.SERVICE_LISTENER)  # for getting messages of type reply
 @Provides(herald.routing_constants.ROUTING_INFO)
 @Requires('_herald', herald.SERVICE_HERALD_INTERNAL)  # for sending messages
+@Requires('_directory', herald.SERVICE_DIRECTORY)  # for the local peer UID
 @Requires('_hellos', herald.routing_constants.GET_NEIGHBOURS_AVAILABLE)
 @Property('_filters', herald.PROP_FILTERS, ['herald/routing/roads/*'])
 @Property('_road_delay', 'road_delay', 5)
+@Property('_refresh_delay', 'road_refresh_delay', 60)
+@Property('_trigger_delay', 'road_trigger_delay', .2)
+@Property('_max_metric', 'road_max_metric', 60)
+@Property('_threshold', 'road_threshold', .1)
+@Property('_multipath', 'road_multipath', 3)
+@Property('_stretch', 'road_multipath_stretch', 1.5)
 @Instantiate('herald-routing-roads')
 class Roads:
     """
-    Herald Routing Roads sender Daemon
+    Herald Routing Roads daemon (distance-vector)
+
+    It keeps the roads announced by each neighbour router and computes the
+    best next hop to each distant peer. Only the roads that changed are
+    sent to the neighbour routers (triggered updates). The roads going
+    through a router are announced to it as withdrawn (split horizon with
+    poisoned reverse). The whole table is sent to new neighbour routers and
+    every ``road_refresh_delay`` seconds, to recover from lost messages.
 
-    It's purpose is to send every period of time Roads to
-    neighbours routers. It keep in mind how to send messages to
-    a distant peer.
-    It can be used by calling the method get_next_hop(peer) to
-    get the next hop to accessing peer.
+    Links to neighbours are checked every ``road_delay`` seconds. The
+    distance of a road must change by more than ``road_threshold`` (ratio)
+    to be announced again. Roads longer than ``road_max_metric`` seconds
+    are considered unreachable, which bounds the count to infinity.
+
+    Up to ``road_multipath`` next hops are kept per destination: the best
+    one, then the neighbour routers announcing a shorter road to the
+    destination than this peer (loop-free alternates), if their road is at
+    most ``road_multipath_stretch`` times longer than the best one.
 
     ROUTING_INFO service provides:
 
@@ -77,6 +135,8 @@ class Roads:
     - get_accessible_peers():
     - get_next_hops()
     - get_next_hop_to(destination)
+    - get_next_hops_to(destination)
+    - routes_generation: incremented each time a next hop changes
     """
 
     def __init__(self):
@@ -85,17 +145,56 @@ class Roads:
         """
         # remote objects
         self._herald = None
+        self._directory = None
         self._hellos = None
 
         # private objects
         self._active = None
         self._lock = None           # for mutex
         self._loop_thread = None    # looping thread
-        self._metric = None         # destination -> time (distance announced)
-        self._next_hop = None       # destination -> neighbour (next hop)
+        self._trigger = None        # set when roads must be announced
+        self._local_uid = None
+
+        self._links = None          # neighbour -> link metric
+        self._routers = None        # neighbours routers
+        self._advertised = None     # router -> {destination -> distance}
+        self._sequences = None      # router -> last sequence received
+        self._next_hop = None       # destination -> first hop of best road
+        self._distance = None       # destination -> distance of best road
+        self._paths = None          # destination -> ((next hop, distance),)
+        self._announced = None      # destination -> (distance, next hop)
+        self._changed = None        # destinations to announce
+        self._sequence = 0          # sequence of the sent messages
+
+        # incremented when a next hop changes (route cache of the core)
+        self.routes_generation = 0
 
         # properties
         self._road_delay = None
+        self._refresh_delay = None
+        self._trigger_delay = None
+        self._max_metric = None
+        self._threshold = None
+        self._multipath = 1
+        self._stretch = 1.
+
+    def _clear(self):
+        """
+        Resets the routing state
+
+        :return: nothing
+        """
+        self._trigger = threading.Event()
+        self._links = {}
+        self._routers = set()
+        self._advertised = {}
+        self._sequences = {}
+        self._next_hop = {}
+        self._distance = {}
+        self._paths = {}
+        self._announced = {}
+        self._changed = set()
+        self.routes_generation += 1
 
     @Validate
     def validate(self, context):
@@ -106,10 +205,18 @@ class Roads:
         :return: nothing
         """
         self._lock = threading.Lock()
+        self._local_uid = self._directory.local_uid
+        self._road_delay = float(self._road_delay)
+        self._refresh_delay = float(self._refresh_delay)
+        self._trigger_delay = float(self._trigger_delay)
+        self._max_metric = float(self._max_metric)
+        self._threshold = float(self._threshold)
+        self._multipath = int(self._multipath)
+        self._stretch = float(self._stretch)
+        self._clear()
         self._active = True
-        self._metric = {}
-        self._next_hop = {}
-        self._loop_thread = threading.Thread(target=self._loop, args=())
+        self._loop_thread = threading.Thread(target=self._loop, args=(),
+                                             name="Herald-Routing-Roads")
 
         # launching daemon thread
         self._loop_thread.start()
@@ -123,24 +230,11 @@ class Roads:
         :return: nothing
         """
         self._active = False
-        self._metric.clear()
-        self._next_hop.clear()
+        self._trigger.set()
         # wait for looping thread to stop current iteration
         self._loop_thread.join()
-
-    def _delete_neighbours_from_roads(self):
-        """
-        delete all known neighbours from roads
-
-        :return: nothing
-        """
-        self._lock.acquire()
-        for i in self._hellos.get_neighbours():
-            if i in self._metric:
-                del self._metric[i]
-            if i in self._next_hop:
-                del self._next_hop[i]
-        self._lock.release()
+        self._clear()
+        self._local_uid = None
 
     def _loop(self):
         """
@@ -150,11 +244,225 @@ class Roads:
 
         :return: nothing
         """
+        next_check = 0
+        next_refresh = time.time() + self._refresh_delay
         while self._active:
-            for target in self._hellos.get_neighbours_routers():
-                self._send_roads_to(target)
-            # wait a moment
-            time.sleep(self._road_delay)
+            now = time.time()
+            if now >= next_check:
+                self.check_links()
+                next_check = now + self._road_delay
+
+            if now >= next_refresh:
+                self.send_full_tables()
+                next_refresh = now + self._refresh_delay
+            else:
+                self.send_updates()
+
+            # wait for the next check or for changes
+            delay = min(next_check, next_refresh) - time.time()
+            if self._trigger.wait(max(delay, 0)):
+                self._trigger.clear()
+                # let changes accumulate
+                time.sleep(self._trigger_delay)
+
+    def check_links(self):
+        """
+        Updates the links to the neighbours, and sends the whole table to
+        the new neighbour routers
+
+        :return: nothing
+        """
+        links = {}
+        for neighbour in self._hellos.get_neighbours():
+            metric = self._hellos.get_neighbour_metric(neighbour)
+            if metric is not None:
+                links[neighbour] = metric
+        routers = self._hellos.get_neighbours_routers().intersection(links)
+
+        with self._lock:
+            new_routers = routers.difference(self._routers)
+            self._routers = routers
+
+            affected = set()
+            for neighbour in set(self._links).difference(links):
+                # lost neighbour: forget its roads
+                del self._links[neighbour]
+                affected.add(neighbour)
+                affected.update(self._advertised.pop(neighbour, ()))
+                self._sequences.pop(neighbour, None)
+
+            for neighbour, metric in links.items():
+                if self._links.get(neighbour) != metric:
+                    self._links[neighbour] = metric
+                    affected.add(neighbour)
+                    affected.update(self._advertised.get(neighbour, ()))
+
+            for destination in affected:
+                self._compute_road(destination)
+
+        if new_routers:
+            self.send_full_tables(new_routers)
+
+    def _compute_road(self, destination):
+        """
+        Computes the best road to a destination, and its alternates, and marks
+        it to be announced if it changed. Must be called with the lock held.
+
+        :param destination: UID of a peer
+        :return: nothing
+        """
+        if destination == self._local_uid:
+            return
+
+        best = self._links.get(destination)
+        best_hop = destination if best is not None else None
+        roads = []  # (distance, router, distance from the router)
+        for router, router_roads in self._advertised.items():
+            distance = router_roads.get(destination)
+            link = self._links.get(router)
+            if distance is not None and link is not None \
+                    and router != destination:
+                roads.append((distance + link, router, distance))
+                if best is None or distance + link < best:
+                    best = distance + link
+                    best_hop = router
+
+        if best is None or best >= self._max_metric:
+            best_hop = None
+        old_hop = self._next_hop.get(destination)
+        old_paths = self._paths.get(destination)
+
+        if best_hop is None:
+            self._next_hop.pop(destination, None)
+            self._distance.pop(destination, None)
+            self._paths.pop(destination, None)
+            changed = destination in self._announced
+        else:
+            self._next_hop[destination] = best_hop
+            self._distance[destination] = best
+            paths = [(best_hop, best)]
+            if self._multipath > 1:
+                # routers closer to the destination don't send back to us
+                limit = min(best * self._stretch, self._max_metric)
+                paths.extend((router, distance)
+                             for distance, router, router_distance
+                             in sorted(roads)
+                             if router != best_hop and router_distance < best
+                             and distance <= limit)
+            self._paths[destination] = tuple(paths[:self._multipath])
+
+            announced = self._announced.get(destination)
+            changed = announced is None or announced[1] != best_hop \
+                or abs(best - announced[0]) > self._threshold * announced[0]
+
+        if best_hop != old_hop or set(hop for hop, _ in old_paths or ()) \
+                != set(hop for hop, _ in self._paths.get(destination, ())):
+            self.routes_generation += 1
+
+        if changed:
+            self._changed.add(destination)
+            self._trigger.set()
+
+    def _mark_announced(self, destinations):
+        """
+        Stores the announced state of the given roads. Must be called with
+        the lock held.
+
+        :param destinations: UIDs of peers
+        :return: nothing
+        """
+        for destination in destinations:
+            next_hop = self._next_hop.get(destination)
+            if next_hop is None:
+                self._announced.pop(destination, None)
+            else:
+                self._announced[destination] = \
+                    (self._distance[destination], next_hop)
+
+    def _make_content(self, full, roads):
+        """
+        Prepares the content of a roads message. Must be called with the lock
+        held.
+
+        :param full: True if the roads are the whole table
+        :param roads: destination -> distance dictionary
+        :return: The content of the message
+        """
+        self._sequence += 1
+        return {'seq': self._sequence, 'full': full, 'routes': roads}
+
+    def send_updates(self):
+        """
+        Sends the roads that changed since the last announce to the
+        neighbour routers
+
+        :return: nothing
+        """
+        with self._lock:
+            if not self._changed:
+                return
+
+            changed = dict((destination, self._announced.get(destination))
+                           for destination in self._changed)
+            self._changed = set()
+            self._mark_announced(changed)
+
+            contents = {}
+            for router in self._routers:
+                roads = {}
+                for destination, previous in changed.items():
+                    if destination == router:
+                        continue
+
+                    next_hop = self._next_hop.get(destination)
+                    if next_hop is not None and next_hop != router:
+                        roads[destination] = \
+                            round(self._distance[destination], 6)
+                    elif previous is not None and previous[1] != router:
+                        # withdrawn, or poisoned reverse
+                        roads[destination] = None
+                if roads:
+                    contents[router] = self._make_content(False, roads)
+
+        self._send_roads(contents)
+
+    def send_full_tables(self, routers=None):
+        """
+        Sends the whole table to the given routers
+
+        :param routers: UIDs of neighbour routers (all if None)
+        :return: nothing
+        """
+        with self._lock:
+            if routers is None:
+                # the tables contain all the changes
+                routers = self._routers
+                self._mark_announced(self._changed)
+                self._changed = set()
+
+            contents = {}
+            for router in routers:
+                # split horizon: don't send roads through the router
+                roads = dict((destination, round(
+                    self._distance[destination], 6))
+                    for destination, next_hop in self._next_hop.items()
+                    if next_hop != router and destination != router)
+                contents[router] = self._make_content(True, roads)
+
+        self._send_roads(contents)
+
+    def _send_roads(self, contents):
+        """
+        Sends roads messages
+
+        :param contents: router -> message content
+        """
+        for target, content in contents.items():
+            msg = Message(SUBJECT_ROADS, content)
+            try:
+                self._herald.fire(target, msg)
+            except (KeyError, herald.exceptions.NoTransport):
+                self._hellos.set_not_reachable(target)
 
     def get_next_hop_to(self, destination):
         """
@@ -165,11 +473,24 @@ class Roads:
         # if it's a direct neighbour
         if self._hellos.is_reachable(destination):
             return destination
-        # if it's reachable from a neighbour router
-        if destination in self._next_hop:
-            return self._next_hop[destination]
-        # if there is no known roads
-        return None
+        # if it's reachable from a neighbour router (None if there is no
+        # known roads)
+        return self._next_hop.get(destination)
+
+    def get_next_hops_to(self, destination):
+        """
+        :param destination: a given destination uid
+        :return: The next hops to the destination, with the distance of their
+            road, best first: a list of (next hop, distance) tuples. Empty
+            if there is no known roads
+        """
+        # if it's a direct neighbour
+        if self._hellos.is_reachable(destination):
+            return [(destination,
+                     self._hellos.get_neighbour_metric(destination))]
+
+        with self._lock:
+            return list(self._paths.get(destination, ()))
 
     def get_next_hops(self):
         """
@@ -178,101 +499,82 @@ class Roads:
 
         :return: returns peer -> next_hop
         """
-        self._delete_neighbours_from_roads()
-        return self._next_hop
+        with self._lock:
+            return dict((destination, next_hop)
+                        for destination, next_hop in self._next_hop.items()
+                        if next_hop != destination)
 
     def get_accessible_peers(self):
         """
         :return: a dict object peer -> delay
         """
-        self._delete_neighbours_from_roads()
-        res = {}
-        for i in self._metric:
-            if self._hellos.is_reachable(self._next_hop[i]):
-                distance = self._hellos.get_neighbour_metric(self._next_hop[i])
-                res[i] = self._metric[i] + distance
-
-        return res
-
-    def _send_roads_to(self, target):
-        """
-        Send road message to a target
-        """
-        self._delete_neighbours_from_roads()
-        roads = {}
-        for i in self._next_hop:
-            # if the receiver is not the gateway
-            if self._next_hop[i] != target:
-                # if the gateway is reachable
-                if self._hellos.is_reachable(self._next_hop[i]):
-                    next_hop = self._next_hop[i]
-                    distance = self._hellos.get_neighbour_metric(next_hop)
-                    roads[i] = self._metric[i] + distance
-        # add neighbours to message
-        for i in self._hellos.get_neighbours():
-            if i != target:
-                distance = self._hellos.get_neighbour_metric(i)
-                if i not in roads or roads[i] > distance:
-                    roads[i] = self._hellos.get_neighbour_metric(i)
-        msg = Message('herald/routing/roads/', content=str(roads))
-        try:
-            self._herald.fire(target, msg)
-        except (KeyError, herald.exceptions.NoTransport):
-            self._hellos.set_not_reachable(target)
+        with self._lock:
+            return dict((destination, self._distance[destination])
+                        for destination, next_hop in self._next_hop.items()
+                        if next_hop != destination)
 
     def change_road(self, next_hop, metric, destination):
         """
-        Change road for going to destination with next\_hop and metric
-        If next\_hop or metric is None, delete the road.
+        Change road for going to destination with next_hop and metric
+        (distance from next_hop to destination).
+        If next_hop or metric is None, delete the roads to destination.
 
         :param: next_hop:
         :param: metric:
         :param: destination:
         :return: nothing
         """
-        self._lock.acquire()
-        # if delete operation
-        if not next_hop or not metric:
-            if destination in self._next_hop:
-                del self._next_hop[destination]
-            if destination in self._metric:
-                del self._metric[destination]
-            # _logger.info("Deleting road to %s", destination)
-        else:
-            self._next_hop[destination] = next_hop
-            self._metric[destination] = metric
-        self._lock.release()
+        with self._lock:
+            # if delete operation
+            if not next_hop or not metric:
+                for roads in self._advertised.values():
+                    roads.pop(destination, None)
+            else:
+                self._advertised.setdefault(next_hop, {})[destination] = \
+                    metric
+            self._compute_road(destination)
 
     def herald_message(self, herald_svc, message):
         """
-        An Herald reply message has been received.
-        It measures delay between sending and answer receiving.
+        Roads have been received from a neighbour router: updates the
+        roads to the announced destinations
         """
-        self._lock.acquire()
-        # _logger.info("-"*10 + " RECEIVE")
-        info = eval(message.content)
-        # _logger.info(info)
-        sender_uid = message.sender
-        # forget all roads from sender_uid
-        next_hop = {}  # a new self._next_hop
-        metric = {}  # a new self._metric
-        for i in self._next_hop:
-            if self._next_hop[i] != sender_uid:
-                next_hop[i] = self._next_hop[i]
-                metric[i] = self._metric[i]
-        # add all new roads from sender_uid
-        # only if neighbour is reachable
-        if self._hellos.is_reachable(sender_uid):
-            for i in info:
-                if i not in self._hellos.get_neighbours():
-                    if i not in next_hop:  # if there is no info about this road
-                        next_hop[i] = sender_uid
-                        metric[i] = info[i]
-                    elif metric[i] > info[i]:  # if we get a better metric
-                        next_hop[i] = sender_uid
-                        metric[i] = info[i]
-
-        self._next_hop = next_hop
-        self._metric = metric
-        self._lock.release()
+        try:
+            sequence, full, roads = parse_roads(message.content)
+        except ValueError as ex:
+            _logger.warning("Ignoring roads from %s: %s", message.sender, ex)
+            return
 
+        sender_uid = message.sender
+        with self._lock:
+            if sender_uid not in self._links:
+                # only accept roads from reachable neighbours
+                metric = self._hellos.get_neighbour_metric(sender_uid)
+                if metric is None:
+                    return
+                self._links[sender_uid] = metric
+                self._compute_road(sender_uid)
+
+            if sequence is not None:
+                last = self._sequences.get(sender_uid)
+                if not full and last is not None and sequence <= last:
+                    # older than the roads we know
+                    return
+                self._sequences[sender_uid] = sequence
+
+            advertised = self._advertised.setdefault(sender_uid, {})
+            if full:
+                affected = set(advertised)
+                advertised.clear()
+            else:
+                affected = set()
+
+            for destination, distance in roads.items():
+                if distance is None or distance >= self._max_metric:
+                    advertised.pop(destination, None)
+                else:
+                    advertised[destination] = float(distance)
+                affected.add(destination)
+
+            for destination in affected:
+                self._compute_road(destination)
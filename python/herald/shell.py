@@ -82,6 +82,7 @@ class HeraldCommands(object):
                 ("post", self.post),
                 ("post_group", self.post_group),
                 ("forget", self.forget),
+                ("dedup", self.dedup_stats),
                 ("peers", self.list_peers),
                 ("local", self.local_peer), ]
 
@@ -205,6 +206,19 @@ class HeraldCommands(object):
         else:
             io_handler.write_line("Herald wasn't aware of {0}", uid)
 
+    def dedup_stats(self, io_handler):
+        """
+        Prints the statistics of the duplicated messages filter
+        """
+        stats = self._herald.get_dedup_stats()
+        if not stats:
+            io_handler.write_line("No statistics available")
+            return
+
+        headers = ('Statistic', 'Value')
+        lines = sorted(stats.items())
+        io_handler.write(self._utils.make_table(headers, lines))
+
     def __print_peer(self, io_handler, peer):
         """
         Prints information about the given peer
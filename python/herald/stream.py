@@ -0,0 +1,662 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Herald streams: transfer of large contents as a sequence of chunks.
+
+The sender gives an iterator of chunks, which are sent as ordinary Herald
+messages: they can be carried by any transport, and each transport request
+stays as small as a chunk. The receiver consumes the chunks as an iterator
+and acknowledges them as they are read: the sender stops sending when the
+receiver hasn't acknowledged a window of chunks. The memory used on the
+receiver side is therefore bounded by the window, whatever the size of the
+content.
+
+Messages of the protocol:
+
+* ``herald/stream/open``: sent with ``send()``, the reply tells if the stream
+  has been accepted by a stream listener and gives the window;
+* ``herald/stream/chunk``: a chunk of data, with its sequence number;
+* ``herald/stream/end``: the number of chunks in the stream;
+* ``herald/stream/ack``: the number of chunks read by the receiver;
+* ``herald/stream/abort``: the stream has been aborted by one side.
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Herald
+from herald.dispatch import SubjectIndex
+from herald.exceptions import HeraldException, HeraldTimeout, StreamAborted
+import herald
+import herald.beans as beans
+
+# Pelix
+from pelix.ipopo.decorators import ComponentFactory, Requires, Provides, \
+    Property, BindField, UnbindField, Invalidate, Instantiate
+import pelix.utilities
+
+# Standard library
+import base64
+import logging
+import threading
+import time
+import uuid
+
+# ------------------------------------------------------------------------------
+
+_PREFIX = "herald/stream"
+MSG_OPEN = "{0}/open".format(_PREFIX)
+MSG_CHUNK = "{0}/chunk".format(_PREFIX)
+MSG_END = "{0}/end".format(_PREFIX)
+MSG_ACK = "{0}/ack".format(_PREFIX)
+MSG_ABORT = "{0}/abort".format(_PREFIX)
+
+_logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+
+
+def read_chunks(fileobj, chunk_size=65536):
+    """
+    Generates the chunks of a file-like object
+
+    :param fileobj: A file-like object, opened in binary mode
+    :param chunk_size: Maximum size of a chunk
+    :return: A generator of bytes
+    """
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _encode_chunk(stream_uid, seq, chunk):
+    """
+    Prepares the content of a chunk message: binary chunks are encoded in
+    base64, text chunks are sent as is
+    """
+    if isinstance(chunk, bytes):
+        return {"stream": stream_uid, "seq": seq,
+                "data": base64.b64encode(chunk).decode("ascii")}
+    return {"stream": stream_uid, "seq": seq, "text": chunk}
+
+
+def _decode_chunk(content):
+    """
+    Reads the chunk from the content of a chunk message
+    """
+    try:
+        return base64.b64decode(content["data"])
+    except KeyError:
+        return content["text"]
+
+# ------------------------------------------------------------------------------
+
+
+class IncomingStream(object):
+    """
+    A stream being received, read by a stream listener as an iterator of
+    chunks
+    """
+    def __init__(self, uid, subject, sender, metadata, window, timeout,
+                 ack_method, abort_method):
+        """
+        Sets up the stream
+
+        :param uid: UID of the stream
+        :param subject: Subject of the stream
+        :param sender: UID of the sending peer
+        :param metadata: Metadata given by the sender
+        :param window: Maximum number of chunks received but not read
+        :param timeout: Maximum time to wait for a chunk (in seconds)
+        :param ack_method: Method called to acknowledge the chunks read:
+                           ack_method(stream, nb_chunks_read)
+        :param abort_method: Method called when the stream is aborted by the
+                             receiver: abort_method(stream, reason)
+        """
+        self.__uid = uid
+        self.__subject = subject
+        self.__sender = sender
+        self.__metadata = metadata or {}
+        self.__window = window
+        self.__timeout = timeout
+        self.__ack = ack_method
+        self.__abort = abort_method
+
+        # Sequence number -> chunk, for chunks received but not read
+        self.__chunks = {}
+        self.__read = 0
+        self.__acked = 0
+        self.__count = None
+        self.__error = None
+        self.__condition = threading.Condition()
+
+    def __str__(self):
+        """
+        String representation
+        """
+        return "Stream {0} ({1}) from {2}".format(self.__uid, self.__subject,
+                                                  self.__sender)
+
+    def __iter__(self):
+        """
+        Iterates over the chunks of the stream
+        """
+        while True:
+            chunk = self.read()
+            if chunk is None:
+                return
+            yield chunk
+
+    @property
+    def uid(self):
+        """
+        UID of the stream
+        """
+        return self.__uid
+
+    @property
+    def subject(self):
+        """
+        Subject of the stream
+        """
+        return self.__subject
+
+    @property
+    def sender(self):
+        """
+        UID of the peer sending the stream
+        """
+        return self.__sender
+
+    @property
+    def metadata(self):
+        """
+        Metadata given by the sender when opening the stream
+        """
+        return self.__metadata
+
+    @property
+    def finished(self):
+        """
+        True if all chunks have been read or if the stream has been aborted
+        """
+        with self.__condition:
+            return self.__error is not None or self.__read == self.__count
+
+    def read(self, timeout=None):
+        """
+        Reads the next chunk of the stream
+
+        :param timeout: Maximum time to wait for a chunk (stream timeout by
+                        default)
+        :return: The next chunk, or None at the end of the stream
+        :raise StreamAborted: The stream has been aborted
+        :raise HeraldTimeout: No chunk received before the timeout
+        """
+        if timeout is None:
+            timeout = self.__timeout
+
+        deadline = time.time() + timeout
+        with self.__condition:
+            while self.__read not in self.__chunks \
+                    and self.__read != self.__count \
+                    and self.__error is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.__condition.wait(remaining)
+
+            if self.__error is not None:
+                raise self.__error
+            elif self.__read == self.__count:
+                # End of stream
+                return None
+
+            try:
+                chunk = self.__chunks.pop(self.__read)
+            except KeyError:
+                timed_out = True
+            else:
+                timed_out = False
+                self.__read += 1
+                read = self.__read
+                if read == self.__count \
+                        or read - self.__acked >= max(1, self.__window // 2):
+                    self.__acked = read
+                else:
+                    read = None
+
+        if timed_out:
+            error = HeraldTimeout(beans.Target(uid=self.__sender),
+                                  "No chunk received before the timeout",
+                                  None)
+            self.abort("Timeout reading the stream", error)
+            raise error
+
+        if read is not None:
+            # Give credits to the sender
+            self.__ack(self, read)
+        return chunk
+
+    def abort(self, reason="Aborted by the receiver", error=None):
+        """
+        Aborts the stream: the sender is notified
+
+        :param reason: Description of the reason of the abort
+        :param error: Exception raised by next calls to read()
+        """
+        with self.__condition:
+            if self.__error is not None:
+                # Already aborted
+                return
+
+            self.__set_error(
+                error or StreamAborted(beans.Target(uid=self.__sender),
+                                       self.__uid, reason))
+
+        self.__abort(self, reason)
+
+    def __set_error(self, error):
+        """
+        Stores the stream error and wakes up the reader.
+        Must be called with the condition held.
+        """
+        self.__error = error
+        self.__chunks.clear()
+        self.__condition.notify_all()
+
+    def _put(self, seq, chunk):
+        """
+        Stores a received chunk
+
+        :param seq: Sequence number of the chunk
+        :param chunk: The chunk
+        :return: False if the chunk is outside of the window
+        """
+        with self.__condition:
+            if self.__error is not None or seq < self.__read:
+                # Aborted stream or chunk already received: ignore
+                return True
+            elif seq >= self.__read + self.__window:
+                # The sender didn't wait for credits
+                return False
+
+            self.__chunks[seq] = chunk
+            if seq == self.__read:
+                self.__condition.notify_all()
+            return True
+
+    def _end(self, count):
+        """
+        The sender has sent all the chunks
+
+        :param count: Number of chunks in the stream
+        """
+        with self.__condition:
+            self.__count = count
+            self.__condition.notify_all()
+
+            if self.__read == count and self.__acked < count:
+                # All chunks have been read before the end message
+                self.__acked = count
+            else:
+                return
+
+        self.__ack(self, count)
+
+    def _aborted(self, reason):
+        """
+        The stream has been aborted by the sender
+
+        :param reason: Description of the reason of the abort
+        """
+        with self.__condition:
+            if self.__error is None:
+                self.__set_error(StreamAborted(
+                    beans.Target(uid=self.__sender), self.__uid, reason))
+
+
+class _OutgoingStream(object):
+    """
+    State of a stream being sent
+    """
+    def __init__(self, uid, target):
+        """
+        Sets up the stream
+
+        :param uid: UID of the stream
+        :param target: UID of the receiving peer
+        """
+        self.uid = uid
+        self.target = target
+        self.__acked = 0
+        self.__error = None
+        self.__condition = threading.Condition()
+
+    def wait_acked(self, nb_chunks, timeout):
+        """
+        Waits for the receiver to read the given number of chunks
+
+        :param nb_chunks: Number of chunks to be read
+        :param timeout: Maximum time to wait for an acknowledgement
+        :raise StreamAborted: The receiver aborted the stream
+        :raise HeraldTimeout: No acknowledgement received before the timeout
+        """
+        with self.__condition:
+            while self.__error is None and self.__acked < nb_chunks:
+                acked = self.__acked
+                self.__condition.wait(timeout)
+                if self.__acked == acked and self.__error is None:
+                    raise HeraldTimeout(
+                        beans.Target(uid=self.target),
+                        "Stream {0}: no acknowledgement received before the "
+                        "timeout".format(self.uid), None)
+
+            if self.__error is not None:
+                raise self.__error
+
+    def acked(self, nb_chunks):
+        """
+        The receiver has read the given number of chunks
+        """
+        with self.__condition:
+            if nb_chunks > self.__acked:
+                self.__acked = nb_chunks
+                self.__condition.notify_all()
+
+    def aborted(self, reason):
+        """
+        The receiver has aborted the stream
+        """
+        with self.__condition:
+            self.__error = StreamAborted(beans.Target(uid=self.target),
+                                         self.uid, reason)
+            self.__condition.notify_all()
+
+# ------------------------------------------------------------------------------
+
+
+@ComponentFactory("herald-stream-factory")
+@Requires('_herald', herald.SERVICE_HERALD)
+@Requires('_listeners', herald.SERVICE_STREAM_LISTENER, True, True)
+@Provides((herald.SERVICE_STREAM, herald.SERVICE_LISTENER))
+@Property('_filters', herald.PROP_FILTERS, ['{0}/*'.format(_PREFIX)])
+@Property('_window', 'stream.window', 16)
+@Property('_timeout', 'stream.timeout', 30)
+@Instantiate("herald-stream")
+class HeraldStreams(object):
+    """
+    Sends and receives streams
+    """
+    def __init__(self):
+        """
+        Sets up the component
+        """
+        # Injected services
+        self._herald = None
+        self._listeners = []
+
+        # Properties
+        self._window = 16
+        self._timeout = 30
+
+        # Subject filter -> stream listeners
+        self.__stream_listeners = SubjectIndex()
+
+        # Stream UID -> IncomingStream/_OutgoingStream
+        self.__incoming = {}
+        self.__outgoing = {}
+        self.__lock = threading.Lock()
+
+    @BindField('_listeners')
+    def _bind_listener(self, _, listener, svc_ref):
+        """
+        A stream listener has been bound
+        """
+        for fn_filter in pelix.utilities.to_iterable(
+                svc_ref.get_property(herald.PROP_FILTERS), False):
+            self.__stream_listeners.add(fn_filter, listener)
+
+    @UnbindField('_listeners')
+    def _unbind_listener(self, _, listener, svc_ref):
+        """
+        A stream listener has gone away
+        """
+        for fn_filter in pelix.utilities.to_iterable(
+                svc_ref.get_property(herald.PROP_FILTERS), False):
+            self.__stream_listeners.remove(fn_filter, listener)
+
+    @Invalidate
+    def _invalidate(self, _):
+        """
+        Component invalidated: abort all streams
+        """
+        with self.__lock:
+            incoming = list(self.__incoming.values())
+            outgoing = list(self.__outgoing.values())
+            self.__incoming.clear()
+            self.__outgoing.clear()
+
+        for stream in incoming:
+            stream._aborted("Receiver stopped")
+        for stream in outgoing:
+            stream.aborted("Sender stopped")
+
+    def send_stream(self, target, subject, chunks, metadata=None,
+                    window=None, timeout=None):
+        """
+        Sends a stream of chunks to a peer. Returns once the receiver has read
+        all the chunks.
+
+        :param target: The UID of a Peer, or a Peer object
+        :param subject: Subject of the stream
+        :param chunks: An iterable of chunks (bytes or strings)
+        :param metadata: A dictionary given to the receiver with the stream
+        :param window: Maximum number of chunks sent and not yet read
+        :param timeout: Maximum time to wait for the receiver (in seconds)
+        :return: The number of chunks sent
+        :raise StreamAborted: The stream has been refused or aborted by the
+                              receiver
+        :raise HeraldTimeout: The receiver didn't read the chunks in time
+        :raise HeraldException: Error sending a message
+        """
+        if isinstance(target, beans.Peer):
+            target = target.uid
+        if window is None:
+            window = self._window
+        if timeout is None:
+            timeout = self._timeout
+
+        stream = _OutgoingStream(uuid.uuid4().hex, target)
+        with self.__lock:
+            self.__outgoing[stream.uid] = stream
+
+        done = False
+        try:
+            # Open the stream
+            reply = self._herald.send(target, beans.Message(
+                MSG_OPEN, {"stream": stream.uid, "subject": subject,
+                           "metadata": metadata or {}, "window": window}),
+                timeout)
+            if not reply.content.get("accepted"):
+                raise StreamAborted(beans.Target(uid=target), stream.uid,
+                                    reply.content.get("reason"))
+            window = max(1, min(window, reply.content.get("window", window)))
+
+            # Send the chunks, waiting for credits from the receiver
+            count = 0
+            for chunk in chunks:
+                if count >= window:
+                    stream.wait_acked(count - window + 1, timeout)
+                self._herald.fire(target, beans.Message(
+                    MSG_CHUNK, _encode_chunk(stream.uid, count, chunk)))
+                count += 1
+
+            self._herald.fire(target, beans.Message(
+                MSG_END, {"stream": stream.uid, "count": count}))
+
+            # Wait for all chunks to be read
+            stream.wait_acked(count, timeout)
+            done = True
+            return count
+        except StreamAborted:
+            # Refused or aborted by the receiver
+            done = True
+            raise
+        finally:
+            with self.__lock:
+                del self.__outgoing[stream.uid]
+
+            if not done:
+                # Error generating or sending chunks, or timeout
+                self.__send_abort(target, stream.uid, "Aborted by the sender")
+
+    def __send_abort(self, target, stream_uid, reason):
+        """
+        Notifies the other side of a stream that it has been aborted.
+        Errors are ignored (the peer might have gone away).
+        """
+        try:
+            self._herald.fire(target, beans.Message(
+                MSG_ABORT, {"stream": stream_uid, "reason": reason}))
+        except (KeyError, HeraldException) as ex:
+            _logger.debug("Error sending the abort of stream %s: %s",
+                          stream_uid, ex)
+
+    def herald_message(self, herald_svc, message):
+        """
+        Handles a stream message
+
+        :param herald_svc: The Herald service
+        :param message: A MessageReceived bean
+        """
+        subject = message.subject
+        content = message.content
+        stream_uid = content["stream"]
+        if subject == MSG_OPEN:
+            self.__open(herald_svc, message)
+            return
+
+        with self.__lock:
+            incoming = self.__incoming.get(stream_uid)
+            outgoing = self.__outgoing.get(stream_uid)
+
+        if subject == MSG_ACK:
+            if outgoing is not None:
+                outgoing.acked(content["read"])
+        elif subject == MSG_ABORT:
+            if outgoing is not None:
+                outgoing.aborted(content["reason"])
+            if incoming is not None:
+                self.__forget(incoming)
+                incoming._aborted(content["reason"])
+        elif incoming is None:
+            # Unknown or finished stream
+            _logger.debug("Message %s for unknown stream %s",
+                          subject, stream_uid)
+        elif subject == MSG_CHUNK:
+            if not incoming._put(content["seq"], _decode_chunk(content)):
+                incoming.abort("Chunk received out of the window")
+        elif subject == MSG_END:
+            incoming._end(content["count"])
+
+    def __open(self, herald_svc, message):
+        """
+        A peer opens a stream: notify a stream listener in a new thread
+        """
+        content = message.content
+        listeners = self.__stream_listeners.match(content["subject"])
+        if not listeners:
+            herald_svc.reply(message, {"accepted": False,
+                                       "reason": "No stream listener"})
+            return
+
+        window = max(1, min(content.get("window", self._window),
+                            self._window))
+        stream = IncomingStream(content["stream"], content["subject"],
+                                message.sender, content.get("metadata"),
+                                window, self._timeout, self.__send_ack,
+                                self.__abort)
+        with self.__lock:
+            self.__incoming[stream.uid] = stream
+
+        # Listeners are stored in a set: use any of them
+        listener = next(iter(listeners))
+        thread = threading.Thread(
+            target=self.__notify, args=(listener, stream),
+            name="Herald-Stream-{0}".format(stream.uid))
+        thread.daemon = True
+        thread.start()
+
+        herald_svc.reply(message, {"accepted": True, "window": window})
+
+    def __notify(self, listener, stream):
+        """
+        Calls a stream listener. The stream is aborted if the listener
+        doesn't read it completely.
+        """
+        try:
+            listener.herald_stream(self._herald, stream)
+        except Exception as ex:
+            # pylint: disable=W0703
+            _logger.exception("Error notifying stream listener %s: %s",
+                              listener, ex)
+
+        if not stream.finished:
+            stream.abort("Stream not read by the listener")
+        self.__forget(stream)
+
+    def __forget(self, stream):
+        """
+        Forgets about an incoming stream
+        """
+        with self.__lock:
+            if self.__incoming.get(stream.uid) is stream:
+                del self.__incoming[stream.uid]
+
+    def __send_ack(self, stream, nb_read):
+        """
+        Gives credits to the sender of a stream
+        """
+        try:
+            self._herald.fire(stream.sender, beans.Message(
+                MSG_ACK, {"stream": stream.uid, "read": nb_read}))
+        except (KeyError, HeraldException) as ex:
+            _logger.error("Error acknowledging stream %s: %s", stream, ex)
+
+    def __abort(self, stream, reason):
+        """
+        An incoming stream has been aborted by the receiver
+        """
+        self.__forget(stream)
+        self.__send_abort(stream.sender, stream.uid, reason)
@@ -166,12 +166,13 @@ class BluetoothTransport(object):
         mac = self.__get_access(peer, extra)
 
         # Log before sending
-        self._probe.store(
-            herald.PROBE_CHANNEL_MSG_SEND,
-            {"uid": message.uid, "timestamp": time.time(),
-             "transport": ACCESS_ID, "subject": message.subject,
-             "target": peer.uid if peer else "<unknown>",
-             "transportTarget": mac})
+        if herald.PROBE_CHANNEL_MSG_SEND in self._probe.active_channels:
+            self._probe.store(
+                herald.PROBE_CHANNEL_MSG_SEND,
+                {"uid": message.uid, "timestamp": time.time(),
+                 "transport": ACCESS_ID, "subject": message.subject,
+                 "target": peer.uid if peer else "<unknown>",
+                 "transportTarget": mac})
 
         self._fire(mac, message)
 
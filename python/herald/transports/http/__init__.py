@@ -31,9 +31,30 @@ __docformat__ = "restructuredtext en"
 
 # ------------------------------------------------------------------------------
 
+# Herald
+import herald.codec
+
+# ------------------------------------------------------------------------------
+
 CONTENT_TYPE_JSON = "application/json"
 """ MIME type: JSON data """
 
+CONTENT_TYPE_BATCH = "application/x-herald-batch+json"
+""" MIME type: JSON array of Herald messages (batch envelope) """
+
+CONTENT_TYPE_MSGPACK = "application/x-herald+msgpack"
+""" MIME type: MessagePack Herald message """
+
+CONTENT_TYPE_BATCH_MSGPACK = "application/x-herald-batch+msgpack"
+""" MIME type: concatenated MessagePack Herald messages (batch envelope) """
+
+CONTENT_TYPES = {
+    herald.codec.CODEC_JSON: (CONTENT_TYPE_JSON, CONTENT_TYPE_BATCH),
+    herald.codec.CODEC_MSGPACK: (CONTENT_TYPE_MSGPACK,
+                                 CONTENT_TYPE_BATCH_MSGPACK),
+}
+""" Codec name -> (message MIME type, batch envelope MIME type) """
+
 # ------------------------------------------------------------------------------
 
 ACCESS_ID = "http"
@@ -70,6 +91,11 @@ FACTORY_DISCOVERY_MULTICAST = "herald-http-discovery-multicast-factory"
 Name of the Multicast discovery component factory
 """
 
+FACTORY_DISCOVERY_GOSSIP = "herald-http-discovery-gossip-factory"
+"""
+Name of the gossip (SWIM) discovery component factory
+"""
+
 # ------------------------------------------------------------------------------
 
 PROP_MULTICAST_GROUP = "multicast.group"
@@ -82,6 +108,18 @@ PROP_MULTICAST_PORT = "multicast.port"
 Name of the multicast port configuration property
 """
 
+PROP_MULTICAST_BATCH = "multicast.batch"
+"""
+Name of the configuration property giving the maximum number of heart beats
+read at once by the multicast discovery (1 to read them one by one)
+"""
+
+PROP_GOSSIP_SEEDS = "gossip.seeds"
+"""
+Name of the gossip seeds configuration property: a list (or a comma-separated
+string) of "host:port/path" addresses of peers to contact at start-up
+"""
+
 # ------------------------------------------------------------------------------
 
 MESSAGE_HEADER_PORT = "herald-http-tansport-port"
@@ -92,3 +130,25 @@ MESSAGE_HEADER_PATH = "herald-http-tansport-path"
 """
 """
 
+# ------------------------------------------------------------------------------
+# Capabilities of the HTTP servlet, given in the responses of the servlet: the
+# HTTP access of a peer stays a (host, port, path) tuple, as read by the
+# other implementations of Herald
+
+HEADER_CAPABILITIES = "herald-capabilities"
+""" Response header giving the comma-separated capabilities of the servlet """
+
+CAPABILITY_BATCH = "batch"
+""" The servlet accepts batch envelopes (CONTENT_TYPE_BATCH) """
+
+CAPABILITY_MSGPACK = herald.codec.CODEC_MSGPACK
+""" The servlet accepts MessagePack messages (CONTENT_TYPE_MSGPACK) """
+
+LOCAL_CAPABILITIES = (CAPABILITY_BATCH,) + tuple(
+    name for name in herald.codec.available_codecs()
+    if name != herald.codec.CODEC_JSON)
+"""
+Capabilities of the local servlet: batch and the available codecs, other than
+JSON (always supported)
+"""
+
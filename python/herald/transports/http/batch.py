@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Herald HTTP transport batching: coalesces the messages sent to the same peer
+server during a linger window into a single request.
+
+The first caller adding a message to a batch (the leader) waits for the
+linger delay, or until the batch is full, then sends the whole batch. The
+other callers wait for the batch to be sent. No thread is started: callers
+still get the sending error, if any, as with a direct request.
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Herald
+from herald.codec import JsonCodec
+
+# Standard library
+import threading
+
+# ------------------------------------------------------------------------------
+
+
+def make_envelope(contents):
+    """
+    Prepares a batch envelope: a JSON array of the given JSON messages
+
+    :param contents: A list of JSON messages (bytes or strings)
+    :return: The JSON array (bytes)
+    """
+    return JsonCodec.make_envelope(contents)
+
+
+class _Batch(object):
+    """
+    Messages waiting to be sent to a peer server
+    """
+    __slots__ = ('url', 'contents', 'size', 'full', 'done', 'error')
+
+    def __init__(self, url):
+        """
+        Sets up the batch
+
+        :param url: URL of the peer servlet
+        """
+        self.url = url
+        self.contents = []
+        self.size = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+
+
+class MessageBatcher(object):
+    """
+    Coalesces the messages sent to the same peer server
+    """
+    def __init__(self, send_method, linger=.002, max_messages=64,
+                 max_bytes=262144):
+        """
+        Sets up the batcher
+
+        :param send_method: Method sending a batch:
+                            send_method(address, url, contents)
+        :param linger: Time to wait for other messages (in seconds)
+        :param max_messages: Maximum number of messages in a batch
+        :param max_bytes: Maximum size of the messages in a batch
+        """
+        self.__send = send_method
+        self.__linger = linger
+        self.__max_messages = max(1, int(max_messages))
+        self.__max_bytes = max(1, int(max_bytes))
+
+        # Address -> _Batch (being filled)
+        self.__pending = {}
+        self.__lock = threading.Lock()
+
+    def send(self, address, url, content):
+        """
+        Adds a message to the batch of the given server and waits for the
+        batch to be sent
+
+        :param address: Address of the peer server: (host, port) tuple
+        :param url: URL of the peer servlet
+        :param content: The JSON message
+        :raise Exception: Error sending the batch
+        """
+        with self.__lock:
+            batch = self.__pending.get(address)
+            leader = batch is None or batch.url != url
+            if leader:
+                batch = self.__pending[address] = _Batch(url)
+
+            batch.contents.append(content)
+            batch.size += len(content)
+            if len(batch.contents) >= self.__max_messages \
+                    or batch.size >= self.__max_bytes:
+                # Batch full: next messages will go in a new one
+                del self.__pending[address]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.__linger)
+            with self.__lock:
+                if self.__pending.get(address) is batch:
+                    del self.__pending[address]
+
+            try:
+                self.__send(address, url, batch.contents)
+            except Exception as ex:
+                batch.error = ex
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
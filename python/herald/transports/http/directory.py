@@ -92,7 +92,8 @@ class HTTPDirectory(object):
         """
         Loads a dumped access
 
-        :param data: Result of a call to HTTPAccess.dump()
+        :param data: Result of a call to HTTPAccess.dump() (extra elements
+                     are ignored)
         :return: An HTTPAccess bean
         """
         return HTTPAccess(data[0], data[1], data[2])
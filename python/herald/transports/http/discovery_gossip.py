@@ -0,0 +1,991 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Herald HTTP transport discovery, based on a SWIM-like gossip protocol
+
+Each peer probes one member per protocol period: a direct ping, then pings
+through a few other members (indirect probing) if it isn't acknowledged in
+time. Members which don't answer are suspected, then declared dead after a
+suspicion timeout unless they refute it. Membership updates are piggybacked
+on the probe messages: the network load and the failure detection time of a
+peer are (almost) independent of the size of the cluster.
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Herald
+from . import ACCESS_ID, SERVICE_HTTP_TRANSPORT, SERVICE_HTTP_RECEIVER, \
+    FACTORY_DISCOVERY_GOSSIP, PROP_GOSSIP_SEEDS
+import herald
+import herald.beans as beans
+import herald.utils as utils
+import herald.transports.peer_contact as peer_contact
+
+# Pelix/iPOPO
+from pelix.ipopo.decorators import ComponentFactory, Requires, Validate, \
+    Invalidate, Property, RequiresBest, Provides
+from pelix.utilities import is_string
+import pelix.threadpool
+
+# Standard library
+import collections
+import heapq
+import logging
+import math
+import random
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+SUBJECT_GOSSIP_PREFIX = "herald/directory/gossip"
+""" Prefix of the gossip messages subjects """
+
+SUBJECT_GOSSIP_MATCH = SUBJECT_GOSSIP_PREFIX + "/*"
+""" Filter matching the gossip messages subjects """
+
+KIND_PING = "ping"
+""" Direct probe of a member """
+
+KIND_PING_REQ = "ping-req"
+""" Request to probe a member on behalf of the sender """
+
+KIND_ACK = "ack"
+""" Acknowledgement of a probe """
+
+KIND_SYNC = "sync"
+""" Exchange of the members lists, when joining the cluster """
+
+STATE_ALIVE = "alive"
+""" The member answers to probes """
+
+STATE_SUSPECT = "suspect"
+""" The member didn't answer to a probe """
+
+STATE_DEAD = "dead"
+""" The member has been suspected for too long """
+
+STATE_LEFT = "left"
+""" The member left the cluster """
+
+PROBE_CHANNEL_GOSSIP = "http_gossip"
+""" Name of the gossip discovery probe channel """
+
+_logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+
+
+class Member(object):
+    """
+    A member of the cluster, as known by the local peer
+    """
+    __slots__ = ('uid', 'address', 'incarnation', 'state', 'deadline')
+
+    def __init__(self, uid, address, incarnation):
+        """
+        Sets up the member
+
+        :param uid: Peer UID
+        :param address: A (host, port, path) tuple
+        :param incarnation: Incarnation number given by the member
+        """
+        self.uid = uid
+        self.address = address
+        self.incarnation = incarnation
+        self.state = STATE_ALIVE
+        self.deadline = None
+
+    def __repr__(self):
+        """
+        Member representation
+        """
+        return "Member({0}, {1}, {2})".format(self.uid, self.state,
+                                              self.incarnation)
+
+
+class _Probe(object):
+    """
+    The probe of a member during a protocol period
+    """
+    __slots__ = ('target', 'seq', 'start', 'acked', 'indirect')
+
+    def __init__(self, target, seq, start):
+        """
+        :param target: The probed Member
+        :param seq: Sequence number of the ping
+        :param start: Start time of the probe
+        """
+        self.target = target
+        self.seq = seq
+        self.start = start
+        self.acked = False
+        self.indirect = False
+
+
+class Swim(object):
+    """
+    Implementation of the SWIM protocol, independent from the network.
+
+    Messages are sent with the ``send(uid, address, kind, content)`` method
+    given to the constructor. Received ones must be given to handle(), and
+    tick() must be called regularly (a few times per protocol period).
+
+    Membership updates are lists: ``[uid, state, incarnation, host, port,
+    path]``. Each one is piggybacked on a number of messages growing with the
+    logarithm of the size of the cluster.
+    """
+    def __init__(self, uid, address, send, on_join=None, on_dead=None,
+                 period=1., ping_timeout=.3, indirect=3, suspicion=5,
+                 retransmit=4, max_piggyback=8, clock=time.time,
+                 randomizer=None):
+        """
+        Sets up the protocol
+
+        :param uid: UID of the local peer
+        :param address: (host, port, path) tuple to access the local peer
+        :param send: Method sending a message
+        :param on_join: Method called with the UID and the address of the
+                        members learned by gossip
+        :param on_dead: Method called with the UID of the members declared
+                        dead or which left
+        :param period: Protocol period (in seconds)
+        :param ping_timeout: Delay before indirect probing (in seconds)
+        :param indirect: Number of members used for indirect probing
+        :param suspicion: Suspicion timeout multiplier (in periods, scaled
+                          by the logarithm of the size of the cluster)
+        :param retransmit: Retransmission multiplier of the updates
+        :param max_piggyback: Maximum number of updates per message
+        :param clock: Method returning the current time
+        :param randomizer: A random.Random object
+        """
+        self.__uid = uid
+        self.__address = address
+        self.__send = send
+        self.__on_join = on_join
+        self.__on_dead = on_dead
+        self.__period = period
+        self.__ping_timeout = ping_timeout
+        self.__indirect = indirect
+        self.__suspicion = suspicion
+        self.__retransmit = retransmit
+        self.__max_piggyback = max_piggyback
+        self.__clock = clock
+        self.__random = randomizer or random.Random()
+
+        # Start from a time-based incarnation, to be newer than the one of a
+        # previous execution
+        self.__incarnation = int(clock())
+
+        # UID -> Member
+        self.__members = {}
+
+        # UID -> suspected Member
+        self.__suspects = {}
+
+        # UID -> Member suspected by the local peer
+        self.__watched = {}
+
+        # UID -> last incarnation of the members declared dead or which left
+        self.__gone = collections.OrderedDict()
+        self.__max_gone = 4096
+
+        # Round-robin probe list, and index of the next member to probe
+        self.__probe_list = []
+        self.__probe_index = 0
+        self.__probe = None
+        self.__seq = 0
+
+        # Ping requests: local sequence -> (requester UID, address, sequence,
+        # deadline)
+        self.__relays = {}
+
+        # UID -> [update, number of transmissions]
+        self.__updates = {}
+
+        self.__lock = threading.RLock()
+
+    @property
+    def incarnation(self):
+        """
+        The incarnation number of the local peer
+        """
+        return self.__incarnation
+
+    def get_member(self, uid):
+        """
+        Returns the member with the given UID
+
+        :param uid: A peer UID
+        :return: A Member bean
+        :raise KeyError: Unknown member
+        """
+        return self.__members[uid]
+
+    def get_members(self):
+        """
+        Returns the UIDs of the current members (alive or suspected)
+
+        :return: A list of peer UIDs
+        """
+        with self.__lock:
+            return list(self.__members)
+
+    def __len__(self):
+        """
+        Returns the number of members
+        """
+        return len(self.__members)
+
+    def __next_seq(self):
+        """
+        Returns a new sequence number
+        """
+        self.__seq += 1
+        return self.__seq
+
+    def __suspicion_timeout(self):
+        """
+        Computes the suspicion timeout: it grows with the logarithm of the
+        size of the cluster, to let the refutations spread
+        """
+        return self.__suspicion * self.__period \
+            * max(1., math.log10(len(self.__members) + 1))
+
+    def __queue(self, uid, state, incarnation, address):
+        """
+        Queues an update, replacing the previous one about the same member
+        """
+        update = [uid, state, incarnation]
+        update.extend(address or (None, None, None))
+        self.__updates[uid] = [update, 0, -self.__next_seq()]
+
+    def __piggyback(self, content):
+        """
+        Adds the least transmitted updates to the content of a message, the
+        most recent ones first
+
+        :param content: A message content dictionary
+        :return: The given dictionary
+        """
+        content['incarnation'] = self.__incarnation
+        updates = content.get('updates') or []
+        if self.__updates:
+            limit = int(self.__retransmit
+                        * math.ceil(math.log10(len(self.__members) + 2)))
+            entries = heapq.nsmallest(
+                self.__max_piggyback - len(updates),
+                self.__updates.items(),
+                key=lambda item: (item[1][1], item[1][2]))
+            for uid, entry in entries:
+                updates.append(entry[0])
+                entry[1] += 1
+                if entry[1] >= limit:
+                    # Sent enough times
+                    del self.__updates[uid]
+
+        if updates:
+            content['updates'] = updates
+        return content
+
+    def __send_message(self, uid, address, kind, content):
+        """
+        Sends a message with piggybacked updates
+        """
+        self.__send(uid, address, kind, self.__piggyback(content))
+
+    def __add(self, uid, address, incarnation):
+        """
+        Adds a member
+        """
+        member = self.__members[uid] = Member(uid, address, incarnation)
+        self.__gone.pop(uid, None)
+
+        # Insert it at a random position of the probe list
+        self.__probe_list.insert(
+            self.__random.randint(0, len(self.__probe_list)), uid)
+        return member
+
+    def __remove(self, uid):
+        """
+        Removes a member (it is removed from the probe list lazily)
+
+        :return: The removed member, or None
+        """
+        self.__suspects.pop(uid, None)
+        self.__watched.pop(uid, None)
+        return self.__members.pop(uid, None)
+
+    def __forget(self, member, state):
+        """
+        Removes a member declared dead or which left, and notifies about it
+        """
+        self.__remove(member.uid)
+        self.__gone[member.uid] = member.incarnation
+        while len(self.__gone) > self.__max_gone:
+            self.__gone.popitem(last=False)
+
+        self.__queue(member.uid, state, member.incarnation, member.address)
+        if self.__on_dead is not None:
+            self.__on_dead(member.uid)
+
+    def __suspect(self, member, incarnation):
+        """
+        Suspects a member
+        """
+        member.state = STATE_SUSPECT
+        member.incarnation = incarnation
+        member.deadline = self.__clock() + self.__suspicion_timeout()
+        self.__suspects[member.uid] = member
+        self.__queue(member.uid, STATE_SUSPECT, incarnation, member.address)
+
+    def __refute(self, incarnation):
+        """
+        Refutes a suspicion about the local peer
+        """
+        if incarnation >= self.__incarnation:
+            self.__incarnation = incarnation + 1
+        self.__queue(self.__uid, STATE_ALIVE, self.__incarnation,
+                     self.__address)
+
+    def __apply(self, update, direct=False):
+        """
+        Applies a membership update
+
+        :param update: A membership update
+        :param direct: If True, the update comes from the member itself: it
+                       is gossiped only if it refutes a suspicion
+        """
+        try:
+            uid, state, incarnation, host, port, path = update
+        except (TypeError, ValueError):
+            _logger.debug("Invalid membership update: %s", update)
+            return
+
+        if uid == self.__uid:
+            if state != STATE_ALIVE:
+                # Someone thinks we're not there
+                self.__refute(incarnation)
+            return
+
+        address = (host, port, path) if host else None
+        member = self.__members.get(uid)
+        if state == STATE_ALIVE:
+            if member is None:
+                if self.__gone.get(uid, -1) >= incarnation or not address:
+                    # Old news or unreachable member
+                    return
+
+                self.__add(uid, address, incarnation)
+                self.__queue(uid, state, incarnation, address)
+                if self.__on_join is not None:
+                    self.__on_join(uid, address)
+
+            elif incarnation > member.incarnation:
+                # Newer incarnation: clears the suspicion
+                suspected = member.state == STATE_SUSPECT
+                member.incarnation = incarnation
+                member.state = STATE_ALIVE
+                member.address = address or member.address
+                self.__suspects.pop(uid, None)
+                if suspected or not direct:
+                    self.__queue(uid, state, incarnation, member.address)
+
+        elif member is None:
+            # Suspicion or death of an unknown member
+            return
+
+        elif state == STATE_SUSPECT:
+            if incarnation > member.incarnation \
+                    or (incarnation == member.incarnation
+                        and member.state == STATE_ALIVE):
+                self.__suspect(member, incarnation)
+
+        elif state in (STATE_DEAD, STATE_LEFT):
+            if incarnation >= member.incarnation:
+                member.incarnation = incarnation
+                self.__forget(member, state)
+
+    def add_member(self, uid, address, incarnation=0, announce=True):
+        """
+        Adds a member known by other means (e.g. registered in the directory)
+
+        :param uid: Peer UID
+        :param address: A (host, port, path) tuple
+        :param incarnation: Incarnation of the member, if known
+        :param announce: If True, gossip about this member
+        """
+        if uid == self.__uid:
+            return
+
+        with self.__lock:
+            member = self.__members.get(uid)
+            if member is not None:
+                member.address = address
+            else:
+                member = self.__add(uid, address, incarnation)
+                if announce:
+                    self.__queue(uid, STATE_ALIVE, incarnation, address)
+
+    def remove_member(self, uid):
+        """
+        Removes a member, without gossiping about it
+
+        :param uid: Peer UID
+        """
+        with self.__lock:
+            self.__remove(uid)
+
+    def announce(self):
+        """
+        Gossips about the local peer (e.g. when joining the cluster)
+        """
+        with self.__lock:
+            self.__queue(self.__uid, STATE_ALIVE, self.__incarnation,
+                         self.__address)
+
+    def join(self, address):
+        """
+        Exchanges the members lists with a member of the cluster, given by
+        its address only (e.g. a seed)
+
+        :param address: A (host, port, path) tuple
+        """
+        with self.__lock:
+            self.__send_message(None, address, KIND_SYNC,
+                                {'seq': self.__next_seq(), 'reply': True,
+                                 'members': self.__dump_members()})
+
+    def __dump_members(self):
+        """
+        Returns the description of the members, for a synchronization
+        """
+        return [[member.uid, member.incarnation] + list(member.address)
+                for member in self.__members.values()
+                if member.state == STATE_ALIVE]
+
+    def __load_members(self, members):
+        """
+        Adds the unknown members of a synchronization, without gossiping
+        about them
+        """
+        for entry in members:
+            try:
+                uid, incarnation, host, port, path = entry
+            except (TypeError, ValueError):
+                continue
+
+            if uid != self.__uid and uid not in self.__members \
+                    and self.__gone.get(uid, -1) < incarnation:
+                address = (host, port, path)
+                self.__add(uid, address, incarnation)
+                if self.__on_join is not None:
+                    self.__on_join(uid, address)
+
+    def leave(self):
+        """
+        Tells some members that the local peer leaves the cluster
+        """
+        with self.__lock:
+            self.__incarnation += 1
+            self.__queue(self.__uid, STATE_LEFT, self.__incarnation,
+                         self.__address)
+            for member in self.__pick(self.__indirect + 1):
+                self.__send_message(member.uid, member.address, KIND_PING,
+                                    {'seq': self.__next_seq()})
+
+    def __pick(self, count, excluded=None):
+        """
+        Picks random members, without scanning all of them
+
+        :param count: Number of members to pick
+        :param excluded: UID of a member not to pick
+        :return: A list of Member beans (can be shorter than count)
+        """
+        picked = {}
+        probe_list = self.__probe_list
+        if probe_list:
+            for _ in range(count * 4):
+                uid = probe_list[self.__random.randrange(len(probe_list))]
+                member = self.__members.get(uid)
+                if member is not None and uid != excluded:
+                    picked[uid] = member
+                    if len(picked) == count:
+                        break
+        return list(picked.values())
+
+    def __next_target(self):
+        """
+        Returns the next member to probe, or None
+        """
+        for _ in range(2):
+            while self.__probe_index < len(self.__probe_list):
+                uid = self.__probe_list[self.__probe_index]
+                self.__probe_index += 1
+                member = self.__members.get(uid)
+                if member is not None:
+                    return member
+
+            # End of the round: remove the forgotten members and shuffle
+            self.__probe_list = list(self.__members)
+            self.__random.shuffle(self.__probe_list)
+            self.__probe_index = 0
+
+        return None
+
+    def tick(self):
+        """
+        Handles the timeouts of the protocol: must be called regularly
+        """
+        with self.__lock:
+            now = self.__clock()
+            probe = self.__probe
+            if probe is not None:
+                if not probe.acked and not probe.indirect \
+                        and now >= probe.start + self.__ping_timeout:
+                    # No direct answer: ask other members to probe it
+                    probe.indirect = True
+                    target = probe.target
+                    for member in self.__pick(self.__indirect, target.uid):
+                        self.__send_message(
+                            member.uid, member.address, KIND_PING_REQ,
+                            {'seq': probe.seq, 'target': target.uid,
+                             'address': target.address})
+
+                if now >= probe.start + self.__period:
+                    # End of the protocol period
+                    self.__probe = None
+                    target = probe.target
+                    if not probe.acked \
+                            and self.__members.get(target.uid) is target \
+                            and target.state == STATE_ALIVE:
+                        self.__suspect(target, target.incarnation)
+                        self.__watched[target.uid] = target
+
+            # Suspicion timeouts
+            if self.__suspects:
+                for member in list(self.__suspects.values()):
+                    if now >= member.deadline:
+                        self.__forget(member, STATE_DEAD)
+
+            # Forget the old ping requests
+            if self.__relays:
+                for seq, relay in list(self.__relays.items()):
+                    if now >= relay[3]:
+                        del self.__relays[seq]
+
+            if self.__probe is None:
+                # Tell the members we suspect about it, so that they can
+                # refute it quickly
+                for member in list(self.__watched.values()):
+                    if member.state != STATE_SUSPECT:
+                        del self.__watched[member.uid]
+                    else:
+                        self.__send_message(
+                            member.uid, member.address, KIND_PING,
+                            {'seq': self.__next_seq(),
+                             'updates': [[member.uid, STATE_SUSPECT,
+                                          member.incarnation]
+                                         + list(member.address)]})
+
+                # Start the next probe
+                target = self.__next_target()
+                if target is not None:
+                    self.__probe = _Probe(target, self.__next_seq(), now)
+                    self.__send_message(target.uid, target.address,
+                                        KIND_PING, {'seq': self.__probe.seq})
+
+    def handle(self, sender, kind, content, address=None):
+        """
+        Handles a received message
+
+        :param sender: UID of the sender
+        :param kind: Kind of message
+        :param content: Content of the message (dictionary)
+        :param address: (host, port, path) tuple to access the sender
+        """
+        with self.__lock:
+            try:
+                incarnation = content.get('incarnation', 0)
+                updates = content.get('updates') or ()
+                seq = content['seq']
+            except (AttributeError, KeyError):
+                _logger.debug("Invalid gossip message from %s", sender)
+                return
+
+            # The sender is alive
+            if sender != self.__uid:
+                self.__apply([sender, STATE_ALIVE, incarnation]
+                             + list(address or (None, None, None)), True)
+
+            for update in updates:
+                self.__apply(update)
+
+            if kind == KIND_PING:
+                self.__send_message(sender, address, KIND_ACK, {'seq': seq})
+
+            elif kind == KIND_PING_REQ:
+                # Probe the target on behalf of the sender
+                local_seq = self.__next_seq()
+                self.__relays[local_seq] = (sender, address, seq,
+                                            self.__clock() + self.__period)
+                target_address = content.get('address')
+                self.__send_message(
+                    content.get('target'),
+                    tuple(target_address) if target_address else None,
+                    KIND_PING, {'seq': local_seq})
+
+            elif kind == KIND_SYNC:
+                self.__load_members(content.get('members') or ())
+                if content.get('reply'):
+                    self.__send_message(sender, address, KIND_SYNC,
+                                        {'seq': seq,
+                                         'members': self.__dump_members()})
+
+            elif kind == KIND_ACK:
+                probe = self.__probe
+                if probe is not None and probe.seq == seq:
+                    # Direct or indirect acknowledgement of our probe
+                    probe.acked = True
+                else:
+                    relay = self.__relays.pop(seq, None)
+                    if relay is not None:
+                        # Acknowledgement of a ping request: forward it
+                        self.__send_message(relay[0], relay[1], KIND_ACK,
+                                            {'seq': relay[2]})
+
+# ------------------------------------------------------------------------------
+
+
+@ComponentFactory(FACTORY_DISCOVERY_GOSSIP)
+@RequiresBest('_probe', herald.SERVICE_PROBE)
+@Requires('_directory', herald.SERVICE_DIRECTORY)
+@Requires('_receiver', SERVICE_HTTP_RECEIVER)
+@Requires('_transport', SERVICE_HTTP_TRANSPORT)
+@Provides((herald.SERVICE_LISTENER, herald.SERVICE_DIRECTORY_LISTENER))
+@Property('_filters', herald.PROP_FILTERS, [SUBJECT_GOSSIP_MATCH])
+@Property('_seeds', PROP_GOSSIP_SEEDS, None)
+@Property('_period', 'gossip.period', 1)
+@Property('_ping_timeout', 'gossip.ping.timeout', .3)
+@Property('_indirect', 'gossip.indirect', 3)
+@Property('_suspicion', 'gossip.suspicion', 5)
+@Property('_retransmit', 'gossip.retransmit', 4)
+@Property('_max_piggyback', 'gossip.piggyback', 8)
+class GossipDiscovery(object):
+    """
+    Discovery of Herald peers based on the SWIM gossip protocol.
+
+    Peers join the cluster by contacting the configured seeds
+    (``host:port/path`` strings) or by being registered in the directory by
+    another discovery (e.g. multicast). Members declared dead lose their HTTP
+    access.
+    """
+    def __init__(self):
+        """
+        Sets up the component
+        """
+        # Injected services
+        self._directory = None
+        self._receiver = None
+        self._transport = None
+        self._probe = None
+
+        # Properties
+        self._filters = None
+        self._seeds = None
+        self._period = 1
+        self._ping_timeout = .3
+        self._indirect = 3
+        self._suspicion = 5
+        self._retransmit = 4
+        self._max_piggyback = 8
+
+        # Local peer bean
+        self._local_peer = None
+
+        # Protocol
+        self.__swim = None
+
+        # Sending threads
+        self.__pool = None
+
+        # Protocol thread
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    @staticmethod
+    def __normalize(host, port, path):
+        """
+        Normalizes an address: (host, port, path with a leading slash)
+        """
+        path = path or '/'
+        if not path.startswith('/'):
+            path = '/' + path
+        return utils.normalize_ip(host), int(port), path
+
+    def __parse_seeds(self):
+        """
+        Parses the seeds configuration property
+
+        :return: A list of (host, port, path) tuples
+        """
+        seeds = self._seeds
+        if not seeds:
+            return []
+        elif is_string(seeds):
+            seeds = seeds.split(',')
+
+        result = []
+        for seed in seeds:
+            seed = seed.strip()
+            try:
+                address, _, path = seed.partition('/')
+                host, port = address.rsplit(':', 1)
+                result.append(self.__normalize(host, port, path))
+            except ValueError:
+                _logger.error("Invalid gossip seed: %s", seed)
+        return result
+
+    @Validate
+    def _validate(self, _):
+        """
+        Component validated
+        """
+        self._period = float(self._period)
+        self._local_peer = self._directory.get_local_peer()
+
+        host, port, path = self._receiver.get_access_info()
+        self.__swim = Swim(
+            self._local_peer.uid, self.__normalize(host, port, path),
+            self.__send, self.__on_join, self.__on_dead, self._period,
+            float(self._ping_timeout), int(self._indirect),
+            float(self._suspicion), int(self._retransmit),
+            int(self._max_piggyback))
+
+        # Members already known
+        for peer in self._directory.get_peers():
+            self.peer_registered(peer)
+        self.__swim.announce()
+
+        self.__pool = pelix.threadpool.ThreadPool(
+            8, logname="herald-http-gossip")
+        self.__pool.start()
+
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__loop,
+                                         name="Herald-HTTP-Gossip")
+        self.__thread.start()
+
+    @Invalidate
+    def _invalidate(self, _):
+        """
+        Component invalidated
+        """
+        self.__stop_event.set()
+        self.__thread.join(1)
+        self.__thread = None
+
+        # Tell some members we're leaving
+        self.__swim.leave()
+        self.__pool.stop()
+        self.__pool = None
+        self.__swim = None
+        self._local_peer = None
+
+    def __loop(self):
+        """
+        Protocol loop
+        """
+        seeds = self.__parse_seeds()
+        next_contact = 0
+        while not self.__stop_event.wait(self._period / 10):
+            if seeds and not len(self.__swim) \
+                    and time.time() >= next_contact:
+                # Alone: contact the seeds
+                next_contact = time.time() + 10 * self._period
+                for address in seeds:
+                    self.__pool.enqueue(self.__contact, address,
+                                        self.__make_contact())
+                    self.__swim.join(address)
+
+            try:
+                self.__swim.tick()
+            except Exception as ex:
+                # pylint: disable=W0703
+                _logger.exception("Error in the gossip protocol: %s", ex)
+
+    def __make_contact(self):
+        """
+        Prepares the first discovery message sent to a peer
+        """
+        return beans.Message(peer_contact.SUBJECT_DISCOVERY_STEP_1,
+                             self._local_peer.dump())
+
+    def __contact(self, address, message):
+        """
+        Sends a message to a peer which may not be known by the directory
+
+        :param address: A (host, port, path) tuple
+        :param message: The message to send
+        """
+        host, port, path = address
+        try:
+            self._transport.fire(None, message,
+                                 {'host': host, 'port': port, 'path': path})
+        except Exception as ex:
+            # pylint: disable=W0703
+            _logger.debug("Error contacting %s: %s", address, ex)
+
+    def __send(self, uid, address, kind, content):
+        """
+        Sends a gossip message (called by the protocol)
+        """
+        content['generation'] = self._local_peer.generation
+        message = beans.Message('/'.join((SUBJECT_GOSSIP_PREFIX, kind)),
+                                content)
+        self.__pool.enqueue(self.__fire, uid, address, message)
+
+    def __fire(self, uid, address, message):
+        """
+        Sends a gossip message to a member
+        """
+        try:
+            peer = self._directory.get_peer(uid)
+            if not peer.has_access(ACCESS_ID):
+                raise KeyError(uid)
+        except KeyError:
+            # Not yet (or no more) in the directory
+            if address:
+                self.__contact(address, message)
+        else:
+            try:
+                self._transport.fire(peer, message)
+            except Exception as ex:
+                # pylint: disable=W0703
+                # The protocol will detect it
+                _logger.debug("Error sending gossip to %s: %s", uid, ex)
+
+    def __on_join(self, uid, address):
+        """
+        A member has been learned by gossip
+        """
+        if uid not in self._directory:
+            self._probe.store(
+                PROBE_CHANNEL_GOSSIP,
+                {"uid": uid, "timestamp": time.time(), "event": "discovered"})
+            self.__pool.enqueue(self.__contact, address,
+                                self.__make_contact())
+
+    def __on_dead(self, uid):
+        """
+        A member has been declared dead or left
+        """
+        self._probe.store(
+            PROBE_CHANNEL_GOSSIP,
+            {"uid": uid, "timestamp": time.time(), "event": "dead"})
+        self.__pool.enqueue(self.__unset_access, uid)
+
+    def __unset_access(self, uid):
+        """
+        Removes the HTTP access of a dead member
+        """
+        try:
+            self._directory.get_peer(uid).unset_access(ACCESS_ID)
+        except KeyError:
+            # Unknown peer
+            pass
+
+    def herald_message(self, herald_svc, message):
+        """
+        Handles a gossip message
+
+        :param herald_svc: Herald service
+        :param message: Received message
+        """
+        if message.sender == "<invalid>":
+            # Spoofed sender UID
+            return
+
+        extra = message.extra or {}
+        address = None
+        if extra.get('host') and extra.get('port'):
+            address = self.__normalize(extra['host'], extra['port'],
+                                       extra.get('path'))
+
+        kind = message.subject.rsplit('/', 1)[-1]
+        content = message.content
+        self.__swim.handle(message.sender, kind, content, address)
+
+        # Ask for the changes of the description of the sender
+        try:
+            peer = self._directory.get_peer(message.sender)
+            generation = content.get('generation')
+        except (KeyError, AttributeError):
+            return
+
+        if generation is not None and generation > peer.generation:
+            herald_svc.fire(
+                peer, beans.Message(peer_contact.SUBJECT_DELTA_REQUEST,
+                                    {"generation": peer.generation}))
+
+    def peer_registered(self, peer):
+        """
+        A peer has been registered in the directory
+        """
+        self.peer_updated(peer, ACCESS_ID, None, None)
+
+    def peer_updated(self, peer, access_id, data, previous):
+        """
+        The description of a peer has been updated
+        """
+        if access_id != ACCESS_ID:
+            return
+
+        try:
+            access = peer.get_access(ACCESS_ID)
+        except KeyError:
+            # HTTP access removed
+            self.__swim.remove_member(peer.uid)
+        else:
+            try:
+                self.__swim.add_member(
+                    peer.uid,
+                    self.__normalize(access.host, access.port, access.path))
+            except AttributeError:
+                # Not a parsed access
+                pass
+
+    def peer_unregistered(self, peer):
+        """
+        A peer has been unregistered from the directory
+        """
+        self.__swim.remove_member(peer.uid)
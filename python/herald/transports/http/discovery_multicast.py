@@ -37,7 +37,8 @@ __docformat__ = "restructuredtext en"
 
 # Herald
 from . import ACCESS_ID, SERVICE_HTTP_TRANSPORT, SERVICE_HTTP_RECEIVER, \
-    FACTORY_DISCOVERY_MULTICAST, PROP_MULTICAST_GROUP, PROP_MULTICAST_PORT
+    FACTORY_DISCOVERY_MULTICAST, PROP_MULTICAST_GROUP, PROP_MULTICAST_PORT, \
+    PROP_MULTICAST_BATCH
 import herald
 import herald.beans as beans
 import herald.utils as utils
@@ -46,9 +47,10 @@ import herald.transports.peer_contact as peer_contact
 # Pelix/iPOPO
 from pelix.ipopo.decorators import ComponentFactory, Requires, Validate, \
     Invalidate, Property, RequiresBest
-from pelix.utilities import to_bytes, to_unicode
+from pelix.utilities import to_bytes
 
 # Standard library
+import collections
 import logging
 import os
 import select
@@ -65,6 +67,16 @@ PACKET_TYPE_HEARTBEAT = 1
 # Last beat packet type
 PACKET_TYPE_LASTBEAT = 2
 
+BEAT_MAX_SIZE = 1024
+""" Maximum size of a heart beat packet """
+
+# Packet headers: kind / kind, port and path length / kind and UID length
+_KIND = struct.Struct("<B")
+_HEARTBEAT_HEADER = struct.Struct("<BHH")
+_LASTBEAT_HEADER = struct.Struct("<BH")
+_STRING_SIZE = struct.Struct("<H")
+_GENERATION = struct.Struct("<Q")
+
 PROBE_CHANNEL_MULTICAST = "http_multicast"
 """ Name of the multicast discovery probe channel """
 
@@ -278,7 +290,7 @@ def close_multicast_socket(sock, address):
 # ------------------------------------------------------------------------------
 
 
-def make_heartbeat(port, path, peer_uid, app_id):
+def make_heartbeat(port, path, peer_uid, app_id, generation=None):
     """
     Prepares the heart beat UDP packet
 
@@ -291,11 +303,13 @@ def make_heartbeat(port, path, peer_uid, app_id):
     * Peer UID (variable, UTF-8)
     * Application ID length (2 bytes)
     * Application ID (variable, UTF-8)
+    * Generation of the peer description (8 bytes, optional)
 
     :param port: The port to access the Herald HTTP server
     :param path: The path to the Herald HTTP servlet
     :param peer_uid: The UID of the peer
     :param app_id: Application ID
+    :param generation: Generation of the description of the peer
     :return: The heart beat packet content (byte array)
     """
     # Type and port...
@@ -306,6 +320,10 @@ def make_heartbeat(port, path, peer_uid, app_id):
         packet += struct.pack("<H", len(string_bytes))
         packet += string_bytes
 
+    if generation is not None:
+        # Ignored by previous versions
+        packet += struct.pack("<Q", generation)
+
     return packet
 
 
@@ -332,29 +350,102 @@ def make_lastbeat(peer_uid, app_id):
 
     return packet
 
+
+def _read_string(view, offset, size):
+    """
+    Decodes a string of a packet
+
+    :param view: A memoryview on the packet
+    :param offset: Offset of the string content
+    :param size: Size of the string content
+    :return: A (string, offset of the next field) tuple
+    :raise struct.error: Truncated packet
+    """
+    end = offset + size
+    if end > len(view):
+        raise struct.error("Truncated string")
+    return view[offset:end].tobytes().decode("utf-8"), end
+
+
+def parse_beat(data):
+    """
+    Parses a heart beat or a last beat packet, without copying it
+
+    :param data: Packet content (bytes, bytearray or memoryview)
+    :return: A (kind, peer UID, application ID, port, path, generation)
+             tuple. The port is -1 and the path None for last beats. The
+             generation is None if the peer didn't send it.
+    :raise ValueError: Unknown kind of packet
+    :raise struct.error: Truncated packet
+    """
+    view = memoryview(data)
+    kind = _KIND.unpack_from(view)[0]
+    if kind == PACKET_TYPE_HEARTBEAT:
+        _, port, size = _HEARTBEAT_HEADER.unpack_from(view)
+        path, offset = _read_string(view, _HEARTBEAT_HEADER.size, size)
+        size = _STRING_SIZE.unpack_from(view, offset)[0]
+        uid, offset = _read_string(view, offset + _STRING_SIZE.size, size)
+
+        if len(view) >= offset + _STRING_SIZE.size:
+            size = _STRING_SIZE.unpack_from(view, offset)[0]
+            app_id, offset = _read_string(
+                view, offset + _STRING_SIZE.size, size)
+        else:
+            # Compatibility with previous version
+            app_id = herald.DEFAULT_APPLICATION_ID
+
+        if len(view) >= offset + _GENERATION.size:
+            generation = _GENERATION.unpack_from(view, offset)[0]
+        else:
+            # Compatibility with previous version
+            generation = None
+
+        return kind, uid, app_id, port, path, generation
+
+    elif kind == PACKET_TYPE_LASTBEAT:
+        # Peer is going away
+        _, size = _LASTBEAT_HEADER.unpack_from(view)
+        uid, offset = _read_string(view, _LASTBEAT_HEADER.size, size)
+        size = _STRING_SIZE.unpack_from(view, offset)[0]
+        app_id, _ = _read_string(view, offset + _STRING_SIZE.size, size)
+        return kind, uid, app_id, -1, None, None
+
+    raise ValueError("Unknown kind of packet: {0}".format(kind))
+
 # ------------------------------------------------------------------------------
 
 
 class MulticastReceiver(object):
     """
-    A multicast datagram receiver
+    A multicast datagram receiver.
+
+    Each time the socket is readable, it is drained of up to ``batch_size``
+    datagrams, read in pre-allocated buffers. The heart beats of a batch are
+    coalesced by peer UID: only the last one of each peer is given to the
+    callback.
     """
-    def __init__(self, group, port, callback):
+    def __init__(self, group, port, callback, batch_size=64):
         """
         Sets up the receiver
 
         The given callback must have the following signature:
-        ``callback(host, port, path, peer_uid)``.
+        ``callback(kind, peer_uid, app_id, host, port, path, generation)``.
 
         :param group: Multicast group to listen
         :param port: Multicast port
         :param callback: Method to call back once a packet is received
+        :param batch_size: Maximum number of datagrams read at once
+                           (1 to read them one by one)
         """
         # Parameters
         self._group = group
         self._port = port
         self._callback = callback
 
+        # Reception buffers
+        self._buffers = [bytearray(BEAT_MAX_SIZE)
+                         for _ in range(max(1, int(batch_size)))]
+
         # Reception loop
         self._stop_event = threading.Event()
         self._thread = None
@@ -372,6 +463,8 @@ class MulticastReceiver(object):
         self._socket, self._group = create_multicast_socket(self._group,
                                                             self._port)
 
+        self._setup_socket()
+
         # Start the listening thread
         self._stop_event.clear()
         self._thread = threading.Thread(
@@ -393,6 +486,22 @@ class MulticastReceiver(object):
         # Close the socket
         close_multicast_socket(self._socket, self._group)
 
+    def _setup_socket(self):
+        """
+        Prepares the socket for batched reads
+        """
+        # Set the socket as non-blocking
+        self._socket.setblocking(0)
+
+        if len(self._buffers) > 1:
+            try:
+                # Let the system keep a storm of heart beats until we read it
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                        len(self._buffers) * BEAT_MAX_SIZE * 4)
+            except socket.error as ex:
+                _logger.debug("Can't set the size of the reception buffer: "
+                              "%s", ex)
+
     def _handle_heartbeat(self, sender, data):
         """
         Handles a raw heart beat
@@ -400,86 +509,67 @@ class MulticastReceiver(object):
         :param sender: Sender (address, port) tuple
         :param data: Raw packet data
         """
-        # Kind of beat
-        parsed, data = self._unpack("<B", data)
-        kind = parsed[0]
-        if kind == PACKET_TYPE_HEARTBEAT:
-            # Extract content
-            parsed, data = self._unpack("<H", data)
-            port = parsed[0]
-            path, data = self._unpack_string(data)
-            uid, data = self._unpack_string(data)
-            try:
-                app_id, data = self._unpack_string(data)
-            except struct.error:
-                # Compatibility with previous version
-                app_id = herald.DEFAULT_APPLICATION_ID
-
-        elif kind == PACKET_TYPE_LASTBEAT:
-            # Peer is going away
-            uid, data = self._unpack_string(data)
-            app_id, data = self._unpack_string(data)
-            port = -1
-            path = None
+        self._handle_batch(((sender, data),))
 
-        else:
-            _logger.warning("Unknown kind of packet: %d", kind)
-            return
-
-        try:
-            self._callback(kind, uid, app_id, sender[0], port, path)
-        except Exception as ex:
-            _logger.exception("Error handling heart beat: %s", ex)
-
-    def _unpack(self, fmt, data):
+    def _handle_batch(self, packets):
         """
-        Calls struct.unpack().
-
-        Returns a tuple containing the result tuple and the subset of data
-        containing the unread content.
+        Handles a batch of raw heart beats
 
-        :param fmt: The format of data
-        :param data: Data to unpack
-        :return: A tuple (result tuple, unread_data)
+        :param packets: A list of (sender (address, port) tuple, packet data)
         """
-        size = struct.calcsize(fmt)
-        read, unread = data[:size], data[size:]
-        return struct.unpack(fmt, read), unread
+        # Peer UID -> (sender, parsed beat), in reception order
+        beats = collections.OrderedDict()
+        for sender, data in packets:
+            try:
+                beat = parse_beat(data)
+            except ValueError as ex:
+                _logger.warning("%s", ex)
+            except (struct.error, UnicodeError) as ex:
+                _logger.warning("Invalid heart beat from %s: %s", sender, ex)
+            else:
+                # Only keep the last beat of a peer
+                beats.pop(beat[1], None)
+                beats[beat[1]] = sender, beat
+
+        for sender, beat in beats.values():
+            kind, uid, app_id, port, path, generation = beat
+            try:
+                self._callback(kind, uid, app_id, sender[0], port, path,
+                               generation)
+            except Exception as ex:
+                # pylint: disable=W0703
+                _logger.exception("Error handling heart beat: %s", ex)
 
-    def _unpack_string(self, data):
+    def _read_batch(self):
         """
-        Unpacks the next string from the given data
+        Reads the datagrams available in the (non-blocking) socket, up to the
+        number of buffers
 
-        :param data: A datagram, starting at a string size
-        :return: A (string, unread_data) tuple
+        :return: A list of (sender, memoryview on the packet) tuples, valid
+                 until the next call
         """
-        # Get the size of the string
-        result, data = self._unpack("<H", data)
-        size = result[0]
-
-        # Read it
-        string_bytes = data[:size]
+        packets = []
+        for buffer in self._buffers:
+            try:
+                size, sender = self._socket.recvfrom_into(buffer)
+            except socket.error:
+                # Nothing more to read
+                break
+            else:
+                packets.append((sender, memoryview(buffer)[:size]))
 
-        # Convert it
-        return to_unicode(string_bytes), data[size:]
+        return packets
 
     def __read(self):
         """
         Reads packets from the socket
         """
-        # Set the socket as non-blocking
-        self._socket.setblocking(0)
-
         while not self._stop_event.is_set():
             # Watch for content
             ready = select.select([self._socket], [], [], 1)
             if ready[0]:
-                # Socket is ready
-                data, sender = self._socket.recvfrom(1024)
-                try:
-                    self._handle_heartbeat(sender, data)
-                except Exception as ex:
-                    _logger.exception("Error handling the heart beat: %s", ex)
+                # Socket is ready: drain it
+                self._handle_batch(self._read_batch())
 
 # ------------------------------------------------------------------------------
 
@@ -492,6 +582,7 @@ class MulticastReceiver(object):
 @Property('_group', PROP_MULTICAST_GROUP, '239.0.0.1')
 @Property('_port', PROP_MULTICAST_PORT, 42000)
 @Property('_peer_ttl', 'peer.ttl', 30)
+@Property('_batch', PROP_MULTICAST_BATCH, 64)
 class MulticastHeartbeat(object):
     """
     Discovery of Herald peers based on multicast
@@ -513,6 +604,7 @@ class MulticastHeartbeat(object):
         self._group = "239.0.0.1"
         self._port = 42000
         self._peer_ttl = 30
+        self._batch = 64
 
         # Multicast receiver
         self._multicast_recv = None
@@ -523,12 +615,10 @@ class MulticastHeartbeat(object):
 
         # Threads
         self._stop_event = threading.Event()
-        self._lst_thread = None
         self._heart_thread = None
 
-        # peer UID -> Last Time Seen
-        self._peer_lst = {}
-        self._lst_lock = threading.Lock()
+        # Last Time Seen of the peers
+        self._peer_lst = None
 
     @Validate
     def _validate(self, _):
@@ -542,7 +632,8 @@ class MulticastHeartbeat(object):
 
         # Start the multicast listener
         self._multicast_recv = MulticastReceiver(self._group, self._port,
-                                                 self.handle_heartbeat)
+                                                 self.handle_heartbeat,
+                                                 int(self._batch))
         self._multicast_recv.start()
 
         # Create the multicast sender socket
@@ -552,12 +643,13 @@ class MulticastHeartbeat(object):
         self._multicast_target = (address, self._port)
 
         # Start the heart & TTL threads
+        self._peer_lst = utils.ExpiryTracker(self._peer_ttl,
+                                             self.__peers_timeout,
+                                             "Herald-HTTP-LST")
+        self._peer_lst.start()
         self._heart_thread = threading.Thread(target=self.__heart_loop,
                                               name="Herald-HTTP-HeartBeat")
-        self._lst_thread = threading.Thread(target=self.__lst_loop,
-                                            name="Herald-HTTP-LST")
         self._heart_thread.start()
-        self._lst_thread.start()
 
     @Invalidate
     def _invalidate(self, _):
@@ -571,8 +663,7 @@ class MulticastHeartbeat(object):
 
         # Wait for the threads to stop
         self._heart_thread.join(.5)
-        self._lst_thread.join(.5)
-        self._lst_thread = None
+        self._peer_lst.stop()
 
         # Send a last beat: "leaving"
         beat = make_lastbeat(self._local_peer.uid, self._local_peer.app_id)
@@ -584,9 +675,10 @@ class MulticastHeartbeat(object):
         self._multicast_target = None
 
         # Clear storage
-        self._peer_lst.clear()
+        self._peer_lst = None
 
-    def handle_heartbeat(self, kind, peer_uid, app_id, host, port, path):
+    def handle_heartbeat(self, kind, peer_uid, app_id, host, port, path,
+                         generation=None):
         """
         Handles a parsed heart beat
 
@@ -596,6 +688,8 @@ class MulticastHeartbeat(object):
         :param host: Address which sent the heart beat
         :param port: Port of the Herald HTTP server
         :param path: Path to the Herald HTTP servlet
+        :param generation: Generation of the description of the peer
+                           (None for previous versions)
         """
         if peer_uid == self._local_peer.uid \
                 or app_id != self._local_peer.app_id:
@@ -603,12 +697,7 @@ class MulticastHeartbeat(object):
             return
 
         if kind == PACKET_TYPE_LASTBEAT:
-            with self._lst_lock:
-                try:
-                    del self._peer_lst[peer_uid]
-                except KeyError:
-                    # We weren't aware of that peer
-                    pass
+            self._peer_lst.discard(peer_uid)
 
             self._probe.store(
                 PROBE_CHANNEL_MULTICAST,
@@ -624,26 +713,38 @@ class MulticastHeartbeat(object):
                 pass
 
         elif kind == PACKET_TYPE_HEARTBEAT:
-            with self._lst_lock:
-                # Update the peer LST
-                self._peer_lst[peer_uid] = time.time()
+            # Update the peer LST
+            self._peer_lst.touch(peer_uid)
 
-            if peer_uid not in self._directory:
+            try:
+                peer = self._directory.get_peer(peer_uid)
+            except KeyError:
                 # The peer isn't known, register it
                 self._probe.store(
                     PROBE_CHANNEL_MULTICAST,
                     {"uid": peer_uid, "timestamp": time.time(),
                      "event": "discovered"})
 
-                self.__discover_peer(host, port, path)
+                self.__contact_peer(
+                    host, port, path,
+                    beans.Message(peer_contact.SUBJECT_DISCOVERY_STEP_1,
+                                  self._directory.get_local_peer().dump()))
+            else:
+                if generation is not None and generation > peer.generation:
+                    # The description of the peer changed: get the changes
+                    self.__contact_peer(
+                        host, port, path,
+                        beans.Message(peer_contact.SUBJECT_DELTA_REQUEST,
+                                      {"generation": peer.generation}))
 
-    def __discover_peer(self, host, port, path):
+    def __contact_peer(self, host, port, path, message):
         """
-        Grabs the description of a peer using the Herald servlet
+        Sends a discovery message to a peer using the Herald servlet
 
         :param host: Address which sent the heart beat
         :param port: Port of the Herald HTTP server
         :param path: Path to the Herald HTTP servlet
+        :param message: The message to send
         """
         if path.startswith('/'):
             # Remove the starting /, as it is added while forging the URL
@@ -654,12 +755,8 @@ class MulticastHeartbeat(object):
 
         # Prepare the "extra" information, like for a reply
         extra = {'host': host, 'port': port, 'path': path}
-        local_dump = self._directory.get_local_peer().dump()
         try:
-            self._transport.fire(
-                None,
-                beans.Message(peer_contact.SUBJECT_DISCOVERY_STEP_1,
-                              local_dump), extra)
+            self._transport.fire(None, message, extra)
         except Exception as ex:
             _logger.exception("Error contacting peer: %s", ex)
 
@@ -670,45 +767,30 @@ class MulticastHeartbeat(object):
         # Get local information
         access = self._receiver.get_access_info()
 
-        # Prepare the packet
-        beat = make_heartbeat(access[1], access[2], self._local_peer.uid,
-                              self._local_peer.app_id)
         while not self._stop_event.is_set():
+            # Prepare the packet, with the current generation
+            beat = make_heartbeat(access[1], access[2], self._local_peer.uid,
+                                  self._local_peer.app_id,
+                                  self._local_peer.generation)
+
             # Send the heart beat using the multicast socket
             self._multicast_send.sendto(beat, 0, self._multicast_target)
 
             # Wait 20 seconds before next loop
             self._stop_event.wait(20)
 
-    def __lst_loop(self):
+    def __peers_timeout(self, uids):
         """
-        Loop that validates the LST of all peers and removes those who took
-        to long to respond
+        Unregisters the peers which took too long to send a heart beat
+        (called by the LST tracker)
+
+        :param uids: UIDs of the peers which reached their TTL
         """
-        while not self._stop_event.is_set():
-            with self._lst_lock:
-                loop_start = time.time()
-                to_delete = set()
-
-                for uid, last_seen in self._peer_lst.items():
-                    if not last_seen:
-                        # No LST for this peer
-                        _logger.debug("Invalid LST for %s", uid)
-
-                    elif (loop_start - last_seen) > self._peer_ttl:
-                        # TTL reached
-                        to_delete.add(uid)
-                        _logger.debug("Peer %s reached TTL.", uid)
-
-                        self._probe.store(
-                            PROBE_CHANNEL_MULTICAST,
-                            {"uid": uid, "timestamp": time.time(),
-                             "event": "timeout"})
-
-                for uid in to_delete:
-                    # Unregister those peers
-                    del self._peer_lst[uid]
-                    self._directory.unregister(uid)
-
-            # Wait a second or the event before next loop
-            self._stop_event.wait(1)
+        for uid in uids:
+            _logger.debug("Peer %s reached TTL.", uid)
+            self._probe.store(
+                PROBE_CHANNEL_MULTICAST,
+                {"uid": uid, "timestamp": time.time(), "event": "timeout"})
+
+        # Unregister those peers
+        self._directory.unregister_all(uids)
@@ -0,0 +1,253 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Herald HTTP transport fan-out engine: sends the same payload to many peers,
+with its own workers, so that large group messages don't delay the other
+messages.
+
+The caller gets a FanOutHandle immediately, which tells which peers have
+been reached or have failed as the requests complete.
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Standard library
+import collections
+import logging
+import threading
+
+# ------------------------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+
+
+class FanOutHandle(object):
+    """
+    Progress of a message sent to a group of peers
+    """
+    def __init__(self, uid, peers):
+        """
+        Sets up the handle
+
+        :param uid: UID of the message
+        :param peers: Targeted peers
+        """
+        self.uid = uid
+        self.__pending = set(peers)
+        self.__reached = set()
+        self.__failed = {}
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+        self.__event = threading.Event()
+        if not self.__pending:
+            self.__event.set()
+
+    @property
+    def pending(self):
+        """
+        The set of peers which haven't been contacted yet
+        """
+        with self.__lock:
+            return self.__pending.copy()
+
+    @property
+    def reached(self):
+        """
+        The set of peers which received the message
+        """
+        with self.__lock:
+            return self.__reached.copy()
+
+    @property
+    def failed(self):
+        """
+        Peer -> exception dictionary of the peers which couldn't be reached
+        """
+        with self.__lock:
+            return self.__failed.copy()
+
+    def done(self):
+        """
+        Checks if all the peers have been contacted
+        """
+        return self.__event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for all the peers to be contacted
+
+        :param timeout: Maximum time to wait (in seconds)
+        :return: True if all peers have been contacted
+        """
+        return self.__event.wait(timeout) or self.__event.is_set()
+
+    def add_done_callback(self, method):
+        """
+        Calls the given method once all the peers have been contacted, or
+        immediately if it's already the case. The method is called with this
+        handle as argument.
+
+        :param method: A method accepting a FanOutHandle
+        """
+        with self.__lock:
+            if not self.__event.is_set():
+                self.__callbacks.append(method)
+                return
+
+        self.__call(method)
+
+    def __call(self, method):
+        """
+        Calls a done callback
+        """
+        try:
+            # pylint: disable=W0703
+            method(self)
+        except Exception as ex:
+            _logger.exception("Error calling a fan-out callback: %s", ex)
+
+    def set_result(self, peer, error=None):
+        """
+        Stores the result of the sending to a peer
+
+        :param peer: A peer bean
+        :param error: The error raised while sending the message, if any
+        """
+        with self.__lock:
+            self.__pending.discard(peer)
+            if error is None:
+                self.__reached.add(peer)
+            else:
+                self.__failed[peer] = error
+
+            if self.__pending or self.__event.is_set():
+                return
+
+            self.__event.set()
+            callbacks = self.__callbacks[:]
+            del self.__callbacks[:]
+
+        for method in callbacks:
+            self.__call(method)
+
+
+class FanOutEngine(object):
+    """
+    Sends messages to many peers with a limited number of workers.
+    Workers are started on demand and stop when there is nothing left to send.
+    """
+    def __init__(self, send_method, max_workers=16, name="Herald-FanOut"):
+        """
+        Sets up the engine
+
+        :param send_method: Method sending a payload to a peer:
+                            send_method(peer, target, payload, headers)
+        :param max_workers: Maximum number of concurrent requests
+        :param name: Prefix of the name of the workers
+        """
+        self.__send = send_method
+        self.__max_workers = max(1, int(max_workers))
+        self.__name = name
+
+        # Queue of (handle, peer, target, payload, headers)
+        self.__queue = collections.deque()
+        self.__nb_workers = 0
+        self.__running = False
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the engine
+        """
+        with self.__lock:
+            self.__running = True
+
+    def stop(self):
+        """
+        Stops the engine: pending sendings are marked as failed
+        """
+        with self.__lock:
+            self.__running = False
+            pending = list(self.__queue)
+            self.__queue.clear()
+
+        error = IOError("Fan-out engine stopped")
+        for handle, peer, _, _, _ in pending:
+            handle.set_result(peer, error)
+
+    def fire(self, handle, targets, payload, headers):
+        """
+        Queues the sending of a payload to the given targets
+
+        :param handle: The FanOutHandle of the message
+        :param targets: A list of (peer, target) tuples, the target being
+                        given as is to the send method
+        :param payload: The message payload (shared by all requests)
+        :param headers: The request headers (shared by all requests)
+        """
+        with self.__lock:
+            if not self.__running:
+                raise ValueError("Fan-out engine stopped")
+
+            self.__queue.extend((handle, peer, target, payload, headers)
+                                for peer, target in targets)
+            nb_workers = min(self.__max_workers, len(self.__queue)) \
+                - self.__nb_workers
+            for _ in range(nb_workers):
+                thread = threading.Thread(
+                    target=self.__run,
+                    name="{0}-{1}".format(self.__name, self.__nb_workers))
+                thread.daemon = True
+                self.__nb_workers += 1
+                thread.start()
+
+    def __run(self):
+        """
+        Worker loop
+        """
+        while True:
+            with self.__lock:
+                if not self.__queue:
+                    self.__nb_workers -= 1
+                    return
+
+                handle, peer, target, payload, headers = \
+                    self.__queue.popleft()
+
+            try:
+                self.__send(peer, target, payload, headers)
+            except Exception as ex:
+                handle.set_result(peer, ex)
+            else:
+                handle.set_result(peer)
@@ -0,0 +1,336 @@
+#!/usr/bin/python
+# -- Content-Encoding: UTF-8 --
+"""
+Herald HTTP transport sender engine: keeps a pool of persistent (keep-alive)
+connections for each peer HTTP server, closes the idle ones and tracks the
+health of each server.
+
+After a few consecutive failures, a server is considered down: requests to it
+fail immediately until a back-off delay (doubled on each new failure) is
+elapsed, instead of blocking the callers on connection timeouts.
+
+:author: Thomas Calmant
+:copyright: Copyright 2015, isandlaTech
+:license: Apache License 2.0
+:version: 0.0.4
+:status: Alpha
+
+..
+
+    Copyright 2015 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 0, 4)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# HTTP requests
+import requests
+import requests.adapters
+import requests.exceptions
+
+# Herald
+from . import HEADER_CAPABILITIES
+from herald.utils import LoopTimer
+
+# Standard library
+import logging
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+
+
+class PeerUnreachable(IOError):
+    """
+    The HTTP server of a peer is considered down: the request hasn't been sent
+    """
+    pass
+
+
+class _PeerConnections(object):
+    """
+    Connection pool and health information about a peer HTTP server
+    """
+    def __init__(self, address, pool_size, ewma_alpha=.2):
+        """
+        Sets up the pool
+
+        :param address: A (host, port) tuple
+        :param pool_size: Maximum number of connections kept alive
+        :param ewma_alpha: Weight of the last request in the average latency
+        """
+        self.address = address
+        self.session = requests.Session()
+        self.session.stream = False
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Time of the last request
+        self.last_use = time.time()
+
+        # Capabilities given by the server in its last response
+        self.capabilities = frozenset()
+
+        # Health
+        self.__alpha = ewma_alpha
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.last_error = None
+        self.down_until = 0
+        self.backoff = 0
+
+    def close(self):
+        """
+        Closes the connections to the server
+        """
+        self.session.close()
+
+    def success(self, latency):
+        """
+        Updates the health after a successful request
+
+        :param latency: Duration of the request (in seconds)
+        """
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.backoff = 0
+        self.down_until = 0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.__alpha * (latency - self.latency)
+
+    def failure(self, error, threshold, min_backoff, max_backoff):
+        """
+        Updates the health after a failed request
+
+        :param error: Description of the error
+        :param threshold: Number of consecutive failures before considering
+                          the server down
+        :param min_backoff: First back-off delay (in seconds)
+        :param max_backoff: Maximum back-off delay (in seconds)
+        """
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.consecutive_failures >= threshold:
+            self.backoff = min(max(min_backoff, self.backoff * 2),
+                               max_backoff)
+            self.down_until = time.time() + self.backoff
+
+    def stats(self):
+        """
+        Returns the health of the server
+
+        :return: A dictionary
+        """
+        return {"address": self.address, "up": self.down_until <= time.time(),
+                "successes": self.successes, "failures": self.failures,
+                "consecutive_failures": self.consecutive_failures,
+                "latency": self.latency, "last_error": self.last_error,
+                "idle": time.time() - self.last_use,
+                "capabilities": sorted(self.capabilities)}
+
+
+class HttpSender(object):
+    """
+    Sends HTTP POST requests using a connection pool per peer server
+    """
+    def __init__(self, pool_size=4, idle_timeout=60, request_timeout=30,
+                 failure_threshold=3, min_backoff=1, max_backoff=30):
+        """
+        Sets up the engine
+
+        :param pool_size: Maximum number of connections kept alive per server
+        :param idle_timeout: Time after which the connections to an unused
+                             server are closed (in seconds)
+        :param request_timeout: Maximum time to wait for a server (connection
+                                or response), in seconds (None for ever)
+        :param failure_threshold: Number of consecutive failures before
+                                  considering a server down
+        :param min_backoff: First delay during which a down server won't be
+                            contacted (in seconds)
+        :param max_backoff: Maximum back-off delay (in seconds)
+        """
+        self.__pool_size = max(1, int(pool_size))
+        self.__idle_timeout = idle_timeout
+        self.__request_timeout = request_timeout
+        self.__failure_threshold = max(1, int(failure_threshold))
+        self.__min_backoff = min_backoff
+        self.__max_backoff = max_backoff
+
+        # (host, port) -> _PeerConnections
+        self.__peers = {}
+        self.__lock = threading.Lock()
+
+        # Idle connections reaper
+        self.__reaper = None
+
+    def start(self):
+        """
+        Starts the idle connections reaper
+        """
+        if self.__reaper is None and self.__idle_timeout:
+            self.__reaper = LoopTimer(max(1, self.__idle_timeout / 2.),
+                                      self.reap, name="Herald-HTTP-Reaper")
+            self.__reaper.start()
+
+    def stop(self):
+        """
+        Stops the reaper and closes all connections
+        """
+        if self.__reaper is not None:
+            self.__reaper.cancel()
+            self.__reaper.join()
+            self.__reaper = None
+
+        with self.__lock:
+            peers = list(self.__peers.values())
+            self.__peers.clear()
+
+        for peer in peers:
+            peer.close()
+
+    def reap(self):
+        """
+        Closes the connections to the servers which haven't been used for
+        idle_timeout seconds. Their health information is forgotten too.
+        """
+        limit = time.time() - self.__idle_timeout
+        with self.__lock:
+            idle = [address for address, peer in self.__peers.items()
+                    if peer.last_use < limit]
+            peers = [self.__peers.pop(address) for address in idle]
+
+        for peer in peers:
+            _logger.debug("Closing idle connections to %s", peer.address)
+            peer.close()
+
+    def __get_peer(self, address):
+        """
+        Returns the connections to the given server
+
+        :param address: A (host, port) tuple
+        :return: A _PeerConnections object
+        """
+        try:
+            return self.__peers[address]
+        except KeyError:
+            with self.__lock:
+                peer = self.__peers.get(address)
+                if peer is None:
+                    peer = self.__peers[address] = \
+                        _PeerConnections(address, self.__pool_size)
+                return peer
+
+    def post(self, address, url, content, headers):
+        """
+        Sends a POST request to a peer
+
+        :param address: Address of the peer server: (host, port) tuple
+        :param url: Target URL
+        :param content: Request body
+        :param headers: Request headers
+        :return: The response bean
+        :raise PeerUnreachable: The server is considered down
+        :raise requests.exceptions.RequestException: Error sending the request
+        """
+        peer = self.__get_peer(address)
+        now = time.time()
+        peer.last_use = now
+        if peer.down_until > now:
+            raise PeerUnreachable("{0}:{1} is down ({2})"
+                                  .format(address[0], address[1],
+                                          peer.last_error))
+
+        try:
+            response = peer.session.post(url, content, headers=headers,
+                                         timeout=self.__request_timeout)
+        except requests.exceptions.RequestException as ex:
+            peer.failure(str(ex), self.__failure_threshold,
+                         self.__min_backoff, self.__max_backoff)
+            raise
+
+        if response.status_code >= 500:
+            peer.failure("HTTP {0}".format(response.status_code),
+                         self.__failure_threshold,
+                         self.__min_backoff, self.__max_backoff)
+        else:
+            peer.success(time.time() - now)
+
+            # Servers without the header (older peers, other implementations)
+            # have no capabilities
+            capabilities = response.headers.get(HEADER_CAPABILITIES)
+            peer.capabilities = frozenset(
+                item.strip() for item in (capabilities or "").split(",")
+                if item.strip())
+        return response
+
+    def get_capabilities(self, address):
+        """
+        Returns the capabilities given by a peer server in its last response
+
+        :param address: A (host, port) tuple
+        :return: A frozen set, empty if the server hasn't been contacted yet
+        """
+        try:
+            return self.__peers[address].capabilities
+        except KeyError:
+            # Unknown server
+            return frozenset()
+
+    def is_up(self, address):
+        """
+        Checks if the given server is not considered down
+
+        :param address: A (host, port) tuple
+        :return: False if the server is considered down
+        """
+        try:
+            return self.__peers[address].down_until <= time.time()
+        except KeyError:
+            # Unknown server
+            return True
+
+    def health(self, address=None):
+        """
+        Returns the health of a peer server, or of all of them
+
+        :param address: A (host, port) tuple, or None
+        :return: A dictionary, a list of dictionaries or None
+        """
+        if address is not None:
+            try:
+                return self.__peers[address].stats()
+            except KeyError:
+                return None
+
+        with self.__lock:
+            peers = list(self.__peers.values())
+        return [peer.stats() for peer in peers]
@@ -37,8 +37,10 @@ __docformat__ = "restructuredtext en"
 
 # Herald
 from . import ACCESS_ID, SERVICE_HTTP_DIRECTORY, SERVICE_HTTP_RECEIVER, \
-    FACTORY_SERVLET, CONTENT_TYPE_JSON
+    FACTORY_SERVLET, CONTENT_TYPE_JSON, CONTENT_TYPES, HEADER_CAPABILITIES, \
+    LOCAL_CAPABILITIES
 from . import beans
+from herald.codec import get_codec
 import herald.beans
 import herald.transports.peer_contact as peer_contact
 import herald.utils as utils
@@ -46,7 +48,7 @@ import herald.transports.http
 
 # Pelix
 from pelix.ipopo.decorators import ComponentFactory, Requires, Provides, \
-    Property, Validate, Invalidate, RequiresBest
+    Property, Validate, Invalidate, RequiresBest, BindField, UnbindField
 from pelix.utilities import to_bytes, to_unicode
 import pelix.http
 import pelix.misc.jabsorb as jabsorb
@@ -60,6 +62,17 @@ import uuid
 
 # ------------------------------------------------------------------------------
 
+_MESSAGE_TYPES = dict(
+    (types[0], name) for name, types in CONTENT_TYPES.items())
+""" MIME type -> name of the codec of a single message """
+
+_BATCH_TYPES = dict(
+    (types[1], name) for name, types in CONTENT_TYPES.items())
+""" MIME type -> name of the codec of a batch envelope """
+
+_CAPABILITIES = ",".join(LOCAL_CAPABILITIES)
+""" Value of the capabilities header of the responses """
+
 _logger = logging.getLogger(__name__)
 
 # ------------------------------------------------------------------------------
@@ -83,6 +96,7 @@ def _make_json_result(code, message="", results=None):
 @Requires('_core', herald.SERVICE_HERALD_INTERNAL)
 @Requires('_directory', herald.SERVICE_DIRECTORY)
 @Requires('_http_directory', SERVICE_HTTP_DIRECTORY)
+@Requires('_metrics', herald.SERVICE_METRICS, optional=True)
 @Provides(pelix.http.HTTP_SERVLET)
 @Provides(SERVICE_HTTP_RECEIVER, '_controller')
 @Property('_servlet_path', pelix.http.HTTP_SERVLET_PATH, '/herald')
@@ -99,6 +113,10 @@ class HeraldServlet(object):
         self._directory = None
         self._probe = None
 
+        # Metrics registry (optional) and serialization time histogram
+        self._metrics = None
+        self.__decode_time = None
+
         # Peer contact handling
         self.__contact = None
 
@@ -115,6 +133,22 @@ class HeraldServlet(object):
         self._port = None
         self._servlet_path = None
 
+    @BindField('_metrics')
+    def _bind_metrics(self, _, metrics, svc_ref):
+        """
+        The metrics registry has been bound
+        """
+        self.__decode_time = metrics.histogram(
+            "herald.serialization.time", ("transport", "operation"),
+            "Time to encode or decode messages").labels(ACCESS_ID, "decode")
+
+    @UnbindField('_metrics')
+    def _unbind_metrics(self, _, metrics, svc_ref):
+        """
+        The metrics registry has gone away
+        """
+        self.__decode_time = None
+
     @staticmethod
     def __load_dump(message, description):
         """
@@ -124,8 +158,11 @@ class HeraldServlet(object):
         :param description: The parsed remote peer description
         :return: The peer dump map
         """
-        if message.access == ACCESS_ID:
+        if message.access == ACCESS_ID and (
+                ACCESS_ID in description.get('accesses', ())
+                or not description.get('since')):
             # Forge the access to the HTTP server using extra information
+            # (partial descriptions only contain the changed accesses)
             extra = message.extra
             description['accesses'][ACCESS_ID] = \
                 beans.HTTPAccess(extra['host'], extra['port'],
@@ -230,11 +267,13 @@ class HeraldServlet(object):
         peer_dump = self._directory.get_local_peer().dump()
         jabsorb_content = jabsorb.to_jabsorb(peer_dump)
         content = json.dumps(jabsorb_content, default=utils.json_converter)
+        response.set_header(HEADER_CAPABILITIES, _CAPABILITIES)
         response.send_content(200, content, CONTENT_TYPE_JSON)
 
     def do_POST(self, request, response):
         """
-        Handles a POST request, i.e. the reception of a message
+        Handles a POST request, i.e. the reception of a message or of a batch
+        envelope
 
         :param request: The HTTP request bean
         :param response: The HTTP response handler
@@ -244,111 +283,139 @@ class HeraldServlet(object):
         code = 200
         content = ""
 
-        # Extract headers
-        """
         content_type = request.get_header('content-type')
-        subject = request.get_header('herald-subject')
-        uid = request.get_header('herald-uid')
-        reply_to = request.get_header('herald-reply-to')
-        timestamp = request.get_header('herald-timestamp')
-        sender_uid = request.get_header('herald-sender-uid')
+        data = request.read_data()
+
+        # Client information
+        host = utils.normalize_ip(request.get_client_address()[0])
+
+        try:
+            if content_type in _BATCH_TYPES:
+                # Batch envelope
+                codec = get_codec(_BATCH_TYPES[content_type])
+                batch = True
+            else:
+                # Herald message, or raw message
+                codec = get_codec(_MESSAGE_TYPES[content_type])
+                batch = False
+        except KeyError:
+            # Raw message (or unsupported codec)
+            self.__handle_message(None, host, to_unicode(data), None)
+        else:
+            if not codec.binary:
+                data = to_unicode(data)
+
+            decode_time = self.__decode_time
+            start = time.time()
+            if batch:
+                try:
+                    received_msgs = codec.read_envelope(data)
+                except ValueError as ex:
+                    _logger.error("Invalid batch envelope: %s", ex)
+                    code = 400
+                else:
+                    if decode_time is not None:
+                        decode_time.record(time.time() - start)
+
+                    for received_msg in received_msgs:
+                        self.__handle_message(received_msg, host, None,
+                                              codec.name)
+            else:
+                try:
+                    received_msg = codec.decode(data)
+                except Exception as ex:
+                    _logger.exception("DoPOST ERROR:: %s", ex)
+                    received_msg = None
+                else:
+                    if decode_time is not None:
+                        decode_time.record(time.time() - start)
+                self.__handle_message(received_msg, host, data, codec.name)
+
+        # Convert content (Python 3)
+        if content:
+            content = jabsorb.to_jabsorb(content)
+
+        content = to_bytes(content)
+
+        # Send response, with the capabilities of the servlet: the sender
+        # learns them from its first request
+        response.set_header(HEADER_CAPABILITIES, _CAPABILITIES)
+        response.send_content(code, content, CONTENT_TYPE_JSON)
+
+    def __handle_message(self, received_msg, host, raw_content, codec_name):
+        """
+        Completes a received message with its HTTP access information and
+        gives it to Herald
+
+        :param received_msg: The parsed MessageReceived bean, or None for a
+                             raw message
+        :param host: Address of the client
+        :param raw_content: The request body (for raw messages)
+        :param codec_name: Name of the codec of the message, used to reply
         """
-        content_type = request.get_header('content-type')
-        subject = None
-        uid = None
         reply_to = None
-        timestamp = None
         sender_uid = None
-        
-        raw_content = to_unicode(request.read_data())
-        # print('#'*20)
-        # print(raw_content)
-        # print('#'*20)
-        #
-        # Client information
-        host = utils.normalize_ip(request.get_client_address()[0])
-        
-        message = None
-        
-        if content_type != CONTENT_TYPE_JSON:
+
+        if received_msg is None or not received_msg.uid \
+                or not received_msg.subject:
             # Raw message
             uid = str(uuid.uuid4())
             subject = herald.SUBJECT_RAW
-            #msg_content = raw_content
-            msg_content = raw_content
             port = -1
-            extra = {'host': host, 'raw': True}     
-            
+            extra = {'host': host, 'raw': True}
+
             # construct a new Message bean
-            message = herald.beans.MessageReceived(uid, subject, msg_content,
-                                               None, None,
-                                               ACCESS_ID, None, extra)                  
+            message = herald.beans.MessageReceived(uid, subject, raw_content,
+                                                   None, None,
+                                                   ACCESS_ID, None, extra)
         else:
-            # Herald message
-            try:            
-                received_msg = utils.from_json(raw_content)                
-            except Exception as ex:
-                _logger.exception("DoPOST ERROR:: %s", ex)
-                
-            msg_content = received_msg.content
-            
             subject = received_msg.subject
             uid = received_msg.uid
             reply_to = received_msg.reply_to
-            timestamp = received_msg.timestamp
             sender_uid = received_msg.sender
-            
-            if not uid or not subject:
-                # Raw message
-                uid = str(uuid.uuid4())
-                subject = herald.SUBJECT_RAW
-                #msg_content = raw_content
-                msg_content = raw_content
-                port = -1
-                extra = {'host': host, 'raw': True}     
-                
-                # construct a new Message bean
-                message = herald.beans.MessageReceived(uid, subject, msg_content,
-                                               None, None,
-                                               ACCESS_ID, None, extra) 
-                
-            else:       
-                # Store sender information
-                try:                 
-                    port = int(received_msg.get_header(herald.transports.http.MESSAGE_HEADER_PORT))                    
-                except (KeyError, ValueError, TypeError):
-                    port = 80
-                path = None
-                if herald.transports.http.MESSAGE_HEADER_PATH in received_msg.headers:
-                    path = received_msg.get_header(herald.transports.http.MESSAGE_HEADER_PATH)                
-                extra = {'host': host, 'port': port,
-                         'path': path,
-                         'parent_uid': uid}
-    
-                try:
-                    # Check the sender UID port
-                    # (not perfect, but can avoid spoofing)
-                    if not self._http_directory.check_access(
-                            sender_uid, host, port):
-                        # Port doesn't match: invalid UID
-                        sender_uid = "<invalid>"
-                except ValueError:
-                    # Unknown peer UID: keep it as is
-                    pass
-            
-                # Prepare the bean
-                received_msg.add_header(herald.MESSAGE_HEADER_SENDER_UID, sender_uid)
-                received_msg.set_access(ACCESS_ID)
-                received_msg.set_extra(extra)
-                message = received_msg
-                           
+
+            # Store sender information
+            try:
+                port = int(received_msg.get_header(
+                    herald.transports.http.MESSAGE_HEADER_PORT))
+            except (KeyError, ValueError, TypeError):
+                port = 80
+            path = None
+            if herald.transports.http.MESSAGE_HEADER_PATH \
+                    in received_msg.headers:
+                path = received_msg.get_header(
+                    herald.transports.http.MESSAGE_HEADER_PATH)
+            extra = {'host': host, 'port': port,
+                     'path': path,
+                     'parent_uid': uid,
+                     'codec': codec_name}
+
+            try:
+                # Check the sender UID port
+                # (not perfect, but can avoid spoofing)
+                if not self._http_directory.check_access(
+                        sender_uid, host, port):
+                    # Port doesn't match: invalid UID
+                    sender_uid = "<invalid>"
+            except ValueError:
+                # Unknown peer UID: keep it as is
+                pass
+
+            # Prepare the bean
+            received_msg.add_header(herald.MESSAGE_HEADER_SENDER_UID,
+                                    sender_uid)
+            received_msg.set_access(ACCESS_ID)
+            received_msg.set_extra(extra)
+            message = received_msg
+
         # Log before giving message to Herald
-        self._probe.store(
-            herald.PROBE_CHANNEL_MSG_RECV,
-            {"uid": message.uid, "timestamp": time.time(),
-             "transport": ACCESS_ID, "subject": message.subject,
-             "source": sender_uid, "repliesTo": reply_to or "",
-             "transportSource": "[{0}]:{1}".format(host, port)})
+        if herald.PROBE_CHANNEL_MSG_RECV in self._probe.active_channels:
+            self._probe.store(
+                herald.PROBE_CHANNEL_MSG_RECV,
+                {"uid": message.uid, "timestamp": time.time(),
+                 "transport": ACCESS_ID, "subject": message.subject,
+                 "source": sender_uid, "repliesTo": reply_to or "",
+                 "transportSource": "[{0}]:{1}".format(host, port)})
 
         if subject.startswith(peer_contact.SUBJECT_DISCOVERY_PREFIX):
             # Handle discovery message
@@ -356,12 +423,3 @@ class HeraldServlet(object):
         else:
             # All other messages are given to Herald Core
             self._core.handle_message(message)
-
-        # Convert content (Python 3)
-        if content:
-            content = jabsorb.to_jabsorb(content)
-
-        content = to_bytes(content)
-
-        # Send response
-        response.send_content(code, content, CONTENT_TYPE_JSON)
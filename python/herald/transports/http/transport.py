@@ -37,28 +37,28 @@ __docformat__ = "restructuredtext en"
 
 # Herald HTTP
 from . import ACCESS_ID, SERVICE_HTTP_RECEIVER, SERVICE_HTTP_TRANSPORT, \
-    CONTENT_TYPE_JSON
+    CONTENT_TYPE_JSON, CONTENT_TYPES, CAPABILITY_BATCH
+from .batch import MessageBatcher
+from .fanout import FanOutEngine, FanOutHandle
+from .sender import HttpSender, PeerUnreachable
 
 # HTTP requests
 import requests.exceptions
 
 # Herald Core
+from herald.codec import get_codec, select_codec
 from herald.exceptions import InvalidPeerAccess
 import herald
 import herald.beans as beans
-import herald.utils as utils
 import herald.transports.http
 
 # Pelix
 from pelix.ipopo.decorators import ComponentFactory, Requires, Provides, \
-    Property, BindField, Validate, Invalidate, Instantiate, RequiresBest
-from pelix.utilities import to_str
-import pelix.utilities
-import pelix.threadpool
-import pelix.misc.jabsorb as jabsorb
+    Property, BindField, UnbindField, Validate, Invalidate, Instantiate, \
+    RequiresBest
+from pelix.utilities import to_bytes, to_str
 
 # Standard library
-import json
 import logging
 import time
 
@@ -73,8 +73,16 @@ _logger = logging.getLogger(__name__)
 @RequiresBest('_probe', herald.SERVICE_PROBE)
 @Requires('_directory', herald.SERVICE_DIRECTORY)
 @Requires('_local_recv', SERVICE_HTTP_RECEIVER)
+@Requires('_metrics', herald.SERVICE_METRICS, optional=True)
 @Provides((herald.SERVICE_TRANSPORT, SERVICE_HTTP_TRANSPORT))
 @Property('_access_id', herald.PROP_ACCESS_ID, ACCESS_ID)
+@Property('_pool_size', 'http.pool.size', 4)
+@Property('_idle_timeout', 'http.pool.idle_timeout', 60)
+@Property('_request_timeout', 'http.request.timeout', 30)
+@Property('_batch_linger', 'http.batch.linger', 0)
+@Property('_batch_max_messages', 'http.batch.max_messages', 64)
+@Property('_batch_max_bytes', 'http.batch.max_bytes', 262144)
+@Property('_fanout_workers', 'http.fanout.workers', 16)
 @Instantiate('herald-http-transport')
 class HttpTransport(object):
     """
@@ -90,17 +98,34 @@ class HttpTransport(object):
         # Debug probe
         self._probe = None
 
+        # Metrics registry (optional) and serialization time histogram
+        self._metrics = None
+        self.__encode_time = None
+
         # Properties
         self._access_id = ACCESS_ID
+        self._pool_size = 4
+        self._idle_timeout = 60
+        self._request_timeout = 30
+
+        # Batching configuration: linger window (in seconds, 0 to disable)
+        # and maximum size of a batch
+        self._batch_linger = 0
+        self._batch_max_messages = 64
+        self._batch_max_bytes = 262144
 
         # Local UID
         self.__peer_uid = None
 
-        # Request send pool
-        self.__pool = pelix.threadpool.ThreadPool(5, logname="herald-http")
+        # Group messages sender
+        self._fanout_workers = 16
+        self.__fanout = None
+
+        # Sender engine: connections to each peer
+        self.__sender = None
 
-        # Requests session
-        self.__session = requests.Session()
+        # Messages batcher (None if disabled)
+        self.__batcher = None
 
         # Local access information
         self.__access_port = None
@@ -115,15 +140,39 @@ class HttpTransport(object):
         self.__access_port = access[1]
         self.__access_path = access[2]
 
+    @BindField('_metrics')
+    def _bind_metrics(self, _, metrics, svc_ref):
+        """
+        The metrics registry has been bound
+        """
+        self.__encode_time = metrics.histogram(
+            "herald.serialization.time", ("transport", "operation"),
+            "Time to encode or decode messages").labels(ACCESS_ID, "encode")
+
+    @UnbindField('_metrics')
+    def _unbind_metrics(self, _, metrics, svc_ref):
+        """
+        The metrics registry has gone away
+        """
+        self.__encode_time = None
+
     @Validate
     def _validate(self, _):
         """
         Component validated
         """
         self.__peer_uid = self._directory.local_uid
-        self.__session = requests.Session()
-        self.__session.stream = False
-        self.__pool.start()
+        self.__sender = HttpSender(self._pool_size, self._idle_timeout,
+                                   self._request_timeout)
+        self.__sender.start()
+        if self._batch_linger and float(self._batch_linger) > 0:
+            self.__batcher = MessageBatcher(
+                self.__post_batch, float(self._batch_linger),
+                self._batch_max_messages, self._batch_max_bytes)
+        self.__fanout = FanOutEngine(self.__send_prepared,
+                                     self._fanout_workers,
+                                     "Herald-HTTP-FanOut")
+        self.__fanout.start()
 
     @Invalidate
     def _invalidate(self, _):
@@ -131,8 +180,11 @@ class HttpTransport(object):
         Component invalidated
         """
         self.__peer_uid = None
-        self.__session.close()
-        self.__pool.stop()
+        self.__fanout.stop()
+        self.__fanout = None
+        self.__sender.stop()
+        self.__sender = None
+        self.__batcher = None
 
     def __get_access(self, peer, extra=None):
         """
@@ -140,7 +192,7 @@ class HttpTransport(object):
 
         :param peer: A Peer bean
         :param extra: Extra information, given for replies
-        :return: A URL, or None
+        :return: A ((host, port), URL) tuple, or (None, None)
         """
         host = None
         port = 0
@@ -157,9 +209,10 @@ class HttpTransport(object):
                 host, port, path = peer.get_access(ACCESS_ID).access
             except (KeyError, AttributeError):
                 # Invalid access: stop here
-                return None
+                return None, None
 
         # Normalize arguments
+        address = (host, port)
         if ':' in host:
             # IPv6 address
             host = '[{0}]'.format(host)
@@ -170,13 +223,32 @@ class HttpTransport(object):
         if path[0] == '/':
             path = path[1:]
 
-        return 'http://{0}:{1}/{2}'.format(host, port, path)
+        return address, 'http://{0}:{1}/{2}'.format(host, port, path)
+
+    def __get_codec(self, address, extra=None):
+        """
+        Selects the codec to use to send messages to the given peer server:
+        the one of the message we reply to, or the preferred one among those
+        given in the capabilities of the server (JSON until it answered)
+
+        :param address: Address of the peer server: (host, port) tuple
+        :param extra: Extra information, given for replies
+        :return: A codec
+        """
+        if extra is not None and extra.get('codec'):
+            try:
+                return get_codec(extra['codec'])
+            except KeyError:
+                pass
+
+        return select_codec(self.__sender.get_capabilities(address))
 
-    def __prepare_message(self, message, parent_uid=None, target_peer=None, target_group=None):
+    def __prepare_message(self, message, codec, parent_uid=None, target_peer=None, target_group=None):
         """
         Prepares a HTTP request.
 
         :param message: The Message bean to send
+        :param codec: The codec used to encode the message
         :param parent_uid: UID of the message this one replies to (optional)
         :return: A (headers, content) tuple
         """
@@ -190,7 +262,7 @@ class HttpTransport(object):
                    'herald-port': self.__access_port,
                    'herald-path': self.__access_path}
         """
-        headers = {'content-type': CONTENT_TYPE_JSON} 
+        headers = {'content-type': CONTENT_TYPES[codec.name][0]}
         message.add_header(herald.MESSAGE_HEADER_SENDER_UID, self.__peer_uid)
         message.add_header(herald.transports.http.MESSAGE_HEADER_PORT, self.__access_port)
         message.add_header(herald.transports.http.MESSAGE_HEADER_PATH, self.__access_path)
@@ -204,32 +276,111 @@ class HttpTransport(object):
         if target_group is not None:
             message.add_header(herald.MESSAGE_HEADER_TARGET_GROUP, target_group)     
         if message.subject in herald.SUBJECTS_RAW:
-            content = utils.to_str(message.content)
+            headers['content-type'] = CONTENT_TYPE_JSON
+            content = to_str(message.content)
         else:
-            # Convert content to JSON
-            # print("debug: message: {}".format(message))
-            # print(type(message))
-            # print(message.content)
-            content = utils.to_json(message)
-            
+            encode_time = self.__encode_time
+            if encode_time is None:
+                content = codec.encode(message)
+            else:
+                start = time.time()
+                content = codec.encode(message)
+                encode_time.record(time.time() - start)
+
         return headers, content
 
-    def __post_message(self, url, content, headers):
+    def __post_message(self, address, url, content, headers):
         """
         Method called directly or in a thread to send a POST HTTP request
 
+        :param address: Address of the peer server: (host, port) tuple
         :param url: Target URL
         :param content: Request body
         :param headers: Request headers
         :return: A response bean
         """
         try:
-            return self.__session.post(url, content, headers=headers)
-        except requests.exceptions.ConnectionError as ex:
+            return self.__sender.post(address, url, content, headers)
+        except PeerUnreachable as ex:
+            # Peer considered down: don't wait for it
+            _logger.debug("Message not sent: %s", ex)
+            return None
+        except requests.exceptions.RequestException as ex:
             # Connection aborted during request
             _logger.error("Connection error while posting a message: %s", ex)
             return None
 
+    def __post_batch(self, key, url, contents):
+        """
+        Sends a batch of messages, in an envelope if necessary
+
+        :param key: A ((host, port), codec name) tuple
+        :param url: Target URL
+        :param contents: List of encoded messages
+        :raise IOError: Error sending the batch
+        :raise requests.exceptions.HTTPError: Error on the server side
+        """
+        address, codec_name = key
+        content_type, batch_content_type = CONTENT_TYPES[codec_name]
+        if len(contents) == 1:
+            content = contents[0]
+            headers = {'content-type': content_type}
+        else:
+            content = get_codec(codec_name).make_envelope(contents)
+            headers = {'content-type': batch_content_type}
+
+        response = self.__post_message(address, url, content, headers)
+        if response is None:
+            # The error has been logged in post_message
+            raise IOError("Error sending {0} message(s) to {1}"
+                          .format(len(contents), url))
+        else:
+            # Raise an error if the status isn't 2XX
+            response.raise_for_status()
+
+    def __send(self, peer, message, codec, address, url, content, headers):
+        """
+        Sends a prepared message, in a batch if the peer server supports it
+
+        :param peer: The target Peer bean (can be None)
+        :param message: The Message bean
+        :param codec: The codec used to encode the message
+        :param address: Address of the peer server: (host, port) tuple
+        :param url: Target URL
+        :param content: Request body
+        :param headers: Request headers
+        :raise IOError: Error sending the message
+        :raise requests.exceptions.HTTPError: Error on the server side
+        """
+        batcher = self.__batcher
+        if batcher is not None and peer is not None \
+                and message.subject not in herald.SUBJECTS_RAW \
+                and CAPABILITY_BATCH in self.__sender.get_capabilities(address):
+            # Messages are batched by server and by codec
+            batcher.send((address, codec.name), url, content)
+            return
+
+        response = self.__post_message(address, url, content, headers)
+        if response is None:
+            # The error has been logged in post_message
+            raise IOError("Error sending message {0}".format(message.uid))
+        else:
+            # Raise an error if the status isn't 2XX
+            response.raise_for_status()
+
+    def get_peers_health(self):
+        """
+        Returns the health of the HTTP servers of the peers contacted
+        recently: number of successful and failed requests, average latency,
+        ...
+
+        :return: A list of dictionaries
+        """
+        sender = self.__sender
+        if sender is None:
+            return []
+        return sender.health()
+
     def fire(self, peer, message, extra=None):
         """
         Fires a message to a peer
@@ -251,35 +402,49 @@ class HttpTransport(object):
         # print(message.content)
 
         # Try to read extra information
-        url = self.__get_access(peer, extra)
+        address, url = self.__get_access(peer, extra)
         if not url:
             # No HTTP access description
             raise InvalidPeerAccess(beans.Target(peer=peer),
                                     "No '{0}' access found"
                                     .format(self._access_id))           
         # Send the HTTP request (blocking) and raise an error if necessary
-        headers, content = self.__prepare_message(message, parent_uid, target_peer=peer)
+        codec = self.__get_codec(address, extra)
+        headers, content = self.__prepare_message(message, codec, parent_uid,
+                                                  target_peer=peer)
 
         # Log before sending
-        self._probe.store(
-            herald.PROBE_CHANNEL_MSG_SEND,
-            {"uid": message.uid, "timestamp": time.time(),
-             "transport": ACCESS_ID, "subject": message.subject,
-             "target": peer.uid if peer else "<unknown>",
-             "transportTarget": url, "repliesTo": parent_uid or ""})
-
-        self._probe.store(
-            herald.PROBE_CHANNEL_MSG_CONTENT,
-            {"uid": message.uid, "content": content}
-        )
-
-        response = self.__post_message(url, content, headers)
-        if response is None:
-            # The error has been logged in post_message
-            raise IOError("Error sending message {0}".format(message.uid))
-        else:
-            # Raise an error if the status isn't 2XX
-            response.raise_for_status()
+        probed = self._probe.active_channels
+        if probed:
+            if herald.PROBE_CHANNEL_MSG_SEND in probed:
+                self._probe.store(
+                    herald.PROBE_CHANNEL_MSG_SEND,
+                    {"uid": message.uid, "timestamp": time.time(),
+                     "transport": ACCESS_ID, "subject": message.subject,
+                     "target": peer.uid if peer else "<unknown>",
+                     "transportTarget": url, "repliesTo": parent_uid or ""})
+
+            if herald.PROBE_CHANNEL_MSG_CONTENT in probed:
+                self._probe.store(
+                    herald.PROBE_CHANNEL_MSG_CONTENT,
+                    {"uid": message.uid, "content": content})
+
+        self.__send(peer, message, codec, address, url, content, headers)
+
+    def __send_prepared(self, peer, target, payload, headers):
+        """
+        Sends a prepared group message to a peer (called by the fan-out
+        engine)
+
+        :param peer: The target Peer bean
+        :param target: A (message, codec, address, url) tuple
+        :param payload: Request body
+        :param headers: Request headers
+        :raise IOError: Error sending the message
+        :raise requests.exceptions.HTTPError: Error on the server side
+        """
+        message, codec, address, url = target
+        self.__send(peer, message, codec, address, url, payload, headers)
 
     def fire_group(self, group, peers, message):
         """
@@ -289,57 +454,66 @@ class HttpTransport(object):
         :param peers: Peers to communicate with
         :param message: Message to send
         :return: The list of reached peers
-
         """
-        # Prepare the message
-        headers, content = self.__prepare_message(message, target_group=group)
-
-        # The list of peers having been reached
-        accessed_peers = set()
-        countdown = pelix.utilities.CountdownEvent(len(peers))
-
-        def peer_result(_, exception, target_peer):
-            """
-            Called back once the request has been posted
-            """
-            if exception is None:
-                # No exception => success
-                accessed_peers.add(target_peer)
+        handle = self.fire_group_async(group, peers, message)
+        if not handle.wait(10):
+            _logger.warning("Not all peers have been reached after 10s...")
 
-            # In any case: update the count down
-            countdown.step()
+        return handle.reached
 
-        # Store the message once
-        self._probe.store(
-            herald.PROBE_CHANNEL_MSG_CONTENT,
-            {"uid": message.uid, "content": content}
-        )
+    def fire_group_async(self, group, peers, message):
+        """
+        Fires a message to a group of peers, without waiting for the requests
+        to be sent
 
-        # Send a request to each peers
+        :param group: Name of a group
+        :param peers: Peers to communicate with
+        :param message: Message to send
+        :return: A FanOutHandle, giving the reached and failed peers
+        """
+        handle = FanOutHandle(message.uid, peers)
+
+        # Codec name -> list of (peer, target)
+        targets = {}
+        records = []
+        probe_send = herald.PROBE_CHANNEL_MSG_SEND \
+            in self._probe.active_channels
+        timestamp = time.time()
         for peer in peers:
-
-            # Try to read extra information
-            url = self.__get_access(peer)
+            address, url = self.__get_access(peer)
             if url:
-                # Log before sending
-                self._probe.store(
-                    herald.PROBE_CHANNEL_MSG_SEND,
-                    {"uid": message.uid, "timestamp": time.time(),
-                     "transport": ACCESS_ID, "subject": message.subject,
-                     "target": peer.uid, "transportTarget": url,
-                     "repliesTo": ""})
-
-                # Send the HTTP requests (from the thread pool)
-                future = self.__pool.enqueue(self.__post_message,
-                                             url, content, headers)
-                future.set_callback(peer_result, peer)
+                codec = self.__get_codec(address)
+                targets.setdefault(codec.name, []).append(
+                    (peer, (message, codec, address, url)))
+                if probe_send:
+                    records.append(
+                        {"uid": message.uid, "timestamp": timestamp,
+                         "transport": ACCESS_ID, "subject": message.subject,
+                         "target": peer.uid, "transportTarget": url,
+                         "repliesTo": ""})
             else:
                 # No HTTP access description
                 _logger.debug("No '%s' access found for %s", self._access_id,
                               peer)
+                handle.set_result(peer, InvalidPeerAccess(
+                    beans.Target(peer=peer),
+                    "No '{0}' access found".format(self._access_id)))
 
-        # Wait for the requests to be sent (no more than 30s)
-        if not countdown.wait(10):
-            _logger.warning("Not all peers have been reached after 10s...")
+        # Log before sending
+        if records:
+            self._probe.store_batch(herald.PROBE_CHANNEL_MSG_SEND, records)
+
+        for codec_name, codec_targets in targets.items():
+            # Prepare the message once per codec: requests share the same
+            # bytes
+            headers, content = self.__prepare_message(
+                message, get_codec(codec_name), target_group=group)
+
+            if herald.PROBE_CHANNEL_MSG_CONTENT in self._probe.active_channels:
+                self._probe.store(
+                    herald.PROBE_CHANNEL_MSG_CONTENT,
+                    {"uid": message.uid, "content": content})
 
-        return set(accessed_peers)
+            self.__fanout.fire(handle, codec_targets, to_bytes(content),
+                               headers)
+        return handle
@@ -47,6 +47,12 @@ SUBJECT_DISCOVERY_STEP_2 = SUBJECT_DISCOVERY_PREFIX + "/step2"
 # Third message: the remote peer acknowledge, notify our listeners
 SUBJECT_DISCOVERY_STEP_3 = SUBJECT_DISCOVERY_PREFIX + "/step3"
 
+# Request for the changes of the description of a known peer since the
+# generation given in the content
+SUBJECT_DELTA_REQUEST = SUBJECT_DISCOVERY_PREFIX + "/delta/request"
+# Reply to a delta request: the changes of the description of the peer
+SUBJECT_DELTA = SUBJECT_DISCOVERY_PREFIX + "/delta"
+
 # ------------------------------------------------------------------------------
 
 
@@ -139,6 +145,26 @@ class PeerContact(object):
                 self._logger.error("Error registering a peer using the "
                                    "description it sent")
 
+        elif subject == SUBJECT_DELTA_REQUEST:
+            # Reply with the changes of our description
+            try:
+                since = int(message.content['generation'])
+            except (KeyError, TypeError, ValueError):
+                # Unknown generation: send a full description
+                since = -1
+
+            herald_svc.reply(
+                message, self._directory.get_local_peer().dump_delta(since),
+                SUBJECT_DELTA)
+
+        elif subject == SUBJECT_DELTA:
+            # Apply the changes of the description of a peer
+            try:
+                self._directory.load_delta(self.__load_dump(message))
+            except (KeyError, TypeError, ValueError) as ex:
+                self._logger.error("Error loading the changes of a peer: %s",
+                                   ex)
+
         elif subject == SUBJECT_DISCOVERY_STEP_3:
             # Step 3: notify local listeners about the remote peer
             try:
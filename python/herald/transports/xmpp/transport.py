@@ -594,12 +594,13 @@ class XmppTransport(object):
         except KeyError:
             sender_uid = "<unknown>"
 
-        try:            
-            received_msg = utils.from_json(msg['body'])
-            content = received_msg.content
-        except ValueError:
+        # Only the headers are decoded here: the content is decoded on
+        # first access
+        received_msg = utils.from_json(msg['body'])
+        if received_msg is None:
             # Content can't be decoded, use its string representation as is
-            content = msg['body']
+            self.__handle_raw_message(msg)
+            return
 
         uid = msg['thread']
         reply_to = msg['parent_thread']
@@ -611,7 +612,6 @@ class XmppTransport(object):
         received_msg.add_header(herald.MESSAGE_HEADER_UID, uid)
         received_msg.add_header(herald.MESSAGE_HEADER_SENDER_UID, sender_uid)
         received_msg.add_header(herald.MESSAGE_HEADER_REPLIES_TO, reply_to)
-        received_msg.set_content(content)
         received_msg.set_access(self._access_id)
         received_msg.set_extra(extra)
         
@@ -619,12 +619,13 @@ class XmppTransport(object):
         message = received_msg
 
         # Log before giving message to Herald
-        self._probe.store(
-            herald.PROBE_CHANNEL_MSG_RECV,
-            {"uid": message.uid, "timestamp": time.time(),
-             "transport": ACCESS_ID, "subject": message.subject,
-             "source": sender_uid, "repliesTo": reply_to or "",
-             "transportSource": str(sender_jid)})
+        if herald.PROBE_CHANNEL_MSG_RECV in self._probe.active_channels:
+            self._probe.store(
+                herald.PROBE_CHANNEL_MSG_RECV,
+                {"uid": message.uid, "timestamp": time.time(),
+                 "transport": ACCESS_ID, "subject": message.subject,
+                 "source": sender_uid, "repliesTo": reply_to or "",
+                 "transportSource": str(sender_jid)})
 
         if subject.startswith(peer_contact.SUBJECT_DISCOVERY_PREFIX):
             # Handle discovery message
@@ -658,12 +659,13 @@ class XmppTransport(object):
                                         None, self._access_id, extra=extra)
 
         # Log before giving message to Herald
-        self._probe.store(
-            herald.PROBE_CHANNEL_MSG_RECV,
-            {"uid": message.uid, "timestamp": time.time(),
-             "transport": ACCESS_ID, "subject": message.subject,
-             "source": sender_uid, "repliesTo": "",
-             "transportSource": str(sender_jid)})
+        if herald.PROBE_CHANNEL_MSG_RECV in self._probe.active_channels:
+            self._probe.store(
+                herald.PROBE_CHANNEL_MSG_RECV,
+                {"uid": message.uid, "timestamp": time.time(),
+                 "transport": ACCESS_ID, "subject": message.subject,
+                 "source": sender_uid, "repliesTo": "",
+                 "transportSource": str(sender_jid)})
 
         # All other messages are given to Herald Core
         self._herald.handle_message(message)
@@ -723,10 +725,10 @@ class XmppTransport(object):
             xmpp_msg['parent_thread'] = parent_uid
 
         # Store message content
-        self._probe.store(
-            herald.PROBE_CHANNEL_MSG_CONTENT,
-            {"uid": message.uid, "content": content}
-        )
+        if herald.PROBE_CHANNEL_MSG_CONTENT in self._probe.active_channels:
+            self._probe.store(
+                herald.PROBE_CHANNEL_MSG_CONTENT,
+                {"uid": message.uid, "content": content})
 
         # Send it, using the 1-thread pool, and wait for its execution
         future = self.__pool.enqueue(xmpp_msg.send)
@@ -750,12 +752,14 @@ class XmppTransport(object):
 
         if jid:
             # Log before sending
-            self._probe.store(
-                herald.PROBE_CHANNEL_MSG_SEND,
-                {"uid": message.uid, "timestamp": time.time(),
-                 "transport": ACCESS_ID, "subject": message.subject,
-                 "target": peer.uid if peer else "<unknown>",
-                 "transportTarget": str(jid), "repliesTo": parent_uid or ""})
+            if herald.PROBE_CHANNEL_MSG_SEND in self._probe.active_channels:
+                self._probe.store(
+                    herald.PROBE_CHANNEL_MSG_SEND,
+                    {"uid": message.uid, "timestamp": time.time(),
+                     "transport": ACCESS_ID, "subject": message.subject,
+                     "target": peer.uid if peer else "<unknown>",
+                     "transportTarget": str(jid),
+                     "repliesTo": parent_uid or ""})
 
             # Send the XMPP message
             self.__send_message("chat", jid, message, parent_uid, target_peer=peer)
@@ -785,12 +789,13 @@ class XmppTransport(object):
             group_jid = self.room_jid("{0}--{1}".format(app_id, group))
 
         # Log before sending
-        self._probe.store(
-            herald.PROBE_CHANNEL_MSG_SEND,
-            {"uid": message.uid, "timestamp": time.time(),
-             "transport": ACCESS_ID, "subject": message.subject,
-             "target": group, "transportTarget": str(group_jid),
-             "repliesTo": ""})
+        if herald.PROBE_CHANNEL_MSG_SEND in self._probe.active_channels:
+            self._probe.store(
+                herald.PROBE_CHANNEL_MSG_SEND,
+                {"uid": message.uid, "timestamp": time.time(),
+                 "transport": ACCESS_ID, "subject": message.subject,
+                 "target": group, "transportTarget": str(group_jid),
+                 "repliesTo": ""})
 
         # Send the XMPP message
         self.__send_message("groupchat", group_jid, message, target_group=group)
@@ -35,9 +35,15 @@ __docformat__ = "restructuredtext en"
 
 # ------------------------------------------------------------------------------
 
+import binascii
+import heapq
+import itertools
 import threading
 import json
 import logging
+import math
+import os
+import time
 
 import herald
 
@@ -47,6 +53,46 @@ import pelix.misc.jabsorb as jabsorb
 
 _logger = logging.getLogger(__name__)
 
+CONTENT_FORMAT_JABSORB = "jabsorb"
+"""
+Format of the encoded content of the lazy messages read from JSON: the
+content converted by jabsorb, but not yet converted back
+"""
+
+# ------------------------------------------------------------------------------
+
+_uid_prefix = None
+_uid_counter = None
+
+
+def _reset_uid_generator():
+    """
+    Draws a new random prefix for the UIDs generated by this process
+    """
+    global _uid_prefix, _uid_counter
+    _uid_prefix = binascii.hexlify(os.urandom(8)).decode('ascii').upper()
+    _uid_counter = itertools.count()
+
+
+def generate_uid():
+    """
+    Generates a message UID: 32 upper case hexadecimal characters, like the
+    UUID4 strings previously used, made of a random prefix drawn once per
+    process and of a counter.
+
+    :return: A new UID
+    """
+    return "%s%016X" % (_uid_prefix, next(_uid_counter))
+
+
+_reset_uid_generator()
+try:
+    # Forked processes must not generate the UIDs of their parent
+    os.register_at_fork(after_in_child=_reset_uid_generator)
+except AttributeError:
+    # Python < 3.7
+    pass
+
 # ------------------------------------------------------------------------------
 
 def json_converter(obj):
@@ -76,7 +122,10 @@ def to_json(msg):
     # subject
     result[herald.MESSAGE_SUBJECT] = msg.subject
     # content
-    if msg.content is not None:
+    if msg.raw_format == CONTENT_FORMAT_JABSORB:
+        # content received and not decoded: send it as is
+        result[herald.MESSAGE_CONTENT] = msg.raw_content
+    elif msg.content is not None:
         if isinstance(msg.content, str):
             # string content
             result[herald.MESSAGE_CONTENT] = msg.content
@@ -108,6 +157,19 @@ def from_json(json_string):
         _logger.error('TypeError')
         # if json_message not string or buffer
         return None
+    return from_dict(parsed_msg)
+
+
+def from_dict(parsed_msg, content_format=CONTENT_FORMAT_JABSORB,
+              content_decoder=jabsorb.from_jabsorb):
+    """
+    Returns a new MessageReceived from the provided parsed JSON message
+    (dictionary). Contents which are not strings are decoded on first access.
+
+    :param parsed_msg: The parsed message
+    :param content_format: Format of the encoded content
+    :param content_decoder: Method decoding the content
+    """
     herald_version = None
     # check if it is a valid Herald JSON message
     if herald.MESSAGE_HEADERS in parsed_msg:
@@ -116,37 +178,38 @@ def from_json(json_string):
     if herald_version is None or herald_version != herald.HERALD_SPECIFICATION_VERSION:
         _logger.error("Herald specification of the received message is not supported!")
         return None   
-    # construct new Message object from the provided JSON object    
-    msg = herald.beans.MessageReceived(uid=(parsed_msg[herald.MESSAGE_HEADERS].get(herald.MESSAGE_HEADER_UID) or None), 
-                          subject=parsed_msg[herald.MESSAGE_SUBJECT], 
-                          content=None, 
-                          sender_uid=(parsed_msg[herald.MESSAGE_HEADERS].get(herald.MESSAGE_HEADER_SENDER_UID) or None), 
-                          reply_to=(parsed_msg[herald.MESSAGE_HEADERS].get(herald.MESSAGE_HEADER_REPLIES_TO) or None), 
-                          access=None,
-                          timestamp=(parsed_msg[herald.MESSAGE_HEADERS].get(herald.MESSAGE_HEADER_TIMESTAMP) or None) 
-                          )                           
-    # set content
-    try:
-        if herald.MESSAGE_CONTENT in parsed_msg:
-            parsed_content = parsed_msg[herald.MESSAGE_CONTENT]                              
-            if parsed_content is not None:
-                if isinstance(parsed_content, str):
-                    msg.set_content(parsed_content)
-                else:
-                    msg.set_content(jabsorb.from_jabsorb(parsed_content))
-    except KeyError as ex:
-        _logger.error("Error retrieving message content! " + str(ex)) 
+    # construct new Message object from the provided JSON object
+    headers = parsed_msg[herald.MESSAGE_HEADERS]
+    uid = headers.get(herald.MESSAGE_HEADER_UID) or None
+    subject = parsed_msg[herald.MESSAGE_SUBJECT]
+    sender_uid = headers.get(herald.MESSAGE_HEADER_SENDER_UID) or None
+    reply_to = headers.get(herald.MESSAGE_HEADER_REPLIES_TO) or None
+    timestamp = headers.get(herald.MESSAGE_HEADER_TIMESTAMP) or None
+
+    parsed_content = parsed_msg.get(herald.MESSAGE_CONTENT)
+    if parsed_content is None or isinstance(parsed_content, str):
+        # string content
+        msg = herald.beans.MessageReceived(uid, subject, parsed_content,
+                                           sender_uid, reply_to, None,
+                                           timestamp)
+    else:
+        # encoded content: converted on first access
+        msg = herald.beans.LazyMessageReceived(
+            uid, subject, parsed_content, content_format, content_decoder,
+            sender_uid, reply_to, None, timestamp)
     # other headers
-    if herald.MESSAGE_HEADERS in parsed_msg:
-        for key in parsed_msg[herald.MESSAGE_HEADERS]:
-            if key not in msg._headers:
-                msg._headers[key] = parsed_msg[herald.MESSAGE_HEADERS][key]         
+    msg_headers = msg.headers
+    for key, value in headers.items():
+        if key not in msg_headers:
+            msg_headers[key] = value
     # metadata
-    if herald.MESSAGE_METADATA in parsed_msg:
-        for key in parsed_msg[herald.MESSAGE_METADATA]:
-            if key not in msg._metadata:
-                msg._metadata[key] = parsed_msg[herald.MESSAGE_METADATA][key] 
-                       
+    parsed_metadata = parsed_msg.get(herald.MESSAGE_METADATA)
+    if parsed_metadata:
+        msg_metadata = msg.metadata
+        for key, value in parsed_metadata.items():
+            if key not in msg_metadata:
+                msg_metadata[key] = value
+
     return msg
 
 # ------------------------------------------------------------------------------
@@ -226,3 +289,328 @@ class LoopTimer(threading.Thread):
         while not (self.finished.wait(self.interval)
                    or self.finished.is_set()):
             self.function(*self.args, **self.kwargs)
+
+
+class TimerHandle(object):
+    """
+    A timer scheduled in a TimerWheel
+    """
+    __slots__ = ('tick', 'slot', 'function', 'args', 'kwargs')
+
+    def __init__(self, tick, function, args, kwargs):
+        """
+        Sets up the timer
+
+        :param tick: Wheel tick at which the timer expires
+        :param function: Function to call
+        :param args: Function arguments
+        :param kwargs: Function keyword arguments
+        """
+        self.tick = tick
+        self.slot = None
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+
+class TimerWheel(object):
+    """
+    A hashed timing wheel: calls functions after a delay, with the precision
+    of its resolution. Scheduling and cancelling a timer cost O(1), and each
+    tick only looks at the timers of a single slot.
+
+    The functions are called in the thread of the wheel: they must return
+    quickly.
+    """
+    def __init__(self, resolution=.1, nb_slots=512, name=None):
+        """
+        Sets up the wheel
+
+        :param resolution: Duration of a tick (in seconds)
+        :param nb_slots: Number of slots in the wheel
+        :param name: Name of the wheel thread
+        """
+        self.__resolution = float(resolution)
+        self.__slots = [set() for _ in range(nb_slots)]
+        self.__name = name or "TimerWheel"
+        self.__clock = getattr(time, 'monotonic', time.time)
+
+        # Time of the tick 0 and last processed tick
+        self.__origin = self.__clock()
+        self.__tick = 0
+
+        self.__lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    def __len__(self):
+        """
+        Returns the number of scheduled timers
+        """
+        with self.__lock:
+            return sum(len(slot) for slot in self.__slots)
+
+    def start(self):
+        """
+        Starts the wheel thread
+        """
+        if self.__thread is None:
+            self.__stop_event.clear()
+            self.__thread = threading.Thread(target=self.__run,
+                                             name=self.__name)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def stop(self):
+        """
+        Stops the wheel thread and forgets all timers
+        """
+        self.__stop_event.set()
+        if self.__thread is not None:
+            if self.__thread is not threading.current_thread():
+                self.__thread.join()
+            self.__thread = None
+
+        with self.__lock:
+            for slot in self.__slots:
+                for handle in slot:
+                    handle.slot = None
+                slot.clear()
+
+    def schedule(self, delay, function, *args, **kwargs):
+        """
+        Calls the given function after the given delay
+
+        :param delay: Delay before the call (in seconds)
+        :param function: Function to call
+        :param args: Function arguments
+        :param kwargs: Function keyword arguments
+        :return: A TimerHandle, to give to cancel()
+        """
+        tick = int(math.ceil((self.__clock() + delay - self.__origin)
+                             / self.__resolution))
+        with self.__lock:
+            handle = TimerHandle(max(tick, self.__tick + 1),
+                                 function, args, kwargs)
+            handle.slot = self.__slots[handle.tick % len(self.__slots)]
+            handle.slot.add(handle)
+
+        return handle
+
+    def cancel(self, handle):
+        """
+        Cancels a timer
+
+        :param handle: The TimerHandle returned by schedule() (can be None)
+        :return: True if the timer was cancelled before its expiration
+        """
+        if handle is None:
+            return False
+
+        with self.__lock:
+            if handle.slot is None:
+                # Already expired or cancelled
+                return False
+
+            handle.slot.discard(handle)
+            handle.slot = None
+            return True
+
+    def __expire(self):
+        """
+        Pops the timers which expired since the last tick
+
+        :return: The list of expired timers
+        """
+        now_tick = int((self.__clock() - self.__origin) / self.__resolution)
+        expired = []
+        with self.__lock:
+            nb_slots = len(self.__slots)
+            first_tick = max(self.__tick + 1, now_tick - nb_slots + 1)
+            for tick in range(first_tick, now_tick + 1):
+                slot = self.__slots[tick % nb_slots]
+                for handle in [handle for handle in slot
+                               if handle.tick <= now_tick]:
+                    slot.discard(handle)
+                    handle.slot = None
+                    expired.append(handle)
+
+            self.__tick = max(self.__tick, now_tick)
+
+        return expired
+
+    def __run(self):
+        """
+        Wheel thread loop
+        """
+        while not self.__stop_event.is_set():
+            next_tick = self.__origin \
+                + (self.__tick + 1) * self.__resolution
+            self.__stop_event.wait(max(0, next_tick - self.__clock()))
+            if self.__stop_event.is_set():
+                break
+
+            for handle in sorted(self.__expire(), key=lambda h: h.tick):
+                try:
+                    # pylint: disable=W0703
+                    handle.function(*handle.args, **handle.kwargs)
+                except Exception as ex:
+                    _logger.exception("Error calling timer %s: %s",
+                                      handle.function, ex)
+
+
+class ExpiryTracker(object):
+    """
+    Calls back the keys which haven't been refreshed for a given time (e.g.
+    peers which stopped sending heart beats).
+
+    Deadlines are kept in a heap: the thread sleeps until the next one and
+    only looks at the expired entries. Refreshing a key only updates its
+    last-seen time: its heap entry is checked (and pushed back) when it
+    pops. The expired keys are given to the callback in batches.
+    """
+    def __init__(self, ttl, callback, name=None):
+        """
+        Sets up the tracker
+
+        :param ttl: Time to live of a key without refresh (in seconds)
+        :param callback: Method called with the list of expired keys, in the
+                         thread of the tracker
+        :param name: Name of the tracker thread
+        """
+        self.__ttl = float(ttl)
+        self.__callback = callback
+        self.__name = name or "ExpiryTracker"
+        self.__clock = getattr(time, 'monotonic', time.time)
+
+        # Key -> [last seen time]
+        self.__entries = {}
+
+        # Heap of (deadline, sequence, entry, key) tuples
+        self.__heap = []
+        self.__seq = itertools.count()
+
+        self.__condition = threading.Condition()
+        self.__stopped = True
+        self.__thread = None
+
+    def __len__(self):
+        """
+        Returns the number of tracked keys
+        """
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        """
+        Checks if the given key is tracked
+        """
+        return key in self.__entries
+
+    def start(self):
+        """
+        Starts the tracker thread
+        """
+        with self.__condition:
+            if self.__thread is not None:
+                return
+            self.__stopped = False
+            self.__thread = threading.Thread(target=self.__run,
+                                             name=self.__name)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def stop(self):
+        """
+        Stops the tracker thread and forgets all keys
+        """
+        with self.__condition:
+            self.__stopped = True
+            self.__entries.clear()
+            del self.__heap[:]
+            self.__condition.notify()
+            thread, self.__thread = self.__thread, None
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def touch(self, key):
+        """
+        Refreshes the last-seen time of a key, starting to track it if needed
+
+        :param key: A hashable key
+        :return: True if the key wasn't tracked yet
+        """
+        now = self.__clock()
+        with self.__condition:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                # Lazy refresh: the heap is updated when the entry pops
+                entry[0] = now
+                return False
+
+            entry = self.__entries[key] = [now]
+            heapq.heappush(self.__heap, (now + self.__ttl, next(self.__seq),
+                                         entry, key))
+            if len(self.__heap) == 1:
+                # The thread was waiting for a first key
+                self.__condition.notify()
+            return True
+
+    def discard(self, key):
+        """
+        Stops tracking a key (its heap entry is ignored when it pops)
+
+        :param key: A hashable key
+        :return: True if the key was tracked
+        """
+        with self.__condition:
+            return self.__entries.pop(key, None) is not None
+
+    def __expire(self, now):
+        """
+        Pops the heap entries which reached their deadline
+
+        :param now: Current time
+        :return: The list of expired keys
+        """
+        expired = []
+        heap = self.__heap
+        while heap and heap[0][0] <= now:
+            _, _, entry, key = heapq.heappop(heap)
+            if self.__entries.get(key) is not entry:
+                # Discarded key
+                continue
+
+            deadline = entry[0] + self.__ttl
+            if deadline > now:
+                # Refreshed in the meantime
+                heapq.heappush(heap, (deadline, next(self.__seq), entry, key))
+            else:
+                del self.__entries[key]
+                expired.append(key)
+
+        return expired
+
+    def __run(self):
+        """
+        Tracker thread loop
+        """
+        while True:
+            with self.__condition:
+                if self.__stopped:
+                    break
+
+                now = self.__clock()
+                expired = self.__expire(now)
+                if not expired:
+                    # Sleep until the next deadline
+                    timeout = self.__heap[0][0] - now if self.__heap else None
+                    self.__condition.wait(timeout)
+                    continue
+
+            try:
+                self.__callback(expired)
+            except Exception as ex:
+                # pylint: disable=W0703
+                _logger.exception("Error notifying expired keys %s: %s",
+                                  expired, ex)
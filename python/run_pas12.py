@@ -90,6 +90,7 @@ def main(http_port, peer_name, node_name, app_id):
          'herald.routing_hellos',
          'herald.routing_roads',
          'herald.routing_json',
+         'herald.metrics',
 
          # TEST
          'displayMessages',
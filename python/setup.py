@@ -86,5 +86,8 @@ setup(
         'iPOPO>=0.6.1',
         'sleekxmpp>=1.3.1',
         'requests>=2.3.0'
-    ]
+    ],
+    extras_require={
+        'msgpack': ['msgpack>=0.5.6']
+    }
 )
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Benchmark of the memory used by the Herald beans.
+
+Creates messages, received messages and peers, and prints the creation rate
+(objects per second) and the memory allocated per object (using tracemalloc,
+Python 3.4+).
+
+Usage: python bench_beans.py [nb_messages] [nb_peers]
+"""
+
+# Herald
+import herald
+import herald.beans as beans
+
+# Standard library
+import gc
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# ------------------------------------------------------------------------------
+
+
+def make_message(_):
+    """
+    Prepares a message with the headers added by the transports
+    """
+    message = beans.Message("bench/beans", "content")
+    message.add_header(herald.MESSAGE_HEADER_SENDER_UID, "0" * 32)
+    message.add_header(herald.MESSAGE_HEADER_TARGET_PEER, "F" * 32)
+    return message
+
+
+def make_received(idx):
+    """
+    Prepares a message as read by a transport
+    """
+    message = beans.MessageReceived("{0:032X}".format(idx), "bench/beans",
+                                    "content", "0" * 32, None, "http", idx)
+    message.add_header("herald-http-tansport-port", 8080)
+    return message
+
+
+def make_peer(idx):
+    """
+    Prepares a peer as registered by the directory
+    """
+    uid = "{0:032X}".format(idx)
+    peer = beans.Peer(uid, uid, herald.DEFAULT_APPLICATION_ID, ["all"], None)
+    peer.name = "peer-{0}".format(idx)
+    return peer
+
+
+def run(factory, count):
+    """
+    Creates the given number of objects
+
+    :return: A (objects/s, bytes per object) tuple
+    """
+    gc.collect()
+    start = time.time()
+    objects = [factory(idx) for idx in range(count)]
+    rate = count / (time.time() - start)
+    del objects
+
+    if tracemalloc is None:
+        return rate, float('nan')
+
+    gc.collect()
+    tracemalloc.start()
+    objects = [factory(idx) for idx in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return rate, float(size) / count
+
+
+def main(nb_messages=100000, nb_peers=50000):
+    """
+    Runs the benchmark
+    """
+    line = "{0:>9} | {1:>10} | {2:>10}"
+    print(line.format("bean", "created/s", "bytes"))
+    for name, factory, count in (("message", make_message, nb_messages),
+                                 ("received", make_received, nb_messages),
+                                 ("peer", make_peer, nb_peers)):
+        rate, size = run(factory, count)
+        print(line.format(name, "{0:.0f}".format(rate),
+                          "{0:.0f}".format(size)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
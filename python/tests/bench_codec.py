@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Benchmark of the Herald messages codecs.
+
+Encodes and decodes small, medium and large messages with each available
+codec. Prints the encoding and decoding throughput (messages per second) and
+the size of the encoded messages. Contents are decoded on demand: the
+"headers/s" column gives the decoding throughput when the content isn't read
+(e.g. when forwarding a message), the "decode/s" one when it is.
+
+Usage: python bench_codec.py [nb_messages]
+"""
+
+# Herald
+from herald.codec import available_codecs, get_codec
+import herald
+import herald.beans
+
+# Standard library
+import sys
+import time
+
+# ------------------------------------------------------------------------------
+
+
+def make_payloads():
+    """
+    Prepares the message contents: (name, content) tuples
+    """
+    small = {"name": "isolate", "port": 8080}
+    medium = {"peers": [{"uid": "{0:032X}".format(idx),
+                         "name": "peer-{0}".format(idx),
+                         "groups": ["all", "others", "group-{0}".format(idx)],
+                         "accesses": {"http": ["10.0.0.{0}".format(idx),
+                                               8080, "/herald"]}}
+                        for idx in range(10)]}
+    large = {"samples": [{"id": idx, "value": idx * .5,
+                          "tags": set(["a", "b", str(idx % 10)])}
+                         for idx in range(1000)]}
+    return (("small", small), ("medium", medium), ("large", large))
+
+
+def make_message(content):
+    """
+    Prepares a message with the headers added by the HTTP transport
+    """
+    message = herald.beans.Message("bench/codec", content)
+    message.add_header(herald.MESSAGE_HEADER_SENDER_UID, "0" * 32)
+    message.add_header(herald.MESSAGE_HEADER_TARGET_PEER, "F" * 32)
+    message.add_header("herald-http-tansport-port", 8080)
+    message.add_header("herald-http-tansport-path", "/herald")
+    return message
+
+
+def run(codec, message, nb_messages):
+    """
+    Encodes and decodes the given message
+
+    :return: A (encoded messages/s, messages/s without content,
+             decoded messages/s, size) tuple
+    """
+    start = time.time()
+    for _ in range(nb_messages):
+        data = codec.encode(message)
+    encode_time = time.time() - start
+
+    start = time.time()
+    for _ in range(nb_messages):
+        codec.decode(data)
+    headers_time = time.time() - start
+
+    start = time.time()
+    for _ in range(nb_messages):
+        codec.decode(data).content
+    decode_time = time.time() - start
+
+    return nb_messages / encode_time, nb_messages / headers_time, \
+        nb_messages / decode_time, len(data)
+
+
+def main(nb_messages=1000):
+    """
+    Runs the benchmark
+    """
+    line = "{0:>7} | {1:>8} | {2:>10} | {3:>10} | {4:>10} | {5:>8}"
+    print(line.format("payload", "codec", "encode/s", "headers/s",
+                      "decode/s", "bytes"))
+    for name, content in make_payloads():
+        message = make_message(content)
+        # Large payloads are slower: send less of them
+        count = max(1, nb_messages // 100) if name == "large" else nb_messages
+        for codec_name in available_codecs():
+            results = run(get_codec(codec_name), message, count)
+            print(line.format(name, codec_name,
+                              *["{0:.0f}".format(result)
+                                for result in results[:3]] + [results[3]]))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
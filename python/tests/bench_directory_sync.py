@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Simulation of the synchronization of Herald directories.
+
+Brings up peers in-process, each with its own directory, and observers
+knowing all of them. In each round, some peers change their description,
+then:
+
+* the first observer gets the changes of the peers announcing a newer
+  generation (like with the multicast heart beats): full descriptions
+  ("full" column) or deltas ("delta" column);
+* the other observers synchronize with the first one: full directory dump
+  ("dump" column) or digest and deltas ("digest" and "delta" columns).
+
+Prints the bytes exchanged per round (JSON) for each rate of changes.
+
+Usage: python bench_directory_sync.py [nb_peers] [nb_rounds]
+"""
+
+# Herald
+from herald.directory import HeraldDirectory
+import herald
+import herald.beans as beans
+import herald.utils as utils
+
+# Standard library
+import json
+import random
+import sys
+import time
+
+# ------------------------------------------------------------------------------
+
+
+class Context(object):
+    """
+    Bundle context giving the framework properties of a peer
+    """
+    def __init__(self, uid):
+        self.uid = uid
+
+    def get_property(self, name):
+        if name == herald.FWPROP_PEER_UID:
+            return self.uid
+        elif name == herald.FWPROP_PEER_GROUPS:
+            return ["all", "workers"]
+
+
+def make_directory(idx):
+    """
+    Prepares the directory of a peer
+    """
+    directory = HeraldDirectory()
+    directory._validate(Context("{0:032X}".format(idx)))
+    set_access(directory.get_local_peer(), 8080)
+    return directory
+
+
+def set_access(peer, port):
+    """
+    Sets the (simulated) HTTP access of a peer
+    """
+    peer.set_access("http", beans.RawAccess(
+        "http", ["10.0.{0}.{1}".format(*divmod(hash(peer.uid) % 65536, 256)),
+                 port, "herald", ["batch", "msgpack"]]))
+
+
+def size(data):
+    """
+    Returns the size of the given data in JSON
+    """
+    return len(json.dumps(data, default=utils.json_converter))
+
+
+def sync_peers(observer, peers):
+    """
+    The observer gets the changes of the peers with a newer generation
+
+    :return: A (full descriptions size, deltas size) tuple
+    """
+    full_size = delta_size = 0
+    for peer in peers:
+        known = observer.get_peer(peer.uid).generation
+        if peer.generation > known:
+            full_size += size(peer.dump())
+            delta = peer.dump_delta(known)
+            delta_size += size(delta)
+            observer.load_delta(delta)
+    return full_size, delta_size
+
+
+def sync_observers(source, target):
+    """
+    Synchronizes an observer with another one
+
+    :return: A (full dump size, digest size, deltas size) tuple
+    """
+    dump_size = size(source.dump())
+    digest = target.digest()
+    deltas = source.dump_delta(digest)
+    for delta in deltas:
+        target.load_delta(delta)
+    return dump_size, size(digest), size(deltas)
+
+
+def run(peers, observers, rate, nb_rounds):
+    """
+    Runs the rounds of changes and synchronizations
+
+    :return: The average bytes exchanged per round: (full descriptions,
+             deltas of peers, directory dumps, digests, deltas of
+             directories)
+    """
+    totals = [0] * 5
+    local_peers = [directory.get_local_peer() for directory in peers]
+    for round_idx in range(nb_rounds):
+        # Change some peers
+        for peer in random.sample(local_peers, int(len(peers) * rate)):
+            if random.random() < .5:
+                set_access(peer, 9000 + round_idx)
+            else:
+                peer.name = "peer-{0}".format(random.random())
+
+        for idx, result in enumerate(sync_peers(observers[0], local_peers)):
+            totals[idx] += result
+
+        for observer in observers[1:]:
+            for idx, result in enumerate(
+                    sync_observers(observers[0], observer)):
+                totals[2 + idx] += result
+
+    # Check the observers views
+    for observer in observers:
+        for peer in local_peers:
+            assert observer.get_peer(peer.uid).generation == peer.generation
+
+    return [total / nb_rounds for total in totals]
+
+
+def main(nb_peers=1000, nb_rounds=10):
+    """
+    Runs the benchmark
+    """
+    start = time.time()
+    peers = [make_directory(idx) for idx in range(nb_peers)]
+    observers = [make_directory(nb_peers + idx) for idx in range(3)]
+    for observer in observers:
+        for directory in peers:
+            observer.load_delta(directory.get_local_peer().dump_delta(-1))
+    print("{0} peers up in {1:.2f}s".format(nb_peers, time.time() - start))
+
+    line = "{0:>6} | {1:>9} | {2:>9} | {3:>9} | {4:>9} | {5:>9}"
+    print(line.format("change", "full", "delta", "dump", "digest", "delta"))
+    for rate in (0, .001, .01, .1):
+        start = time.time()
+        results = run(peers, observers, rate, nb_rounds)
+        print(line.format("{0:.1%}".format(rate),
+                          *["{0:.0f}".format(result) for result in results]))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
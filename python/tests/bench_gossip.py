@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Benchmark of the SWIM gossip discovery.
+
+Simulates clusters of growing sizes in-process, with a simulated clock, then
+stops a peer. Prints the number of messages sent per peer and per protocol
+period, the time (in protocol periods) before the first peer suspects the
+stopped one, and the time before all the peers have forgotten it.
+
+With multicast heartbeats, each peer receives the heartbeats of all the
+others: the load per peer grows linearly with the size of the cluster.
+
+Usage: python bench_gossip.py [size [size ...]]
+"""
+
+# Herald
+from herald.transports.http.discovery_gossip import Swim, STATE_SUSPECT
+
+# Standard library
+import random
+import sys
+import time
+
+# ------------------------------------------------------------------------------
+
+STEPS_PER_PERIOD = 10
+""" Number of simulation steps per protocol period """
+
+
+class Clock(object):
+    """
+    Simulated clock
+    """
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class Cluster(object):
+    """
+    In-process cluster: messages are delivered at the next step
+    """
+    def __init__(self, size, seed=0):
+        self.clock = Clock()
+        self.queue = []
+        self.down = set()
+        self.sent = 0
+        self.forgotten = set()
+
+        rand = random.Random(seed)
+        uids = ["peer-{0}".format(idx) for idx in range(size)]
+        self.nodes = {}
+        for uid in uids:
+            self.nodes[uid] = Swim(
+                uid, (uid, 8080, "/herald"), self.__sender(uid),
+                on_dead=self.__on_dead(uid), clock=self.clock,
+                randomizer=random.Random(rand.random()))
+
+        for uid, node in self.nodes.items():
+            for other in uids:
+                node.add_member(other, (other, 8080, "/herald"),
+                                self.nodes[other].incarnation, False)
+
+    def __sender(self, uid):
+        def send(target, address, kind, content):
+            self.sent += 1
+            self.queue.append((uid, target, kind, dict(content)))
+        return send
+
+    def __on_dead(self, uid):
+        def on_dead(_):
+            self.forgotten.add(uid)
+        return on_dead
+
+    def step(self):
+        """
+        Delivers the pending messages and ticks all the peers
+        """
+        queue, self.queue = self.queue, []
+        for sender, target, kind, content in queue:
+            if target not in self.down:
+                self.nodes[target].handle(sender, kind, content,
+                                          (sender, 8080, "/herald"))
+
+        self.clock.now += 1. / STEPS_PER_PERIOD
+        for uid, node in self.nodes.items():
+            if uid not in self.down:
+                node.tick()
+
+    def suspected(self, uid):
+        """
+        Checks if a peer suspects the given one
+        """
+        for other, node in self.nodes.items():
+            if other not in self.down:
+                try:
+                    if node.get_member(uid).state == STATE_SUSPECT:
+                        return True
+                except KeyError:
+                    pass
+        return False
+
+
+def run(size, max_periods=60):
+    """
+    Simulates a cluster
+
+    :return: A (messages per peer per period, periods before the first
+             suspicion, periods before the failure is known by all peers)
+             tuple
+    """
+    cluster = Cluster(size)
+
+    # Steady state
+    for _ in range(3 * STEPS_PER_PERIOD):
+        cluster.step()
+    cluster.sent = 0
+    periods = 5
+    for _ in range(periods * STEPS_PER_PERIOD):
+        cluster.step()
+    load = float(cluster.sent) / size / periods
+
+    # Stop a peer
+    cluster.down.add("peer-0")
+    suspicion = None
+    for step in range(max_periods * STEPS_PER_PERIOD):
+        cluster.step()
+        if suspicion is None and cluster.suspected("peer-0"):
+            suspicion = float(step + 1) / STEPS_PER_PERIOD
+        if len(cluster.forgotten) == size - 1:
+            return load, suspicion, float(step + 1) / STEPS_PER_PERIOD
+    return load, suspicion, None
+
+
+def main(sizes=(50, 200, 1000)):
+    """
+    Runs the benchmark
+    """
+    line = "{0:>6} | {1:>10} | {2:>10} | {3:>10} | {4:>8}"
+    print(line.format("peers", "msg/peer/T", "suspect(T)", "removed(T)",
+                      "time(s)"))
+    for size in sizes:
+        start = time.time()
+        load, suspicion, removed = run(size)
+        print(line.format(size, "{0:.2f}".format(load),
+                          "{0:.1f}".format(suspicion) if suspicion else "-",
+                          "{0:.1f}".format(removed) if removed else "-",
+                          "{0:.1f}".format(time.time() - start)))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or (50, 200, 1000))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Benchmark of the HTTP transport sender engine against a single shared
+requests session (the previous sending path).
+
+Starts local keep-alive HTTP servers, one per simulated peer, and posts
+messages to them from a set of threads. Prints the throughput (messages per
+second) and the 99th percentile latency of both paths for 1, 10 and 100 peers.
+
+Usage: python bench_http_sender.py [nb_messages] [nb_threads]
+"""
+
+# Herald
+from herald.transports.http.sender import HttpSender
+
+# HTTP requests
+import requests
+
+# Standard library
+import itertools
+import sys
+import threading
+import time
+
+try:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# ------------------------------------------------------------------------------
+
+PAYLOAD = '{"subject": "bench/test", "content": "' + 'x' * 512 + '"}'
+HEADERS = {'content-type': 'application/json'}
+
+# ------------------------------------------------------------------------------
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Keep-alive handler, reading the request and answering an empty response
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('content-length', 0)))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server
+    """
+    daemon_threads = True
+
+
+def start_servers(nb_servers, handler=_Handler):
+    """
+    Starts the given number of HTTP servers
+
+    :param handler: Request handler class
+    :return: The list of (server, (host, port)) tuples
+    """
+    servers = []
+    for _ in range(nb_servers):
+        server = _Server(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append((server, server.server_address[:2]))
+    return servers
+
+
+def run(post, addresses, nb_messages, nb_threads):
+    """
+    Posts messages to the given servers, round-robin
+
+    :param post: Method to call: post(address, url)
+    :param addresses: List of (host, port) tuples
+    :param nb_messages: Total number of messages
+    :param nb_threads: Number of sending threads
+    :return: A (messages per second, p99 latency in ms) tuple
+    """
+    targets = itertools.cycle(
+        [(address, "http://{0}:{1}/herald".format(*address))
+         for address in addresses])
+    lock = threading.Lock()
+    latencies = []
+    remaining = [nb_messages]
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+                address, url = next(targets)
+
+            start = time.time()
+            post(address, url)
+            duration = time.time() - start
+            with lock:
+                latencies.append(duration)
+
+    threads = [threading.Thread(target=worker) for _ in range(nb_threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = time.time() - start
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * .99) - 1] * 1000
+    return nb_messages / total, p99
+
+
+def main(nb_messages=2000, nb_threads=10):
+    """
+    Runs the benchmark
+    """
+    print("{0:>6} | {1:>18} | {2:>18}".format(
+        "peers", "session msg/s p99", "sender msg/s p99"))
+    for nb_peers in (1, 10, 100):
+        servers = start_servers(nb_peers)
+        addresses = [address for _, address in servers]
+
+        # Previous path: one shared session
+        session = requests.Session()
+
+        def session_post(_, url):
+            session.post(url, PAYLOAD, headers=HEADERS).raise_for_status()
+
+        session_result = run(session_post, addresses, nb_messages, nb_threads)
+        session.close()
+
+        # Sender engine
+        sender = HttpSender(pool_size=4)
+        sender.start()
+
+        def sender_post(address, url):
+            sender.post(address, url, PAYLOAD, HEADERS).raise_for_status()
+
+        sender_result = run(sender_post, addresses, nb_messages, nb_threads)
+        sender.stop()
+
+        print("{0:>6} | {1:>8.0f} {2:>7.1f}ms | {3:>8.0f} {4:>7.1f}ms".format(
+            nb_peers, session_result[0], session_result[1],
+            sender_result[0], sender_result[1]))
+
+        for server, _ in servers:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
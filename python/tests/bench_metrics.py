@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Benchmark of the metrics recording costs.
+
+Measures the cost of the operations done by Herald on its message paths:
+incrementing a counter, recording a duration in a histogram and looking up a
+labelled series, compared to an empty loop.
+
+Usage: python bench_metrics.py [nb_calls]
+"""
+
+# Herald
+from herald.metrics import MetricsRegistry
+
+# Standard library
+import sys
+import time
+
+# ------------------------------------------------------------------------------
+
+
+def bench(method, nb_calls):
+    """
+    Calls a method
+
+    :return: The time per call, in nanoseconds
+    """
+    start = time.time()
+    for _ in range(nb_calls):
+        method()
+    return (time.time() - start) * 1e9 / nb_calls
+
+
+def main(nb_calls=500000):
+    """
+    Runs the benchmark
+    """
+    registry = MetricsRegistry()
+    counters = registry.counter("bench.counter", ("transport",))
+    histograms = registry.histogram("bench.histogram", ("subject", "peer"))
+    counter = counters.labels("http")
+    histogram = histograms.labels("bench/subject", "peer")
+
+    empty = bench(lambda: None, nb_calls)
+    print("{0} calls (ns/call, empty call of {1:.0f} ns deduced)"
+          .format(nb_calls, empty))
+    print("Counter inc .............. {0:.0f}"
+          .format(bench(counter.inc, nb_calls) - empty))
+    print("Histogram record ......... {0:.0f}"
+          .format(bench(lambda: histogram.record(.0012), nb_calls) - empty))
+    print("Counter labels + inc ..... {0:.0f}"
+          .format(bench(lambda: counters.labels("http").inc(), nb_calls)
+                  - empty))
+    print("Histogram labels + record  {0:.0f}"
+          .format(bench(lambda: histograms.labels("bench/subject", "peer")
+                        .record(.0012), nb_calls) - empty))
+    print("Timed record (2 x time()) {0:.0f}"
+          .format(bench(lambda: histogram.record(time.time() - time.time()),
+                        nb_calls) - empty))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Benchmark of the expiry of the peers discovered by multicast.
+
+Compares the previous full scan of the last-seen times every second (under
+the lock taken for each heart beat) with the ExpiryTracker: CPU time used
+while no peer expires, and time to handle a heart beat. Then compares
+unregistering the peers which timed out one by one and in a single batch.
+
+Usage: python bench_multicast_expiry.py [nb_peers [duration]]
+"""
+
+# Herald
+from herald.directory import HeraldDirectory
+from herald.utils import ExpiryTracker
+import herald
+
+# Standard library
+import sys
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+PEER_TTL = 30
+""" Time to live of a peer without heart beat """
+
+
+def cpu_time():
+    """
+    Returns the CPU time of the process
+    """
+    try:
+        return time.process_time()
+    except AttributeError:
+        # Python 2
+        return time.clock()
+
+
+class FullScan(object):
+    """
+    The previous implementation: a dictionary scanned every second
+    """
+    def __init__(self):
+        self.lst = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__loop)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def touch(self, uid):
+        with self.lock:
+            self.lst[uid] = time.time()
+
+    def __loop(self):
+        while not self.stop_event.is_set():
+            with self.lock:
+                loop_start = time.time()
+                to_delete = set()
+                for uid, last_seen in self.lst.items():
+                    if not last_seen:
+                        pass
+                    elif (loop_start - last_seen) > PEER_TTL:
+                        to_delete.add(uid)
+                for uid in to_delete:
+                    del self.lst[uid]
+            self.stop_event.wait(1)
+
+
+class NoOp(object):
+    """
+    No expiry at all: CPU time of the heart beats simulation
+    """
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def touch(self, uid):
+        pass
+
+
+class Tracker(object):
+    """
+    The ExpiryTracker
+    """
+    def __init__(self):
+        self.tracker = ExpiryTracker(PEER_TTL, lambda uids: None)
+
+    def start(self):
+        self.tracker.start()
+
+    def stop(self):
+        self.tracker.stop()
+
+    def touch(self, uid):
+        self.tracker.touch(uid)
+
+
+def run_idle(engine, nb_peers, duration):
+    """
+    Tracks peers which don't send heart beats during the given duration
+    (shorter than the TTL)
+
+    :return: The CPU time used per second (in ms)
+    """
+    engine.start()
+    for idx in range(nb_peers):
+        engine.touch("peer-{0}".format(idx))
+
+    start_cpu = cpu_time()
+    time.sleep(duration)
+    used = cpu_time() - start_cpu
+    engine.stop()
+    return used * 1000 / duration
+
+
+def run_heartbeats(engine, nb_peers, nb_beats):
+    """
+    Feeds an expiry engine with the heart beats of known peers
+
+    :return: The time to handle a heart beat (in microseconds)
+    """
+    uids = ["peer-{0}".format(idx) for idx in range(nb_peers)]
+    engine.start()
+    for uid in uids:
+        engine.touch(uid)
+
+    start = time.time()
+    for idx in range(nb_beats):
+        engine.touch(uids[idx % nb_peers])
+    used = time.time() - start
+    engine.stop()
+    return used * 1000000 / nb_beats
+
+
+def run_unregister(nb_peers, nb_expired):
+    """
+    Unregisters the peers which expired together
+
+    :return: A (one by one, batch) tuple of durations in seconds
+    """
+    class Context(object):
+        @staticmethod
+        def get_property(name):
+            if name in (herald.FWPROP_PEER_UID, herald.FWPROP_NODE_UID):
+                return "local"
+
+    results = []
+    for batch in (False, True):
+        directory = HeraldDirectory()
+        directory._validate(Context())
+        for idx in range(nb_peers):
+            directory.register({
+                "uid": "peer-{0}".format(idx), "name": "peer",
+                "node_uid": "node-{0}".format(idx % 10), "node_name": "node",
+                "app_id": herald.DEFAULT_APPLICATION_ID,
+                "groups": ["all", "group-{0}".format(idx % 10)],
+                "accesses": {}})
+
+        uids = ["peer-{0}".format(idx) for idx in range(nb_expired)]
+        start = time.time()
+        if batch:
+            directory.unregister_all(uids)
+        else:
+            for uid in uids:
+                directory.unregister(uid)
+        results.append(time.time() - start)
+
+    return tuple(results)
+
+
+def main(nb_peers=5000, duration=5):
+    """
+    Runs the benchmark
+    """
+    print("{0} peers, TTL {1}s".format(nb_peers, PEER_TTL))
+    print("Idle CPU time (ms/s): full scan {0:.2f} | tracker {1:.2f}".format(
+        run_idle(FullScan(), nb_peers, duration),
+        run_idle(Tracker(), nb_peers, duration)))
+    print("Heart beat handling (us): full scan {0:.2f} | tracker {1:.2f}"
+          .format(run_heartbeats(FullScan(), nb_peers, 100000),
+                  run_heartbeats(Tracker(), nb_peers, 100000)))
+
+    nb_expired = nb_peers // 5
+    single, batch = run_unregister(nb_peers, nb_expired)
+    print("Unregistering {0} peers (s): one by one {1:.3f} | batch {2:.3f}"
+          .format(nb_expired, single, batch))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Benchmark of the reception of multicast heart beats.
+
+Compares the parsing of heart beats by successive slices (previous
+implementation) and by parse_beat(). Then simulates a storm of heart beats
+(e.g. after a network partition heals) sent to a local UDP socket, read one
+by one or in batches, and prints the number of packets lost and the number
+of heart beats given to the discovery.
+
+Usage: python bench_multicast_receive.py [nb_peers [beats_per_peer]]
+"""
+
+# Herald
+from herald.transports.http.discovery_multicast import MulticastReceiver, \
+    make_heartbeat, parse_beat
+import herald
+
+# Standard library
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+
+def slice_parse(data):
+    """
+    Previous parsing of the heart beats: unpacks fields from successive
+    slices of the packet
+    """
+    def unpack(fmt, data):
+        size = struct.calcsize(fmt)
+        read, unread = data[:size], data[size:]
+        return struct.unpack(fmt, read), unread
+
+    def unpack_string(data):
+        result, data = unpack("<H", data)
+        size = result[0]
+        return data[:size].decode("utf-8"), data[size:]
+
+    parsed, data = unpack("<B", data)
+    kind = parsed[0]
+    parsed, data = unpack("<H", data)
+    port = parsed[0]
+    path, data = unpack_string(data)
+    uid, data = unpack_string(data)
+    try:
+        app_id, data = unpack_string(data)
+    except struct.error:
+        app_id = herald.DEFAULT_APPLICATION_ID
+    try:
+        generation = unpack("<Q", data)[0][0]
+    except struct.error:
+        generation = None
+    return kind, uid, app_id, port, path, generation
+
+
+def bench_parse(nb_beats=100000):
+    """
+    Compares the parsers
+
+    :return: A (slices, parse_beat) tuple of parsed beats per second
+    """
+    beat = make_heartbeat(8080, "/herald", "{0:032X}".format(1),
+                          herald.DEFAULT_APPLICATION_ID, 123456)
+    results = []
+    for parser in (slice_parse, parse_beat):
+        start = time.time()
+        for _ in range(nb_beats):
+            parser(beat)
+        results.append(nb_beats / (time.time() - start))
+    return tuple(results)
+
+
+def bench_storm(batch_size, nb_peers, beats_per_peer):
+    """
+    Sends a storm of heart beats to a receiver
+
+    :return: A (received packets, handled heart beats, duration) tuple
+    """
+    handled = [0]
+
+    def callback(*_):
+        handled[0] += 1
+
+    receiver = MulticastReceiver("239.0.0.1", 0, callback, batch_size)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    receiver._socket = sock
+    receiver._setup_socket()
+
+    received = [0]
+    running = threading.Event()
+    running.set()
+
+    def read():
+        while running.is_set():
+            if select.select([sock], [], [], .1)[0]:
+                packets = receiver._read_batch()
+                received[0] += len(packets)
+                receiver._handle_batch(packets)
+
+    thread = threading.Thread(target=read)
+    thread.start()
+
+    beats = [make_heartbeat(8080, "/herald", "{0:032X}".format(idx),
+                            herald.DEFAULT_APPLICATION_ID, 1)
+             for idx in range(nb_peers)]
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    target = sock.getsockname()
+    start = time.time()
+    for _ in range(beats_per_peer):
+        for beat in beats:
+            sender.sendto(beat, target)
+
+    # Let the receiver drain the socket
+    time.sleep(.5)
+    duration = time.time() - start - .5
+    running.clear()
+    thread.join()
+    sender.close()
+    sock.close()
+    return received[0], handled[0], duration
+
+
+def main(nb_peers=2000, beats_per_peer=10):
+    """
+    Runs the benchmark
+    """
+    slices, parse = bench_parse()
+    print("Parsing (beats/s): slices {0:.0f} | parse_beat {1:.0f}"
+          .format(slices, parse))
+
+    nb_sent = nb_peers * beats_per_peer
+    print("Storm of {0} heart beats from {1} peers".format(nb_sent, nb_peers))
+    line = "{0:>6} | {1:>8} | {2:>6} | {3:>8} | {4:>8}"
+    print(line.format("batch", "received", "lost", "handled", "send(s)"))
+    for batch_size in (1, 16, 64):
+        received, handled, duration = bench_storm(batch_size, nb_peers,
+                                                  beats_per_peer)
+        print(line.format(batch_size, received, nb_sent - received, handled,
+                          "{0:.2f}".format(duration)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
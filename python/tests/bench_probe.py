@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Benchmark of the probe calls on the message paths.
+
+Compares the time spent by a transport to log a received message when the
+probe is disabled: building the data then calling store() (previous
+behaviour), or checking the active channels first. Then compares the
+matching of channel filters, parsed or compiled.
+
+Usage: python bench_probe.py [nb_calls]
+"""
+
+# Herald
+from herald.probe.core import ProbeCore, compile_filter
+import herald
+
+# Pelix
+import pelix.ldapfilter as ldapfilter
+
+# Standard library
+import sys
+import time
+
+# ------------------------------------------------------------------------------
+
+
+def store_always(probe, uid, host, port):
+    """
+    Previous transport code: the data is prepared before calling the probe
+    """
+    probe.store(
+        herald.PROBE_CHANNEL_MSG_RECV,
+        {"uid": uid, "timestamp": time.time(), "transport": "http",
+         "subject": "bench/subject", "source": "peer", "repliesTo": "",
+         "transportSource": "[{0}]:{1}".format(host, port)})
+
+
+def store_checked(probe, uid, host, port):
+    """
+    Current transport code: checks if the channel is active first
+    """
+    if herald.PROBE_CHANNEL_MSG_RECV in probe.active_channels:
+        probe.store(
+            herald.PROBE_CHANNEL_MSG_RECV,
+            {"uid": uid, "timestamp": time.time(), "transport": "http",
+             "subject": "bench/subject", "source": "peer", "repliesTo": "",
+             "transportSource": "[{0}]:{1}".format(host, port)})
+
+
+def bench_calls(method, probe, nb_calls):
+    """
+    Calls a logging method
+
+    :return: The time per call, in nanoseconds
+    """
+    start = time.time()
+    for _ in range(nb_calls):
+        method(probe, "uid", "localhost", 8080)
+    return (time.time() - start) * 1e9 / nb_calls
+
+
+def bench_filter(matcher, samples, nb_calls):
+    """
+    Tests samples against a filter
+
+    :return: The time per test, in nanoseconds
+    """
+    start = time.time()
+    for idx in range(nb_calls):
+        matcher(samples[idx % len(samples)])
+    return (time.time() - start) * 1e9 / nb_calls
+
+
+def main(nb_calls=500000):
+    """
+    Runs the benchmark
+    """
+    probe = ProbeCore()
+    probe._activated = False
+    probe._validate(None)
+
+    print("Probe disabled, {0} calls (ns/call): store {1:.0f} | checked {2:.0f}"
+          .format(nb_calls, bench_calls(store_always, probe, nb_calls),
+                  bench_calls(store_checked, probe, nb_calls)))
+
+    parsed = ldapfilter.get_ldap_filter(
+        "(&(subject=herald/*)(|(transport=http)(transport=xmpp))"
+        "(!(source=local)))")
+    compiled = compile_filter(parsed)
+    samples = [{"subject": "herald/test", "transport": "http",
+                "source": "peer"},
+               {"subject": "app/test", "transport": "http", "source": "peer"},
+               {"subject": "herald/test", "transport": "xmpp",
+                "source": "local"}]
+    print("Channel filter (ns/test): parsed {0:.0f} | compiled {1:.0f}"
+          .format(bench_filter(parsed.matches, samples, nb_calls),
+                  bench_filter(compiled, samples, nb_calls)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Benchmark of the SQLite probe store.
+
+Compares the previous store, which opened a connection and committed a
+transaction for each event, with the queued store and its background writer.
+Prints the time spent by the caller of store() (i.e. by the transports) per
+event, and the time before all events are in the database.
+
+Usage: python bench_probe_sqlite.py [nb_events]
+"""
+
+# Herald
+from herald.probe.store_sqlite import SqliteStore, CHANNEL_FIELDS
+import herald
+
+# Standard library
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+# ------------------------------------------------------------------------------
+
+
+class ConnectStore(object):
+    """
+    The previous store: a connection and a transaction per event
+    """
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.sql = {}
+        for channel, fields in CHANNEL_FIELDS.items():
+            self.sql[channel] = "INSERT INTO {0}({1}) values ({2})".format(
+                channel, ",".join(fields),
+                ",".join(":{0}".format(field) for field in fields))
+
+    def store(self, channel, data):
+        data = data.copy()
+        data["timestamp"] = int(data["timestamp"] * 1000)
+        sql_con = sqlite3.connect(self.db_name)
+        try:
+            with sql_con:
+                sql_con.execute(self.sql[channel], data)
+        finally:
+            sql_con.close()
+
+
+def make_events(nb_events):
+    """
+    Prepares message sending events
+    """
+    return [{"uid": "msg-{0}".format(idx), "timestamp": time.time(),
+             "transport": "http", "subject": "bench/subject",
+             "target": "peer-{0}".format(idx % 10),
+             "transportTarget": "localhost:8080", "repliesTo": None}
+            for idx in range(nb_events)]
+
+
+def run(folder, queued, nb_events):
+    """
+    Stores events
+
+    :return: A (caller time per event in microseconds, total time in
+             seconds) tuple
+    """
+    db_name = os.path.join(folder, "probe-{0}.db".format(queued))
+    # Create the tables
+    store = SqliteStore()
+    store._db_name = db_name
+    store.validate(None)
+    if not queued:
+        store.invalidate(None)
+        store = ConnectStore(db_name)
+
+    events = make_events(nb_events)
+    start = time.time()
+    for data in events:
+        store.store(herald.PROBE_CHANNEL_MSG_SEND, data)
+    caller = time.time() - start
+
+    if queued:
+        store.flush()
+        store.invalidate(None)
+    total = time.time() - start
+
+    sql_con = sqlite3.connect(db_name)
+    try:
+        nb_rows = sql_con.execute("SELECT COUNT(*) FROM {0}".format(
+            herald.PROBE_CHANNEL_MSG_SEND)).fetchone()[0]
+    finally:
+        sql_con.close()
+    assert nb_rows == nb_events, nb_rows
+
+    return caller * 1000000 / nb_events, total
+
+
+def main(nb_events=5000):
+    """
+    Runs the benchmark
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        print("{0} events".format(nb_events))
+        line = "{0:>18} | {1:>12} | {2:>9} | {3:>12}"
+        print(line.format("store", "caller (us)", "total (s)", "events/s"))
+        for queued, name in ((False, "connection/event"),
+                             (True, "queued writer")):
+            caller, total = run(folder, queued, nb_events)
+            print(line.format(name, "{0:.1f}".format(caller),
+                              "{0:.3f}".format(total),
+                              "{0:.0f}".format(nb_events / total)))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Benchmark of the route cache of Herald.fire().
+
+Prepares a Herald core with a real directory of neighbours and a routing
+service knowing distant peers, then fires messages to neighbours and to
+distant peers. Prints the cost of fire() per message with the route cache,
+and without it (routing service without routes generation, which disables
+the cache for the routed destinations).
+
+Usage: python bench_route_cache.py [nb_neighbours] [nb_messages]
+"""
+
+# Herald
+from herald.core import Herald
+from herald.directory import HeraldDirectory
+import herald
+import herald.beans as beans
+
+# Standard library
+import sys
+import time
+
+# ------------------------------------------------------------------------------
+
+
+class Context(object):
+    """
+    Bundle context giving the framework properties of a peer
+    """
+    def __init__(self, uid):
+        self.uid = uid
+
+    def get_property(self, name):
+        if name == herald.FWPROP_PEER_UID:
+            return self.uid
+        elif name == herald.FWPROP_PEER_GROUPS:
+            return ["all"]
+
+
+class Routing(object):
+    """
+    Routing service with a static table
+    """
+    def __init__(self, next_hops):
+        self.next_hops = next_hops
+
+    def get_next_hop_to(self, destination):
+        return self.next_hops.get(destination)
+
+
+class CachedRouting(Routing):
+    """
+    Routing service giving the generation of its routes
+    """
+    routes_generation = 0
+
+
+class Transport(object):
+    """
+    Transport dropping messages
+    """
+    def __init__(self):
+        self.count = 0
+
+    def fire(self, peer, message):
+        self.count += 1
+
+
+def make_herald(nb_neighbours, routing_class):
+    """
+    Prepares a Herald core and the UIDs of neighbours and distant peers
+    """
+    directory = HeraldDirectory()
+    directory._validate(Context("local"))
+    neighbours = []
+    for idx in range(nb_neighbours):
+        peer = HeraldDirectory()
+        peer._validate(Context("neighbour-{0}".format(idx)))
+        peer.get_local_peer().set_access(
+            "http", beans.RawAccess("http", ["10.0.0.1", 8080, "herald"]))
+        neighbours.append(directory.register(peer.get_local_peer().dump()).uid)
+
+    distant = ["distant-{0}".format(idx) for idx in range(nb_neighbours)]
+    routing = routing_class(dict(zip(distant, neighbours)))
+
+    core = Herald()
+    core._directory = directory
+    core._routing = routing
+    core._transports = {"http": Transport()}
+    return core, neighbours, distant
+
+
+def run(core, targets, nb_messages):
+    """
+    Fires messages to the targets, in turn
+
+    :return: The time per message, in microseconds
+    """
+    messages = [beans.Message("bench/route", "content")
+                for _ in range(nb_messages)]
+    nb_targets = len(targets)
+    start = time.time()
+    for idx, message in enumerate(messages):
+        core.fire(targets[idx % nb_targets], message)
+    return (time.time() - start) * 1e6 / nb_messages
+
+
+def main(nb_neighbours=200, nb_messages=100000):
+    """
+    Runs the benchmark
+    """
+    print("{0} neighbours, {1} messages per test"
+          .format(nb_neighbours, nb_messages))
+    line = "{0:<18} {1:>8.2f} us/message (neighbours) " \
+        "{2:>8.2f} us/message (distant peers)"
+    for name, routing_class in (("Without cache", Routing),
+                                ("With route cache", CachedRouting)):
+        core, neighbours, distant = make_herald(nb_neighbours, routing_class)
+        print(line.format(name, run(core, neighbours, nb_messages),
+                          run(core, distant, nb_messages)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Simulation of the neighbours monitoring (herald.routing_hellos) with
+thousands of neighbours.
+
+Each neighbour answers the hellos after a round trip time made of a base
+latency and of a random jitter. The simulation runs on a virtual clock and
+prints:
+
+* the spreading of the hellos: maximum number of hellos sent in a 100 ms
+  window (the previous implementation sent all of them at once),
+* the changes of the metrics given to the routing, compared to the raw
+  samples used as metrics by the previous implementation, and the error of
+  the metrics against the base latencies,
+* the processing time of the hellos and replies, and of the queries made
+  by the routing engines each time they check their links.
+
+Usage: python bench_routing_hellos.py [nb_neighbours] [jitter] [seed]
+"""
+
+# Herald
+from herald.routing_hellos import Hellos
+import herald.beans as beans
+
+# Standard library
+import heapq
+import random
+import sys
+import time
+
+# ------------------------------------------------------------------------------
+
+
+class Peer(object):
+    """
+    Minimal peer bean
+    """
+    def __init__(self, uid):
+        self.uid = uid
+
+
+class Directory(object):
+    """
+    Directory of the neighbours
+    """
+    def __init__(self, uids):
+        self.peers = tuple(Peer(uid) for uid in uids)
+
+    def get_peers(self):
+        return self.peers
+
+
+class Clock(object):
+    """
+    Virtual clock
+    """
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class Network(object):
+    """
+    Neighbours answering the hellos after a jittered round trip time
+    """
+    def __init__(self, clock, nb_neighbours, jitter, seed):
+        self.clock = clock
+        self.jitter = jitter
+        self.rand = random.Random(seed)
+        self.latency = dict(("neighbour-{0:04d}".format(idx),
+                             self.rand.uniform(.001, .050))
+                            for idx in range(nb_neighbours))
+        self.replies = []   # heap: (time, sequence, uid, hello UID)
+        self.sequence = 0
+        self.sent = {}      # hello UID -> sending time
+
+    def fire(self, target, message):
+        """
+        Schedules the reply to a hello
+        """
+        rtt = self.latency[target] \
+            * (1 + self.rand.uniform(-self.jitter, self.jitter))
+        self.sequence += 1
+        heapq.heappush(self.replies, (self.clock.now + rtt, self.sequence,
+                                      target, message.uid))
+        self.sent[message.uid] = self.clock.now
+
+
+def main(nb_neighbours=2000, jitter=.3, seed=42):
+    """
+    Runs the simulation
+    """
+    nb_neighbours = int(nb_neighbours)
+    jitter = float(jitter)
+    duration = 120.
+    clock = Clock()
+    network = Network(clock, nb_neighbours, jitter, seed)
+
+    hellos = Hellos()
+    hellos._herald = network
+    hellos._directory = Directory(network.latency)
+    hellos._clock = clock
+    hellos._hello_delay = 5.
+    hellos._hello_timeout = 12.
+    hellos._granularity = .00003
+    hellos._hysteresis = .05
+
+    print("{0} neighbours, RTT jitter +/-{1:.0%}, {2:.0f}s simulated, "
+          "hello_delay {3:.0f}s".format(nb_neighbours, jitter, duration,
+                                        hellos._hello_delay))
+
+    # Run the simulation, measuring the processing time
+    start = clock.now
+    end = start + duration
+    processing = 0.
+    next_tick = start
+    samples = {}
+    changes = raw_changes = 0
+    while clock.now < end:
+        if network.replies and network.replies[0][0] < next_tick:
+            # deliver a reply
+            clock.now, _, uid, hello_uid = heapq.heappop(network.replies)
+            old_metric = hellos.get_neighbour_metric(uid)
+            begin = time.time()
+            hellos.herald_message(None, beans.MessageReceived(
+                "reply", "herald/routing/reply/R/", None, uid, hello_uid,
+                "bench"))
+            processing += time.time() - begin
+
+            metric = hellos.get_neighbour_metric(uid)
+            if old_metric is not None and metric != old_metric:
+                changes += 1
+
+            # the previous implementation used the raw samples as metrics
+            sample = clock.now - network.sent[hello_uid]
+            previous = samples.get(uid)
+            if previous is not None and abs(sample - previous) >= .00003:
+                raw_changes += 1
+            samples[uid] = sample
+        else:
+            clock.now = next_tick
+            begin = time.time()
+            next_tick = hellos.tick()
+            processing += time.time() - begin
+
+    # Spreading of the hellos
+    windows = {}
+    for sent in network.sent.values():
+        window = int((sent - start) * 10)
+        windows[window] = windows.get(window, 0) + 1
+    periods = duration / hellos._hello_delay
+    print("Hellos sent: {0} ({1:.0f} per period), at most {2} per 100 ms "
+          "(previous: {3} at once)".format(len(network.sent),
+                                           len(network.sent) / periods,
+                                           max(windows.values()),
+                                           nb_neighbours))
+
+    # Stability and accuracy of the metrics
+    errors = [abs(hellos.get_neighbour_metric(uid) - latency) / latency
+              for uid, latency in network.latency.items()]
+    samples = nb_neighbours * periods
+    print("Metric changes: {0} ({1:.2f} per neighbour per period), "
+          "previous (raw samples): {2} ({3:.2f})"
+          .format(changes, changes / samples, raw_changes,
+                  raw_changes / samples))
+    print("Metric error against the base latency: {0:.1%} mean, "
+          "{1:.1%} max".format(sum(errors) / len(errors), max(errors)))
+
+    # Processing time
+    print("Hellos and replies processing: {0:.1f} ms per period, "
+          "{1:.1f} us per neighbour".format(
+              processing * 1000 / periods,
+              processing * 1e6 / (periods * nb_neighbours)))
+
+    begin = time.time()
+    for _ in range(10):
+        # queries of the routing engines in check_links()
+        links = {}
+        for neighbour in hellos.get_neighbours():
+            metric = hellos.get_neighbour_metric(neighbour)
+            if metric is not None:
+                links[neighbour] = metric
+        hellos.get_neighbours_routers().intersection(links)
+    print("Routing links check: {0:.2f} ms".format(
+        (time.time() - begin) * 100))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:4])
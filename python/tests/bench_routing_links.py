@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Simulation of the routing engines with hundreds of in-process routers.
+
+Builds a random mesh (routers placed on a plane, linked to their close
+neighbours, with a latency proportional to the distance), then runs the
+same scenario with the link-state (herald.routing_links) and the
+distance-vector (herald.routing_roads) engines: initial convergence, link
+metric changes and link losses. Messages are delivered synchronously,
+through JSON. For each step, prints the number of messages, the number of
+rounds of messages needed to converge (each round costs a flood or trigger
+delay to real routers) and the processing time, then checks the roads of
+all routers against Dijkstra's algorithm on the real topology.
+
+Usage: python bench_routing_links.py [nb_routers] [seed]
+"""
+
+# Herald
+from herald.routing_links import LinkState, shortest_paths
+from herald.routing_roads import Roads
+import herald.beans as beans
+
+# Standard library
+import json
+import math
+import random
+import sys
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+
+class Hellos(object):
+    """
+    Neighbours of a router, read from the mesh links
+    """
+    def __init__(self, links):
+        self.links = links
+
+    def get_neighbours(self):
+        return set(self.links)
+
+    def get_neighbour_metric(self, neighbour):
+        return self.links.get(neighbour)
+
+    def get_neighbours_routers(self):
+        return set(self.links)
+
+    def is_reachable(self, neighbour):
+        return neighbour in self.links
+
+    def set_not_reachable(self, neighbour):
+        pass
+
+
+class Directory(object):
+    """
+    Local peer information
+    """
+    def __init__(self, uid):
+        self.local_uid = uid
+
+
+class Herald(object):
+    """
+    Queues the sent messages
+    """
+    def __init__(self, queue, uid):
+        self.queue = queue
+        self.uid = uid
+
+    def fire(self, target, message):
+        self.queue.append((self.uid, target, message))
+
+
+def make_link_state(uid, queue, links):
+    """
+    Prepares a link-state router
+    """
+    router = LinkState()
+    router._herald = Herald(queue, uid)
+    router._directory = Directory(uid)
+    router._hellos = Hellos(links)
+    router._link_delay = 5.
+    router._refresh_delay = 60.
+    router._max_age = 180.
+    router._threshold = 0.
+    router._local_uid = uid
+    router._clear()
+    return router
+
+
+def make_roads(uid, queue, links):
+    """
+    Prepares a distance-vector router
+    """
+    router = Roads()
+    router._herald = Herald(queue, uid)
+    router._directory = Directory(uid)
+    router._hellos = Hellos(links)
+    router._road_delay = 5.
+    router._refresh_delay = 60.
+    router._trigger_delay = 0.
+    router._max_metric = 60.
+    router._threshold = 0.
+    router._lock = threading.Lock()
+    router._local_uid = uid
+    router._clear()
+    return router
+
+
+class Mesh(object):
+    """
+    Random mesh of routers
+    """
+    def __init__(self, nb_routers, seed, factory):
+        rand = random.Random(seed)
+        self.queue = []
+        self.links = {}
+        self.routers = {}
+
+        positions = {}
+        for idx in range(nb_routers):
+            uid = "router-{0:04d}".format(idx)
+            positions[uid] = (rand.random(), rand.random())
+            self.links[uid] = {}
+            self.routers[uid] = factory(uid, self.queue, self.links[uid])
+
+        # Link each router to its closest neighbours
+        radius = 1.6 / math.sqrt(nb_routers)
+        uids = sorted(positions)
+        for idx, uid in enumerate(uids):
+            for other in uids[idx + 1:]:
+                distance = math.hypot(positions[uid][0] - positions[other][0],
+                                      positions[uid][1] - positions[other][1])
+                if distance < radius:
+                    self.set_link(uid, other, round(.001 + distance / 10, 6))
+
+        # Ensure the mesh is connected
+        for previous, uid in zip(uids, uids[1:]):
+            if not self.links[uid]:
+                self.set_link(previous, uid, .05)
+
+    def set_link(self, uid_a, uid_b, metric):
+        """
+        Sets the metric of a link (None to remove it)
+        """
+        for uid, other in ((uid_a, uid_b), (uid_b, uid_a)):
+            if metric is None:
+                self.links[uid].pop(other, None)
+            else:
+                self.links[uid][other] = metric
+
+    def run(self):
+        """
+        Checks the links and delivers messages until convergence
+
+        :return: A (messages, rounds, seconds) tuple
+        """
+        start = time.time()
+        for router in self.routers.values():
+            router.check_links()
+
+        messages = rounds = 0
+        while True:
+            for router in self.routers.values():
+                send_updates = getattr(router, "send_updates", None)
+                if send_updates is not None:
+                    send_updates()
+            if not self.queue:
+                return messages, rounds, time.time() - start
+
+            rounds += 1
+            queue = self.queue[:]
+            del self.queue[:]
+            for sender, target, message in queue:
+                content = json.loads(json.dumps(message.content))
+                messages += 1
+                self.routers[target].herald_message(
+                    None, beans.MessageReceived(
+                        message.uid, message.subject, content, sender, None,
+                        "bench"))
+
+    def check(self):
+        """
+        Checks the roads of all routers
+
+        :return: The number of wrong roads
+        """
+        errors = 0
+        for uid, router in self.routers.items():
+            expected = shortest_paths(self.links, uid)[0]
+            found = router.get_accessible_peers()
+            for destination, distance in expected.items():
+                if destination in self.links[uid]:
+                    # direct neighbour
+                    continue
+                if abs(found.get(destination, -1) - distance) > 1e-6:
+                    errors += 1
+        return errors
+
+
+def scenario(nb_routers, seed, factory):
+    """
+    Runs the scenario with a routing engine
+    """
+    mesh = Mesh(nb_routers, seed, factory)
+    rand = random.Random(seed)
+    links = sorted(set(tuple(sorted((uid, other)))
+                       for uid in mesh.links for other in mesh.links[uid]))
+
+    line = "  {0:<24} {1:>7} messages {2:>4} max rounds {3:>7.3f}s " \
+        "{4:>3} wrong roads"
+    messages, rounds, duration = mesh.run()
+    print(line.format("Initial convergence", messages, rounds, duration,
+                      mesh.check()))
+
+    for name, count, factor in (("link metric changes", 20, 1.5),
+                                ("link losses", 10, None)):
+        total_messages = max_rounds = total_duration = 0
+        for _ in range(count):
+            uid_a, uid_b = rand.choice(links)
+            if factor is None:
+                mesh.set_link(uid_a, uid_b, None)
+            else:
+                mesh.set_link(uid_a, uid_b,
+                              mesh.links[uid_a].get(uid_b, .01) * factor)
+            messages, rounds, duration = mesh.run()
+            total_messages += messages
+            max_rounds = max(max_rounds, rounds)
+            total_duration += duration
+        print(line.format("{0} {1}".format(count, name), total_messages,
+                          max_rounds, total_duration, mesh.check()))
+
+    return mesh
+
+
+def main(nb_routers=300, seed=42):
+    """
+    Runs the simulation
+    """
+    print("Mesh of {0} routers".format(nb_routers))
+    print("Link-state (herald.routing_links)")
+    mesh = scenario(nb_routers, seed, make_link_state)
+    stats = {}
+    for router in mesh.routers.values():
+        for key, value in router.get_stats().items():
+            stats[key] = stats.get(key, 0) + value
+    print("  Roads computations: {full} full, {partial} partial, "
+          "{skipped} skipped".format(**stats))
+
+    print("Distance-vector (herald.routing_roads)")
+    scenario(nb_routers, seed, make_roads)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Benchmark of the distance-vector routing (Roads) control traffic.
+
+Builds a grid of in-process routers, lets it converge, then changes the
+metric of a link and removes another one. For each step, prints the number
+of roads messages and of announced roads sent until the grid converges,
+and compares it to the traffic of the periodic full tables sent by the
+previous implementation every road_delay.
+
+Usage: python bench_routing_roads.py [grid_size]
+"""
+
+# Herald
+from herald.routing_roads import Roads
+import herald.beans as beans
+
+# Standard library
+import json
+import sys
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+
+class Hellos(object):
+    """
+    Neighbours of a router, read from the grid links
+    """
+    def __init__(self, links):
+        self.links = links
+
+    def get_neighbours(self):
+        return set(self.links)
+
+    def get_neighbour_metric(self, neighbour):
+        return self.links.get(neighbour)
+
+    def get_neighbours_routers(self):
+        return set(self.links)
+
+    def is_reachable(self, neighbour):
+        return neighbour in self.links
+
+    def set_not_reachable(self, neighbour):
+        pass
+
+
+class Directory(object):
+    """
+    Local peer information
+    """
+    def __init__(self, uid):
+        self.local_uid = uid
+
+
+class Herald(object):
+    """
+    Queues the sent messages
+    """
+    def __init__(self, queue, uid):
+        self.queue = queue
+        self.uid = uid
+
+    def fire(self, target, message):
+        self.queue.append((self.uid, target, message))
+
+
+class Grid(object):
+    """
+    Grid of routers
+    """
+    def __init__(self, size):
+        self.queue = []
+        self.links = {}
+        self.routers = {}
+        for row in range(size):
+            for col in range(size):
+                uid = "{0}-{1}".format(row, col)
+                self.links[uid] = {}
+                roads = Roads()
+                roads._herald = Herald(self.queue, uid)
+                roads._directory = Directory(uid)
+                roads._hellos = Hellos(self.links[uid])
+                roads._road_delay = 5.
+                roads._refresh_delay = 60.
+                roads._trigger_delay = 0.
+                roads._max_metric = 60.
+                roads._threshold = .1
+                roads._lock = threading.Lock()
+                roads._local_uid = uid
+                roads._clear()
+                self.routers[uid] = roads
+
+        for row in range(size):
+            for col in range(size):
+                if col + 1 < size:
+                    self.set_link((row, col), (row, col + 1), .001)
+                if row + 1 < size:
+                    self.set_link((row, col), (row + 1, col), .001)
+
+    def set_link(self, node_a, node_b, metric):
+        """
+        Sets the metric of a link (None to remove it)
+        """
+        uid_a = "{0}-{1}".format(*node_a)
+        uid_b = "{0}-{1}".format(*node_b)
+        for uid, other in ((uid_a, uid_b), (uid_b, uid_a)):
+            if metric is None:
+                self.links[uid].pop(other, None)
+            else:
+                self.links[uid][other] = metric
+
+    def run(self):
+        """
+        Checks the links and delivers messages until convergence
+
+        :return: A (messages, roads, rounds, seconds) tuple
+        """
+        start = time.time()
+        for roads in self.routers.values():
+            roads.check_links()
+
+        messages = entries = rounds = 0
+        while True:
+            for roads in self.routers.values():
+                roads.send_updates()
+            if not self.queue:
+                return messages, entries, rounds, time.time() - start
+
+            rounds += 1
+            queue = self.queue[:]
+            del self.queue[:]
+            for sender, target, message in queue:
+                content = json.loads(json.dumps(message.content))
+                messages += 1
+                entries += len(content["routes"])
+                self.routers[target].herald_message(
+                    None, beans.MessageReceived(
+                        message.uid, message.subject, content, sender, None,
+                        "bench"))
+
+    def full_tables_traffic(self):
+        """
+        Computes the traffic of a period of the previous implementation:
+        each router sends its whole table to each neighbour router
+
+        :return: A (messages, roads) tuple
+        """
+        messages = entries = 0
+        for uid, roads in self.routers.items():
+            size = len(roads._next_hop)
+            for _ in self.links[uid]:
+                messages += 1
+                entries += size - 1
+        return messages, entries
+
+
+def main(size=15):
+    """
+    Runs the benchmark
+    """
+    grid = Grid(size)
+    print("Grid of {0} routers".format(size * size))
+    line = "{0:<24} {1:>9} messages {2:>9} roads {3:>4} rounds {4:.3f}s"
+
+    print(line.format("Initial convergence", *grid.run()))
+    print(line.format("No change", *grid.run()))
+    print("{0:<24} {1:>9} messages {2:>9} roads (every road_delay)"
+          .format("Previous periodic tables", *grid.full_tables_traffic()))
+
+    middle = size // 2
+    grid.set_link((middle, middle), (middle, middle + 1), .01)
+    print(line.format("Link metric change", *grid.run()))
+
+    grid.set_link((0, 0), (0, 1), None)
+    print(line.format("Link loss", *grid.run()))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
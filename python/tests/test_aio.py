@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the asyncio facade of Herald
+"""
+
+# Herald
+from herald.aio import AsyncHerald
+from herald.exceptions import HeraldTimeout
+
+# Standard library
+import asyncio
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class ThreadedHerald(object):
+    """
+    Herald-like service calling back posts and listeners from other threads,
+    like transports do
+    """
+    def __init__(self):
+        self.listeners = []
+        self.forgotten = []
+
+    def __later(self, method, *args):
+        threading.Timer(.05, method, args).start()
+
+    def post(self, target, message, callback, errback, timeout=180,
+             forget_on_first=True):
+        if target == "timeout":
+            self.__later(errback, self, HeraldTimeout(None, "timeout", None))
+        elif target != "never":
+            self.__later(callback, self, (target, message))
+        return message
+
+    def fire(self, target, message):
+        for listener, _ in self.listeners:
+            self.__later(listener.herald_dispatch, self, message)
+        return message
+
+    def forget(self, uid):
+        self.forgotten.append(uid)
+        return True
+
+    def add_message_listener(self, listener, filters):
+        self.listeners.append((listener, filters))
+
+    def remove_message_listener(self, listener, filters):
+        self.listeners.remove((listener, filters))
+
+
+class AsyncHeraldTest(unittest.TestCase):
+    """
+    Tests the asyncio facade
+    """
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.herald = ThreadedHerald()
+        self.aherald = AsyncHerald(self.herald, self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_send(self):
+        """
+        Checks that concurrent send() calls get their own reply
+        """
+        async def run():
+            return await asyncio.gather(*[self.aherald.send(idx, "msg")
+                                          for idx in range(50)])
+
+        replies = self.loop.run_until_complete(run())
+        self.assertEqual(replies, [(idx, "msg") for idx in range(50)])
+
+    def test_send_error(self):
+        """
+        Checks errors and cancellation of send()
+        """
+        self.assertRaises(HeraldTimeout, self.loop.run_until_complete,
+                          self.aherald.send("timeout", "msg"))
+
+        async def cancelled():
+            await asyncio.wait_for(self.aherald.send("never", "msg-id"), .1)
+
+        self.assertRaises(asyncio.TimeoutError, self.loop.run_until_complete,
+                          cancelled())
+        self.assertEqual(self.herald.forgotten, ["msg-id"])
+
+    def test_post(self):
+        """
+        Checks that post() callbacks are called in the loop thread
+        """
+        results = []
+        loop_thread = threading.current_thread()
+
+        async def callback(aherald, reply):
+            results.append((aherald, reply, threading.current_thread()))
+
+        async def run():
+            uid = await self.aherald.post("peer", "msg", callback, None)
+            await asyncio.sleep(.2)
+            return uid
+
+        self.assertEqual(self.loop.run_until_complete(run()), "msg")
+        self.assertEqual(results,
+                         [(self.aherald, ("peer", "msg"), loop_thread)])
+
+    def test_listener(self):
+        """
+        Checks that async listeners are notified in the loop thread
+        """
+        results = []
+        loop_thread = threading.current_thread()
+
+        class Listener(object):
+            async def herald_message(self, aherald, message):
+                results.append((message, threading.current_thread()))
+
+        listener = Listener()
+        self.aherald.add_listener(listener, "test/*")
+        self.assertEqual(len(self.herald.listeners), 1)
+
+        async def run():
+            await self.aherald.fire("peer", "msg")
+            await asyncio.sleep(.2)
+
+        self.loop.run_until_complete(run())
+        self.assertEqual(results, [("msg", loop_thread)])
+
+        self.assertTrue(self.aherald.remove_listener(listener))
+        self.assertFalse(self.aherald.remove_listener(listener))
+        self.assertEqual(self.herald.listeners, [])
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the Herald beans
+"""
+
+# Herald
+import herald
+import herald.beans as beans
+import herald.utils as utils
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class MessageTest(unittest.TestCase):
+    """
+    Tests the Message beans
+    """
+    def test_headers(self):
+        """
+        Tests the headers mapping
+        """
+        message = beans.Message("test/subject", "content")
+        headers = message.headers
+        self.assertEqual(sorted(headers),
+                         sorted([herald.MESSAGE_HERALD_VERSION,
+                                 herald.MESSAGE_HEADER_TIMESTAMP,
+                                 herald.MESSAGE_HEADER_UID]))
+        self.assertEqual(headers[herald.MESSAGE_HEADER_UID], message.uid)
+        self.assertEqual(headers[herald.MESSAGE_HERALD_VERSION],
+                         herald.HERALD_SPECIFICATION_VERSION)
+
+        # Well-known and other headers
+        message.add_header(herald.MESSAGE_HEADER_TARGET_PEER, "peer")
+        message.add_header("custom", None)
+        self.assertEqual(len(headers), 5)
+        self.assertIn("custom", headers)
+        self.assertIsNone(message.get_header("custom"))
+        self.assertEqual(message.get_header(herald.MESSAGE_HEADER_TARGET_PEER),
+                         "peer")
+        self.assertIsNone(message.get_header(herald.MESSAGE_HEADER_TARGET_GROUP))
+        self.assertRaises(KeyError, headers.__getitem__,
+                          herald.MESSAGE_HEADER_TARGET_GROUP)
+        self.assertEqual(headers.copy(), dict(headers.items()))
+        self.assertEqual(headers, headers.copy())
+
+        message.remove_header(herald.MESSAGE_HEADER_TARGET_PEER)
+        message.remove_header("custom")
+        message.remove_header("unknown")
+        self.assertNotIn(herald.MESSAGE_HEADER_TARGET_PEER, headers)
+        self.assertEqual(len(headers), 3)
+        self.assertRaises(KeyError, headers.__delitem__, "custom")
+
+        # Compact beans
+        for bean in (message, headers):
+            self.assertFalse(hasattr(bean, "__dict__"))
+
+    def test_metadata(self):
+        """
+        Tests the metadata
+        """
+        message = beans.Message("test/subject")
+        self.assertIsNone(message.get_metadata("key"))
+        message.remove_metadata("key")
+        self.assertEqual(message.metadata, {})
+
+        message.add_metadata("key", "value")
+        self.assertEqual(message.get_metadata("key"), "value")
+        message.remove_metadata("key")
+        self.assertEqual(message.metadata, {})
+
+    def test_received(self):
+        """
+        Tests the received messages
+        """
+        message = beans.MessageReceived("uid", "test/subject", "content",
+                                        "sender", None, "http", 42)
+        self.assertEqual(message.uid, "uid")
+        self.assertEqual(message.timestamp, 42)
+        self.assertEqual(message.sender, "sender")
+        self.assertIsNone(message.reply_to)
+        self.assertIn(herald.MESSAGE_HEADER_REPLIES_TO, message.headers)
+        self.assertEqual(message.access, "http")
+        self.assertFalse(hasattr(message, "__dict__"))
+
+        lazy = beans.LazyMessageReceived("uid", "test/subject", "[1]", "test",
+                                         lambda raw: [int(raw[1])],
+                                         "sender", None, "http")
+        self.assertFalse(hasattr(lazy, "__dict__"))
+        self.assertEqual(lazy.content, [1])
+        self.assertTrue(lazy.decoded)
+
+    def test_uid(self):
+        """
+        Tests the generation of message UIDs
+        """
+        uids = set(beans.Message("test").uid for _ in range(1000))
+        self.assertEqual(len(uids), 1000)
+        for uid in uids:
+            self.assertEqual(len(uid), 32)
+            self.assertEqual(uid, uid.upper())
+            int(uid, 16)
+
+        # A new prefix is drawn after a fork
+        uid = utils.generate_uid()
+        utils._reset_uid_generator()
+        self.assertNotEqual(utils.generate_uid()[:16], uid[:16])
+
+
+class PeerTest(unittest.TestCase):
+    """
+    Tests the Peer bean
+    """
+    def test_peer(self):
+        """
+        Tests the basic properties of a peer
+        """
+        peer = beans.Peer("uid", None, "app", ["all", "group"], None)
+        self.assertFalse(hasattr(peer, "__dict__"))
+        self.assertEqual(peer.node_uid, "uid")
+        self.assertEqual(peer.name, "uid")
+
+        # Groups can't be modified
+        groups = peer.groups
+        groups.add("other")
+        self.assertEqual(peer.groups, {"all", "group"})
+
+        peer.set_access("test", beans.RawAccess("test", "data"))
+        self.assertEqual(peer.dump()["accesses"], {"test": "data"})
+        self.assertEqual(peer, beans.Peer("uid", "node", "app", [], None))
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the Herald messages codecs
+"""
+
+# Herald
+from herald.codec import CODEC_JSON, CODEC_MSGPACK, get_codec, \
+    available_codecs, select_codec
+from herald.transports.http.transport import HttpTransport
+import herald
+import herald.beans
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+def make_message(content):
+    """
+    Prepares a message with the headers added by the transports
+    """
+    message = herald.beans.Message("test/codec", content)
+    message.add_header(herald.MESSAGE_HEADER_SENDER_UID, "sender")
+    message.add_header(herald.MESSAGE_HEADER_TARGET_GROUP, "all")
+    message.add_header("custom-header", 42)
+    message.add_metadata("key", "value")
+    return message
+
+
+class CodecTest(unittest.TestCase):
+    """
+    Tests the codecs
+    """
+    def _check_codec(self, codec):
+        """
+        Checks that messages are decoded as they were sent
+        """
+        for content in (None, "text", [1, 2.5, None],
+                        {"name": "value", "nested": {"list": [True]}}):
+            message = make_message(content)
+            received = codec.decode(codec.encode(message))
+            self.assertEqual(received.uid, message.uid)
+            self.assertEqual(received.subject, message.subject)
+            self.assertEqual(received.content, content)
+            self.assertEqual(received.sender, "sender")
+            self.assertEqual(received.get_header("custom-header"), 42)
+            self.assertEqual(
+                received.get_header(herald.MESSAGE_HEADER_TARGET_GROUP), "all")
+            self.assertEqual(received.get_metadata("key"), "value")
+
+        # Batch envelope
+        messages = [make_message(idx) for idx in range(3)]
+        received = codec.read_envelope(
+            codec.make_envelope([codec.encode(message)
+                                 for message in messages]))
+        self.assertEqual([message.uid for message in received],
+                         [message.uid for message in messages])
+        self.assertEqual([message.content for message in received],
+                         [0, 1, 2])
+
+    def test_json(self):
+        """
+        Tests the JSON codec
+        """
+        self._check_codec(get_codec(CODEC_JSON))
+        self.assertIsNone(get_codec(CODEC_JSON).decode("invalid"))
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        """
+        Tests the MessagePack codec
+        """
+        codec = get_codec(CODEC_MSGPACK)
+        self._check_codec(codec)
+        self.assertIsNone(codec.decode(msgpack.packb([1, 2])))
+
+        # Interned headers make the message smaller
+        message = make_message({"value": 42})
+        self.assertLess(len(codec.encode(message)),
+                        len(get_codec(CODEC_JSON).encode(message)) * .8)
+
+    def test_select(self):
+        """
+        Tests the negotiation of codecs
+        """
+        self.assertEqual(available_codecs()[-1], CODEC_JSON)
+        self.assertEqual(select_codec(None).name, CODEC_JSON)
+        self.assertEqual(select_codec(["batch", "unknown"]).name, CODEC_JSON)
+        self.assertEqual(select_codec([CODEC_MSGPACK]).name,
+                         CODEC_JSON if msgpack is None else CODEC_MSGPACK)
+
+    def test_http_negotiation(self):
+        """
+        Tests the choice of the codec by the HTTP transport, from the
+        capabilities given by the peer servers in their responses
+        """
+        class Sender(object):
+            def get_capabilities(self, address):
+                return capabilities.get(address, frozenset())
+
+        capabilities = {("new", 80): frozenset(["batch", CODEC_MSGPACK])}
+        transport = HttpTransport()
+        transport._HttpTransport__sender = Sender()
+        get = transport._HttpTransport__get_codec
+
+        # Servers not contacted yet, or without the header: JSON
+        self.assertEqual(get(("old", 80)).name, CODEC_JSON)
+        self.assertEqual(get(("new", 80)).name,
+                         CODEC_JSON if msgpack is None else CODEC_MSGPACK)
+
+        # Replies use the codec of the request
+        self.assertEqual(get(("new", 80), {'codec': CODEC_JSON}).name,
+                         CODEC_JSON)
+
+
+class LazyMessageTest(unittest.TestCase):
+    """
+    Tests the decoding of the content of received messages on demand
+    """
+    def _check_forward(self, codec_in, codec_out):
+        """
+        Checks that a message can be forwarded without decoding its content
+        """
+        content = {"list": [1, 2], "set": set([3])}
+        received = codec_in.decode(codec_in.encode(make_message(content)))
+        self.assertFalse(received.decoded)
+
+        # Forward it with a new header
+        received.add_header("final_destination", "target")
+        forwarded = codec_out.decode(codec_out.encode(received))
+        self.assertFalse(received.decoded)
+
+        self.assertEqual(forwarded.get_header("final_destination"), "target")
+        self.assertEqual(forwarded.uid, received.uid)
+        self.assertEqual(forwarded.content, content)
+        self.assertTrue(forwarded.decoded)
+
+        # Content read by the first peer
+        self.assertEqual(received.content, content)
+        self.assertTrue(received.decoded)
+        self.assertIsNotNone(received.raw_content)
+
+        # Replaced content: the encoded one is forgotten
+        received.set_content("text")
+        self.assertIsNone(received.raw_content)
+        self.assertEqual(codec_out.decode(codec_out.encode(received)).content,
+                         "text")
+
+    def test_json(self):
+        """
+        Tests the lazy messages read from JSON
+        """
+        codec = get_codec(CODEC_JSON)
+        self._check_forward(codec, codec)
+
+        # String contents are not encoded
+        received = codec.decode(codec.encode(make_message("text")))
+        self.assertIsNone(received.raw_content)
+        self.assertEqual(received.content, "text")
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        """
+        Tests the lazy messages read from MessagePack
+        """
+        json_codec = get_codec(CODEC_JSON)
+        msgpack_codec = get_codec(CODEC_MSGPACK)
+        self._check_forward(msgpack_codec, msgpack_codec)
+        self._check_forward(json_codec, msgpack_codec)
+
+        # Forwarded from MessagePack to JSON: the content must be decoded
+        received = msgpack_codec.decode(
+            msgpack_codec.encode(make_message([1, 2])))
+        self.assertEqual(json_codec.decode(json_codec.encode(received))
+                         .content, [1, 2])
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
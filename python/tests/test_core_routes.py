@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the route cache of the Herald core
+"""
+
+# Herald
+from herald.core import Herald
+from herald.exceptions import NoTransport
+from herald.metrics import MetricsRegistry
+import herald
+import herald.beans as beans
+import herald.routing_constants
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+def make_peer(uid, accesses=("http",)):
+    """
+    Prepares a peer bean
+    """
+    peer = beans.Peer(uid, uid, "app", ["all"], None)
+    for access in accesses:
+        peer.set_access(access, access)
+    return peer
+
+
+class Directory(object):
+    """
+    Directory of the neighbours
+    """
+    local_uid = "local"
+
+    def __init__(self, *peers):
+        self.peers = dict((peer.uid, peer) for peer in peers)
+
+    def __contains__(self, peer):
+        return getattr(peer, "uid", peer) in self.peers
+
+    def get_peer(self, uid):
+        return self.peers[uid]
+
+
+class Routing(object):
+    """
+    Routing service with a static table
+    """
+    def __init__(self, next_hops):
+        self.next_hops = next_hops
+        self.lookups = 0
+        self.routes_generation = 0
+
+    def get_next_hop_to(self, destination):
+        self.lookups += 1
+        return self.next_hops.get(destination)
+
+
+class Transport(object):
+    """
+    Transport keeping the sent messages
+    """
+    def __init__(self):
+        self.sent = []
+        self.error = None
+
+    def fire(self, peer, message):
+        if self.error is not None:
+            raise self.error
+        self.sent.append((peer.uid, message.get_header("final_destination")))
+
+
+class RouteCacheTest(unittest.TestCase):
+    """
+    Tests the route cache of fire()
+    """
+    def setUp(self):
+        """
+        Prepares a router with two neighbours, A and B
+        """
+        self.peer_a = make_peer("A", ("xmpp", "http"))
+        self.registry = MetricsRegistry()
+        self.routing = Routing({"C": "A", "D": "B"})
+        self.http = Transport()
+        self.xmpp = Transport()
+        self.herald = Herald()
+        self.herald._directory = Directory(self.peer_a, make_peer("B"))
+        self.herald._routing = self.routing
+        self.herald._transports = {"http": self.http, "xmpp": self.xmpp}
+        self.herald._bind_metrics(None, self.registry, None)
+
+    def tearDown(self):
+        """
+        Cleans up
+        """
+        self.herald._unbind_metrics(None, self.registry, None)
+
+    def fire(self, target, count=1):
+        """
+        Fires messages to the target
+        """
+        for _ in range(count):
+            self.herald.fire(target, beans.Message("test/routes", "content"))
+
+    def values(self):
+        """
+        Returns the values of the metrics
+        """
+        result = {}
+        for metric in self.registry.snapshot():
+            for series in metric["series"]:
+                labels = tuple(value for _, value
+                               in sorted(series["labels"].items()))
+                result[(metric["name"],) + labels] = series["value"]
+        return result
+
+    def test_cache(self):
+        """
+        The route to a destination is resolved once
+        """
+        self.fire("C", 10)
+        self.fire("B", 5)
+        self.assertEqual(self.routing.lookups, 1)
+        self.assertEqual(self.xmpp.sent, [("A", "C")] * 10)
+        self.assertEqual(self.http.sent, [("B", None)] * 5)
+
+        values = self.values()
+        self.assertEqual(values[("herald.routes.cache", "miss")], 2)
+        self.assertEqual(values[("herald.routes.cache", "hit")], 13)
+        self.assertAlmostEqual(values[("herald.routes.cache.ratio",)],
+                               13. / 15)
+        self.assertEqual(values[("herald.routes.cached",)], 2)
+        self.assertEqual(values[("herald.messages.routed", "next-hop")], 10)
+        self.assertEqual(values[("herald.messages.out", "xmpp")], 10)
+
+    def test_routing_changes(self):
+        """
+        The cache follows the generation of the routes
+        """
+        self.fire("C", 2)
+        self.routing.next_hops["C"] = "B"
+        self.routing.routes_generation += 1
+        self.fire("C", 2)
+        self.assertEqual(self.routing.lookups, 2)
+        self.assertEqual(self.xmpp.sent, [("A", "C")] * 2)
+        self.assertEqual(self.http.sent, [("B", "C")] * 2)
+
+        # Routing services without generation are always queried
+        del self.routing.routes_generation
+        self.fire("C", 3)
+        self.assertEqual(self.routing.lookups, 5)
+
+        # ... as the routing service going away
+        self.herald._routing = None
+        self.herald._unbind_routing(None, self.routing, None)
+        self.herald._gateway = "A"
+        self.fire("D", 2)
+        self.assertEqual(self.xmpp.sent[-2:], [("A", "D")] * 2)
+
+    def test_directory_changes(self):
+        """
+        Directory events clear the cache
+        """
+        for event in (lambda: self.herald.peer_registered(make_peer("E")),
+                      lambda: self.herald.peer_updated(self.peer_a, "http",
+                                                       None, None),
+                      lambda: self.herald.peer_unregistered(make_peer("E"))):
+            self.fire("C", 2)
+            lookups = self.routing.lookups
+            event()
+            self.fire("C")
+            self.assertEqual(self.routing.lookups, lookups + 1)
+
+        # A neighbour gets away: the message is routed
+        self.fire("B")
+        self.herald.peer_unregistered(self.herald._directory.peers.pop("B"))
+        self.routing.next_hops["B"] = "A"
+        self.fire("B")
+        self.assertEqual(self.http.sent, [("B", None)])
+        self.assertEqual(self.xmpp.sent[-1], ("A", "B"))
+
+    def test_transport_error(self):
+        """
+        A failing cached transport is replaced by another access
+        """
+        self.fire("C")
+        self.xmpp.error = IOError("test")
+        self.fire("C", 2)
+        self.assertEqual(self.http.sent, [("A", "C")] * 2)
+
+        # The next hop is kept: only its access changed
+        self.assertEqual(self.routing.lookups, 1)
+
+        self.http.error = IOError("test")
+        self.assertRaises(NoTransport, self.fire, "C")
+        self.assertEqual(self.values()[("herald.routes.cached",)], 0)
+
+
+class MultipathRouting(Routing):
+    """
+    Routing service giving several next hops
+    """
+    def get_next_hops_to(self, destination):
+        self.lookups += 1
+        return list(self.next_hops.get(destination, ()))
+
+
+class MultipathTest(RouteCacheTest):
+    """
+    Tests the balancing of the routed messages over several next hops
+    """
+    def setUp(self):
+        """
+        Prepares a router with three neighbours, A, B and E, all of them
+        next hops to C
+        """
+        RouteCacheTest.setUp(self)
+        self.routing = MultipathRouting({"C": [("A", 2.), ("B", 2.),
+                                               ("E", 4.)]})
+        self.herald._routing = self.routing
+        self.herald._directory.peers["E"] = make_peer("E")
+
+    def fire_from(self, sender, count=1):
+        """
+        Fires messages to C, as forwarded from the given sender
+        """
+        for _ in range(count):
+            message = beans.Message("test/routes", "content")
+            message.add_header(herald.MESSAGE_HEADER_SENDER_UID, sender)
+            self.herald.fire("C", message)
+
+    def next_hops(self):
+        """
+        Returns the next hops used, in order
+        """
+        return [uid for uid, _ in sorted(self.xmpp.sent + self.http.sent)]
+
+    def test_flow(self):
+        """
+        Messages of a flow take the same next hop, flows are spread
+        """
+        self.fire_from("S1", 10)
+        self.assertEqual(len(set(self.next_hops())), 1)
+
+        for idx in range(50):
+            self.fire_from("S{0}".format(idx))
+        self.assertEqual(set(self.next_hops()), set(["A", "B", "E"]))
+        self.assertEqual(self.routing.lookups, 1)
+
+    def test_latency(self):
+        """
+        Messages are spread according to the inverse of the distances
+        """
+        self.herald._balance = herald.routing_constants.BALANCE_LATENCY
+        self.fire_from("S1", 1000)
+        counts = dict((uid, self.next_hops().count(uid))
+                      for uid in ("A", "B", "E"))
+        self.assertAlmostEqual(counts["A"], 400, delta=80)
+        self.assertAlmostEqual(counts["B"], 400, delta=80)
+        self.assertAlmostEqual(counts["E"], 200, delta=80)
+
+    def test_no_balance(self):
+        """
+        Without balancing, the best next hop is used
+        """
+        self.herald._balance = None
+        del self.routing.next_hops["C"]
+        self.routing.next_hop = {"C": "B"}
+        self.routing.get_next_hop_to = self.routing.next_hop.get
+        for idx in range(20):
+            self.fire_from("S{0}".format(idx))
+        self.assertEqual(set(self.next_hops()), set(["B"]))
+
+    def test_failover(self):
+        """
+        Messages go through the next best hop when a next hop fails
+        """
+        # B can also be reached by FTP
+        ftp = Transport()
+        self.herald._transports["ftp"] = ftp
+        self.herald._directory.peers["B"] = make_peer("B", ("http", "ftp"))
+
+        # E is unknown: it is removed from the route
+        del self.herald._directory.peers["E"]
+        for idx in range(20):
+            self.fire_from("S{0}".format(idx))
+        self.assertEqual(set(self.next_hops()), set(["A", "B"]))
+        self.assertEqual(self.herald._Herald__routes["C"].hops, ("A", "B"))
+        self.assertEqual(self.values()[("herald.routes.failover",)], 1)
+
+        # A has no transport left: B takes all the messages
+        self.xmpp.error = self.http.error = NoTransport(None, "test")
+        for idx in range(20):
+            self.fire_from("S{0}".format(idx))
+        self.assertEqual(len(ftp.sent), 20)
+        self.assertEqual(self.herald._Herald__routes["C"].hops, ("B",))
+        self.assertEqual(self.routing.lookups, 1)
+
+        # No next hop left: the route is resolved again
+        ftp.error = IOError("test")
+        self.assertRaises(NoTransport, self.fire_from, "S1")
+        self.assertNotIn("C", self.herald._Herald__routes)
+
+    # Single path tests of the parent class
+    test_cache = test_routing_changes = test_directory_changes = \
+        test_transport_error = None
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
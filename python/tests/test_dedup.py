@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the stores of treated messages UIDs
+"""
+
+# Herald
+from herald.dedup import create_store, TimeBucketedSet, RotatingBloomFilter, \
+    STORE_BLOOM, STORE_BUCKETS
+
+# Standard library
+import threading
+import uuid
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class FakeClock(object):
+    """
+    A clock whose time is set by the test
+    """
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class TimeBucketedSetTest(unittest.TestCase):
+    """
+    Tests the time-bucketed exact store
+    """
+    def test_duplicates(self):
+        """
+        Checks that a known UID is detected
+        """
+        store = TimeBucketedSet(300, 1000)
+        self.assertFalse(store.check_and_add("A"))
+        self.assertFalse(store.check_and_add("B"))
+        self.assertTrue(store.check_and_add("A"))
+        self.assertTrue(store.check_and_add("B"))
+
+        stats = store.stats()
+        self.assertEqual(stats["kind"], STORE_BUCKETS)
+        self.assertEqual(stats["size"], 2)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["evictions"], 0)
+        self.assertGreater(stats["memory"], 0)
+
+    def test_expiry(self):
+        """
+        Checks that UIDs are kept at least the TTL, then forgotten
+        """
+        clock = FakeClock()
+        store = TimeBucketedSet(100, 1000, 10, clock)
+        self.assertFalse(store.check_and_add("A"))
+
+        clock.now += 99
+        self.assertTrue(store.check_and_add("A"))
+
+        clock.now += 15
+        self.assertFalse(store.check_and_add("A"))
+        self.assertEqual(store.stats()["evictions"], 1)
+
+        # Jump far away in time
+        clock.now += 10000
+        self.assertFalse(store.check_and_add("A"))
+        self.assertEqual(len(store), 1)
+
+    def test_capacity(self):
+        """
+        Checks that the store size is bounded
+        """
+        store = TimeBucketedSet(300, 100, 10)
+        for _ in range(10000):
+            store.check_and_add(str(uuid.uuid4()))
+            self.assertLessEqual(len(store), 100)
+
+        # The most recent UIDs are still known
+        uid = str(uuid.uuid4())
+        store.check_and_add(uid)
+        self.assertTrue(store.check_and_add(uid))
+        self.assertGreater(store.stats()["evictions"], 0)
+
+    def test_concurrent_capacity(self):
+        """
+        Checks that a full bucket is rotated once when several threads fill
+        it at the same time
+        """
+        store = TimeBucketedSet(300, 1100, 10, FakeClock())
+        start = threading.Event()
+
+        def receive():
+            start.wait()
+            for _ in range(5000):
+                store.check_and_add(str(uuid.uuid4()))
+
+        threads = [threading.Thread(target=receive) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        # One rotation per 100 UIDs at most: no bucket has been skipped
+        self.assertLessEqual(store._TimeBucketedSet__offset, 20000 // 100)
+        self.assertGreaterEqual(len(store), 1000)
+
+
+class RotatingBloomFilterTest(unittest.TestCase):
+    """
+    Tests the Bloom filters store
+    """
+    def test_duplicates(self):
+        """
+        Checks that a known UID is detected
+        """
+        store = RotatingBloomFilter(300, 1000, .01)
+        uids = [str(uuid.uuid4()) for _ in range(200)]
+        for uid in uids:
+            store.check_and_add(uid)
+
+        for uid in uids:
+            self.assertTrue(store.check_and_add(uid))
+
+        stats = store.stats()
+        self.assertEqual(stats["kind"], STORE_BLOOM)
+        self.assertEqual(stats["error_rate"], .01)
+        self.assertGreaterEqual(stats["hits"], 200)
+
+    def test_error_rate(self):
+        """
+        Checks that the false-positive rate is close to the configured one
+        """
+        store = RotatingBloomFilter(300, 20000, .01)
+        for _ in range(10000):
+            store.check_and_add(str(uuid.uuid4()))
+
+        false_positives = sum(store.check_and_add(str(uuid.uuid4()))
+                              for _ in range(10000))
+        self.assertLess(false_positives, 10000 * .01 * 2)
+
+    def test_rotation(self):
+        """
+        Checks that old generations are forgotten
+        """
+        store = RotatingBloomFilter(300, 100, .001)
+        self.assertFalse(store.check_and_add("A"))
+        for _ in range(200):
+            store.check_and_add(str(uuid.uuid4()))
+
+        self.assertFalse(store.check_and_add("A"))
+        self.assertGreater(store.stats()["evictions"], 0)
+
+    def test_concurrency(self):
+        """
+        Checks that a UID received by several threads at once is new for
+        only one of them
+        """
+        store = RotatingBloomFilter(300, 100000, 1e-9)
+        uids = [str(uuid.uuid4()) for _ in range(5000)]
+        start = threading.Event()
+        new_uids = []
+
+        def receive():
+            start.wait()
+            new_uids.extend(uid for uid in uids
+                            if not store.check_and_add(uid))
+
+        threads = [threading.Thread(target=receive) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(new_uids), sorted(uids))
+
+    def test_factory(self):
+        """
+        Tests the store factory
+        """
+        self.assertIsInstance(create_store(STORE_BUCKETS, 300, 100),
+                              TimeBucketedSet)
+        self.assertIsInstance(create_store(STORE_BLOOM, 300, 100),
+                              RotatingBloomFilter)
+        self.assertRaises(ValueError, create_store, "unknown", 300, 100)
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the Herald core directory
+"""
+
+# Herald
+from herald.directory import HeraldDirectory
+import herald
+import herald.beans as beans
+
+# Standard library
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class FakeContext(object):
+    """
+    Bundle context giving the framework properties of the local peer
+    """
+    def __init__(self, uid="local"):
+        self.uid = uid
+
+    def get_property(self, name):
+        if name in (herald.FWPROP_PEER_UID, herald.FWPROP_NODE_UID):
+            return self.uid
+        elif name == herald.FWPROP_PEER_GROUPS:
+            return ["local-group"]
+
+
+class GroupListener(object):
+    """
+    Directory group listener
+    """
+    def __init__(self):
+        self.groups = set()
+
+    def group_set(self, group):
+        self.groups.add(group)
+
+    def group_unset(self, group):
+        self.groups.remove(group)
+
+
+class PeerListener(object):
+    """
+    Directory listener
+    """
+    def __init__(self):
+        self.unregistered = []
+
+    def peer_registered(self, peer):
+        pass
+
+    def peer_updated(self, peer, access_id, data, previous):
+        pass
+
+    def peer_unregistered(self, peer):
+        self.unregistered.append(peer)
+
+
+def make_description(uid, name, node_uid, groups):
+    """
+    Prepares the description of a peer, in the format of dump()
+    """
+    return {"uid": uid, "name": name, "node_uid": node_uid,
+            "node_name": node_uid, "app_id": herald.DEFAULT_APPLICATION_ID,
+            "groups": groups, "accesses": {"test": "access"}}
+
+
+class DirectoryTest(unittest.TestCase):
+    """
+    Tests the indexes of the directory
+    """
+    def setUp(self):
+        self.directory = HeraldDirectory()
+        self.listener = GroupListener()
+        self.directory._group_listeners = [self.listener]
+        self.directory._validate(FakeContext())
+
+    def test_indexes(self):
+        """
+        Checks the lookups after registrations and unregistrations
+        """
+        directory = self.directory
+        self.assertEqual(directory.get_peers_for_group("local-group"),
+                         frozenset())
+        peer_a = directory.register(
+            make_description("A", "name", "node-1", ["all", "g1"]))
+        peer_b = directory.register(
+            make_description("B", "name", "node-1", ["all", "g2"]))
+        peer_c = directory.register(
+            make_description("C", "other", "node-2", ["all", "g2"]))
+        self.assertEqual(self.listener.groups, {"all", "g1", "g2"})
+
+        self.assertIs(directory.get_peer("A"), peer_a)
+        self.assertIn("A", directory)
+        self.assertIn(peer_a, directory)
+        self.assertNotIn("D", directory)
+        self.assertEqual(set(directory.get_peers()), {peer_a, peer_b, peer_c})
+        self.assertEqual(set(directory.get_peers_for_group("all")),
+                         {peer_a, peer_b, peer_c})
+        self.assertEqual(directory.get_peers_for_group("g2"),
+                         {peer_b, peer_c})
+        self.assertEqual(directory.get_uids_for_name("name"), {"A", "B"})
+        self.assertEqual(directory.get_uids_for_name("C"), {"C"})
+        self.assertEqual(set(directory.get_peers_for_name("name")),
+                         {peer_a, peer_b})
+        self.assertEqual(directory.get_peers_for_name("C"), (peer_c,))
+        self.assertEqual(set(directory.get_peers_for_node("node-1")),
+                         {peer_a, peer_b})
+        self.assertEqual(directory.get_peers_for_node("unknown"), ())
+
+        # Same objects while nothing changes
+        self.assertIs(directory.get_peers(), directory.get_peers())
+        self.assertIs(directory.get_peers_for_group("g2"),
+                      directory.get_peers_for_group("g2"))
+
+        # Views held by readers are not modified
+        group = directory.get_peers_for_group("g2")
+        self.assertIs(directory.unregister("B"), peer_b)
+        self.assertEqual(group, {peer_b, peer_c})
+        self.assertEqual(directory.get_peers_for_group("g2"), {peer_c})
+        self.assertEqual(directory.get_uids_for_name("name"), {"A"})
+        self.assertEqual(directory.get_peers_for_node("node-1"), (peer_a,))
+        self.assertNotIn("B", directory)
+
+        directory.unregister("C")
+        self.assertEqual(self.listener.groups, {"all", "g1"})
+        self.assertRaises(KeyError, directory.get_peers_for_group, "g2")
+        self.assertRaises(KeyError, directory.get_uids_for_name, "other")
+        self.assertEqual(directory.get_peers_for_node("node-2"), ())
+        self.assertIsNone(directory.unregister("C"))
+
+    def test_concurrent_reads(self):
+        """
+        Checks that readers always see complete registrations
+        """
+        directory = self.directory
+        errors = []
+        running = threading.Event()
+        running.set()
+
+        def read():
+            while running.is_set():
+                # Peers are only added: a later lookup must see them all
+                peers = directory.get_peers()
+                try:
+                    group = directory.get_peers_for_group("group")
+                except KeyError:
+                    group = frozenset()
+                nodes = directory.get_peers_for_node("node")
+                errors.extend(peer for peer in peers
+                              if peer not in group or peer not in nodes)
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        try:
+            for idx in range(200):
+                directory.register(make_description(
+                    str(idx), "name", "node", ["all", "group"]))
+        finally:
+            running.clear()
+            reader.join()
+
+        self.assertEqual(errors, [])
+        for idx in range(0, 200, 2):
+            directory.unregister(str(idx))
+        self.assertEqual(len(directory.get_peers_for_group("group")), 100)
+        self.assertEqual(len(directory.get_uids_for_name("name")), 100)
+
+    def test_unregister_all(self):
+        """
+        Unregisters several peers at once
+        """
+        directory = self.directory
+        listener = PeerListener()
+        directory._listeners = [listener]
+
+        peers = [directory.register(make_description(
+            str(idx), "name-{0}".format(idx % 2), "node", ["all", "g1"]))
+            for idx in range(4)]
+        peer_e = directory.register(
+            make_description("E", "other", "node-2", ["all", "g2"]))
+        self.assertEqual(self.listener.groups, {"all", "g1", "g2"})
+
+        # Unknown and duplicated UIDs are ignored
+        removed = directory.unregister_all(["0", "1", "1", "2", "3", "X"])
+        self.assertEqual(set(removed), set(peers))
+        self.assertEqual(set(listener.unregistered), set(peers))
+        self.assertEqual(self.listener.groups, {"all", "g2"})
+        self.assertEqual(directory.get_peers(), (peer_e,))
+        self.assertEqual(directory.get_peers_for_group("g2"), {peer_e})
+        self.assertRaises(KeyError, directory.get_uids_for_name, "name-0")
+        self.assertEqual(directory.get_peers_for_node("node"), ())
+
+        self.assertEqual(directory.unregister_all(["0", "X"]), [])
+
+
+class DeltaTest(unittest.TestCase):
+    """
+    Tests the synchronization of directories using deltas
+    """
+    def setUp(self):
+        self.directories = []
+        for uid in ("A", "B", "C"):
+            directory = HeraldDirectory()
+            directory._validate(FakeContext(uid))
+            directory.get_local_peer().set_access(
+                "test", beans.RawAccess("test", uid))
+            self.directories.append(directory)
+
+    def sync(self, source, target):
+        """
+        Sends the changes known by the source to the target
+
+        :return: The deltas
+        """
+        deltas = source.dump_delta(target.digest())
+        for delta in deltas:
+            target.load_delta(delta)
+        return deltas
+
+    def test_peer_delta(self):
+        """
+        Tests the deltas of a peer
+        """
+        peer = self.directories[0].get_local_peer()
+        generation = peer.generation
+
+        # Nothing changed
+        delta = peer.dump_delta(generation)
+        self.assertEqual(delta, {"uid": "A", "generation": generation,
+                                 "since": generation})
+
+        # Changed name and access
+        peer.name = "name"
+        peer.set_access("other", beans.RawAccess("other", "data"))
+        delta = peer.dump_delta(generation)
+        self.assertEqual(delta["generation"], generation + 2)
+        self.assertEqual(delta["name"], "name")
+        self.assertEqual(delta["accesses"], {"other": "data"})
+
+        # Removed access
+        generation = peer.generation
+        peer.unset_access("other")
+        delta = peer.dump_delta(generation)
+        self.assertNotIn("accesses", delta)
+        self.assertEqual(delta["removed"], ["other"])
+
+        # Changes made before the generation of the first description
+        delta = peer.dump_delta(0)
+        self.assertEqual(delta["since"], 0)
+        self.assertEqual(delta["accesses"], {"test": "A"})
+
+    def test_sync(self):
+        """
+        Synchronizes directories with deltas
+        """
+        dir_a, dir_b, dir_c = self.directories
+
+        # First contact: full descriptions
+        self.assertEqual(len(self.sync(dir_a, dir_b)), 1)
+        self.assertEqual(len(self.sync(dir_b, dir_c)), 2)
+        self.assertEqual(dir_c.get_peer("A").get_access("test").data, "A")
+        self.assertEqual(dir_c.digest()["A"], dir_b.digest()["A"])
+
+        # Nothing changed: nothing to send
+        self.assertEqual(self.sync(dir_b, dir_c), [])
+
+        # Change of A, relayed by B
+        peer_a = dir_a.get_local_peer()
+        peer_a.set_access("other", beans.RawAccess("other", "data"))
+        peer_a.set_name("renamed")
+        delta = self.sync(dir_a, dir_b)[0]
+        self.assertEqual(delta["accesses"], {"other": "data"})
+        self.assertNotIn("node_name", delta)
+
+        deltas = self.sync(dir_b, dir_c)
+        self.assertEqual(len(deltas), 1)
+        self.assertNotEqual(deltas[0]["since"], 0)
+        peer = dir_c.get_peer("A")
+        self.assertEqual(peer.generation, peer_a.generation)
+        self.assertEqual(peer.get_access("other").data, "data")
+        self.assertEqual(dir_c.get_uids_for_name("renamed"), {"A"})
+        self.assertEqual(dir_c.get_peers_for_name("renamed"), (peer,))
+
+        # Stale and partial deltas are ignored
+        self.assertIsNone(dir_c.load_delta(delta))
+        unknown = dict(delta, uid="D")
+        self.assertIsNone(dir_c.load_delta(unknown))
+
+        # Changed groups
+        peer_a.set_groups(["new"])
+        self.sync(dir_a, dir_b)
+        self.assertEqual(dir_b.get_peers_for_group("new"),
+                         {dir_b.get_peer("A")})
+        self.assertRaises(KeyError, dir_b.get_peers_for_group, "A")
+
+        # Removed access
+        peer_a.unset_access("other")
+        self.sync(dir_a, dir_b)
+        self.assertFalse(dir_b.get_peer("A").has_access("other"))
+
+        # No access left: the peer is unregistered
+        peer_a.unset_access("test")
+        self.sync(dir_a, dir_b)
+        self.assertNotIn("A", dir_b)
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the Herald subject dispatch index
+"""
+
+# Herald
+from herald.dispatch import SubjectIndex
+
+# Standard library
+import fnmatch
+import re
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+PATTERNS = ('herald/routing/*', 'herald/routing/hello/\\*',
+            'herald/rpc/jsonrpc', 'herald/rpc/jsonrpc/reply', '*',
+            'herald/shell/*', 'reply/*', 'herald/r*/reply', 'HERALD/Rpc/*',
+            'herald/directory/?ye', 'app/[ab]/*', 'app/*/end', '/*', '')
+
+SUBJECTS = ('herald/routing/hello/', 'herald/routing/roads/',
+            'herald/routing', 'herald/rpc/jsonrpc', 'herald/RPC/jsonrpc',
+            'herald/rpc/jsonrpc/reply', 'herald/rpc/xmlrpc/reply',
+            'reply/herald/shell/exec', 'herald/directory/bye', 'app/a/x',
+            'app/c/x', 'app/a/b/end', 'app/end', '/abc', '', 'unknown',
+            'herald/routing/hello/\\')
+
+
+class SubjectIndexTest(unittest.TestCase):
+    """
+    Tests the subject index against the fnmatch behaviour
+    """
+    @staticmethod
+    def brute_force(patterns, subject):
+        """
+        Computes the expected listeners, like Herald did before the index
+        """
+        return set(listener for pattern, listener in patterns
+                   if re.match(fnmatch.translate(pattern), subject,
+                               re.IGNORECASE))
+
+    def test_match(self):
+        """
+        Checks that the index gives the same result as fnmatch
+        """
+        index = SubjectIndex()
+        patterns = [(pattern, idx) for idx, pattern in enumerate(PATTERNS)]
+        for pattern, listener in patterns:
+            index.add(pattern, listener)
+
+        for subject in SUBJECTS:
+            self.assertEqual(index.match(subject),
+                             self.brute_force(patterns, subject), subject)
+
+    def test_remove(self):
+        """
+        Checks that removed patterns are not matched anymore
+        """
+        index = SubjectIndex()
+        patterns = [(pattern, idx) for idx, pattern in enumerate(PATTERNS)]
+        for pattern, listener in patterns:
+            index.add(pattern, listener)
+
+        while patterns:
+            pattern, listener = patterns.pop(0)
+            self.assertTrue(index.remove(pattern, listener))
+            self.assertFalse(index.remove(pattern, listener))
+
+            for subject in SUBJECTS:
+                self.assertEqual(index.match(subject),
+                                 self.brute_force(patterns, subject), subject)
+
+        self.assertEqual(len(index), 0)
+
+    def test_shared_pattern(self):
+        """
+        Checks that a pattern can be shared by multiple listeners
+        """
+        index = SubjectIndex()
+        index.add('herald/routing/*', 'a')
+        index.add('herald/routing/*', 'b')
+        index.add('herald/routing/*', 'b')
+        self.assertEqual(index.match('herald/routing/hello'), {'a', 'b'})
+
+        index.remove('herald/routing/*', 'a')
+        self.assertEqual(index.match('herald/routing/hello'), {'b'})
+
+    def test_snapshot(self):
+        """
+        Checks that a match result isn't modified by later updates
+        """
+        index = SubjectIndex()
+        index.add('herald/*', 'a')
+        result = index.match('herald/test')
+        index.add('herald/*', 'b')
+        self.assertEqual(result, {'a'})
+        self.assertEqual(index.match('herald/test'), {'a', 'b'})
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
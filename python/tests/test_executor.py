@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the Herald notification executor
+"""
+
+# Herald
+from herald.executor import NotificationExecutor, POLICY_BLOCK, \
+    POLICY_DROP_OLDEST, POLICY_OVERLOADED
+
+# Standard library
+import threading
+import time
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+def make_lanes(policy, per_listener=False):
+    """
+    Prepares lanes with a control lane and a tiny application lane
+    """
+    return ({"name": "control", "prefixes": ("herald/routing/",),
+             "max_threads": 1},
+            {"name": "app", "max_threads": 1, "queue_size": 2,
+             "policy": policy, "block_timeout": .2,
+             "per_listener": per_listener})
+
+
+class NotificationExecutorTest(unittest.TestCase):
+    """
+    Tests the notification executor
+    """
+    def setUp(self):
+        self.executor = None
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        if self.executor is not None:
+            self.executor.stop()
+
+    def start(self, lanes):
+        """
+        Starts an executor with the given lanes
+        """
+        self.executor = NotificationExecutor(lanes, "Test")
+        self.executor.start()
+        return self.executor
+
+    def block(self, subject, key="slow"):
+        """
+        Blocks the worker of the lane of the given subject
+        """
+        started = threading.Event()
+
+        def slow():
+            started.set()
+            self.release.wait(5)
+
+        self.assertTrue(self.executor.execute(subject, key, slow))
+        self.assertTrue(started.wait(1))
+
+    def test_control_lane(self):
+        """
+        Checks that control subjects don't queue behind application ones
+        """
+        executor = self.start(make_lanes(POLICY_OVERLOADED))
+        self.block("app/slow")
+
+        event = threading.Event()
+        self.assertTrue(executor.execute("herald/routing/hello", None,
+                                         event.set))
+        self.assertTrue(event.wait(1))
+
+    def test_overloaded(self):
+        """
+        Checks the rejection policy
+        """
+        executor = self.start(make_lanes(POLICY_OVERLOADED))
+        self.block("app/slow")
+
+        calls = []
+        self.assertTrue(executor.execute("app/a", None, calls.append, 1))
+        self.assertTrue(executor.execute("app/a", None, calls.append, 2))
+        self.assertFalse(executor.execute("app/a", None, calls.append, 3))
+
+        self.release.set()
+        time.sleep(.2)
+        self.assertEqual(calls, [1, 2])
+
+        stats = dict((lane["name"], lane) for lane in executor.stats())
+        self.assertEqual(stats["Test-app"]["rejected"], 1)
+
+    def test_drop_oldest(self):
+        """
+        Checks the drop-oldest policy
+        """
+        executor = self.start(make_lanes(POLICY_DROP_OLDEST))
+        self.block("app/slow")
+
+        calls = []
+        for idx in range(5):
+            self.assertTrue(executor.execute("app/a", None, calls.append, idx))
+
+        self.release.set()
+        time.sleep(.2)
+        self.assertEqual(calls, [3, 4])
+
+    def test_block(self):
+        """
+        Checks the blocking policy
+        """
+        executor = self.start(make_lanes(POLICY_BLOCK))
+        self.block("app/slow")
+
+        calls = []
+        self.assertTrue(executor.execute("app/a", None, calls.append, 1))
+        self.assertTrue(executor.execute("app/a", None, calls.append, 2))
+
+        # Blocks until timeout
+        start = time.time()
+        self.assertFalse(executor.execute("app/a", None, calls.append, 3))
+        self.assertGreaterEqual(time.time() - start, .2)
+
+        # Blocks until the worker is released
+        threading.Timer(.1, self.release.set).start()
+        self.assertTrue(executor.execute("app/a", None, calls.append, 4))
+        time.sleep(.2)
+        self.assertEqual(calls, [1, 2, 4])
+
+    def test_per_listener(self):
+        """
+        Checks that a slow listener doesn't delay the others
+        """
+        executor = self.start(make_lanes(POLICY_OVERLOADED, True))
+        self.block("app/slow", "slow")
+
+        event = threading.Event()
+        self.assertTrue(executor.execute("app/a", "other", event.set))
+        self.assertTrue(event.wait(1))
+
+        executor.forget("other")
+        self.assertEqual(len(executor.stats()), 2)
+
+    def test_scaling(self):
+        """
+        Checks that workers are started with the load
+        """
+        executor = self.start(({"name": "app", "max_threads": 4,
+                                "min_threads": 0},))
+        barrier = threading.Semaphore(0)
+        release = threading.Event()
+
+        def task():
+            barrier.release()
+            release.wait(5)
+
+        for _ in range(4):
+            executor.execute("app/a", None, task)
+
+        for _ in range(4):
+            self.assertTrue(barrier.acquire(timeout=1))
+
+        self.assertEqual(executor.stats()[0]["threads"], 4)
+        release.set()
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the SWIM gossip protocol of the HTTP discovery
+"""
+
+# Herald
+from herald.transports.http.discovery_gossip import Swim, STATE_ALIVE, \
+    STATE_SUSPECT
+
+# Standard library
+import random
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class Clock(object):
+    """
+    Simulated clock
+    """
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class Network(object):
+    """
+    In-process network of Swim instances: messages are delivered at the next
+    step
+    """
+    def __init__(self, size, known=True, seed=42):
+        self.clock = Clock()
+        self.random = random.Random(seed)
+        self.nodes = {}
+        self.queue = []
+        self.down = set()
+        self.cut = set()
+        self.dead = dict((uid, set()) for uid in self.names(size))
+        self.joined = dict((uid, set()) for uid in self.names(size))
+        for uid in self.names(size):
+            self.add_node(uid)
+
+        if known:
+            # Everybody knows everybody
+            for uid, node in self.nodes.items():
+                for other in self.nodes:
+                    node.add_member(other, self.address(other),
+                                    self.nodes[other].incarnation, False)
+
+    @staticmethod
+    def names(size):
+        return ["node-{0}".format(idx) for idx in range(size)]
+
+    @staticmethod
+    def address(uid):
+        return (uid, 8080, "/herald")
+
+    def add_node(self, uid):
+        def send(target, address, kind, content):
+            # The host of a peer is its UID
+            self.queue.append((uid, target or address[0], kind,
+                               dict(content)))
+
+        self.dead.setdefault(uid, set())
+        self.joined.setdefault(uid, set())
+        node = self.nodes[uid] = Swim(
+            uid, self.address(uid), send,
+            lambda other, _: self.joined[uid].add(other),
+            self.dead[uid].add, clock=self.clock,
+            randomizer=random.Random(self.random.random()))
+        return node
+
+    def step(self, delay=.1):
+        """
+        Delivers the pending messages, then moves the clock forward
+        """
+        queue, self.queue = self.queue, []
+        for sender, target, kind, content in queue:
+            if sender in self.down or target in self.down \
+                    or (sender, target) in self.cut \
+                    or (target, sender) in self.cut:
+                continue
+            self.nodes[target].handle(sender, kind, content,
+                                      self.address(sender))
+
+        self.clock.now += delay
+        for uid, node in self.nodes.items():
+            if uid not in self.down:
+                node.tick()
+
+    def run(self, periods):
+        for _ in range(int(periods * 10)):
+            self.step()
+
+# ------------------------------------------------------------------------------
+
+
+class GossipTest(unittest.TestCase):
+    """
+    Tests the Swim class
+    """
+    def test_stable(self):
+        """
+        No member is suspected in a healthy network
+        """
+        network = Network(10)
+        network.run(20)
+        for uid, node in network.nodes.items():
+            self.assertEqual(len(node), 9)
+            for other in node.get_members():
+                self.assertEqual(node.get_member(other).state, STATE_ALIVE)
+            self.assertFalse(network.dead[uid])
+
+    def test_failure_detection(self):
+        """
+        A crashed member is suspected, then declared dead by everybody
+        """
+        network = Network(10)
+        network.run(2)
+        network.down.add("node-3")
+        network.run(30)
+        for uid, node in network.nodes.items():
+            if uid != "node-3":
+                self.assertNotIn("node-3", node.get_members())
+                self.assertEqual(network.dead[uid], set(["node-3"]))
+                self.assertEqual(len(node), 8)
+
+    def test_refutation(self):
+        """
+        A member suspected by mistake refutes the suspicion
+        """
+        network = Network(10)
+        network.run(2)
+
+        # node-3 doesn't answer for a while
+        network.down.add("node-3")
+        for _ in range(100):
+            network.step()
+            if any(uid != "node-3" and
+                   node.get_member("node-3").state == STATE_SUSPECT
+                   for uid, node in network.nodes.items()):
+                break
+        else:
+            self.fail("node-3 not suspected")
+
+        incarnation = network.nodes["node-3"].incarnation
+        network.down.clear()
+        network.run(20)
+        self.assertGreater(network.nodes["node-3"].incarnation, incarnation)
+        for uid, node in network.nodes.items():
+            self.assertFalse(network.dead[uid])
+            if uid != "node-3":
+                self.assertEqual(node.get_member("node-3").state,
+                                 STATE_ALIVE)
+
+    def test_indirect_probe(self):
+        """
+        A member unreachable by one peer is kept alive thanks to the others
+        """
+        network = Network(5)
+        network.cut.add(("node-0", "node-1"))
+        network.run(30)
+        for uid, node in network.nodes.items():
+            self.assertFalse(network.dead[uid])
+            self.assertEqual(len(node), 4)
+
+    def test_join(self):
+        """
+        A new member gets the members list from a single seed, and is
+        spread by gossip
+        """
+        network = Network(8)
+        network.run(2)
+
+        newcomer = network.add_node("newcomer")
+        newcomer.join(network.address("node-0"))
+        network.run(20)
+
+        for uid, node in network.nodes.items():
+            if uid != "newcomer":
+                self.assertIn("newcomer", node.get_members())
+        self.assertEqual(len(newcomer), 8)
+        self.assertEqual(network.joined["newcomer"], set(network.names(8)))
+
+    def test_leave(self):
+        """
+        A member leaving the cluster is forgotten without being suspected
+        """
+        network = Network(8)
+        network.run(2)
+        network.nodes["node-5"].leave()
+        network.step()
+        network.down.add("node-5")
+        network.run(5)
+        for uid, node in network.nodes.items():
+            if uid != "node-5":
+                self.assertNotIn("node-5", node.get_members())
+
+        # Stale gossip doesn't resurrect it
+        node = network.nodes["node-0"]
+        node.handle("node-1", "ping",
+                    {"seq": 1, "incarnation": 0,
+                     "updates": [["node-5", STATE_ALIVE, 0,
+                                  "node-5", 8080, "/herald"]]})
+        self.assertNotIn("node-5", node.get_members())
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
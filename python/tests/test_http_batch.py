@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the batching of messages in the HTTP transport
+"""
+
+# Herald
+from herald.transports.http.batch import MessageBatcher, make_envelope
+from herald.transports.http.beans import HTTPAccess
+from herald.transports.http.directory import HTTPDirectory
+import herald.beans
+import herald.utils
+
+# Standard library
+import json
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class MessageBatcherTest(unittest.TestCase):
+    """
+    Tests the messages batcher
+    """
+    def test_coalesce(self):
+        """
+        Checks that concurrent messages to the same server share a request
+        """
+        batches = []
+        lock = threading.Lock()
+
+        def send(address, url, contents):
+            with lock:
+                batches.append((address, url, list(contents)))
+
+        batcher = MessageBatcher(send, .2, 100)
+        threads = [threading.Thread(target=batcher.send,
+                                    args=(("host", idx % 2), "url", str(idx)))
+                   for idx in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(batches), 2)
+        for address, url, contents in batches:
+            self.assertEqual(url, "url")
+            self.assertEqual(sorted(contents),
+                             [str(idx) for idx in range(address[1], 10, 2)])
+
+    def test_size_limit(self):
+        """
+        Checks that a full batch is sent without waiting for the linger delay
+        """
+        batches = []
+        batcher = MessageBatcher(lambda *args: batches.append(args[2]),
+                                 10, 1)
+        batcher.send(("host", 80), "url", "a")
+        batcher.send(("host", 80), "url", "b")
+        self.assertEqual(batches, [["a"], ["b"]])
+
+    def test_error(self):
+        """
+        Checks that all the senders of a batch get its error
+        """
+        def send(*_):
+            raise IOError("Test")
+
+        errors = []
+
+        def run():
+            try:
+                batcher.send(("host", 80), "url", "a")
+            except IOError as ex:
+                errors.append(ex)
+
+        batcher = MessageBatcher(send, .2, 100)
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 3)
+
+    def test_envelope(self):
+        """
+        Checks that an envelope can be read back as messages
+        """
+        messages = [herald.beans.Message("test/{0}".format(idx), [idx])
+                    for idx in range(3)]
+        envelope = make_envelope([herald.utils.to_json(message)
+                                  for message in messages])
+
+        received = [herald.utils.from_dict(parsed)
+                    for parsed in json.loads(envelope)]
+        self.assertEqual([msg.uid for msg in received],
+                         [msg.uid for msg in messages])
+        self.assertEqual([msg.content for msg in received],
+                         [[0], [1], [2]])
+
+
+class HTTPAccessDumpTest(unittest.TestCase):
+    """
+    Tests the dump of the HTTP access, read by the other implementations
+    """
+    def test_dump(self):
+        """
+        Checks that the dump is the (host, port, path) tuple read by the Java
+        HTTPAccess.load(), whatever the capabilities of the servlet
+        """
+        directory = HTTPDirectory()
+
+        access = HTTPAccess("localhost", 8080, "/herald")
+        dump = access.dump()
+        self.assertEqual(dump, ("localhost", 8080, "herald"))
+        self.assertEqual(len(json.loads(json.dumps(dump))), 3)
+        self.assertEqual(directory.load_access(dump), access)
+
+        # Dumps of the peers which gave their capabilities as 4th element
+        self.assertEqual(directory.load_access(
+            ["localhost", 8080, "herald", ["batch"]]), access)
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
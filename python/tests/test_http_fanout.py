@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the HTTP transport fan-out engine
+"""
+
+# Herald
+from herald.transports.http.fanout import FanOutEngine, FanOutHandle
+
+# Standard library
+import threading
+import time
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class FanOutTest(unittest.TestCase):
+    """
+    Tests the fan-out engine and its handles
+    """
+    def test_handle(self):
+        """
+        Checks the results stored in a handle
+        """
+        called = []
+        handle = FanOutHandle("uid", ["a", "b", "c"])
+        handle.add_done_callback(called.append)
+        self.assertFalse(handle.done())
+        self.assertEqual(handle.pending, set(["a", "b", "c"]))
+
+        error = IOError("Test")
+        handle.set_result("a")
+        handle.set_result("b", error)
+        self.assertFalse(called)
+        self.assertFalse(handle.wait(.01))
+
+        handle.set_result("c")
+        self.assertTrue(handle.done())
+        self.assertTrue(handle.wait(0))
+        self.assertEqual(called, [handle])
+        self.assertEqual(handle.reached, set(["a", "c"]))
+        self.assertEqual(handle.failed, {"b": error})
+        self.assertEqual(handle.pending, set())
+
+        # Late callback: called immediately
+        handle.add_done_callback(called.append)
+        self.assertEqual(called, [handle, handle])
+
+        # No peer
+        self.assertTrue(FanOutHandle("uid", []).done())
+
+    def test_fire(self):
+        """
+        Checks the concurrency limit and the shared payload
+        """
+        lock = threading.Lock()
+        state = {"current": 0, "max": 0}
+        payloads = set()
+
+        def send(peer, target, payload, headers):
+            with lock:
+                state["current"] += 1
+                state["max"] = max(state["max"], state["current"])
+                payloads.add(id(payload))
+
+            time.sleep(.02)
+            with lock:
+                state["current"] -= 1
+
+            if peer % 5 == 0:
+                raise IOError(target)
+
+        engine = FanOutEngine(send, max_workers=4)
+        engine.start()
+        try:
+            peers = list(range(20))
+            handle = FanOutHandle("uid", peers)
+            start = time.time()
+            engine.fire(handle, [(peer, str(peer)) for peer in peers],
+                        b"payload", {})
+
+            # Returns before the messages are sent
+            self.assertLess(time.time() - start, .02)
+            self.assertTrue(handle.wait(5))
+        finally:
+            engine.stop()
+
+        self.assertEqual(state["max"], 4)
+        self.assertEqual(len(payloads), 1)
+        self.assertEqual(sorted(handle.failed), [0, 5, 10, 15])
+        self.assertEqual(len(handle.reached), 16)
+
+    def test_stop(self):
+        """
+        Checks that the pending sendings fail when the engine stops
+        """
+        event = threading.Event()
+        engine = FanOutEngine(lambda *args: event.wait(), max_workers=1)
+        self.assertRaises(ValueError, engine.fire,
+                          FanOutHandle("uid", [1]), [(1, None)], b"", {})
+
+        engine.start()
+        handle = FanOutHandle("uid", [1, 2, 3])
+        engine.fire(handle, [(peer, None) for peer in (1, 2, 3)], b"", {})
+        time.sleep(.05)
+        engine.stop()
+        event.set()
+
+        self.assertTrue(handle.wait(1))
+        self.assertEqual(handle.reached, set([1]))
+        self.assertEqual(sorted(handle.failed), [2, 3])
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
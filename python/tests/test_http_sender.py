@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the HTTP transport sender engine
+"""
+
+# Herald
+from herald.transports.http import HEADER_CAPABILITIES
+from herald.transports.http.sender import HttpSender, PeerUnreachable
+
+# Tests
+from tests.bench_http_sender import start_servers
+
+# HTTP requests
+import requests.exceptions
+
+# Standard library
+import socket
+import time
+
+try:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+def free_address():
+    """
+    Returns the address of a local port without server
+    """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    address = sock.getsockname()
+    sock.close()
+    return address
+
+
+class CapabilitiesHandler(BaseHTTPRequestHandler):
+    """
+    Answers with the capabilities header of the Herald servlet, except on
+    the /legacy path
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('content-length', 0)))
+        self.send_response(200)
+        if self.path != "/legacy":
+            self.send_header(HEADER_CAPABILITIES, "batch, msgpack")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpSenderTest(unittest.TestCase):
+    """
+    Tests the HTTP sender engine
+    """
+    def setUp(self):
+        self.sender = HttpSender(pool_size=2, idle_timeout=0,
+                                 request_timeout=2, failure_threshold=2,
+                                 min_backoff=.2, max_backoff=1)
+        self.servers = []
+
+    def tearDown(self):
+        self.sender.stop()
+        for server, _ in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_health(self):
+        """
+        Checks the health tracking of a working server
+        """
+        self.servers = start_servers(1)
+        address = self.servers[0][1]
+        url = "http://{0}:{1}/herald".format(*address)
+
+        for _ in range(3):
+            self.assertEqual(
+                self.sender.post(address, url, "data", {}).status_code, 200)
+
+        health = self.sender.health(address)
+        self.assertTrue(health["up"])
+        self.assertEqual(health["successes"], 3)
+        self.assertEqual(health["failures"], 0)
+        self.assertIsNotNone(health["latency"])
+        self.assertEqual(len(self.sender.health()), 1)
+
+        # Reap the idle connections
+        self.sender.reap()
+        self.assertIsNone(self.sender.health(address))
+
+    def test_capabilities(self):
+        """
+        Checks that the capabilities of a server are read from its responses
+        """
+        self.servers = start_servers(1, CapabilitiesHandler)
+        address = self.servers[0][1]
+        url = "http://{0}:{1}/herald".format(*address)
+
+        self.assertEqual(self.sender.get_capabilities(address), frozenset())
+        self.sender.post(address, url, "data", {})
+        self.assertEqual(self.sender.get_capabilities(address),
+                         frozenset(["batch", "msgpack"]))
+        self.assertEqual(self.sender.health(address)["capabilities"],
+                         ["batch", "msgpack"])
+
+        # Older peers and other implementations don't give the header
+        self.sender.post(address, "http://{0}:{1}/legacy".format(*address),
+                         "data", {})
+        self.assertEqual(self.sender.get_capabilities(address), frozenset())
+
+    def test_backoff(self):
+        """
+        Checks that a failing server is considered down for a while
+        """
+        address = free_address()
+        url = "http://{0}:{1}/herald".format(*address)
+
+        for _ in range(2):
+            self.assertRaises(requests.exceptions.ConnectionError,
+                              self.sender.post, address, url, "data", {})
+
+        self.assertFalse(self.sender.is_up(address))
+        self.assertRaises(PeerUnreachable,
+                          self.sender.post, address, url, "data", {})
+        self.assertEqual(self.sender.health(address)["failures"], 2)
+
+        # Server is contacted again after the back-off delay
+        time.sleep(.3)
+        self.assertTrue(self.sender.is_up(address))
+        self.assertRaises(requests.exceptions.ConnectionError,
+                          self.sender.post, address, url, "data", {})
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the metrics registry and the metrics of the Herald core
+"""
+
+# Herald
+from herald.core import Herald
+from herald.metrics import MetricsRegistry, HeraldMetrics, Histogram, \
+    OTHER_LABEL, to_prometheus, _bucket_index, _bucket_value
+import herald.beans as beans
+
+# Pelix
+try:
+    from pelix.shell.core import _ShellUtils as ShellUtils
+except ImportError:
+    from pelix.shell.core import ShellUtils
+
+# Standard library
+import json
+import random
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class HistogramTest(unittest.TestCase):
+    """
+    Tests the log-linear histogram
+    """
+    def test_buckets(self):
+        """
+        Values are stored in contiguous buckets with a bounded error
+        """
+        previous = -1
+        for value in range(5000):
+            index = _bucket_index(value)
+            self.assertIn(index, (previous, previous + 1))
+            previous = index
+
+        for value in list(range(5000)) + [2 ** 20 + 5, 2 ** 30, 2 ** 36]:
+            upper = _bucket_value(_bucket_index(value))
+            self.assertGreaterEqual(upper, value)
+            self.assertLessEqual(upper - value, value / 16.)
+
+    def test_percentiles(self):
+        """
+        Percentiles are close to the exact ones
+        """
+        rand = random.Random(0)
+        values = [rand.expovariate(1000) for _ in range(10000)]
+        histogram = Histogram()
+        for value in values:
+            histogram.record(value)
+
+        values.sort()
+        for percentile, result in zip(
+                (50, 90, 99, 99.9),
+                histogram.percentiles((50, 90, 99, 99.9))):
+            exact = values[int(len(values) * percentile / 100.) - 1]
+            self.assertAlmostEqual(result, exact, delta=exact / 16. + 2e-6)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["count"], 10000)
+        self.assertAlmostEqual(snapshot["max"], values[-1], delta=1e-6)
+        self.assertAlmostEqual(snapshot["min"], values[0], delta=1e-6)
+
+        histogram.reset()
+        self.assertEqual(histogram.percentiles((50,)), [None])
+        self.assertEqual(histogram.snapshot()["count"], 0)
+
+
+class RegistryTest(unittest.TestCase):
+    """
+    Tests the metrics registry
+    """
+    def test_counters(self):
+        """
+        Counters are shared by name and labels
+        """
+        registry = MetricsRegistry(max_series=3)
+        counter = registry.counter("msg", ("transport",))
+        self.assertIs(registry.counter("msg", ("transport",)), counter)
+        counter.labels("http").inc()
+        counter.labels("http").inc(2)
+        counter.labels("xmpp").inc()
+        for transport in ("a", "b", "c"):
+            counter.labels(transport).inc()
+
+        # Series beyond the limit are folded in the "other" one
+        series = dict((item["labels"]["transport"], item["value"])
+                      for item in registry.snapshot()[0]["series"])
+        self.assertEqual(series, {"http": 3, "xmpp": 1, "a": 1,
+                                  OTHER_LABEL: 2})
+
+        # Invalid uses
+        self.assertRaises(ValueError, registry.histogram, "msg",
+                          ("transport",))
+        self.assertRaises(ValueError, registry.counter, "msg", ("peer",))
+        self.assertRaises(ValueError, counter.labels, "http", "extra")
+
+        registry.reset()
+        self.assertEqual(counter.labels("http").value, 0)
+
+    def test_gauges(self):
+        """
+        Gauges are read on snapshots
+        """
+        registry = MetricsRegistry()
+        values = {("control",): 1, ("default",): 4}
+        registry.gauge("queued", lambda: values, ("lane",), "Queued")
+        registry.gauge("simple", lambda: 42)
+        registry.gauge("none", lambda: None)
+
+        def error():
+            raise IOError("Error")
+        registry.gauge("error", error)
+
+        self.assertEqual(registry.get_names(),
+                         ["error", "none", "queued", "simple"])
+        snapshot = dict((metric["name"], metric["series"])
+                        for metric in registry.snapshot())
+        self.assertEqual(snapshot["queued"],
+                         [{"labels": {"lane": "control"}, "value": 1},
+                          {"labels": {"lane": "default"}, "value": 4}])
+        self.assertEqual(snapshot["simple"], [{"labels": {}, "value": 42}])
+        self.assertEqual(snapshot["none"], [])
+        self.assertEqual(snapshot["error"], [])
+
+        # Replace a gauge
+        registry.gauge("simple", lambda: 12)
+        self.assertEqual(registry.snapshot("simple")[0]["series"],
+                         [{"labels": {}, "value": 12}])
+
+        self.assertTrue(registry.remove("simple"))
+        self.assertFalse(registry.remove("simple"))
+        self.assertEqual(registry.snapshot("simple"), [])
+
+    def test_prometheus(self):
+        """
+        Tests the Prometheus text format
+        """
+        registry = MetricsRegistry()
+        registry.counter("herald.messages.in", ("transport",),
+                         "Received").labels('h"t').inc(3)
+        registry.histogram("herald.rtt", ("peer",)).labels("p1").record(.5)
+        text = to_prometheus(registry.snapshot())
+        lines = text.splitlines()
+        self.assertIn("# HELP herald_messages_in Received", lines)
+        self.assertIn("# TYPE herald_messages_in counter", lines)
+        self.assertIn('herald_messages_in{transport="h\\"t"} 3', lines)
+        self.assertIn("# TYPE herald_rtt_seconds summary", lines)
+        self.assertIn('herald_rtt_seconds_count{peer="p1"} 1', lines)
+        self.assertIn('herald_rtt_seconds_sum{peer="p1"} 0.5', lines)
+        self.assertTrue(any(line.startswith(
+            'herald_rtt_seconds{peer="p1",quantile="0.99"} ')
+            for line in lines))
+
+
+class Output(object):
+    """
+    Shell I/O handler and HTTP response
+    """
+    def __init__(self):
+        self.text = []
+        self.content = None
+
+    def write(self, text):
+        self.text.append(text)
+
+    def write_line(self, text, *args):
+        self.text.append(text.format(*args))
+
+    def send_content(self, code, content, mime_type):
+        self.content = (code, content, mime_type)
+
+
+class Request(object):
+    """
+    HTTP request
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self):
+        return self.path
+
+
+class ComponentTest(unittest.TestCase):
+    """
+    Tests the shell commands and the servlet
+    """
+    def setUp(self):
+        """
+        Prepares the component
+        """
+        self.metrics = HeraldMetrics()
+        self.metrics._path = "/herald-metrics"
+        self.metrics._utils = ShellUtils()
+        self.metrics._validate(None)
+        self.metrics.counter("herald.messages.in", ("transport",)) \
+            .labels("http").inc()
+        self.metrics.histogram("herald.rtt", ("subject",)) \
+            .labels("test").record(.002)
+
+    def test_shell(self):
+        """
+        Tests the shell commands
+        """
+        output = Output()
+        self.metrics.print_metrics(output)
+        text = "".join(output.text)
+        self.assertIn("herald.messages.in", text)
+        self.assertIn("transport=http", text)
+        self.assertIn("2.00ms", text)
+
+        output = Output()
+        self.metrics.print_metrics(output, "herald.rtt")
+        self.assertNotIn("herald.messages.in", "".join(output.text))
+
+        self.metrics.reset_metrics(output)
+        output = Output()
+        self.metrics.print_metrics(output, "herald.messages")
+        self.assertIn("| 0 ", "".join(output.text))
+
+    def test_servlet(self):
+        """
+        Tests the export servlet
+        """
+        response = Output()
+        self.metrics.do_GET(Request("/herald-metrics"), response)
+        code, content, mime_type = response.content
+        self.assertEqual(code, 200)
+        self.assertEqual(mime_type, "application/json")
+        names = [metric["name"] for metric in json.loads(content)]
+        self.assertEqual(names, ["herald.messages.in", "herald.rtt"])
+
+        self.metrics.do_GET(Request("/herald-metrics/prometheus"), response)
+        code, content, mime_type = response.content
+        self.assertTrue(mime_type.startswith("text/plain"))
+        self.assertIn('herald_messages_in{transport="http"} 1', content)
+
+# ------------------------------------------------------------------------------
+
+
+class Peer(object):
+    """
+    Minimal peer bean
+    """
+    def __init__(self, uid):
+        self.uid = uid
+
+    @staticmethod
+    def get_accesses():
+        return ("http",)
+
+
+class Directory(object):
+    """
+    Minimal directory
+    """
+    local_uid = "local"
+
+    def __contains__(self, peer):
+        return getattr(peer, "uid", peer) == "peer"
+
+    def get_peer(self, peer):
+        if peer not in self:
+            raise KeyError(peer)
+        return Peer("peer")
+
+
+class Transport(object):
+    """
+    Transport keeping the sent messages
+    """
+    def __init__(self):
+        self.sent = []
+
+    def fire(self, peer, message):
+        self.sent.append((peer.uid, message))
+
+
+class CoreMetricsTest(unittest.TestCase):
+    """
+    Tests the metrics of the Herald core
+    """
+    def setUp(self):
+        """
+        Prepares a Herald core
+        """
+        self.registry = MetricsRegistry()
+        self.herald = Herald()
+        self.herald._directory = Directory()
+        self.herald._routing = None
+        self.herald._transports = {"http": Transport()}
+        self.herald._validate(None)
+        self.herald._bind_metrics(None, self.registry, None)
+
+    def tearDown(self):
+        """
+        Cleans up
+        """
+        self.herald._unbind_metrics(None, self.registry, None)
+        self.herald._invalidate(None)
+
+    def values(self):
+        """
+        Returns the values of the metrics
+        """
+        result = {}
+        for metric in self.registry.snapshot():
+            for series in metric["series"]:
+                labels = tuple(value for _, value
+                               in sorted(series["labels"].items()))
+                result[(metric["name"],) + labels] = series["value"]
+        return result
+
+    def test_messages(self):
+        """
+        Counts messages, duplicates and listener execution times
+        """
+        event = threading.Event()
+
+        class Listener(object):
+            def herald_message(self, herald_svc, message):
+                event.set()
+
+        self.herald.add_message_listener(Listener(), "test/*")
+        message = beans.MessageReceived("uid-1", "test/a", "content", "peer",
+                                        None, "http")
+        self.herald.handle_message(message)
+        self.herald.handle_message(message)
+        self.assertTrue(event.wait(5))
+
+        values = self.values()
+        self.assertEqual(values[("herald.messages.in", "http")], 2)
+        self.assertEqual(values[("herald.messages.duplicates",)], 1)
+        for _ in range(50):
+            values = self.values()
+            if values[("herald.listener.time", "test/a")]["count"]:
+                break
+            event.wait(.1)
+        self.assertEqual(values[("herald.listener.time", "test/a")]["count"],
+                         1)
+        self.assertTrue(any(key[0] == "herald.notify.queued"
+                            for key in values))
+
+    def test_rtt(self):
+        """
+        Records the round trip time of posted messages
+        """
+        replies = []
+        message = beans.Message("test/rtt", "content")
+        self.herald.post("peer", message,
+                         lambda _, reply: replies.append(reply), None)
+        self.herald.handle_message(beans.MessageReceived(
+            "uid-2", "reply/test/rtt", "reply", "peer", message.uid, "http"))
+        self.assertEqual(len(replies), 1)
+
+        values = self.values()
+        self.assertEqual(values[("herald.messages.out", "http")],
+                         len(self.herald._transports["http"].sent))
+        self.assertEqual(values[("herald.rtt", "peer", "test/rtt")]["count"],
+                         1)
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
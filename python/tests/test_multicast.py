@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the parsing and the batched reception of the multicast heart beats
+"""
+
+# Herald
+from herald.transports.http.discovery_multicast import MulticastReceiver, \
+    make_heartbeat, make_lastbeat, parse_beat, PACKET_TYPE_HEARTBEAT, \
+    PACKET_TYPE_LASTBEAT
+import herald
+
+# Standard library
+import socket
+import struct
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class ParseTest(unittest.TestCase):
+    """
+    Tests the parsing of the packets
+    """
+    def test_heartbeat(self):
+        """
+        Parses heart beats, with or without the optional fields
+        """
+        beat = make_heartbeat(8080, "/herald", u"peer-é", "app", 42)
+        self.assertEqual(parse_beat(beat),
+                         (PACKET_TYPE_HEARTBEAT, u"peer-é", "app", 8080,
+                          "/herald", 42))
+
+        # Previous versions
+        self.assertEqual(parse_beat(make_heartbeat(80, "/", "peer", "app")),
+                         (PACKET_TYPE_HEARTBEAT, "peer", "app", 80, "/",
+                          None))
+        beat = struct.pack("<BHH", PACKET_TYPE_HEARTBEAT, 80, 1) + b"/" \
+            + struct.pack("<H", 4) + b"peer"
+        self.assertEqual(parse_beat(beat),
+                         (PACKET_TYPE_HEARTBEAT, "peer",
+                          herald.DEFAULT_APPLICATION_ID, 80, "/", None))
+
+    def test_lastbeat(self):
+        """
+        Parses last beats
+        """
+        self.assertEqual(parse_beat(make_lastbeat("peer", "app")),
+                         (PACKET_TYPE_LASTBEAT, "peer", "app", -1, None,
+                          None))
+
+    def test_buffer(self):
+        """
+        Parses a packet read in a larger buffer
+        """
+        beat = make_heartbeat(8080, "/herald", "peer", "app", 1)
+        buffer = bytearray(b"\xff" * 1024)
+        buffer[:len(beat)] = beat
+        self.assertEqual(parse_beat(memoryview(buffer)[:len(beat)]),
+                         parse_beat(beat))
+
+    def test_invalid(self):
+        """
+        Checks the errors on invalid packets
+        """
+        beat = make_heartbeat(8080, "/herald", "peer", "app")
+        self.assertRaises(struct.error, parse_beat, beat[:10])
+        self.assertRaises(struct.error, parse_beat, b"")
+        self.assertRaises(ValueError, parse_beat, b"\x03" + beat[1:])
+        self.assertRaises(struct.error, parse_beat,
+                          make_lastbeat("peer", "app")[:-1])
+
+
+class ReceiverTest(unittest.TestCase):
+    """
+    Tests the batched reception
+    """
+    def setUp(self):
+        """
+        Prepares a receiver reading a local UDP socket
+        """
+        self.beats = []
+        self.receiver = MulticastReceiver("239.0.0.1", 0, self.callback, 16)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.receiver._socket = self.socket
+        self.receiver._setup_socket()
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        """
+        Closes the sockets
+        """
+        self.socket.close()
+        self.sender.close()
+
+    def callback(self, kind, uid, app_id, host, port, path, generation):
+        """
+        Heart beat callback
+        """
+        self.beats.append((kind, uid, generation))
+
+    def send(self, packet):
+        """
+        Sends a packet to the receiver
+        """
+        self.sender.sendto(packet, self.socket.getsockname())
+
+    def read_all(self):
+        """
+        Reads all the batches
+
+        :return: The number of batches
+        """
+        nb_batches = 0
+        while True:
+            for _ in range(100):
+                packets = self.receiver._read_batch()
+                if packets:
+                    break
+            else:
+                return nb_batches
+
+            nb_batches += 1
+            self.receiver._handle_batch(packets)
+
+    def test_batches(self):
+        """
+        Reads packets in batches
+        """
+        for idx in range(40):
+            self.send(make_heartbeat(8080, "/", "peer-{0}".format(idx),
+                                     "app", idx))
+
+        self.assertEqual(self.read_all(), 3)
+        self.assertEqual(self.beats,
+                         [(PACKET_TYPE_HEARTBEAT, "peer-{0}".format(idx), idx)
+                          for idx in range(40)])
+
+    def test_coalesce(self):
+        """
+        Only the last beat of a peer in a batch is handled
+        """
+        self.send(make_heartbeat(8080, "/", "peer-1", "app", 1))
+        self.send(make_heartbeat(8080, "/", "peer-2", "app", 1))
+        self.send(b"\x01\x00")
+        self.send(make_heartbeat(8080, "/", "peer-1", "app", 2))
+        self.send(make_lastbeat("peer-2", "app"))
+        self.send(make_heartbeat(8080, "/", "peer-3", "app", 1))
+
+        self.assertEqual(self.read_all(), 1)
+        self.assertEqual(self.beats,
+                         [(PACKET_TYPE_HEARTBEAT, "peer-1", 2),
+                          (PACKET_TYPE_LASTBEAT, "peer-2", None),
+                          (PACKET_TYPE_HEARTBEAT, "peer-3", 1)])
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the probe core service
+"""
+
+# Herald
+from herald.probe.core import ProbeCore, compile_filter
+
+# Pelix
+import pelix.ldapfilter as ldapfilter
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class RecordStore(object):
+    """
+    Probe store keeping the stored data
+    """
+    def __init__(self):
+        self.stored = []
+
+    def store(self, channel, data):
+        self.stored.append((channel, data))
+
+    def store_batch(self, channel, data_list):
+        for data in data_list:
+            self.stored.append((channel, data))
+
+
+class ProbeCoreTest(unittest.TestCase):
+    """
+    Tests the probe core service
+    """
+    def setUp(self):
+        """
+        Prepares a deactivated probe
+        """
+        self.store = RecordStore()
+        self.probe = ProbeCore()
+        self.probe._activated = False
+        self.probe._stores = [self.store]
+        self.probe._validate(None)
+
+    def test_active_channels(self):
+        """
+        Channels are active only when the probe is activated
+        """
+        self.probe.activate_channel("a")
+        self.assertEqual(self.probe.active_channels, frozenset())
+
+        self.probe.activate(True)
+        self.assertEqual(self.probe.active_channels, frozenset(["a"]))
+
+        self.probe.activate_channel("b")
+        self.probe.activate_channel("a", False)
+        self.assertEqual(self.probe.active_channels, frozenset(["b"]))
+        self.assertEqual(self.probe.get_active_channels(), ["b"])
+
+        self.probe.activate(False)
+        self.assertEqual(self.probe.active_channels, frozenset())
+
+    def test_store(self):
+        """
+        Data is only stored in active channels
+        """
+        calls = []
+
+        def factory():
+            calls.append(1)
+            return {"uid": "1"}
+
+        self.probe.activate_channel("a")
+        self.probe.store("a", {"uid": "0"})
+        self.probe.store_lazy("a", factory)
+        self.probe.store_batch("a", [{"uid": "0"}])
+        self.assertEqual(self.store.stored, [])
+        self.assertEqual(calls, [])
+
+        self.probe.activate(True)
+        self.probe.store("a", {"uid": "0"})
+        self.probe.store_lazy("a", factory)
+        self.probe.store_lazy("b", factory)
+        self.assertEqual(self.store.stored,
+                         [("a", {"uid": "0"}), ("a", {"uid": "1"})])
+        self.assertEqual(calls, [1])
+
+    def test_filter(self):
+        """
+        Filtered data isn't stored
+        """
+        self.probe.activate(True)
+        self.probe.activate_channel("a")
+        self.probe.set_channel_filter("a", "(subject=herald/*)")
+        self.probe.store("a", {"subject": "herald/test"})
+        self.probe.store("a", {"subject": "app/test"})
+        self.probe.store_batch("a", [{"subject": "app/test"},
+                                     {"subject": "herald/batch"}])
+        self.assertEqual(self.store.stored,
+                         [("a", {"subject": "herald/test"}),
+                          ("a", {"subject": "herald/batch"})])
+
+        # Remove the filter
+        self.probe.set_channel_filter("a", None)
+        self.probe.store("a", {"subject": "app/test"})
+        self.assertEqual(len(self.store.stored), 3)
+
+        self.assertRaises(ValueError, self.probe.set_channel_filter,
+                          "a", "(invalid")
+
+    def test_compile_filter(self):
+        """
+        Compiled filters give the same results as the parsed ones
+        """
+        samples = [{}, {"a": 1}, {"a": "1", "b": "text"}, {"b": "other"},
+                   {"a": 2, "b": "text"}, {"a": [1, 2], "c": None},
+                   {"b": ["next", "other"]}, {"b": 42}]
+        for ldap_filter in ("(a=1)", "(!(a=1))", "(&(a=1)(b=text))",
+                            "(|(a=1)(b=t*))", "(!(&(a=*)(b=text)))",
+                            "(&(|(a=1)(a=2))(!(b=other)))", "(a>=2)",
+                            "(c=*)", "(b=*ex*)", "(b=t*t)", "(b=\\2a*)"):
+            parsed = ldapfilter.get_ldap_filter(ldap_filter)
+            compiled = compile_filter(parsed)
+            for sample in samples:
+                self.assertEqual(compiled(sample), parsed.matches(sample),
+                                 "{0} - {1}".format(ldap_filter, sample))
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
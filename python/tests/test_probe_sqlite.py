@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the SQLite probe store and its background writer
+"""
+
+# Herald
+from herald.probe.store_sqlite import SqliteStore, POLICY_DROP_OLDEST
+import herald
+
+# Standard library
+import os
+import shutil
+import sqlite3
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+def make_event(idx):
+    """
+    Makes a message sending event
+    """
+    return {"uid": "msg-{0}".format(idx), "timestamp": 1.5 + idx,
+            "transport": "http", "subject": "test", "target": "peer",
+            "transportTarget": "localhost", "repliesTo": None}
+
+
+class SqliteStoreTest(unittest.TestCase):
+    """
+    Tests the SQLite probe store
+    """
+    def setUp(self):
+        """
+        Prepares a store in a temporary directory
+        """
+        self.folder = tempfile.mkdtemp()
+        self.store = SqliteStore()
+        self.store._db_name = os.path.join(self.folder, "probe.db")
+        self.store._queue_size = 10
+        self.store._batch_size = 4
+        self.store._flush_interval = 60
+        self.validated = False
+
+    def tearDown(self):
+        """
+        Cleans up
+        """
+        if self.validated:
+            self.store.invalidate(None)
+        shutil.rmtree(self.folder)
+
+    def validate(self):
+        """
+        Starts the writer
+        """
+        self.store.validate(None)
+        self.validated = True
+
+    def select(self, sql):
+        """
+        Reads the database with another connection
+        """
+        sql_con = sqlite3.connect(self.store._db_name)
+        try:
+            return sql_con.execute(sql).fetchall()
+        finally:
+            sql_con.close()
+
+    def test_store(self):
+        """
+        Events are written by batches
+        """
+        self.validate()
+        for idx in range(6):
+            self.store.store(herald.PROBE_CHANNEL_MSG_SEND, make_event(idx))
+        self.store.store_batch(herald.PROBE_CHANNEL_MSG_CONTENT,
+                               [{"uid": "msg-1", "content": "a"},
+                                {"uid": "msg-1", "content": "b"}])
+        self.store.store("unknown", {"uid": "msg-1"})
+        self.assertTrue(self.store.flush(5))
+
+        self.assertEqual(
+            self.select("SELECT uid, timestamp FROM {0} ORDER BY id"
+                        .format(herald.PROBE_CHANNEL_MSG_SEND)),
+            [("msg-{0}".format(idx), 1500 + idx * 1000)
+             for idx in range(6)])
+
+        # Duplicate contents are ignored
+        self.assertEqual(
+            self.select("SELECT uid, content FROM {0}"
+                        .format(herald.PROBE_CHANNEL_MSG_CONTENT)),
+            [("msg-1", "a")])
+
+        stats = self.store.stats()
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["written"], 8)
+        self.assertEqual(stats["dropped"], 0)
+
+    def test_drop_newest(self):
+        """
+        New events are dropped when the queue is full
+        """
+        self.store.store_batch(herald.PROBE_CHANNEL_MSG_SEND,
+                               [make_event(idx) for idx in range(8)])
+        for idx in range(8, 15):
+            self.store.store(herald.PROBE_CHANNEL_MSG_SEND, make_event(idx))
+        self.assertEqual(self.store.stats()["dropped"], 5)
+
+        self.validate()
+        self.assertTrue(self.store.flush(5))
+        self.assertEqual(
+            self.select("SELECT uid FROM {0} ORDER BY id"
+                        .format(herald.PROBE_CHANNEL_MSG_SEND)),
+            [("msg-{0}".format(idx),) for idx in range(10)])
+
+    def test_drop_oldest(self):
+        """
+        The oldest events are dropped when the queue is full
+        """
+        self.store._policy = POLICY_DROP_OLDEST
+        for idx in range(5):
+            self.store.store(herald.PROBE_CHANNEL_MSG_SEND, make_event(idx))
+        self.store.store_batch(herald.PROBE_CHANNEL_MSG_SEND,
+                               [make_event(idx) for idx in range(5, 20)])
+        self.assertEqual(self.store.stats()["dropped"], 10)
+
+        self.validate()
+        self.assertTrue(self.store.flush(5))
+        self.assertEqual(
+            self.select("SELECT uid FROM {0} ORDER BY id"
+                        .format(herald.PROBE_CHANNEL_MSG_SEND)),
+            [("msg-{0}".format(idx),) for idx in range(10, 20)])
+
+    def test_invalidate(self):
+        """
+        Pending events are written when the store is invalidated
+        """
+        self.validate()
+        for idx in range(3):
+            self.store.store(herald.PROBE_CHANNEL_MSG_SEND, make_event(idx))
+
+        self.store.invalidate(None)
+        self.validated = False
+        self.assertEqual(
+            len(self.select("SELECT uid FROM {0}"
+                            .format(herald.PROBE_CHANNEL_MSG_SEND))), 3)
+        self.assertEqual(self.select("PRAGMA journal_mode"), [("wal",)])
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the neighbours monitoring of the routing (hellos)
+"""
+
+# Herald
+from herald.routing_hellos import Hellos, NeighbourTable, NO_METRIC, \
+    SUBJECT_HELLO
+import herald.beans as beans
+import herald.exceptions
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class Peer(object):
+    """
+    Minimal peer bean
+    """
+    def __init__(self, uid):
+        self.uid = uid
+
+
+class Directory(object):
+    """
+    Directory of the neighbours
+    """
+    def __init__(self, uids):
+        self.uids = set(uids)
+
+    def get_peers(self):
+        return tuple(Peer(uid) for uid in self.uids)
+
+
+class Herald(object):
+    """
+    Keeps the sent messages
+    """
+    def __init__(self):
+        self.sent = []
+        self.lost = set()
+
+    def fire(self, target, message):
+        if target in self.lost:
+            raise herald.exceptions.NoTransport(None, "lost")
+        self.sent.append((target, message))
+
+
+class Clock(object):
+    """
+    Manual clock
+    """
+    def __init__(self):
+        self.now = 100.
+
+    def __call__(self):
+        return self.now
+
+
+class NeighbourTableTest(unittest.TestCase):
+    """
+    Tests the structure of arrays of the neighbours
+    """
+    def test_slots(self):
+        """
+        Slots are given, reset and reused
+        """
+        table = NeighbourTable()
+        slot_a = table.add("A")
+        slot_b = table.add("B")
+        self.assertEqual(table.add("A"), slot_a)
+        self.assertNotEqual(slot_a, slot_b)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.metric[slot_a], NO_METRIC)
+        self.assertEqual(table.router[slot_a], -1)
+
+        table.metric[slot_a] = 1.
+        table.pending[slot_a] = "uid"
+        self.assertTrue(table.remove("A"))
+        self.assertFalse(table.remove("A"))
+        self.assertNotIn("A", table)
+
+        # The slot is reused, with a clean state
+        self.assertEqual(table.add("C"), slot_a)
+        self.assertEqual(table.metric[slot_a], NO_METRIC)
+        self.assertIsNone(table.pending[slot_a])
+        self.assertEqual(table.uids, ["C", "B"])
+        self.assertEqual(len(table.metric), 2)
+
+
+class HellosTest(unittest.TestCase):
+    """
+    Tests the hellos sender
+    """
+    def setUp(self):
+        """
+        Prepares the component, with 100 peers
+        """
+        self.clock = Clock()
+        self.herald = Herald()
+        self.directory = Directory("P{0}".format(idx) for idx in range(100))
+        self.hellos = Hellos()
+        self.hellos._herald = self.herald
+        self.hellos._directory = self.directory
+        self.hellos._clock = self.clock
+        self.hellos._hello_delay = 5.
+        self.hellos._hello_timeout = 12.
+        self.hellos._granularity = .00003
+        self.hellos._hysteresis = .05
+
+    def run_until(self, end, rtt=None, answering=None, router=True):
+        """
+        Runs the ticks until the given time. The hellos to the answering
+        peers (all if None) are answered after rtt seconds, if given.
+        """
+        while True:
+            next_tick = self.hellos.tick()
+            if rtt is not None:
+                self.reply(rtt, answering, router)
+            if next_tick >= end:
+                break
+            self.clock.now = max(self.clock.now, next_tick)
+        self.clock.now = max(self.clock.now, end)
+
+    def reply(self, rtt, answering=None, router=True):
+        """
+        Replies to the pending hellos of the answering peers (all if None)
+        """
+        remaining = []
+        replies = []
+        for uid, message in self.herald.sent:
+            if answering is None or uid in answering:
+                replies.append((uid, message))
+            else:
+                remaining.append((uid, message))
+        self.herald.sent = remaining
+        if not replies:
+            return
+
+        self.clock.now += rtt
+        subject = "herald/routing/reply/{0}/".format("R" if router else "N")
+        for uid, message in replies:
+            self.hellos.herald_message(None, beans.MessageReceived(
+                "reply-" + message.uid, subject, None, uid, message.uid,
+                "test"))
+
+    def test_spread(self):
+        """
+        Hellos are spread over the period, one per peer and per period
+        """
+        start = self.clock.now
+        sent = []
+        while self.clock.now < start + 10:
+            self.clock.now = min(self.hellos.tick(self.clock.now), start + 10)
+            sent.append(len(self.herald.sent))
+            self.reply(0.)
+
+        self.assertEqual(sum(sent), 200)
+        self.assertLess(max(sent), 10)
+        self.assertEqual(self.hellos.get_neighbours(),
+                         self.directory.uids)
+        self.assertEqual(self.hellos.get_neighbours_routers(),
+                         self.directory.uids)
+
+    def test_smoothing(self):
+        """
+        Jitter doesn't change the metric, a lasting change does
+        """
+        self.directory.uids = set(["A"])
+        for rtt in (.010, .012, .009, .011, .008, .010, .012, .009):
+            self.run_until(self.clock.now + 5, rtt)
+        self.assertAlmostEqual(self.hellos.get_neighbour_metric("A"), .010)
+        srtt, rttvar = self.hellos.get_neighbour_rtt("A")
+        self.assertAlmostEqual(srtt, .010, 2)
+        self.assertLess(rttvar, .005)
+
+        self.run_until(self.clock.now + 100, .050)
+        self.assertAlmostEqual(self.hellos.get_neighbour_metric("A"), .050,
+                               delta=.005)
+
+        # A reply above the timeout is taken at once
+        self.hellos.change_metric("A", 13.)
+        self.assertIsNone(self.hellos.get_neighbour_metric("A"))
+        self.assertFalse(self.hellos.is_reachable("A"))
+        self.hellos.change_metric("A", .020)
+        self.assertEqual(self.hellos.get_neighbour_metric("A"), .020)
+
+    def test_pending(self):
+        """
+        Hellos are not sent while one is pending, and late replies are
+        ignored
+        """
+        self.directory.uids = set(["A", "B"])
+        self.run_until(self.clock.now + 5, .5, ["B"], False)
+        first = dict(self.herald.sent)
+        self.assertEqual(list(first), ["A"])
+        self.assertEqual(self.hellos.get_neighbours(), set(["B"]))
+        self.assertEqual(self.hellos.get_neighbours_routers(), set())
+
+        # No new hello to A before the timeout
+        self.run_until(self.clock.now + 5, .5, ["B"])
+        self.assertEqual(self.herald.sent, list(first.items()))
+
+        # Timeout: a new hello is sent, the late reply is ignored
+        next_tick = self.hellos.tick()
+        while [uid for uid, _ in self.herald.sent].count("A") < 2:
+            self.reply(.5, ["B"])
+            self.clock.now = max(self.clock.now, next_tick)
+            next_tick = self.hellos.tick()
+        self.assertEqual(self.herald.sent[0], ("A", first["A"]))
+        self.hellos.herald_message(None, beans.MessageReceived(
+            "late", "herald/routing/reply/R/", None, "A", first["A"].uid,
+            "test"))
+        self.assertIsNone(self.hellos.get_neighbour_metric("A"))
+        self.reply(.1, ["A"])
+        self.assertAlmostEqual(self.hellos.get_neighbour_metric("A"), .1)
+        self.assertEqual(first["A"].subject, SUBJECT_HELLO)
+
+    def test_directory(self):
+        """
+        Peers leaving the directory are forgotten, lost links are detected
+        """
+        self.directory.uids = set(["A", "B"])
+        self.run_until(self.clock.now + 5, .1)
+        self.assertEqual(self.hellos.get_neighbours(), set(["A", "B"]))
+
+        self.directory.uids.remove("B")
+        self.herald.lost.add("A")
+        self.run_until(self.clock.now + 5, .1)
+        self.assertEqual(self.hellos.get_neighbours(), set())
+        self.assertNotIn("B", self.hellos._table)
+        self.assertIn("A", self.hellos._table)
+
+        self.hellos.set_not_reachable("unknown")
+        self.assertIsNone(self.hellos.get_neighbour_rtt("A"))
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the link-state routing
+"""
+
+# Herald
+from herald.routing_links import LinkState, parse_lsas, shortest_paths, \
+    SUBJECT_LINKS
+import herald.beans as beans
+
+# Standard library
+import json
+import random
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class Hellos(object):
+    """
+    Neighbours of a peer, read from the network links
+    """
+    def __init__(self, network, uid):
+        self.network = network
+        self.uid = uid
+
+    def get_neighbours(self):
+        return set(self.network.neighbours(self.uid))
+
+    def get_neighbour_metric(self, neighbour):
+        return self.network.neighbours(self.uid).get(neighbour)
+
+    def get_neighbours_routers(self):
+        return set(uid for uid in self.network.neighbours(self.uid)
+                   if uid in self.network.routers)
+
+    def is_reachable(self, neighbour):
+        return neighbour in self.network.neighbours(self.uid)
+
+    def set_not_reachable(self, neighbour):
+        pass
+
+
+class Directory(object):
+    """
+    Local peer information
+    """
+    def __init__(self, uid):
+        self.local_uid = uid
+
+
+class Herald(object):
+    """
+    Queues the sent messages in the network
+    """
+    def __init__(self, network, uid):
+        self.network = network
+        self.uid = uid
+
+    def fire(self, target, message):
+        self.network.queue.append((self.uid, target, message))
+
+
+class Network(object):
+    """
+    In-process network of link-state routers and of leaves
+    """
+    def __init__(self):
+        self.links = {}
+        self.routers = {}
+        self.queue = []
+
+    def add_router(self, uid):
+        """
+        Adds a router
+        """
+        router = LinkState()
+        router._herald = Herald(self, uid)
+        router._directory = Directory(uid)
+        router._hellos = Hellos(self, uid)
+        router._link_delay = 5.
+        router._refresh_delay = 60.
+        router._max_age = 180.
+        router._threshold = 0.
+        router._local_uid = uid
+        router._clear()
+        self.routers[uid] = router
+
+    def set_link(self, uid_a, uid_b, metric):
+        """
+        Adds or updates a link (None to remove it)
+        """
+        if metric is None:
+            self.links.pop(frozenset((uid_a, uid_b)), None)
+        else:
+            self.links[frozenset((uid_a, uid_b))] = metric
+
+    def neighbours(self, uid):
+        """
+        Returns the neighbour -> metric dictionary of a peer
+        """
+        result = {}
+        for link, metric in self.links.items():
+            if uid in link:
+                result[[item for item in link if item != uid][0]] = metric
+        return result
+
+    def run(self):
+        """
+        Checks the links of all routers and delivers messages until the
+        network converges
+
+        :return: The number of delivered messages
+        """
+        for router in self.routers.values():
+            router.check_links()
+
+        delivered = 0
+        while True:
+            for router in self.routers.values():
+                router.send_updates()
+            if not self.queue:
+                return delivered
+
+            queue, self.queue = self.queue, []
+            for sender, target, message in queue:
+                if target in self.routers:
+                    content = json.loads(json.dumps(message.content))
+                    self.routers[target].herald_message(
+                        None, beans.MessageReceived(
+                            message.uid, message.subject, content, sender,
+                            None, "test"))
+                    delivered += 1
+
+
+def reference_distances(network, source):
+    """
+    Computes the distances from a source with the Bellman-Ford algorithm,
+    only going through routers
+    """
+    distance = {source: 0.}
+    for _ in range(len(network.links) + 1):
+        changed = False
+        for link, metric in network.links.items():
+            uid_a, uid_b = tuple(link)
+            for start, end in ((uid_a, uid_b), (uid_b, uid_a)):
+                if start in distance and start in network.routers and \
+                        distance[start] + metric < distance.get(
+                            end, float('inf')):
+                    distance[end] = distance[start] + metric
+                    changed = True
+        if not changed:
+            break
+    del distance[source]
+    return distance
+
+
+class LinkStateTest(unittest.TestCase):
+    """
+    Tests the link-state routing
+    """
+    def setUp(self):
+        """
+        Prepares a network: A - B - C - D (routers), with leaves E (linked to
+        B and D) and F (linked to D)
+        """
+        self.network = Network()
+        for uid in "ABCD":
+            self.network.add_router(uid)
+        self.network.set_link("A", "B", 1.)
+        self.network.set_link("B", "C", 2.)
+        self.network.set_link("C", "D", 3.)
+        self.network.set_link("B", "E", 10.)
+        self.network.set_link("D", "E", 1.)
+        self.network.set_link("D", "F", 2.)
+        self.network.run()
+
+    def test_parse(self):
+        """
+        Tests the parsing of link-state messages
+        """
+        self.assertEqual(parse_lsas({"lsas": [["A", 2, {"B": 1}]]}),
+                         [("A", 2, {"B": 1.})])
+        for invalid in ({}, {"lsas": [["A", 2]]}, {"lsas": [["A", "x", {}]]},
+                        {"lsas": [["A", 1, {"B": "x"}]]}, None, "text"):
+            self.assertRaises(ValueError, parse_lsas, invalid)
+
+    def test_convergence(self):
+        """
+        All routers know the topology and the shortest paths
+        """
+        router = self.network.routers["A"]
+        self.assertEqual(set(router.get_topology()), set("ABCD"))
+        self.assertEqual(router.get_next_hops(),
+                         {"C": "B", "D": "B", "E": "B", "F": "B"})
+        self.assertEqual(router.get_accessible_peers(),
+                         {"C": 3., "D": 6., "E": 7., "F": 8.})
+        self.assertEqual(router.get_next_hop_to("B"), "B")
+        self.assertEqual(router.get_next_hop_to("F"), "B")
+        self.assertIsNone(router.get_next_hop_to("G"))
+
+        router = self.network.routers["C"]
+        self.assertEqual(router.get_next_hops(),
+                         {"A": "B", "E": "D", "F": "D"})
+        self.assertEqual(router.get_accessible_peers(),
+                         {"A": 3., "E": 4., "F": 5.})
+
+    def test_changes(self):
+        """
+        Roads follow the changes of the links
+        """
+        router = self.network.routers["A"]
+        stats = router.get_stats()
+
+        # Leaf link change: partial computation
+        self.network.set_link("D", "F", 1.)
+        self.network.run()
+        self.assertEqual(router.get_accessible_peers()["F"], 7.)
+        new_stats = router.get_stats()
+        self.assertEqual(new_stats["full"], stats["full"])
+        self.assertEqual(new_stats["partial"], stats["partial"] + 1)
+
+        # Link out of the tree getting longer: nothing to compute
+        generation = router.routes_generation
+        self.network.set_link("B", "E", 20.)
+        self.network.run()
+        self.assertEqual(router.get_accessible_peers()["E"], 7.)
+        stats = router.get_stats()
+        self.assertEqual(stats["full"], new_stats["full"])
+        self.assertEqual(stats["skipped"], new_stats["skipped"] + 1)
+        self.assertEqual(router.routes_generation, generation)
+
+        # Link between routers lost
+        self.network.set_link("C", "D", None)
+        self.network.run()
+        self.assertGreater(router.routes_generation, generation)
+        self.assertEqual(router.get_accessible_peers(), {"C": 3., "E": 21.})
+        self.assertIsNone(router.get_next_hop_to("D"))
+        self.assertIsNone(router.get_next_hop_to("F"))
+
+    def test_multipath(self):
+        """
+        Loop-free alternates are given, within the stretch of the best road
+        """
+        for uid in "GH":
+            self.network.add_router(uid)
+        router = self.network.routers["A"]
+        router._multipath = 3
+        router._stretch = 1.5
+        self.network.set_link("A", "G", 1.5)
+        self.network.set_link("G", "C", 2.)
+        self.network.set_link("A", "H", 10.)
+        self.network.set_link("H", "C", 1.)
+        self.network.run()
+
+        self.assertEqual(router.get_next_hop_to("D"), "B")
+        self.assertEqual(router.get_next_hops_to("D"),
+                         [("B", 6.), ("G", 6.5)])
+        self.assertEqual(router.get_next_hops_to("F"),
+                         [("B", 8.), ("G", 8.5)])
+        self.assertEqual(router.get_next_hops_to("B"), [("B", 1.)])
+        self.assertEqual(router.get_next_hops_to("X"), [])
+
+        # G is further from D than A once its link to C is lost
+        generation = router.routes_generation
+        self.network.set_link("G", "C", None)
+        self.network.run()
+        self.assertGreater(router.routes_generation, generation)
+        self.assertEqual(router.get_next_hops_to("D"), [("B", 6.)])
+
+        # Single path
+        router._multipath = 1
+        self.assertEqual(router.get_next_hops_to("F"), [("B", 8.)])
+
+    def test_messages(self):
+        """
+        Old and repeated LSAs are ignored, older neighbours are updated
+        """
+        self.network.set_link("A", "X", 1.)
+        router = self.network.routers["A"]
+        topology = router.get_topology()
+        sequence = router._lsa_info["D"][0]
+
+        # The sender of an old LSA gets the newer one
+        router.herald_message(None, beans.MessageReceived(
+            "1", SUBJECT_LINKS, {"lsas": [["D", sequence - 1, {}]]}, "B",
+            None, "test"))
+        router.send_updates()
+        self.assertEqual(router.get_topology(), topology)
+        self.assertEqual(len(self.network.queue), 1)
+        self.assertEqual(self.network.queue[0][:2], ("A", "B"))
+        self.assertEqual(self.network.queue[0][2].content,
+                         {"lsas": [["D", sequence, topology["D"]]]})
+        del self.network.queue[:]
+
+        # ... unless it sent the newer one in the meantime
+        for lsa in (["D", sequence - 1, {}], ["D", sequence, {}]):
+            router.herald_message(None, beans.MessageReceived(
+                "1", SUBJECT_LINKS, {"lsas": [lsa]}, "B", None, "test"))
+        router.send_updates()
+        self.assertEqual(router.get_topology(), topology)
+        self.assertEqual(self.network.queue, [])
+
+        # Unknown senders and invalid contents are ignored
+        for content, sender in (({"lsas": [["D", sequence + 1, {}]]}, "Y"),
+                                ("invalid", "B")):
+            router.herald_message(None, beans.MessageReceived(
+                "2", SUBJECT_LINKS, content, sender, None, "test"))
+        router.send_updates()
+        self.assertEqual(router.get_topology(), topology)
+        self.assertEqual(self.network.queue, [])
+
+    def test_expire(self):
+        """
+        Old LSAs are forgotten
+        """
+        router = self.network.routers["A"]
+        router.expire(router._lsa_info["D"][1] + 181)
+        router.send_updates()
+        self.assertEqual(set(router.get_topology()), set("A"))
+        self.assertEqual(router.get_next_hops(), {})
+
+    def test_change_road(self):
+        """
+        Static roads override the computed ones
+        """
+        router = self.network.routers["A"]
+        router.change_road("B", 42., "Z")
+        router.change_road("B", 5., "F")
+        self.assertEqual(router.get_next_hop_to("Z"), "B")
+        self.assertEqual(router.get_accessible_peers()["F"], 5.)
+        router.change_road(None, None, "Z")
+        router.change_road(None, None, "F")
+        self.assertIsNone(router.get_next_hop_to("Z"))
+        self.assertEqual(router.get_accessible_peers()["F"], 8.)
+
+    def test_random_changes(self):
+        """
+        Incremental computations give the same roads as Dijkstra's algorithm
+        """
+        rand = random.Random(42)
+        network = Network()
+        uids = ["R{0}".format(idx) for idx in range(30)]
+        for uid in uids:
+            network.add_router(uid)
+        leaves = ["L{0}".format(idx) for idx in range(10)]
+
+        for idx, uid in enumerate(uids[1:]):
+            network.set_link(uid, rand.choice(uids[:idx + 1]),
+                             rand.randint(1, 20))
+        for _ in range(20):
+            network.set_link(*rand.sample(uids, 2) + [rand.randint(1, 20)])
+        for leaf in leaves:
+            for _ in range(2):
+                network.set_link(leaf, rand.choice(uids), rand.randint(1, 20))
+        network.run()
+
+        for step in range(60):
+            link = rand.choice(list(network.links))
+            if step % 5 == 0:
+                network.set_link(*tuple(link) + (None,))
+            else:
+                network.set_link(*tuple(link) + (rand.randint(1, 20),))
+            network.run()
+
+            for uid in rand.sample(uids, 5):
+                router = network.routers[uid]
+                distances = shortest_paths(router.get_topology(), uid)[0]
+                self.assertEqual(router._distance, distances)
+                self.assertEqual(distances,
+                                 reference_distances(network, uid))
+
+                # Next hops are on a shortest path (ties can differ)
+                links = network.neighbours(uid)
+                for destination, next_hop in router._next_hop.items():
+                    if next_hop == destination:
+                        distance = 0
+                    else:
+                        distance = reference_distances(
+                            network, next_hop)[destination]
+                    self.assertEqual(distances[destination],
+                                     links[next_hop] + distance)
+
+        stats = network.routers["R0"].get_stats()
+        self.assertTrue(stats["skipped"] and stats["partial"])
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
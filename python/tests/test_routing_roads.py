@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the distance-vector routing (Roads)
+"""
+
+# Herald
+from herald.routing_roads import Roads, parse_roads, SUBJECT_ROADS
+import herald.beans as beans
+
+# Standard library
+import json
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class Hellos(object):
+    """
+    Neighbours of a router, read from the network links
+    """
+    def __init__(self, network, uid):
+        self.network = network
+        self.uid = uid
+
+    def get_neighbours(self):
+        return set(self.network.neighbours(self.uid))
+
+    def get_neighbour_metric(self, neighbour):
+        return self.network.neighbours(self.uid).get(neighbour)
+
+    def get_neighbours_routers(self):
+        return self.get_neighbours()
+
+    def is_reachable(self, neighbour):
+        return neighbour in self.network.neighbours(self.uid)
+
+    def set_not_reachable(self, neighbour):
+        pass
+
+
+class Directory(object):
+    """
+    Local peer information
+    """
+    def __init__(self, uid):
+        self.local_uid = uid
+
+
+class Herald(object):
+    """
+    Queues the sent messages in the network
+    """
+    def __init__(self, network, uid):
+        self.network = network
+        self.uid = uid
+
+    def fire(self, target, message):
+        self.network.queue.append((self.uid, target, message))
+
+
+class Network(object):
+    """
+    In-process network of Roads routers
+    """
+    def __init__(self, multipath=1):
+        self.links = {}
+        self.routers = {}
+        self.queue = []
+        self.sent = []
+        self.multipath = multipath
+
+    def add_link(self, uid_a, uid_b, metric):
+        """
+        Adds or updates a link (None to remove it)
+        """
+        for uid in (uid_a, uid_b):
+            if uid not in self.routers:
+                self.add_router(uid)
+
+        if metric is None:
+            self.links.pop(frozenset((uid_a, uid_b)), None)
+        else:
+            self.links[frozenset((uid_a, uid_b))] = metric
+
+    def add_router(self, uid):
+        """
+        Adds a router
+        """
+        roads = Roads()
+        roads._herald = Herald(self, uid)
+        roads._directory = Directory(uid)
+        roads._hellos = Hellos(self, uid)
+        roads._road_delay = 5.
+        roads._refresh_delay = 60.
+        roads._trigger_delay = 0.
+        roads._max_metric = 60.
+        roads._threshold = .1
+        roads._multipath = self.multipath
+        roads._stretch = 1.5
+        roads._lock = threading.Lock()
+        roads._local_uid = uid
+        roads._clear()
+        self.routers[uid] = roads
+
+    def neighbours(self, uid):
+        """
+        Returns the neighbour -> metric dictionary of a router
+        """
+        result = {}
+        for link, metric in self.links.items():
+            if uid in link:
+                other = [item for item in link if item != uid]
+                if other:
+                    result[other[0]] = metric
+        return result
+
+    def run(self):
+        """
+        Checks the links of all routers and delivers messages until the
+        network converges
+
+        :return: The number of delivered messages
+        """
+        for roads in self.routers.values():
+            roads.check_links()
+
+        delivered = 0
+        while True:
+            for roads in self.routers.values():
+                roads.send_updates()
+            if not self.queue:
+                return delivered
+
+            queue, self.queue = self.queue, []
+            for sender, target, message in queue:
+                # Content goes through JSON, like through a transport
+                content = json.loads(json.dumps(message.content))
+                self.sent.append((sender, target, content))
+                self.routers[target].herald_message(None, beans.MessageReceived(
+                    message.uid, message.subject, content, sender, None,
+                    "test"))
+                delivered += 1
+
+
+class RoadsTest(unittest.TestCase):
+    """
+    Tests the distance-vector routing
+    """
+    def setUp(self):
+        """
+        Prepares a line network: A - B - C - D
+        """
+        self.network = Network()
+        self.network.add_link("A", "B", 1.)
+        self.network.add_link("B", "C", 2.)
+        self.network.add_link("C", "D", 3.)
+        self.network.run()
+
+    def test_parse(self):
+        """
+        Tests the parsing of the roads messages
+        """
+        self.assertEqual(parse_roads({"seq": 2, "full": False,
+                                      "routes": {"A": 1., "B": None}}),
+                         (2, False, {"A": 1., "B": None}))
+        self.assertEqual(parse_roads("{'A': 1.5, 'B': 2}"),
+                         (None, True, {"A": 1.5, "B": 2}))
+        for invalid in ("[1, 2]", "__import__('os')", "{", {"seq": 1}, None):
+            self.assertRaises(ValueError, parse_roads, invalid)
+
+    def test_convergence(self):
+        """
+        Roads are found through the routers
+        """
+        roads = self.network.routers["A"]
+        self.assertEqual(roads.get_next_hops(), {"C": "B", "D": "B"})
+        self.assertEqual(roads.get_accessible_peers(), {"C": 3., "D": 6.})
+        self.assertEqual(roads.get_next_hop_to("B"), "B")
+        self.assertEqual(roads.get_next_hop_to("D"), "B")
+        self.assertIsNone(roads.get_next_hop_to("E"))
+
+        roads = self.network.routers["D"]
+        self.assertEqual(roads.get_next_hops(), {"A": "C", "B": "C"})
+        self.assertEqual(roads.get_accessible_peers(), {"A": 6., "B": 5.})
+
+    def test_split_horizon(self):
+        """
+        Roads through a router are announced as withdrawn to it
+        """
+        for sender, target, content in self.network.sent:
+            for destination, distance in content["routes"].items():
+                next_hop = self.network.routers[sender] \
+                    .get_next_hop_to(destination)
+                if next_hop == target:
+                    self.assertIsNone(distance)
+                self.assertNotEqual(destination, target)
+
+    def test_triggered_updates(self):
+        """
+        Only changed roads are sent, and small changes are ignored
+        """
+        del self.network.sent[:]
+        self.network.add_link("C", "D", 3.1)
+        self.assertEqual(self.network.run(), 0)
+
+        self.network.add_link("C", "D", 5.)
+        self.network.run()
+        self.assertEqual(self.network.routers["A"].get_accessible_peers(),
+                         {"C": 3., "D": 8.})
+        for _, _, content in self.network.sent:
+            self.assertFalse(content["full"])
+            self.assertEqual(list(content["routes"]), ["D"])
+
+    def test_failover(self):
+        """
+        Roads switch to another path when a link is lost
+        """
+        self.network.add_link("A", "E", 4.)
+        self.network.add_link("E", "D", 4.)
+        self.network.run()
+        roads = self.network.routers["A"]
+        self.assertEqual(roads.get_next_hop_to("D"), "B")
+        self.assertEqual(roads.get_next_hop_to("C"), "B")
+        generation = roads.routes_generation
+
+        # Link lost
+        self.network.add_link("B", "C", None)
+        self.network.run()
+        self.assertGreater(roads.routes_generation, generation)
+        self.assertEqual(roads.get_next_hop_to("D"), "E")
+        self.assertEqual(roads.get_next_hop_to("C"), "E")
+        self.assertEqual(roads.get_accessible_peers(), {"C": 11., "D": 8.})
+
+        # Network split
+        self.network.add_link("A", "E", None)
+        self.network.run()
+        self.assertEqual(roads.get_next_hops(), {})
+        self.assertIsNone(self.network.routers["D"].get_next_hop_to("A"))
+
+    def test_multipath(self):
+        """
+        Loop-free alternates are kept, within the stretch of the best road
+        """
+        network = Network(3)
+        for uid_a, uid_b, metric in (("A", "B", 1.), ("B", "C", 2.),
+                                     ("C", "D", 3.), ("A", "E", 1.5),
+                                     ("E", "C", 2.), ("A", "F", 10.),
+                                     ("F", "C", 1.)):
+            network.add_link(uid_a, uid_b, metric)
+        network.run()
+
+        roads = network.routers["A"]
+        self.assertEqual(roads.get_next_hop_to("D"), "B")
+        self.assertEqual(roads.get_next_hops_to("D"),
+                         [("B", 6.), ("E", 6.5)])
+        self.assertEqual(roads.get_next_hops_to("B"), [("B", 1.)])
+        self.assertEqual(roads.get_next_hops_to("G"), [])
+
+        # A is further from D than B: not an alternate of B
+        self.assertEqual(network.routers["B"].get_next_hops_to("D"),
+                         [("C", 5.)])
+
+        # Alternates changes are visible in the generation
+        generation = roads.routes_generation
+        network.add_link("E", "C", None)
+        network.run()
+        self.assertEqual(roads.get_next_hops_to("D"), [("B", 6.)])
+        self.assertGreater(roads.routes_generation, generation)
+
+    def test_messages(self):
+        """
+        Tests the reception of full, partial, stale and legacy messages
+        """
+        roads = self.network.routers["A"]
+        full = beans.MessageReceived("1", SUBJECT_ROADS, {
+            "seq": 100, "full": True, "routes": {"X": 2., "Y": 3.}},
+            "B", None, "test")
+        roads.herald_message(None, full)
+        self.assertEqual(roads.get_accessible_peers(), {"X": 3., "Y": 4.})
+
+        stale = beans.MessageReceived("2", SUBJECT_ROADS, {
+            "seq": 99, "full": False, "routes": {"X": None}},
+            "B", None, "test")
+        roads.herald_message(None, stale)
+        self.assertEqual(roads.get_accessible_peers(), {"X": 3., "Y": 4.})
+
+        partial = beans.MessageReceived("3", SUBJECT_ROADS, {
+            "seq": 101, "full": False, "routes": {"X": None, "Z": 1.}},
+            "B", None, "test")
+        roads.herald_message(None, partial)
+        self.assertEqual(roads.get_accessible_peers(), {"Y": 4., "Z": 2.})
+
+        # Tables of older peers replace the known roads
+        legacy = beans.MessageReceived("4", SUBJECT_ROADS, "{'W': 5.0}",
+                                       "B", None, "test")
+        roads.herald_message(None, legacy)
+        self.assertEqual(roads.get_accessible_peers(), {"W": 6.})
+
+        # Unknown neighbours and invalid contents are ignored
+        for content, sender in (({"seq": 1, "full": True,
+                                  "routes": {"V": 1.}}, "D"),
+                                ("invalid", "B")):
+            roads.herald_message(None, beans.MessageReceived(
+                "5", SUBJECT_ROADS, content, sender, None, "test"))
+        self.assertEqual(roads.get_accessible_peers(), {"W": 6.})
+
+    def test_change_road(self):
+        """
+        Tests the manual modification of roads
+        """
+        roads = self.network.routers["A"]
+        roads.change_road("B", 10., "X")
+        self.assertEqual(roads.get_next_hop_to("X"), "B")
+        self.assertEqual(roads.get_accessible_peers()["X"], 11.)
+        roads.change_road(None, None, "X")
+        self.assertIsNone(roads.get_next_hop_to("X"))
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the Herald streams
+"""
+
+# Herald
+from herald.exceptions import HeraldTimeout, StreamAborted
+from herald.stream import HeraldStreams, read_chunks
+import herald
+import herald.beans as beans
+
+# Standard library
+import io
+import threading
+import time
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class FakeHerald(object):
+    """
+    Herald-like service delivering messages to the streams component of
+    another peer, from other threads, like transports do
+    """
+    def __init__(self, uid, network):
+        self.uid = uid
+        self.network = network
+        self.streams = None
+        self.replies = {}
+        self.lock = threading.Lock()
+        self.messages = []
+
+    def __deliver(self, target, message, reply_to=None):
+        with self.lock:
+            self.messages.append(message.subject)
+
+        received = beans.MessageReceived(
+            message.uid, message.subject, message.content, self.uid,
+            reply_to, "test")
+        peer = self.network[target]
+        threading.Thread(target=peer.streams.herald_message,
+                         args=(peer, received)).start()
+
+    def fire(self, target, message):
+        self.__deliver(target, message)
+        return message.uid
+
+    def send(self, target, message, timeout=None):
+        event = threading.Event()
+        self.replies[message.uid] = event
+        self.__deliver(target, message)
+        if not event.wait(timeout):
+            raise HeraldTimeout(None, "timeout", message)
+        return event.reply
+
+    def reply(self, message, content, subject=None):
+        waiting = self.network[message.sender].replies.pop(message.uid)
+        waiting.reply = beans.Message("reply", content)
+        waiting.set()
+
+
+class Listener(object):
+    """
+    Stream listener
+    """
+    def __init__(self, delay=0, max_chunks=None):
+        self.delay = delay
+        self.max_chunks = max_chunks
+        self.chunks = []
+        self.metadata = None
+        self.error = None
+        self.done = threading.Event()
+
+    def herald_stream(self, _, stream):
+        self.metadata = stream.metadata
+        try:
+            for chunk in stream:
+                self.chunks.append(chunk)
+                if len(self.chunks) == self.max_chunks:
+                    break
+                time.sleep(self.delay)
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self.done.set()
+
+
+class FakeReference(object):
+    """
+    Service reference giving the filters of a stream listener
+    """
+    def __init__(self, filters):
+        self.filters = filters
+
+    def get_property(self, name):
+        return self.filters if name == herald.PROP_FILTERS else None
+
+
+def make_streams(herald_svc, window=4, timeout=2):
+    """
+    Prepares a streams component
+    """
+    streams = HeraldStreams()
+    streams._herald = herald_svc
+    streams._window = window
+    streams._timeout = timeout
+    herald_svc.streams = streams
+    return streams
+
+
+class StreamTest(unittest.TestCase):
+    """
+    Tests the streams component
+    """
+    def setUp(self):
+        network = {}
+        self.sender = FakeHerald("sender", network)
+        self.receiver = FakeHerald("receiver", network)
+        network["sender"] = self.sender
+        network["receiver"] = self.receiver
+        self.sender_streams = make_streams(self.sender)
+        self.receiver_streams = make_streams(self.receiver)
+
+    def bind(self, listener, filters):
+        """
+        Binds a stream listener to the receiver
+        """
+        self.receiver_streams._bind_listener(None, listener,
+                                             FakeReference(filters))
+
+    def test_stream(self):
+        """
+        Sends a stream of binary and text chunks
+        """
+        listener = Listener()
+        self.bind(listener, ["test/*"])
+
+        chunks = [b"\x00\x01" * idx for idx in range(20)] + ["text"]
+        self.assertEqual(self.sender_streams.send_stream(
+            "receiver", "test/stream", iter(chunks), {"name": "file"}), 21)
+        self.assertTrue(listener.done.wait(1))
+        self.assertEqual(listener.chunks, chunks)
+        self.assertEqual(listener.metadata, {"name": "file"})
+        self.assertIsNone(listener.error)
+
+        # Chunks of a file
+        listener = Listener()
+        self.bind(listener, ["file/*"])
+        data = bytes(bytearray(range(256))) * 100
+        self.sender_streams.send_stream(
+            "receiver", "file/dump", read_chunks(io.BytesIO(data), 1000))
+        self.assertTrue(listener.done.wait(1))
+        self.assertEqual(b"".join(listener.chunks), data)
+
+    def test_flow_control(self):
+        """
+        Checks that the sender waits for the receiver to read chunks
+        """
+        listener = Listener(delay=.05)
+        self.bind(listener, ["test/*"])
+
+        def chunks():
+            for idx in range(12):
+                # At most a window of chunks is not yet read
+                self.assertLessEqual(idx - len(listener.chunks), 4)
+                yield str(idx)
+
+        self.sender_streams.send_stream("receiver", "test/slow", chunks())
+        self.assertEqual(listener.chunks, [str(idx) for idx in range(12)])
+
+        # The stream is forgotten once the listener returns
+        self.assertTrue(listener.done.wait(1))
+        for _ in range(10):
+            if not self.receiver_streams._HeraldStreams__incoming:
+                break
+            time.sleep(.1)
+        else:
+            self.fail("Stream not forgotten")
+
+    def test_refused(self):
+        """
+        Checks the errors of the sender
+        """
+        # No listener
+        self.assertRaises(StreamAborted, self.sender_streams.send_stream,
+                          "receiver", "unknown/subject", ["data"])
+
+        # Listener stopping before the end
+        listener = Listener(max_chunks=2)
+        self.bind(listener, ["test/*"])
+        self.assertRaises(StreamAborted, self.sender_streams.send_stream,
+                          "receiver", "test/partial",
+                          (str(idx) for idx in range(20)))
+        self.assertEqual(listener.chunks, ["0", "1"])
+
+    def test_sender_error(self):
+        """
+        Checks that the receiver is notified of errors of the sender
+        """
+        listener = Listener()
+        self.bind(listener, ["test/*"])
+
+        def chunks():
+            yield "first"
+            raise ValueError("Test")
+
+        self.assertRaises(ValueError, self.sender_streams.send_stream,
+                          "receiver", "test/error", chunks())
+        # The abort can overtake the first chunk
+        self.assertTrue(listener.done.wait(1))
+        self.assertIsInstance(listener.error, StreamAborted)
+        self.assertIn(herald.stream.MSG_ABORT, self.sender.messages)
+
+    def test_sender_error_unknown_peer(self):
+        """
+        Checks that the error of the sender is raised when the receiver went
+        away and can't be notified
+        """
+        listener = Listener()
+        self.bind(listener, ["test/*"])
+
+        def chunks():
+            yield "first"
+            # Herald.fire() raises a KeyError for unknown peers
+            del self.sender.network["receiver"]
+            raise ValueError("Test")
+
+        self.assertRaises(ValueError, self.sender_streams.send_stream,
+                          "receiver", "test/error", chunks())
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
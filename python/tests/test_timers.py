@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Tests the timing wheel used for post() timeouts
+"""
+
+# Herald
+from herald.utils import ExpiryTracker, TimerWheel
+
+# Standard library
+import threading
+import time
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# ------------------------------------------------------------------------------
+
+
+class TimerWheelTest(unittest.TestCase):
+    """
+    Tests the timing wheel
+    """
+    def setUp(self):
+        """
+        Starts a wheel
+        """
+        self.wheel = TimerWheel(.02, 16)
+        self.wheel.start()
+
+    def tearDown(self):
+        """
+        Stops the wheel
+        """
+        self.wheel.stop()
+
+    def test_expiry(self):
+        """
+        Checks that timers are called after their delay, in order
+        """
+        calls = []
+        event = threading.Event()
+        start = time.time()
+
+        # Delays longer than a wheel revolution are supported
+        self.wheel.schedule(.5, event.set)
+        self.wheel.schedule(.1, calls.append, 2)
+        self.wheel.schedule(.05, calls.append, 1)
+        self.assertEqual(len(self.wheel), 3)
+
+        self.assertTrue(event.wait(2))
+        self.assertGreaterEqual(time.time() - start, .5)
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel(self):
+        """
+        Checks that cancelled timers are not called
+        """
+        calls = []
+        handle = self.wheel.schedule(.05, calls.append, 1)
+        self.assertTrue(self.wheel.cancel(handle))
+        self.assertFalse(self.wheel.cancel(handle))
+        self.assertFalse(self.wheel.cancel(None))
+
+        event = threading.Event()
+        handle = self.wheel.schedule(.1, event.set)
+        self.assertTrue(event.wait(1))
+        self.assertFalse(self.wheel.cancel(handle))
+        self.assertEqual(calls, [])
+
+    def test_error(self):
+        """
+        Checks that an error in a timer doesn't stop the wheel
+        """
+        def error():
+            raise ValueError("Test")
+
+        event = threading.Event()
+        self.wheel.schedule(0, error)
+        self.wheel.schedule(.05, event.set)
+        self.assertTrue(event.wait(1))
+
+
+
+class ExpiryTrackerTest(unittest.TestCase):
+    """
+    Tests the expiry tracker used for the multicast heart beats
+    """
+    def setUp(self):
+        """
+        Starts a tracker
+        """
+        self.expired = []
+        self.event = threading.Event()
+        self.tracker = ExpiryTracker(.2, self.callback)
+        self.tracker.start()
+
+    def tearDown(self):
+        """
+        Stops the tracker
+        """
+        self.tracker.stop()
+
+    def callback(self, keys):
+        """
+        Expired keys callback
+        """
+        self.expired.append(sorted(keys))
+        self.event.set()
+
+    def test_expiry(self):
+        """
+        Checks that keys expire together after their TTL
+        """
+        start = time.time()
+        self.assertTrue(self.tracker.touch("a"))
+        self.assertTrue(self.tracker.touch("b"))
+        self.assertFalse(self.tracker.touch("a"))
+        self.assertEqual(len(self.tracker), 2)
+        self.assertIn("a", self.tracker)
+
+        self.assertTrue(self.event.wait(1))
+        self.assertGreaterEqual(time.time() - start, .2)
+        self.assertEqual(self.expired, [["a", "b"]])
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_refresh(self):
+        """
+        Checks that refreshed keys don't expire
+        """
+        self.tracker.touch("a")
+        self.tracker.touch("b")
+        for _ in range(5):
+            time.sleep(.1)
+            self.tracker.touch("a")
+
+        self.assertEqual(self.expired, [["b"]])
+        self.assertIn("a", self.tracker)
+        self.assertTrue(self.tracker.discard("a"))
+        self.assertFalse(self.tracker.discard("a"))
+
+        # Discarded keys don't expire, even if tracked again later
+        self.tracker.touch("c")
+        self.tracker.discard("c")
+        time.sleep(.1)
+        self.tracker.touch("c")
+        time.sleep(.15)
+        self.assertEqual(self.expired, [["b"]])
+        time.sleep(.15)
+        self.assertEqual(self.expired, [["b"], ["c"]])
+
+    def test_error(self):
+        """
+        Checks that an error in the callback doesn't stop the tracker
+        """
+        self.tracker.stop()
+        calls = []
+
+        def callback(keys):
+            calls.append(keys)
+            if len(calls) == 1:
+                raise ValueError("Test")
+            self.event.set()
+
+        self.tracker = ExpiryTracker(.05, callback)
+        self.tracker.start()
+        self.tracker.touch("a")
+        time.sleep(.1)
+        self.tracker.touch("b")
+        self.assertTrue(self.event.wait(1))
+        self.assertEqual(calls, [["a"], ["b"]])
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()